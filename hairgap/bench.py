@@ -0,0 +1,266 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""End-to-end benchmarks, using the TCP replacements of the hairgap binaries (`hairgap/tests/hairgap[rs].py`).
+
+Each scenario generates a dataset, sends it with a :class:`DirectorySender` to a :class:`Receiver` running in
+another thread, checks the received files and returns a dict of measures (one JSON object per line with the
+`pyhairgap bench` command).
+
+With a `link` dict, the UDP stand-ins (`hairgap/tests/lossy_hairgap[rs].py`) are used instead and the link is
+emulated with these parameters (see :class:`hairgap.emulator.LinkEmulator`), so the redundancy and the rate
+settings can be compared on a lossy link.
+"""
+
+import filecmp
+import importlib.resources
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import tempfile
+import time
+from contextlib import ExitStack
+from threading import Thread
+from typing import Dict, Iterator, List, Optional
+
+from hairgap.emulator import emulated_link
+from hairgap.receiver import Receiver
+from hairgap.sender import DirectorySender
+from hairgap.utils import Config, ensure_dir
+
+logger = logging.getLogger(__name__)
+
+# (number of files, size of each file) for each dataset profile
+PROFILES = {
+    "tiny": [(200, 1024)],
+    "huge": [(2, 32 * 1024 * 1024)],
+    "mixed": [(100, 1024), (10, 1024 * 1024), (1, 16 * 1024 * 1024)],
+}
+
+
+def generate_dataset(dir_abspath: str, profile: str, seed: int = 0) -> int:
+    """create the files of a dataset profile
+
+    half of each file is random (incompressible), the other half is repeated text.
+
+    :return: the total size of the created files
+    """
+    # reproducible datasets, not security-relevant
+    rnd = random.Random(seed)  # nosec B311
+    total_size = 0
+    index = 0
+    for count, size in PROFILES[profile]:
+        for __ in range(count):
+            file_abspath = os.path.join(
+                dir_abspath, "%02d" % (index % 10), "%06d.bin" % index
+            )
+            ensure_dir(file_abspath, parent=True)
+            with open(file_abspath, "wb") as fd:
+                fd.write(rnd.randbytes(size // 2))
+                fd.write(b"0123456789abcdef" * ((size - size // 2) // 16))
+            total_size += os.path.getsize(file_abspath)
+            index += 1
+    return total_size
+
+
+def get_free_port(port: int = 16000) -> int:
+    while True:
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.bind(("localhost", port))
+            return port
+        except OSError:
+            port += 1
+
+
+class BenchSender(DirectorySender):
+    def __init__(self, config: Config, root_abspath: str):
+        super().__init__(config)
+        self.root_abspath = root_abspath
+
+    def get_attributes(self) -> Dict[str, str]:
+        return {"bench": "1"}
+
+    @property
+    def transfer_abspath(self) -> str:
+        return os.path.join(self.root_abspath, "data")
+
+    @property
+    def index_abspath(self):
+        return os.path.join(self.root_abspath, "index.txt")
+
+
+class BenchReceiver(Receiver):
+    available_attributes = {"bench"}
+
+    def __init__(self, config: Config, after_reception_path: str, threading: bool):
+        super().__init__(config, threading=threading)
+        self.after_reception_path = after_reception_path
+        self.complete_time = None  # type: Optional[float]
+
+    def transfer_complete(self):
+        super().transfer_complete()
+        self.complete_time = time.time()
+        self.continue_loop = False
+
+    def get_current_transfer_directory(self) -> Optional[str]:
+        return self.after_reception_path
+
+    def stop(self):
+        self.continue_loop = False
+        if self.hairgap_subprocess is not None:
+            self.hairgap_subprocess.terminate()
+
+
+def get_scenarios(
+    profiles: List[str],
+    tar_modes: List[bool],
+    split_sizes: List[Optional[int]],
+    threading_modes: List[bool],
+) -> Iterator[Dict]:
+    """return all combinations of parameters (`split_size` is only used without tar)"""
+    for profile, use_tar, split_size, threading in itertools.product(
+        profiles, tar_modes, split_sizes, threading_modes
+    ):
+        if use_tar and split_size:
+            continue
+        yield {
+            "profile": profile,
+            "use_tar_archives": use_tar,
+            "split_size": split_size,
+            "threading": threading,
+        }
+
+
+def run_scenario(
+    profile: str,
+    use_tar_archives: bool,
+    split_size: Optional[int] = None,
+    threading: bool = True,
+    end_delay_s: float = 0.5,
+    tmp_path: Optional[str] = None,
+    timeout_s: float = 600.0,
+    link: Optional[Dict[str, float]] = None,
+    redundancy: float = 3.0,
+    max_rate_mbps: Optional[int] = None,
+) -> Dict:
+    """send a dataset and return the measures"""
+    with ExitStack() as stack:
+        dirname = stack.enter_context(tempfile.TemporaryDirectory(dir=tmp_path))
+        stand_ins = importlib.resources.files("hairgap").joinpath("tests")
+        prefix = ""
+        if link is not None:
+            stack.enter_context(emulated_link(**link))
+            prefix = "lossy_"
+        config = Config(
+            destination_ip="localhost",
+            destination_port=get_free_port(),
+            destination_path=os.path.join(dirname, "receiving"),
+            end_delay_s=end_delay_s,
+            timeout_s=3.0,
+            hairgapr=str(
+                stack.enter_context(
+                    importlib.resources.as_file(
+                        stand_ins.joinpath(prefix + "hairgapr.py")
+                    )
+                )
+            ),
+            hairgaps=str(
+                stack.enter_context(
+                    importlib.resources.as_file(
+                        stand_ins.joinpath(prefix + "hairgaps.py")
+                    )
+                )
+            ),
+            use_tar_archives=use_tar_archives,
+            split_size=split_size,
+            redundancy=redundancy,
+            max_rate_mbps=max_rate_mbps,
+        )
+        sender = BenchSender(config, os.path.join(dirname, "sender"))
+        total_size = generate_dataset(os.path.join(dirname, "original"), profile)
+        ensure_dir(sender.root_abspath, parent=False)
+        os.rename(os.path.join(dirname, "original"), sender.transfer_abspath)
+        reference_abspath = os.path.join(dirname, "reference")
+        generate_dataset(reference_abspath, profile)
+        received_abspath = os.path.join(dirname, "received")
+        receiver = BenchReceiver(config, received_abspath, threading=threading)
+        receiver_thread = Thread(target=receiver.loop)
+        receiver_thread.start()
+        try:
+            start = time.time()
+            total_files, __ = sender.prepare_directory()
+            prepared = time.time()
+            sender.send_directory()
+            sent = time.time()
+            while receiver.complete_time is None and time.time() - sent < timeout_s:
+                time.sleep(0.05)
+        finally:
+            receiver.stop()
+            receiver_thread.join()
+        complete = receiver.complete_time
+        comparison = filecmp.dircmp(reference_abspath, received_abspath)
+        valid = complete is not None and is_identical(comparison)
+        duration = (complete or time.time()) - start
+        return {
+            "profile": profile,
+            "use_tar_archives": use_tar_archives,
+            "split_size": split_size,
+            "threading": threading,
+            "end_delay_s": end_delay_s,
+            "link": link,
+            "redundancy": redundancy,
+            "max_rate_mbps": max_rate_mbps,
+            "files": total_files,
+            "bytes": total_size,
+            "prepare_s": prepared - start,
+            "send_s": sent - prepared,
+            "total_s": duration,
+            "throughput_bps": total_size / duration,
+            "valid": valid,
+        }
+
+
+def is_identical(comparison: filecmp.dircmp) -> bool:
+    if (
+        comparison.left_only
+        or comparison.right_only
+        or comparison.diff_files
+        or comparison.funny_files
+    ):
+        return False
+    # dircmp only compares sizes and dates by default
+    __, mismatch, errors = filecmp.cmpfiles(
+        comparison.left, comparison.right, comparison.common_files, shallow=False
+    )
+    if mismatch or errors:
+        return False
+    return all(is_identical(x) for x in comparison.subdirs.values())
+
+
+def run_benchmarks(scenarios: Iterator[Dict], output=None, **kwargs) -> List[Dict]:
+    """run each scenario and write its result as a JSON line in `output`"""
+    results = []
+    for scenario in scenarios:
+        logger.info("running benchmark %r…", scenario)
+        result = run_scenario(**scenario, **kwargs)
+        results.append(result)
+        if output is not None:
+            output.write(json.dumps(result, sort_keys=True) + "\n")
+            output.flush()
+    return results
@@ -0,0 +1,397 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Search the hairgap options (`mtu_b`, `error_chunk_size`, `redundancy`, `max_rate_mbps`) that give the best goodput
+without loss on a given link.
+
+Probe files (a JSON header with the tested options, then random data) are sent with each combination of options.
+The receiver checks the integrity of each received probe and measures its reception duration (from its first byte);
+both sides are merged to compute the goodput and the loss rate of each combination, and to recommend a profile.
+
+On real hardware, both sides run on different hosts:
+
+.. code-block:: bash
+
+    # receiver side (started first)
+    pyhairgap calibrate receive 10.0.0.2 --output received.jsonl --deadline-s 3600
+    # sender side
+    pyhairgap calibrate send 10.0.0.2 --redundancy 1.2 1.5 2 3 --max-rate-mbps 100 500 --output sent.jsonl
+    # anywhere
+    pyhairgap calibrate merge sent.jsonl received.jsonl --output profile.json
+    pyhairgap send 10.0.0.2 /data --link-profile profile.json
+
+On a single host, `pyhairgap calibrate local` runs both sides against the link emulator (see :mod:`hairgap.emulator`).
+When the receiver is the emulator stand-in, its packet statistics are added to the results.
+"""
+
+import hashlib
+import importlib.resources
+import itertools
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from hairgap.emulator import emulated_link
+from hairgap.utils import Config
+
+logger = logging.getLogger(__name__)
+
+PROBE_MAGIC = b"# *-* HAIRGAP-PROBE *-*\n"
+OPTIONS = ("mtu_b", "error_chunk_size", "redundancy", "max_rate_mbps")
+# options of Config that are calibrated
+STATS_PATTERN = re.compile(r"stats: (\{.*\})")
+# packet statistics printed by the emulated hairgapr
+POLL_S = 0.01
+# polling interval of the size of a probe being received (bounds the error on its first byte time)
+
+
+def get_candidates(
+    mtus: Iterable[Optional[int]] = (None,),
+    error_chunk_sizes: Iterable[Optional[int]] = (None,),
+    redundancies: Iterable[Optional[float]] = (1.2, 1.5, 2.0, 3.0),
+    max_rates_mbps: Iterable[Optional[int]] = (None,),
+) -> List[Dict]:
+    """return all combinations of options (`None` keeps the default value of hairgap)"""
+    return [
+        dict(zip(OPTIONS, values))
+        for values in itertools.product(
+            mtus, error_chunk_sizes, redundancies, max_rates_mbps
+        )
+    ]
+
+
+def get_candidate_config(config: Config, candidate: Dict) -> Config:
+    """return a copy of `config` using the options of a candidate"""
+    return config.replace(**{x: candidate[x] for x in OPTIONS})
+
+
+def make_probe(probe: int, count: int, candidate: Dict, size: int) -> bytes:
+    """return the content of a probe file: a JSON header and `size` random bytes"""
+    payload = os.urandom(size)
+    header = {
+        "probe": probe,
+        "count": count,
+        "candidate": candidate,
+        "size": size,
+        "sha256": hashlib.sha256(payload).hexdigest(),
+    }
+    return PROBE_MAGIC + json.dumps(header, sort_keys=True).encode() + b"\n" + payload
+
+
+def check_probe(data: bytes) -> Optional[Dict]:
+    """return the header of a received probe with its validity, or `None` if this is not a probe"""
+    if not data.startswith(PROBE_MAGIC):
+        return None
+    header_line, sep, payload = data[len(PROBE_MAGIC) :].partition(b"\n")
+    try:
+        header = json.loads(header_line.decode())
+    except ValueError:
+        return None
+    header["valid"] = bool(sep) and (
+        hashlib.sha256(payload).hexdigest() == header.get("sha256")
+    )
+    return header
+
+
+def get_packet_stats(stderr: str) -> Optional[Dict]:
+    matcher = STATS_PATTERN.search(stderr or "")
+    if not matcher:
+        return None
+    try:
+        return json.loads(matcher.group(1))
+    except ValueError:
+        return None
+
+
+def send_probes(
+    config: Config,
+    candidates: List[Dict],
+    probe_size: int = 4 * 1024 * 1024,
+    repeat: int = 2,
+) -> List[Dict]:
+    """send `repeat` probes per candidate, and return the sender-side measures of each probe
+
+    `config.end_delay_s` must be longer than the timeout of the receiver: an incomplete probe is only abandoned
+    after this timeout, and the following probe would be missed meanwhile.
+    """
+    probes = [x for x in candidates for __ in range(repeat)]
+    results = []
+    port = config.destination_port
+    with tempfile.TemporaryFile() as fd:
+        for index, candidate in enumerate(probes):
+            fd.seek(0)
+            fd.truncate()
+            fd.write(make_probe(index, len(probes), candidate, probe_size))
+            fd.seek(0)
+            candidate_config = get_candidate_config(config, candidate)
+            logger.info("sending probe %s/%s %r…", index + 1, len(probes), candidate)
+            start = time.time()
+            try:
+                config.transport.send(candidate_config, fd, port)
+                sent = True
+            except ValueError as e:
+                logger.warning("unable to send probe %s: %s", index, e)
+                sent = False
+            results.append(
+                {
+                    "probe": index,
+                    "candidate": candidate,
+                    "size": probe_size,
+                    "sent": sent,
+                    "send_s": time.time() - start,
+                }
+            )
+            time.sleep(config.end_delay_s or 0.0)
+    return results
+
+
+class ProbeReceiver:
+    """receive probes until the last one (or until `stop()`), and check them"""
+
+    def __init__(self, config: Config, deadline_s: Optional[float] = None):
+        self.config = config
+        self.deadline_s = deadline_s
+        self.results = []  # type: List[Dict]
+        self.continue_loop = True
+        self.handle = None
+
+    def stop(self):
+        self.continue_loop = False
+        if self.handle is not None:
+            self.handle.terminate()
+
+    def register(self, handle):
+        self.handle = handle
+        if not self.continue_loop:
+            handle.terminate()
+
+    def receive_probes(self) -> List[Dict]:
+        timer = None
+        if self.deadline_s:
+            timer = threading.Timer(self.deadline_s, self.stop)
+            timer.daemon = True
+            timer.start()
+        try:
+            while self.continue_loop:
+                if self.receive_probe():
+                    break
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return self.results
+
+    @staticmethod
+    def watch_first_byte(fileno: int, done: threading.Event, empty_at: List[float]):
+        """poll the size of the file being received and keep in `empty_at[0]` the last time it was still empty"""
+        while True:
+            now = time.time()
+            if os.fstat(fileno).st_size:
+                return
+            empty_at[0] = now
+            if done.wait(POLL_S):
+                return
+
+    def receive_probe(self) -> bool:
+        """receive a single probe; return `True` if this is the last one"""
+        config = self.config
+        with tempfile.TemporaryFile() as fd:
+            empty_at = [time.time()]
+            done = threading.Event()
+            watcher = threading.Thread(
+                target=self.watch_first_byte, args=(fd.fileno(), done, empty_at)
+            )
+            watcher.start()
+            try:
+                returncode, stderr = config.transport.receive(
+                    config, fd, config.destination_port, register=self.register
+                )
+            finally:
+                end = time.time()
+                done.set()
+                watcher.join()
+            fd.seek(0)
+            data = fd.read()
+        header = check_probe(data)
+        stats = get_packet_stats(stderr)
+        if header is None:
+            if self.continue_loop:
+                logger.warning(
+                    "invalid probe received (%s bytes, returncode=%s).",
+                    len(data),
+                    returncode,
+                )
+            return not self.continue_loop
+        logger.info(
+            "probe %s/%s received (valid=%s).",
+            header["probe"] + 1,
+            header["count"],
+            header["valid"],
+        )
+        self.results.append(
+            {
+                "probe": header["probe"],
+                "candidate": header["candidate"],
+                "valid": header["valid"] and returncode == 0,
+                "size": len(data),
+                "receive_s": end - empty_at[0],
+                "stats": stats,
+            }
+        )
+        return header["probe"] + 1 >= header["count"] or not self.continue_loop
+
+
+def get_candidate_key(candidate: Dict) -> Tuple:
+    return tuple(candidate.get(x) for x in OPTIONS)
+
+
+def merge_results(sent: List[Dict], received: List[Dict]) -> List[Dict]:
+    """merge the measures of both sides and return a summary per candidate:
+    `{"candidate", "probes", "valid", "loss_rate", "goodput_bps", "stats"}`
+
+    the goodput is the mean goodput of the valid probes, measured by the receiver (received size / duration between
+    the first byte and the end of the reception)
+    """
+    received_by_probe = {x["probe"]: x for x in received}
+    summaries = {}  # type: Dict[Tuple, Dict]
+    for probe in sent:
+        key = get_candidate_key(probe["candidate"])
+        summary = summaries.setdefault(
+            key,
+            {
+                "candidate": probe["candidate"],
+                "probes": 0,
+                "valid": 0,
+                "goodputs": [],
+                "stats": {},
+            },
+        )
+        summary["probes"] += 1
+        reception = received_by_probe.get(probe["probe"])
+        if reception is None or not reception["valid"] or not probe["sent"]:
+            continue
+        summary["valid"] += 1
+        if reception["receive_s"] > 0:
+            summary["goodputs"].append(reception["size"] / reception["receive_s"])
+        for key_, value in (reception.get("stats") or {}).items():
+            summary["stats"][key_] = summary["stats"].get(key_, 0) + value
+    results = []
+    for summary in summaries.values():
+        goodputs = summary.pop("goodputs")
+        summary["loss_rate"] = 1.0 - summary["valid"] / summary["probes"]
+        summary["goodput_bps"] = sum(goodputs) / len(goodputs) if goodputs else 0.0
+        summary["stats"] = summary["stats"] or None
+        results.append(summary)
+    return results
+
+
+def recommend_profile(summaries: List[Dict], max_loss_rate: float = 0.0) -> Dict:
+    """return the options of the candidate with the best goodput among those whose loss rate is acceptable
+    (or with the lowest loss rate if none is acceptable), as keyword arguments of :class:`Config`
+    """
+    if not summaries:
+        raise ValueError("no calibration result")
+
+    def sort_key(summary: Dict):
+        redundancy = summary["candidate"].get("redundancy") or math.inf
+        return summary["goodput_bps"], -redundancy
+
+    acceptable = [x for x in summaries if x["loss_rate"] <= max_loss_rate]
+    if acceptable:
+        best = max(acceptable, key=sort_key)
+    else:
+        lowest = min(x["loss_rate"] for x in summaries)
+        best = max([x for x in summaries if x["loss_rate"] == lowest], key=sort_key)
+    profile = {x: best["candidate"].get(x) for x in OPTIONS}
+    profile["calibration"] = {
+        "goodput_bps": best["goodput_bps"],
+        "loss_rate": best["loss_rate"],
+        "probes": best["probes"],
+    }
+    return profile
+
+
+def load_profile(path: str) -> Dict:
+    """read a profile written by `pyhairgap calibrate` and return the keyword arguments of :class:`Config`"""
+    with open(path) as fd:
+        profile = json.load(fd)
+    return {x: profile[x] for x in OPTIONS if x in profile}
+
+
+def run_calibration(
+    config: Config,
+    candidates: List[Dict],
+    probe_size: int = 4 * 1024 * 1024,
+    repeat: int = 2,
+    start_delay_s: float = 0.5,
+    grace_s: float = 10.0,
+) -> List[Dict]:
+    """run both sides on the same host (the receiver in a thread) and return the summary per candidate
+
+    :param start_delay_s: delay before the first probe (the receiver must be listening)
+    :param grace_s: maximum delay for receiving the last probe (that may be lost) after its sending
+    """
+    receiver = ProbeReceiver(config)
+    receiver_thread = threading.Thread(target=receiver.receive_probes)
+    receiver_thread.start()
+    try:
+        time.sleep(start_delay_s)
+        sent = send_probes(config, candidates, probe_size=probe_size, repeat=repeat)
+        receiver_thread.join(grace_s)
+    finally:
+        receiver.stop()
+        receiver_thread.join()
+    return merge_results(sent, receiver.results)
+
+
+def run_emulated_calibration(
+    candidates: List[Dict],
+    link: Optional[Dict[str, float]] = None,
+    probe_size: int = 4 * 1024 * 1024,
+    repeat: int = 2,
+    end_delay_s: float = 1.0,
+    port: int = 16000,
+) -> List[Dict]:
+    """run a calibration against the UDP stand-ins of the hairgap binaries, over an emulated link
+    (see :class:`hairgap.emulator.LinkEmulator` for the `link` parameters)
+
+    the receiver timeout is half the delay between two probes, so a lost probe does not hide the next one
+    """
+    stand_ins = importlib.resources.files("hairgap").joinpath("tests")
+    with ExitStack() as stack:
+        stack.enter_context(emulated_link(**(link or {})))
+        hairgapr, hairgaps = [
+            str(
+                stack.enter_context(
+                    importlib.resources.as_file(stand_ins.joinpath("lossy_%s.py" % x))
+                )
+            )
+            for x in ("hairgapr", "hairgaps")
+        ]
+        config = Config(
+            destination_ip="127.0.0.1",
+            destination_port=port,
+            end_delay_s=end_delay_s,
+            timeout_s=end_delay_s / 2.0,
+            hairgapr=hairgapr,
+            hairgaps=hairgaps,
+        )
+        return run_calibration(config, candidates, probe_size=probe_size, repeat=repeat)
@@ -0,0 +1,106 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Send large files as fixed-size chunks, each one with its own digest.
+
+With `Config(chunk_size=...)`, :meth:`hairgap.sender.DirectorySender.prepare_directory` hashes each larger file
+chunk by chunk, in a single pass that also computes the digest of the whole file. The file is not copied: each chunk
+is sent as a byte range of the original file (see :class:`hairgap.zerocopy.FileRange`), and is never compressed.
+Each chunk is announced in the index by a line just before its own digest line:
+
+.. code-block:: text
+
+    [chunk 0 1048576 2500000 7d1a…]
+    4e9c… = data/large.bin
+    [chunk 1 1048576 2500000 7d1a…]
+    0b31… = data/large.bin
+
+i.e. `[chunk <index> <chunk size> <file size> <digest of the whole file>]`. The receiver checks each chunk as soon as
+it is received and writes it at its offset in the destination file. At the end of the transfer, it reports the
+missing (or corrupted) chunks (the file is kept, with holes where chunks are missing) and checks the digest of the
+rebuilt files.
+
+Not available with parity files.
+"""
+
+import os
+import re
+from typing import List, Optional, Tuple
+
+from hairgap.digests import BUFFER_SIZE, new_digest
+
+CHUNKS_DIRNAME = ".hairgap-chunks"
+CHUNK_PATTERN = r"^\[chunk (\d+) (\d+) (\d+) ([a-fA-F\d]+)\]$"
+
+
+def get_chunk_count(file_size: int, chunk_size: int) -> int:
+    return max((file_size + chunk_size - 1) // chunk_size, 1)
+
+
+def get_chunk_relpath(file_relpath: str, index: int) -> str:
+    """return the name of a chunk, as an entry of the transfer (no such file exists)"""
+    return os.path.join(CHUNKS_DIRNAME, "%s.%06d" % (file_relpath, index))
+
+
+def parse_chunk(line: str) -> Optional[Tuple[int, int, int, str]]:
+    """return (chunk index, chunk size, file size, file digest) from a `[chunk …]` line, or `None` if it is invalid"""
+    matcher = re.match(CHUNK_PATTERN, line)
+    if not matcher:
+        return None
+    index, chunk_size, file_size, file_digest = matcher.groups()
+    return int(index), int(chunk_size), int(file_size), file_digest.lower()
+
+
+def hash_chunks(
+    file_abspath: str, chunk_size: int, algorithm: str
+) -> Tuple[List[str], str]:
+    """return the digest of each chunk of a file and the digest of the whole file, reading the file once
+
+    :raise ValueError: see :func:`hairgap.digests.new_digest`
+    """
+    file_digest = new_digest(algorithm)
+    chunk_digests = []
+    buffer = bytearray(min(BUFFER_SIZE, chunk_size))
+    view = memoryview(buffer)
+    with open(file_abspath, "rb", buffering=0) as fd:
+        while True:
+            digest = new_digest(algorithm)
+            remaining = chunk_size
+            while remaining:
+                size = fd.readinto(view[: min(remaining, len(buffer))])
+                if not size:
+                    break
+                digest.update(view[:size])
+                file_digest.update(view[:size])
+                remaining -= size
+            if remaining == chunk_size and chunk_digests:
+                break
+            chunk_digests.append(digest.hexdigest())
+            if remaining:
+                break
+    return chunk_digests, file_digest.hexdigest()
+
+
+def format_ranges(indices: List[int]) -> str:
+    """format a sorted list of integers as ranges: `[0, 1, 2, 5]` => `"0-2, 5"`"""
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ", ".join(
+        str(start) if start == end else "%s-%s" % (start, end) for start, end in ranges
+    )
@@ -14,16 +14,37 @@
 #                                                                              #
 # ##############################################################################
 import argparse
+import datetime
+import json
 import logging
 import os
 import shutil
+import sys
 import tempfile
 import uuid
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
+from hairgap.bench import PROFILES, get_scenarios, run_benchmarks
+from hairgap.calibration import (
+    ProbeReceiver,
+    get_candidates,
+    load_profile,
+    merge_results,
+    recommend_profile,
+    run_emulated_calibration,
+    send_probes,
+)
+from hairgap.durability import DURABILITIES, DURABILITY_NONE
+from hairgap.history import ORDERINGS, HistoryStore
+from hairgap.progress import Progress, format_progress
 from hairgap.receiver import Receiver
+from hairgap.replay import replay_streams
 from hairgap.sender import DirectorySender
+from hairgap.spool import SendQueue, SpoolDaemon
+from hairgap.tracing import JsonLinesExporter, Tracer
+from hairgap.transport import TRANSPORTS, Transport
 from hairgap.utils import Config, ensure_dir, get_arp_cache, now
+from hairgap.watch import WatchSender
 
 logger = logging.getLogger(__name__)
 
@@ -68,6 +89,16 @@ class SimpleDirReceiver(Receiver):
         super().transfer_complete()
         logger.info(self.get_current_transfer_directory())
 
+    def message_received(self, data: bytes, attributes: Dict[str, str]):
+        super().message_received(data, attributes)
+        message_abspath = os.path.join(
+            self.after_reception_path, "messages", str(uuid.uuid4())
+        )
+        ensure_dir(message_abspath, parent=True)
+        with open(message_abspath, "wb") as fd:
+            fd.write(data)
+        logger.info(message_abspath)
+
     def get_current_transfer_directory(self) -> Optional[str]:
         if not self.current_attributes["uid"]:
             return None
@@ -79,19 +110,45 @@ def missing_command(args):
     return main(["-h"])
 
 
+def get_tracer(args) -> Optional[Tracer]:
+    if not args.trace_file:
+        return None
+    return Tracer([JsonLinesExporter(args.trace_file)])
+
+
+def get_transport(args) -> Optional[Transport]:
+    if not args.transport:
+        return None
+    return TRANSPORTS[args.transport]()
+
+
+def get_send_config(args, **kwargs) -> Config:
+    options = {
+        "redundancy": args.redundancy,
+        "error_chunk_size": args.error_chunk_size,
+        "max_rate_mbps": args.max_rate_mbps,
+        "mtu_b": args.mtu_b,
+    }
+    if args.link_profile:
+        options.update(load_profile(args.link_profile))
+    return Config(
+        destination_ip=args.ip,
+        destination_port=args.port,
+        keepalive_ms=args.keepalive_ms,
+        end_delay_s=args.delay_s,
+        hairgaps=args.bin_path,
+        tracer=get_tracer(args),
+        history_path=args.history_path,
+        transport=get_transport(args),
+        compression_threads=args.compression_threads,
+        **options,
+        **kwargs,
+    )
+
+
 def send_directory(args):
     with tempfile.TemporaryDirectory(dir=args.tmp_path) as dirname:
-        config = Config(
-            destination_ip=args.ip,
-            destination_port=args.port,
-            redundancy=args.redundancy,
-            error_chunk_size=args.error_chunk_size,
-            max_rate_mbps=args.max_rate_mbps,
-            mtu_b=args.mtu_b,
-            keepalive_ms=args.keepalive_ms,
-            end_delay_s=args.delay_s,
-            hairgaps=args.bin_path,
-        )
+        config = get_send_config(args)
         copy_path = os.path.join(dirname, "data")
         index_path = os.path.join(dirname, "index.txt")
         source = args.source
@@ -101,10 +158,23 @@ def send_directory(args):
         else:
             shutil.copytree(source, copy_path)
         sender = SingleDirSender(config, data_path=copy_path, index_path=index_path)
+        if not args.no_progress:
+            sender.progress.callback = render_progress
+            sender.progress.interval_s = 1.0 if sys.stderr.isatty() else 30.0
         sender.prepare_directory()
         sender.send_directory()
 
 
+def render_progress(progress: Progress):
+    """update a single line on a terminal, or write a new line otherwise"""
+    line = format_progress(progress)
+    if sys.stderr.isatty():
+        sys.stderr.write("\r\033[K" + line + ("\n" if progress.finished else ""))
+    else:
+        sys.stderr.write(line + "\n")
+    sys.stderr.flush()
+
+
 def receive_directory(args):
     with tempfile.TemporaryDirectory(dir=args.tmp_path) as dirname:
         config = Config(
@@ -114,6 +184,13 @@ def receive_directory(args):
             timeout_s=args.timeout_s,
             mem_limit_mb=args.mem_limit_mb,
             hairgapr=args.bin_path,
+            express_port=args.express_port,
+            tracer=get_tracer(args),
+            metrics_port=args.metrics_port,
+            history_path=args.history_path,
+            transport=get_transport(args),
+            record_path=args.record_path,
+            durability=args.durability,
         )
         receiver = SimpleDirReceiver(
             config, args.destination, threading=not args.no_threading
@@ -135,6 +212,11 @@ def populate_receive_parser(receive_parser):
     )
     receive_parser.add_argument("--port", "-p", type=int, default=8008, help="UDP port")
     receive_parser.add_argument("--bin-path", help="path of the hairgapr binary")
+    receive_parser.add_argument(
+        "--express-port",
+        type=int,
+        help="UDP port reserved to small messages (written in the 'messages' subdirectory)",
+    )
     receive_parser.add_argument("--timeout-s", "-t", type=float)
     receive_parser.add_argument(
         "--no-threading",
@@ -152,38 +234,642 @@ def populate_receive_parser(receive_parser):
         help="temporary path, used during reception [%s]" % tmp_dir,
         default=tmp_dir,
     )
+    receive_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve metrics on http://127.0.0.1:{port}/metrics (Prometheus format)",
+    )
+    receive_parser.add_argument(
+        "--trace-file", help="append the timings of each stage to this JSON-lines file"
+    )
+    receive_parser.add_argument(
+        "--history-path", help="add a report of each transfer to this SQLite database"
+    )
+    receive_parser.add_argument(
+        "--transport",
+        choices=sorted(TRANSPORTS),
+        help="'tcp' replaces the hairgap binaries by TCP connections (for testing purposes) [hairgap]",
+    )
+    receive_parser.add_argument(
+        "--record-path",
+        help="copy each received stream to this directory, to replay it later",
+    )
+    receive_parser.add_argument(
+        "--durability",
+        choices=DURABILITIES,
+        default=DURABILITY_NONE,
+        help="flush received files to disk after each file or before the end of each transfer [none]",
+    )
     receive_parser.set_defaults(func=receive_directory)
 
 
-def populate_send_parser(send_parser):
-    tmp_dir = tempfile.gettempdir()
-    send_parser.add_argument(
-        "ip",
-        help="destination IP address (cannot be localhost, even for testing purposes)",
+def send_message(args):
+    config = get_send_config(args, express_port=args.express_port)
+    attributes = dict(x.partition("=")[::2] for x in args.attribute)
+    if args.source == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        with open(args.source, "rb") as fd:
+            data = fd.read()
+    DirectorySender.send_message(config, data, attributes=attributes)
+
+
+def submit_directory(args):
+    queue = SendQueue(args.spool)
+    uid = queue.submit(args.source, priority=args.priority)
+    print(uid)
+
+
+def run_spool_daemon(args):
+    daemon = SpoolDaemon(get_send_config(args), SendQueue(args.spool))
+    try:
+        daemon.loop()
+    except KeyboardInterrupt:
+        pass
+
+
+def watch_directory(args):
+    sender = WatchSender(
+        get_send_config(args),
+        args.spool,
+        state_path=args.state_path,
+        max_batch_files=args.max_batch_files,
+        max_batch_size=args.max_batch_size,
+        max_latency_s=args.max_latency_s,
+        polling=args.polling,
     )
-    send_parser.add_argument("source", help="the directory to send")
-    send_parser.add_argument("--port", "-p", type=int, default=8008, help="UDP port")
-    send_parser.add_argument(
+    try:
+        sender.loop()
+    except KeyboardInterrupt:
+        pass
+
+
+def populate_hairgaps_arguments(parser):
+    parser.add_argument("--port", "-p", type=int, default=8008, help="UDP port")
+    parser.add_argument(
         "--bin-path", help="path of the hairgaps binary", default="hairgaps"
     )
-    send_parser.add_argument("--redundancy", "-r", type=float, default=3.0)
-    send_parser.add_argument("--error-chunk-size", "-N", type=int)
-    send_parser.add_argument("--max-rate-mbps", "-b", type=int)
-    send_parser.add_argument("--mtu-b", "-M", type=int)
-    send_parser.add_argument("--keepalive-ms", "-k", type=int, default=500)
-    send_parser.add_argument(
+    parser.add_argument("--redundancy", "-r", type=float, default=3.0)
+    parser.add_argument("--error-chunk-size", "-N", type=int)
+    parser.add_argument("--max-rate-mbps", "-b", type=int)
+    parser.add_argument("--mtu-b", "-M", type=int)
+    parser.add_argument("--keepalive-ms", "-k", type=int, default=500)
+    parser.add_argument(
+        "--compression-threads",
+        type=int,
+        help="compress the tar archive with this number of threads [single tar process]",
+    )
+    parser.add_argument(
         "--delay-s",
         "-d",
         type=float,
         help="delay between two successive files",
         default=3.0,
     )
+    parser.add_argument(
+        "--trace-file", help="append the timings of each stage to this JSON-lines file"
+    )
+    parser.add_argument(
+        "--history-path", help="add a report of each transfer to this SQLite database"
+    )
+    parser.add_argument(
+        "--transport",
+        choices=sorted(TRANSPORTS),
+        help="'tcp' replaces the hairgap binaries by TCP connections (for testing purposes) [hairgap]",
+    )
+    parser.add_argument(
+        "--link-profile",
+        help="JSON profile written by 'calibrate' (overrides -r, -N, -b and -M)",
+    )
+
+
+def get_link(args) -> Dict[str, float]:
+    """return the parameters of the emulated link (empty if no link is emulated)"""
+    link = {
+        "loss": args.loss,
+        "burst": args.burst,
+        "burst_length": args.burst_length,
+        "bandwidth_mbps": args.bandwidth_mbps,
+        "reorder": args.reorder,
+    }
+    return {k: v for (k, v) in link.items() if v is not None}
+
+
+def populate_link_arguments(parser):
+    group = parser.add_argument_group(
+        "emulated link", "use UDP stand-ins emulating a lossy link"
+    )
+    group.add_argument("--loss", type=float, help="probability of losing a packet")
+    group.add_argument(
+        "--burst", type=float, help="probability of starting a burst of losses"
+    )
+    group.add_argument(
+        "--burst-length", type=float, help="mean number of packets lost in a burst"
+    )
+    group.add_argument("--bandwidth-mbps", type=float, help="capacity of the link")
+    group.add_argument("--reorder", type=float, help="probability of delaying a packet")
+
+
+def run_bench(args):
+    kwargs = {
+        "end_delay_s": args.delay_s,
+        "tmp_path": args.tmp_path,
+        "redundancy": args.redundancy,
+        "max_rate_mbps": args.max_rate_mbps,
+    }
+    link = get_link(args)
+    if link:
+        kwargs["link"] = link
+    scenarios = get_scenarios(
+        profiles=args.profile or ["tiny", "huge", "mixed"],
+        tar_modes=[x == "tar" for x in args.mode or ["tar", "files"]],
+        split_sizes=[x or None for x in args.split_size or [0]],
+        threading_modes=[x == "on" for x in args.threading or ["on"]],
+    )
+    if args.output:
+        with open(args.output, "a") as fd:
+            results = run_benchmarks(scenarios, output=fd, **kwargs)
+    else:
+        results = run_benchmarks(scenarios, output=sys.stdout, **kwargs)
+    if not all(x["valid"] for x in results):
+        sys.exit(1)
+
+
+def populate_bench_parser(bench_parser):
+    tmp_dir = tempfile.gettempdir()
+    bench_parser.add_argument(
+        "--profile", action="append", choices=sorted(PROFILES), help="dataset profile"
+    )
+    bench_parser.add_argument(
+        "--mode",
+        action="append",
+        choices=["tar", "files"],
+        help="send a single tar archive or each file separately",
+    )
+    bench_parser.add_argument(
+        "--split-size",
+        action="append",
+        type=int,
+        help="split size (in bytes, only without tar, 0 to disable)",
+    )
+    bench_parser.add_argument(
+        "--threading",
+        action="append",
+        choices=["on", "off"],
+        help="receive and process files in separate threads",
+    )
+    bench_parser.add_argument(
+        "--delay-s",
+        "-d",
+        type=float,
+        help="delay between two successive files",
+        default=0.5,
+    )
+    bench_parser.add_argument(
+        "--output", "-o", help="append JSON results to this file [standard output]"
+    )
+    bench_parser.add_argument(
+        "--tmp-path",
+        help="temporary path, where datasets are created [%s]" % tmp_dir,
+        default=tmp_dir,
+    )
+    bench_parser.add_argument(
+        "--redundancy", type=float, default=3.0, help="hairgap redundancy [3.0]"
+    )
+    bench_parser.add_argument(
+        "--max-rate-mbps", type=int, default=None, help="hairgap maximum rate"
+    )
+    populate_link_arguments(bench_parser)
+    bench_parser.set_defaults(func=run_bench)
+
+
+def show_history(args):
+    store = HistoryStore(args.history_path)
+    order = "slowest" if args.slowest else args.order
+    records = store.get_records(side=args.side, order=order, limit=args.limit)
+    if args.json:
+        for record in records:
+            print(json.dumps(record.as_dict(), sort_keys=True))
+        return
+    print(
+        "%-19s %-8s %-11s %-12s %7s %13s %10s %13s %6s  %s"
+        % (
+            "date",
+            "side",
+            "status",
+            "transfer",
+            "files",
+            "bytes",
+            "duration",
+            "B/s",
+            "errors",
+            "stages",
+        )
+    )
+    for record in records:
+        throughput = record.throughput_bps
+        stages = ", ".join(
+            "%s=%.1fs" % x
+            for x in sorted(record.durations.items(), key=lambda x: -x[1])
+        )
+        print(
+            "%-19s %-8s %-11s %-12s %7d %13d %9.1fs %13s %6d  %s"
+            % (
+                datetime.datetime.fromtimestamp(record.created).strftime(
+                    "%Y-%m-%d %H:%M:%S"
+                ),
+                record.side,
+                record.status,
+                (record.transfer_id or "")[:12],
+                record.files,
+                record.size,
+                record.duration_s,
+                "-" if throughput is None else "%.0f" % throughput,
+                record.errors,
+                stages,
+            )
+        )
+
+
+def get_calibration_candidates(args) -> List[Dict]:
+    return get_candidates(
+        mtus=args.mtu_b or [None],
+        error_chunk_sizes=args.error_chunk_size or [None],
+        redundancies=args.redundancy or [1.2, 1.5, 2.0, 3.0],
+        max_rates_mbps=args.max_rate_mbps or [None],
+    )
+
+
+def write_json_lines(path: Optional[str], values: List[Dict]):
+    fd = sys.stdout if path is None else open(path, "w")
+    try:
+        for value in values:
+            fd.write(json.dumps(value, sort_keys=True) + "\n")
+    finally:
+        if path is not None:
+            fd.close()
+
+
+def read_json_lines(path: str) -> List[Dict]:
+    with open(path) as fd:
+        return [json.loads(x) for x in fd if x.strip()]
+
+
+def write_profile(args, summaries: List[Dict]):
+    for summary in sorted(summaries, key=lambda x: -x["goodput_bps"]):
+        logger.info(
+            "%r: goodput=%.0f B/s, loss rate=%.2f",
+            summary["candidate"],
+            summary["goodput_bps"],
+            summary["loss_rate"],
+        )
+    profile = recommend_profile(summaries, max_loss_rate=args.max_loss_rate)
+    content = json.dumps(profile, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fd:
+            fd.write(content + "\n")
+    else:
+        print(content)
+
+
+def calibrate_local(args):
+    summaries = run_emulated_calibration(
+        get_calibration_candidates(args),
+        link=get_link(args),
+        probe_size=args.probe_size,
+        repeat=args.repeat,
+        end_delay_s=args.delay_s,
+    )
+    write_profile(args, summaries)
+
+
+def calibrate_send(args):
+    config = Config(
+        destination_ip=args.ip,
+        destination_port=args.port,
+        keepalive_ms=args.keepalive_ms,
+        end_delay_s=args.delay_s,
+        hairgaps=args.bin_path,
+        transport=get_transport(args),
+    )
+    results = send_probes(
+        config,
+        get_calibration_candidates(args),
+        probe_size=args.probe_size,
+        repeat=args.repeat,
+    )
+    write_json_lines(args.output, results)
+
+
+def calibrate_receive(args):
+    config = Config(
+        destination_ip=args.ip,
+        destination_port=args.port,
+        timeout_s=args.timeout_s,
+        hairgapr=args.bin_path,
+        transport=get_transport(args),
+    )
+    receiver = ProbeReceiver(config, deadline_s=args.deadline_s)
+    try:
+        results = receiver.receive_probes()
+    except KeyboardInterrupt:
+        results = receiver.results
+    write_json_lines(args.output, results)
+
+
+def calibrate_merge(args):
+    summaries = merge_results(
+        read_json_lines(args.sent), read_json_lines(args.received)
+    )
+    write_profile(args, summaries)
+
+
+def populate_calibrate_parser(calibrate_parser):
+    subparsers = calibrate_parser.add_subparsers()
+    local_parser = subparsers.add_parser(
+        "local", help="calibrate against the link emulator, on this host"
+    )
+    send_parser = subparsers.add_parser("send", help="send probes (sender side)")
+    receive_parser = subparsers.add_parser(
+        "receive", help="receive probes (receiver side, started first)"
+    )
+    merge_parser = subparsers.add_parser(
+        "merge", help="merge the results of both sides into a profile"
+    )
+    for parser, delay_s in ((local_parser, 1.0), (send_parser, 3.0)):
+        parser.add_argument(
+            "--mtu-b", "-M", type=int, nargs="+", help="tested MTUs [hairgap default]"
+        )
+        parser.add_argument(
+            "--error-chunk-size",
+            "-N",
+            type=int,
+            nargs="+",
+            help="tested error chunk sizes [hairgap default]",
+        )
+        parser.add_argument(
+            "--redundancy",
+            "-r",
+            type=float,
+            nargs="+",
+            help="tested redundancies [1.2 1.5 2 3]",
+        )
+        parser.add_argument(
+            "--max-rate-mbps",
+            "-b",
+            type=int,
+            nargs="+",
+            help="tested maximum rates [unlimited]",
+        )
+        parser.add_argument(
+            "--probe-size",
+            type=int,
+            default=4 * 1024 * 1024,
+            help="size of each probe (in bytes) [4 MiB]",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=2, help="probes per combination [2]"
+        )
+        parser.add_argument(
+            "--delay-s",
+            "-d",
+            type=float,
+            default=delay_s,
+            help="delay between two successive probes, longer than the receiver timeout [%s]"
+            % delay_s,
+        )
+    for parser in (send_parser, receive_parser):
+        parser.add_argument("ip", help="destination IP address")
+        parser.add_argument("--port", "-p", type=int, default=8008, help="UDP port")
+        parser.add_argument("--bin-path", help="path of the hairgap binary")
+        parser.add_argument(
+            "--transport",
+            choices=sorted(TRANSPORTS),
+            help="'tcp' replaces the hairgap binaries by TCP connections [hairgap]",
+        )
+        parser.add_argument(
+            "--output", "-o", help="write JSON results to this file [standard output]"
+        )
+    send_parser.add_argument("--keepalive-ms", "-k", type=int, default=500)
+    receive_parser.add_argument("--timeout-s", "-t", type=float, default=3.0)
+    receive_parser.add_argument(
+        "--deadline-s", type=float, help="stop waiting for probes after this delay"
+    )
+    merge_parser.add_argument("sent", help="JSON results of 'calibrate send'")
+    merge_parser.add_argument("received", help="JSON results of 'calibrate receive'")
+    for parser in (local_parser, merge_parser):
+        parser.add_argument(
+            "--max-loss-rate",
+            type=float,
+            default=0.0,
+            help="maximum acceptable fraction of lost probes [0]",
+        )
+        parser.add_argument(
+            "--output",
+            "-o",
+            help="write the JSON profile to this file [standard output]",
+        )
+    populate_link_arguments(local_parser)
+    local_parser.set_defaults(func=calibrate_local)
+    send_parser.set_defaults(func=calibrate_send)
+    receive_parser.set_defaults(func=calibrate_receive)
+    merge_parser.set_defaults(func=calibrate_merge)
+
+
+def replay_directory(args):
+    with tempfile.TemporaryDirectory(dir=args.tmp_path) as dirname:
+        config = Config(
+            destination_path=dirname,
+            tracer=get_tracer(args),
+            history_path=args.history_path,
+        )
+        receiver = SimpleDirReceiver(config, args.destination)
+        results = replay_streams(receiver, args.record_path, speed=args.speed)
+    if args.json:
+        for result in results:
+            print(json.dumps(result, sort_keys=True))
+        return
+    size = sum(x["size"] for x in results)
+    process_s = sum(x["process_s"] for x in results)
+    print("%s stream(s), %s byte(s)" % (len(results), size))
+    print(
+        "processing: %.3fs (%s B/s)"
+        % (process_s, "%.0f" % (size / process_s) if process_s else "-")
+    )
+    print("max lag: %.3fs" % max([x["lag_s"] for x in results] or [0.0]))
+    for result in sorted(results, key=lambda x: -x["process_s"])[: args.limit]:
+        print("%9.3fs %13d  %s" % (result["process_s"], result["size"], result["name"]))
+
+
+def populate_replay_parser(replay_parser):
+    tmp_dir = tempfile.gettempdir()
+    replay_parser.add_argument(
+        "record_path", help="directory written by 'receive --record-path'"
+    )
+    replay_parser.add_argument(
+        "destination", help="root directory, where received directory are written"
+    )
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="1 to replay at the recorded speed, 2 twice faster, 0 as fast as possible [1]",
+    )
+    replay_parser.add_argument(
+        "--limit",
+        "-n",
+        type=int,
+        default=10,
+        help="number of displayed slowest streams [10]",
+    )
+    replay_parser.add_argument(
+        "--json",
+        action="store_true",
+        default=False,
+        help="display the timings of each stream as JSON lines",
+    )
+    replay_parser.add_argument(
+        "--tmp-path",
+        help="temporary path, used during processing [%s]" % tmp_dir,
+        default=tmp_dir,
+    )
+    replay_parser.add_argument(
+        "--trace-file", help="append the timings of each stage to this JSON-lines file"
+    )
+    replay_parser.add_argument(
+        "--history-path", help="add a report of each transfer to this SQLite database"
+    )
+    replay_parser.set_defaults(func=replay_directory)
+
+
+def populate_history_parser(history_parser):
+    history_parser.add_argument("history_path", help="SQLite history database")
+    history_parser.add_argument(
+        "--slowest",
+        action="store_true",
+        default=False,
+        help="show the transfers with the lowest throughput first",
+    )
+    history_parser.add_argument(
+        "--order", choices=sorted(ORDERINGS), default="recent", help="sort order"
+    )
+    history_parser.add_argument(
+        "--side", choices=["sender", "receiver"], help="only show one side"
+    )
+    history_parser.add_argument(
+        "--limit", "-n", type=int, default=20, help="number of transfers [20]"
+    )
+    history_parser.add_argument(
+        "--json", action="store_true", default=False, help="one JSON object per line"
+    )
+    history_parser.set_defaults(func=show_history)
+
+
+def populate_message_parser(message_parser):
+    message_parser.add_argument(
+        "ip",
+        help="destination IP address (cannot be localhost, even for testing purposes)",
+    )
+    message_parser.add_argument(
+        "source", help="file to send as a message ('-' for the standard input)"
+    )
+    message_parser.add_argument(
+        "--express-port", type=int, required=True, help="UDP port of the express lane"
+    )
+    message_parser.add_argument(
+        "--attribute",
+        "-a",
+        action="append",
+        default=[],
+        help="attribute of the message, as 'key=value'",
+    )
+    populate_hairgaps_arguments(message_parser)
+    message_parser.set_defaults(func=send_message)
+
+
+def populate_submit_parser(submit_parser):
+    submit_parser.add_argument("spool", help="spool directory")
+    submit_parser.add_argument("source", help="the directory to send")
+    submit_parser.add_argument(
+        "--priority",
+        type=int,
+        default=0,
+        help="jobs with higher priorities are sent first",
+    )
+    submit_parser.set_defaults(func=submit_directory)
+
+
+def populate_daemon_parser(daemon_parser):
+    daemon_parser.add_argument(
+        "ip",
+        help="destination IP address (cannot be localhost, even for testing purposes)",
+    )
+    daemon_parser.add_argument("spool", help="spool directory")
+    populate_hairgaps_arguments(daemon_parser)
+    daemon_parser.set_defaults(func=run_spool_daemon)
+
+
+def populate_watch_parser(watch_parser):
+    watch_parser.add_argument(
+        "ip",
+        help="destination IP address (cannot be localhost, even for testing purposes)",
+    )
+    watch_parser.add_argument(
+        "spool", help="directory where files to send are written by producers"
+    )
+    populate_hairgaps_arguments(watch_parser)
+    watch_parser.add_argument(
+        "--state-path",
+        help="where files are moved before being sent, on the same filesystem [spool/.hairgap-watch]",
+    )
+    watch_parser.add_argument(
+        "--max-batch-files",
+        type=int,
+        default=1000,
+        help="maximum number of files of a single transfer [1000]",
+    )
+    watch_parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=1 << 26,
+        help="a transfer is sent as soon as its files reach this size (in bytes) [%s]"
+        % (1 << 26),
+    )
+    watch_parser.add_argument(
+        "--max-latency-s",
+        type=float,
+        default=1.0,
+        help="maximum delay before sending a closed file, when the link is not busy [1.0]",
+    )
+    watch_parser.add_argument(
+        "--polling",
+        action="store_true",
+        default=False,
+        help="poll the directory instead of using inotify",
+    )
+    watch_parser.set_defaults(func=watch_directory)
+
+
+def populate_send_parser(send_parser):
+    tmp_dir = tempfile.gettempdir()
+    send_parser.add_argument(
+        "ip",
+        help="destination IP address (cannot be localhost, even for testing purposes)",
+    )
+    send_parser.add_argument("source", help="the directory to send")
+    populate_hairgaps_arguments(send_parser)
     send_parser.add_argument(
         "--tmp-path",
         help="temporary path, where the whole directory to send is copied [%s]"
         % tmp_dir,
         default=tmp_dir,
     )
+    send_parser.add_argument(
+        "--no-progress",
+        action="store_true",
+        default=False,
+        help="do not display the progress on the standard error",
+    )
     send_parser.set_defaults(func=send_directory)
 
 
@@ -222,6 +908,22 @@ def main(argv=None):
     populate_receive_parser(receive_parser)
     check_parser = subparsers.add_parser("check")
     populate_check_parser(check_parser)
+    submit_parser = subparsers.add_parser("submit")
+    populate_submit_parser(submit_parser)
+    daemon_parser = subparsers.add_parser("daemon")
+    populate_daemon_parser(daemon_parser)
+    watch_parser = subparsers.add_parser("watch")
+    populate_watch_parser(watch_parser)
+    message_parser = subparsers.add_parser("message")
+    populate_message_parser(message_parser)
+    bench_parser = subparsers.add_parser("bench")
+    populate_bench_parser(bench_parser)
+    history_parser = subparsers.add_parser("history")
+    populate_history_parser(history_parser)
+    replay_parser = subparsers.add_parser("replay")
+    populate_replay_parser(replay_parser)
+    calibrate_parser = subparsers.add_parser("calibrate")
+    populate_calibrate_parser(calibrate_parser)
 
     args = parser.parse_args(argv)
     args.func(args)
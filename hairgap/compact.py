@@ -0,0 +1,309 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Compact binary index, for transfers of millions of files.
+
+With `Config(compact_index="raw")` (or `"zlib"`), :meth:`hairgap.sender.DirectorySender.prepare_directory` converts
+the text index into a compact one, sent instead of it. Its header is made of the usual text lines (attributes and
+options), ended by a `[compact <number of entries> <digest size> <raw|zlib>]` line. Then each entry is encoded as:
+
+* the length of the prefix shared with the previous relative path and the length of the remaining bytes (varints),
+  followed by these remaining bytes,
+* the binary digest,
+* a flag byte (`1` for a compressed file, `2` for a chunk, `4` for a file with a known size),
+* for a chunk: its index, the chunk size and the file size (varints), then the binary digest of the whole file,
+* for a file with a known size (carousels): this size (varint).
+
+With `"zlib"`, all entries are compressed as a single zlib stream.
+
+The receiver memory-maps the received index and decodes its entries one by one, as files are received, instead
+of keeping a Python object for each of them (except for carousels and parity files, that need all of them at once).
+"""
+
+import mmap
+import re
+import zlib
+from collections import namedtuple
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+
+from hairgap.chunks import parse_chunk
+from hairgap.compression import ENCODING_GZIP, ENCODING_PATTERN
+from hairgap.constants import HAIRGAP_MAGIC_NUMBER_COMPACT, HAIRGAP_MAGIC_NUMBER_INDEX
+from hairgap.utils import FILENAME_PATTERN, SIZE_PATTERN
+
+COMPACT_RAW = "raw"
+COMPACT_ZLIB = "zlib"
+COMPACT_FORMATS = (COMPACT_RAW, COMPACT_ZLIB)
+COMPACT_PATTERN = r"^\[compact (\d+) (\d+) (\w+)\]$"
+
+FLAG_GZIP = 1
+FLAG_CHUNK = 2
+FLAG_SIZE = 4
+BUFFER_SIZE = 1 << 20
+
+CompactEntry = namedtuple(
+    "CompactEntry", ["digest", "relpath", "encoding", "chunk", "size"]
+)
+# chunk is None or (chunk index, chunk size, file size, digest of the whole file); size is None if not given
+
+
+def encode_varint(value: int) -> bytes:
+    """encode a non-negative integer as a LEB128 varint"""
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def iter_text_index(text_abspath: str) -> Iterator[Union[str, CompactEntry]]:
+    """yield the header lines and the entries of a text index"""
+    encoding, chunk, size = None, None, None
+    with open(text_abspath) as fd:
+        for line in fd:
+            if line == HAIRGAP_MAGIC_NUMBER_INDEX:
+                continue
+            matcher = re.match(ENCODING_PATTERN, line)
+            if matcher:
+                encoding = matcher.group(1)
+                continue
+            if line.startswith("[chunk "):
+                chunk = parse_chunk(line)
+                continue
+            matcher = re.match(SIZE_PATTERN, line)
+            if matcher:
+                size = int(matcher.group(1))
+                continue
+            matcher = re.match(FILENAME_PATTERN, line)
+            if matcher:
+                yield CompactEntry(
+                    matcher.group(1), matcher.group(2), encoding, chunk, size
+                )
+                encoding, chunk, size = None, None, None
+                continue
+            yield line
+
+
+def write_compact_index(text_abspath: str, compact_abspath: str, compact_format: str):
+    """convert a text index (written by :meth:`hairgap.sender.DirectorySender.prepare_directory`) to a compact one
+
+    the text index is read twice, so entries are never kept in memory
+    """
+    if compact_format not in COMPACT_FORMATS:
+        raise ValueError("unknown compact index format %r" % compact_format)
+    header_lines = []
+    count, digest_size = 0, 0
+    for item in iter_text_index(text_abspath):
+        if isinstance(item, str):
+            header_lines.append(item)
+        else:
+            count += 1
+            digest_size = len(item.digest) // 2
+    compressor = zlib.compressobj() if compact_format == COMPACT_ZLIB else None
+    with open(compact_abspath, "wb") as fd:
+        fd.write(HAIRGAP_MAGIC_NUMBER_COMPACT.encode())
+        for line in header_lines:
+            fd.write(line.encode())
+        fd.write(
+            ("[compact %s %s %s]\n" % (count, digest_size, compact_format)).encode()
+        )
+        previous = b""
+        block = bytearray()
+        for entry in iter_text_index(text_abspath):
+            if isinstance(entry, str):
+                continue
+            relpath = entry.relpath.encode()
+            shared = 0
+            for a, b in zip(previous, relpath):
+                if a != b:
+                    break
+                shared += 1
+            block += encode_varint(shared)
+            block += encode_varint(len(relpath) - shared)
+            block += relpath[shared:]
+            block += bytes.fromhex(entry.digest)
+            flags = FLAG_GZIP if entry.encoding == ENCODING_GZIP else 0
+            if entry.chunk:
+                flags |= FLAG_CHUNK
+            if entry.size is not None:
+                flags |= FLAG_SIZE
+            block.append(flags)
+            if entry.chunk:
+                for value in entry.chunk[:3]:
+                    block += encode_varint(value)
+                block += bytes.fromhex(entry.chunk[3])
+            if entry.size is not None:
+                block += encode_varint(entry.size)
+            previous = relpath
+            if len(block) >= BUFFER_SIZE:
+                fd.write(compressor.compress(block) if compressor else block)
+                block = bytearray()
+        fd.write(compressor.compress(block) if compressor else block)
+        if compressor:
+            fd.write(compressor.flush())
+
+
+def is_compact_index(index_abspath: str) -> bool:
+    """return `True` if the index file is a compact one"""
+    magic = HAIRGAP_MAGIC_NUMBER_COMPACT.encode()
+    with open(index_abspath, "rb") as fd:
+        return fd.read(len(magic)) == magic
+
+
+class CompactIndex:
+    """read a compact index, without loading all its entries in memory
+
+    raise ValueError if the header is invalid
+    """
+
+    def __init__(self, index_abspath: str):
+        with open(index_abspath, "rb") as fd:
+            self.data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header_lines = []  # type: List[str]
+        offset = len(HAIRGAP_MAGIC_NUMBER_COMPACT)
+        while True:
+            end = self.data.find(b"\n", offset)
+            if end < 0:
+                raise ValueError("invalid compact index (no [compact] line)")
+            line = self.data[offset : end + 1].decode()
+            offset = end + 1
+            matcher = re.match(COMPACT_PATTERN, line)
+            if matcher:
+                break
+            self.header_lines.append(line)
+        self.count = int(matcher.group(1))
+        self.digest_size = int(matcher.group(2))
+        self.compact_format = matcher.group(3)
+        if self.compact_format not in COMPACT_FORMATS:
+            raise ValueError("unknown compact index format %r" % self.compact_format)
+        self.offset = offset
+
+    def __len__(self):
+        return self.count
+
+    def iter_blocks(self) -> Iterator[bytes]:
+        """yield the (decompressed) entries, as blocks of bytes"""
+        decompressor = (
+            zlib.decompressobj() if self.compact_format == COMPACT_ZLIB else None
+        )
+        for start in range(self.offset, len(self.data), BUFFER_SIZE):
+            block = self.data[start : start + BUFFER_SIZE]
+            yield decompressor.decompress(block) if decompressor else block
+        if decompressor:
+            yield decompressor.flush()
+
+    def __iter__(self) -> Iterator[CompactEntry]:
+        """decode entries, one at a time; stop at the first truncated entry"""
+        blocks = self.iter_blocks()
+        buffer = bytearray()
+        pos = 0
+
+        def read(size: int) -> Optional[bytes]:
+            nonlocal buffer, pos
+            while len(buffer) - pos < size:
+                block = next(blocks, None)
+                if block is None:
+                    return None
+                del buffer[:pos]
+                pos = 0
+                buffer += block
+            pos += size
+            return bytes(buffer[pos - size : pos])
+
+        def read_varint() -> Optional[int]:
+            value, shift = 0, 0
+            while True:
+                byte = read(1)
+                if byte is None:
+                    return None
+                value |= (byte[0] & 0x7F) << shift
+                if byte[0] < 0x80:
+                    return value
+                shift += 7
+
+        previous = b""
+        for __ in range(self.count):
+            shared = read_varint()
+            length = read_varint()
+            suffix = read(length) if length is not None else None
+            digest = read(self.digest_size)
+            flags = read(1)
+            if shared is None or suffix is None or digest is None or flags is None:
+                return
+            chunk = None
+            if flags[0] & FLAG_CHUNK:
+                chunk = tuple(read_varint() for __ in range(3))
+                file_digest = read(self.digest_size)
+                if None in chunk or file_digest is None:
+                    return
+                chunk += (file_digest.hex(),)
+            size = None
+            if flags[0] & FLAG_SIZE:
+                size = read_varint()
+                if size is None:
+                    return
+            relpath = previous[:shared] + suffix
+            previous = relpath
+            encoding = ENCODING_GZIP if flags[0] & FLAG_GZIP else None
+            yield CompactEntry(digest.hex(), relpath.decode(), encoding, chunk, size)
+
+    def iter_lines(self) -> Iterator[str]:
+        """yield the entries as the lines of a text index"""
+        for entry in self:
+            if entry.encoding:
+                yield "[encoding %s]\n" % entry.encoding
+            if entry.chunk:
+                yield "[chunk %s %s %s %s]\n" % entry.chunk
+            if entry.size is not None:
+                yield "[size %s]\n" % entry.size
+            yield "%s = %s\n" % (entry.digest, entry.relpath)
+
+
+class CompactEntries:
+    """expected files of a transfer, decoded from a compact index when they are required
+
+    replaces the `Queue` of :attr:`hairgap.receiver.Receiver.expected_files`
+
+    :param on_chunk: called with (file relative path, chunk index, chunk size, file size, file digest) when a chunk
+        is required, must return the relative path of this chunk
+    """
+
+    def __init__(
+        self,
+        index: CompactIndex,
+        on_chunk: Callable[[str, int, int, int, str], str],
+    ):
+        self.entries = iter(index)
+        self.remaining = len(index)
+        self.on_chunk = on_chunk
+        self.next_entry = next(self.entries, None)  # type: Optional[CompactEntry]
+
+    def empty(self) -> bool:
+        return self.next_entry is None
+
+    def qsize(self) -> int:
+        return self.remaining if self.next_entry is not None else 0
+
+    def get(self) -> Tuple[str, str]:
+        """return the digest and the relative path of the next expected entry"""
+        entry = self.next_entry
+        if entry is None:
+            raise IndexError("no more expected files")
+        self.next_entry = next(self.entries, None)
+        self.remaining -= 1
+        if entry.chunk:
+            return entry.digest, self.on_chunk(entry.relpath, *entry.chunk)
+        return entry.digest, entry.relpath
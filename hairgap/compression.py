@@ -0,0 +1,144 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Choose, for each file sent without tar archive, between storing it and compressing it.
+
+With `Config(compression="auto")`, :meth:`hairgap.sender.DirectorySender.prepare_directory` samples a few blocks of
+each file: files starting by the magic number of a compressed format (gzip, zip, xz, png, jpeg, mp4…) and files whose
+samples do not compress well are sent as-is; other files (like text or JSON logs) are compressed with gzip.
+Compressed copies are written next to the index file (the source files are left untouched), so a directory can be
+prepared several times.
+`Config(compression="gzip")` compresses all files that are large enough.
+
+A compressed file is announced by a `[encoding gzip]` line just before its line in the index, and is sent after the
+HAIRGAP_MAGIC_NUMBER_GZIP header; the receiver decompresses it before checking its digest (computed by the sender on
+the original content).
+"""
+
+import os
+import zlib
+from typing import Optional
+
+COMPRESSION_AUTO = "auto"
+ENCODING_GZIP = "gzip"
+COMPRESSIONS = (COMPRESSION_AUTO, ENCODING_GZIP)
+ENCODING_PATTERN = r"^\[encoding (\w+)\]$"
+
+MIN_SIZE = 4096
+# smaller files are never compressed
+MAX_RATIO = 0.8
+# files are compressed if their samples are compressed to less than this ratio
+SAMPLE_SIZE = 1 << 16
+SAMPLE_COUNT = 3
+BUFFER_SIZE = 1 << 20
+COMPRESSION_LEVEL = 6
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# zlib produces (and reads) gzip streams with these window bits
+
+COMPRESSED_MAGICS = (
+    (0, b"\x1f\x8b"),  # gzip
+    (0, b"BZh"),  # bzip2
+    (0, b"\xfd7zXZ\x00"),  # xz
+    (0, b"\x28\xb5\x2f\xfd"),  # zstandard
+    (0, b"\x04\x22\x4d\x18"),  # lz4
+    (0, b"PK\x03\x04"),  # zip, jar, docx, odt…
+    (0, b"7z\xbc\xaf\x27\x1c"),  # 7-zip
+    (0, b"Rar!\x1a\x07"),  # rar
+    (0, b"\x89PNG\r\n\x1a\n"),  # png
+    (0, b"\xff\xd8\xff"),  # jpeg
+    (0, b"GIF8"),  # gif
+    (0, b"OggS"),  # ogg
+    (0, b"fLaC"),  # flac
+    (0, b"ID3"),  # mp3
+    (4, b"ftyp"),  # mp4, mov, heic…
+    (8, b"WEBP"),  # webp
+    (0, b"\x1a\x45\xdf\xa3"),  # matroska, webm
+)
+
+
+def is_compressed_format(prefix: bytes) -> bool:
+    """return `True` if the file starts by the magic number of a compressed format"""
+    return any(
+        prefix[offset : offset + len(magic)] == magic
+        for (offset, magic) in COMPRESSED_MAGICS
+    )
+
+
+def estimate_ratio(file_abspath: str, size: Optional[int] = None) -> float:
+    """estimate the compression ratio of a file, by compressing a few blocks (at its beginning, middle and end)"""
+    if size is None:
+        size = os.path.getsize(file_abspath)
+    if size <= SAMPLE_SIZE * SAMPLE_COUNT:
+        blocks = [(0, size)]
+    else:
+        step = (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+        blocks = [(i * step, SAMPLE_SIZE) for i in range(SAMPLE_COUNT)]
+    compressed_size, sample_size = 0, 0
+    with open(file_abspath, "rb") as fd:
+        for offset, length in blocks:
+            fd.seek(offset)
+            sample = fd.read(length)
+            # fastest level: only the order of magnitude is required
+            compressed_size += len(zlib.compress(sample, 1))
+            sample_size += len(sample)
+    if not sample_size:
+        return 1.0
+    return compressed_size / sample_size
+
+
+def should_compress(file_abspath: str, compression: Optional[str]) -> bool:
+    """return `True` if the file should be compressed before being sent
+
+    :param compression: `None`, `"auto"` or `"gzip"` (see :attr:`hairgap.utils.Config.compression`)
+    """
+    if not compression:
+        return False
+    size = os.path.getsize(file_abspath)
+    if size < MIN_SIZE:
+        return False
+    elif compression == ENCODING_GZIP:
+        return True
+    with open(file_abspath, "rb") as fd:
+        prefix = fd.read(16)
+    if is_compressed_format(prefix):
+        return False
+    return estimate_ratio(file_abspath, size=size) <= MAX_RATIO
+
+
+def compress_file(src_abspath: str, dst_abspath: str) -> int:
+    """compress a file to a gzip file and return the size of the compressed file"""
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    size = 0
+    with open(src_abspath, "rb") as in_fd, open(dst_abspath, "wb") as out_fd:
+        for data in iter(lambda: in_fd.read(BUFFER_SIZE), b""):
+            data = compressor.compress(data)
+            out_fd.write(data)
+            size += len(data)
+        data = compressor.flush()
+        out_fd.write(data)
+        size += len(data)
+    return size
+
+
+def decompress_file(src_abspath: str, dst_abspath: str, offset: int = 0):
+    """decompress a gzip file, starting at `offset`; raise `zlib.error` on invalid content"""
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    with open(src_abspath, "rb") as in_fd, open(dst_abspath, "wb") as out_fd:
+        in_fd.seek(offset)
+        for data in iter(lambda: in_fd.read(BUFFER_SIZE), b""):
+            out_fd.write(decompressor.decompress(data))
+        out_fd.write(decompressor.flush())
+        if not decompressor.eof:
+            raise zlib.error("truncated gzip stream")
@@ -20,3 +20,11 @@ HAIRGAP_MAGIC_NUMBER_EMPTY = "# *-* HAIRGAP-EMPTY *-*\n"
 # must have the same size than HAIRGAP_MAGIC_NUMBER_INDEX
 HAIRGAP_MAGIC_NUMBER_ESCAPE = "# *-* HAIRGAP-ESCAP *-*\n"
 # must have the same size than HAIRGAP_MAGIC_NUMBER_INDEX
+HAIRGAP_MAGIC_NUMBER_MESSAGE = "# *-* HAIRGAP-MESSG *-*\n"
+# must have the same size than HAIRGAP_MAGIC_NUMBER_INDEX
+HAIRGAP_MAGIC_NUMBER_GZIP = "# *-* HAIRGAP-GZIPD *-*\n"
+# must have the same size than HAIRGAP_MAGIC_NUMBER_INDEX
+HAIRGAP_MAGIC_NUMBER_SEGMENT = "# *-* HAIRGAP-SEGMT *-*\n"
+# must have the same size than HAIRGAP_MAGIC_NUMBER_INDEX
+HAIRGAP_MAGIC_NUMBER_COMPACT = "# *-* HAIRGAP-CINDX *-*\n"
+# must have the same size than HAIRGAP_MAGIC_NUMBER_INDEX
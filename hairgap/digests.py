@@ -0,0 +1,88 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Digest algorithms used to check the files sent without tar archive.
+
+The sender computes the digest of each file with `Config(digest=...)`, and declares the algorithm by a
+`[digest blake2b]` line at the top of the index (no line for sha256, the historical default, so older receivers
+still understand these transfers). The receiver just follows the index: nothing is negotiated.
+
+* `sha256`: always available,
+* `blake2b` (truncated to 256 bits): always available, usually faster than sha256 on 64-bit CPUs without SHA extensions,
+* `blake3`: requires the `blake3` package, much faster,
+* `xxh3_128`: requires the `xxhash` package, not cryptographic but the fastest one (only detects transmission errors).
+
+"""
+
+import hashlib
+from typing import List
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DIGEST_SHA256 = "sha256"
+DIGEST_BLAKE2B = "blake2b"
+DIGEST_BLAKE3 = "blake3"
+DIGEST_XXH3 = "xxh3_128"
+DIGESTS = (DIGEST_SHA256, DIGEST_BLAKE2B, DIGEST_BLAKE3, DIGEST_XXH3)
+DEFAULT_DIGEST = DIGEST_SHA256
+DIGEST_PATTERN = r"^\[digest (\w+)\]$"
+
+BUFFER_SIZE = 1 << 20
+
+
+def get_available_digests() -> List[str]:
+    """return the algorithms that can be used on this host"""
+    unavailable = {DIGEST_BLAKE3: blake3 is None, DIGEST_XXH3: xxhash is None}
+    return [x for x in DIGESTS if not unavailable.get(x)]
+
+
+def new_digest(algorithm: str = DEFAULT_DIGEST):
+    """return a new hash object (with `update` and `hexdigest` methods)
+
+    :raise ValueError: unknown algorithm, or its package is not installed
+    """
+    if algorithm == DIGEST_SHA256:
+        return hashlib.sha256()
+    elif algorithm == DIGEST_BLAKE2B:
+        return hashlib.blake2b(digest_size=32)
+    elif algorithm == DIGEST_BLAKE3 and blake3 is not None:
+        return blake3.blake3()
+    elif algorithm == DIGEST_XXH3 and xxhash is not None:
+        return xxhash.xxh3_128()
+    elif algorithm in DIGESTS:
+        raise ValueError("digest %r requires an optional package" % algorithm)
+    raise ValueError("unknown digest %r" % algorithm)
+
+
+def get_file_digest(file_abspath: str, algorithm: str = DEFAULT_DIGEST) -> str:
+    """return the hexadecimal digest of a file
+
+    :raise ValueError: see :func:`new_digest`
+    """
+    digest = new_digest(algorithm)
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(file_abspath, "rb", buffering=0) as fd:
+        for size in iter(lambda: fd.readinto(buffer), 0):
+            digest.update(view[:size])
+    return digest.hexdigest()
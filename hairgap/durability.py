@@ -0,0 +1,113 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Flush received files to disk, so they survive a power loss once a transfer is complete.
+
+`Config(durability=...)` selects the policy of the receiver:
+
+* `"none"` (default): files are left in the page cache, and written to disk by the operating system,
+* `"file"`: each received file (and its directory) is flushed as soon as it is written,
+* `"transfer"`: all files of a transfer are flushed at once, just before `transfer_complete` is called, with a single
+  `syncfs` call on Linux (that also flushes the other files of the same filesystem), or one `fdatasync` per file
+  (in a few threads) on other systems.
+
+The flush duration is exported as the `hairgap_sync_seconds` metric, and as the `sync` stage of the transfer history.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_NONE = "none"
+DURABILITY_FILE = "file"
+DURABILITY_TRANSFER = "transfer"
+DURABILITIES = (DURABILITY_NONE, DURABILITY_FILE, DURABILITY_TRANSFER)
+SYNC_THREADS = 8
+# number of concurrent fdatasync calls, so the disk can reorder its writes
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _syncfs = _libc.syncfs
+except (OSError, AttributeError):
+    _syncfs = None
+
+
+def sync_file(file_abspath: str):
+    """flush the content of a file to disk"""
+    fd = os.open(file_abspath, os.O_RDONLY)
+    try:
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_directory(dir_abspath: str):
+    """flush the entries of a directory to disk (ignored when directories cannot be opened, like on Windows)"""
+    try:
+        fd = os.open(dir_abspath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def syncfs(path: str) -> bool:
+    """flush the whole filesystem containing `path`; return `False` if `syncfs` is not available"""
+    if _syncfs is None:
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        result = _syncfs(fd)
+    finally:
+        os.close(fd)
+    if result != 0:
+        logger.warning(
+            "syncfs failed on '%s': %s", path, os.strerror(ctypes.get_errno())
+        )
+        return False
+    return True
+
+
+def sync_tree(dir_abspath: str, use_syncfs: bool = True):
+    """flush all files and directories below `dir_abspath` to disk
+
+    :param use_syncfs: use a single `syncfs` call if available, instead of flushing each file
+    """
+    if use_syncfs and syncfs(dir_abspath):
+        return
+    dir_abspaths = [os.path.dirname(dir_abspath)]
+    futures = {}
+    with ThreadPoolExecutor(max_workers=SYNC_THREADS) as executor:
+        for root, dirnames, filenames in os.walk(dir_abspath):
+            dir_abspaths.append(root)
+            for filename in filenames:
+                file_abspath = os.path.join(root, filename)
+                futures[file_abspath] = executor.submit(sync_file, file_abspath)
+    for file_abspath, future in futures.items():
+        if future.exception() is not None:
+            logger.error("unable to flush '%s': %s", file_abspath, future.exception())
+    for path in reversed(dir_abspaths):
+        sync_directory(path)
@@ -0,0 +1,440 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Emulation of a lossy, rate-limited one-way link, used by `hairgap/tests/lossy_hairgap[rs].py`.
+
+Unlike the TCP stand-ins, these replacements of the hairgap binaries send UDP packets and use their options:
+
+  * `-r`: redundancy ratio (sent packets / data packets); `-r 1.5` adds one parity packet for two data packets,
+  * `-N`: number of data packets per error-correction group (64 by default),
+  * `-b`: maximum sending rate (in Mbps, headers included),
+  * `-M`: MTU (in bytes, 1500 by default),
+  * `-k`: keepalive delay (in ms) when no data is available on stdin,
+  * `-t`: timeout of the receiver (in seconds) once the transfer has started.
+
+Each group of data packets is protected by Reed-Solomon parity packets (see :mod:`hairgap.parity`):
+a group is decoded as soon as any `N` of its packets are received.
+
+The link itself is configured by environment variables read by the sender (see :meth:`LinkEmulator.from_environ`):
+random loss, burst loss (Gilbert-Elliott model), bandwidth cap and reordering.
+
+.. code-block:: python
+
+    with emulated_link(loss=0.01, burst=0.001, burst_length=10):
+        sender.send_directory()
+
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from hairgap.parity import decode_blocks, encode_blocks
+
+logger = logging.getLogger(__name__)
+
+PACKET_MAGIC = b"HGEM"
+PACKET_DATA = 0
+PACKET_END = 1
+PACKET_KEEPALIVE = 2
+# magic, packet type, session, group index, index in the group, data packets, parity packets, data size of the group
+PACKET_HEADER = struct.Struct(">4sBIIHHHI")
+END_PAYLOAD = struct.Struct(">Q")
+IP_UDP_HEADERS = 28
+DEFAULT_MTU = 1500
+DEFAULT_GROUP_SIZE = 64
+DEFAULT_TIMEOUT_S = 3.0
+END_REPEAT = 3
+
+ENVIRON_PREFIX = "HAIRGAP_EMULATOR_"
+LINK_PARAMETERS = {
+    "loss": float,
+    "burst": float,
+    "burst_length": float,
+    "bandwidth_mbps": float,
+    "queue_ms": float,
+    "reorder": float,
+    "reorder_depth": int,
+    "seed": int,
+}
+
+
+class LinkEmulator:
+    """decide the fate of each sent packet.
+
+    :param loss: probability of losing a packet (outside bursts)
+    :param burst: probability of starting a burst of losses, for each packet
+    :param burst_length: mean number of packets lost in a burst
+    :param bandwidth_mbps: capacity of the link; packets that overflow its queue are dropped
+    :param queue_ms: size of the queue of the link (as a delay)
+    :param reorder: probability of delaying a packet after the next ones
+    :param reorder_depth: maximum number of packets sent before a delayed one
+    :param seed: seed of the random generator, for reproducible runs
+    """
+
+    def __init__(
+        self,
+        loss: float = 0.0,
+        burst: float = 0.0,
+        burst_length: float = 10.0,
+        bandwidth_mbps: Optional[float] = None,
+        queue_ms: float = 50.0,
+        reorder: float = 0.0,
+        reorder_depth: int = 8,
+        seed: Optional[int] = None,
+    ):
+        self.loss = loss
+        self.burst = burst
+        self.burst_length = burst_length
+        self.bandwidth_mbps = bandwidth_mbps
+        self.queue_ms = queue_ms
+        self.reorder = reorder
+        self.reorder_depth = reorder_depth
+        # loss emulation is not security-relevant
+        self.random = random.Random(seed)  # nosec B311
+        self.in_burst = False
+        self.link_free_at = 0.0  # when the queue of the link is empty
+        self.delayed = []  # type: List[Tuple[int, bytes]]
+        # (number of packets to wait for, packet)
+        self.sent_count = 0
+        self.dropped_count = 0
+
+    @classmethod
+    def from_environ(cls, environ=None) -> "LinkEmulator":
+        """read the parameters from `HAIRGAP_EMULATOR_LOSS`, `HAIRGAP_EMULATOR_BURST`, …"""
+        environ = os.environ if environ is None else environ
+        kwargs = {}
+        for name, cast in LINK_PARAMETERS.items():
+            value = environ.get(ENVIRON_PREFIX + name.upper())
+            if value:
+                kwargs[name] = cast(value)
+        return cls(**kwargs)
+
+    def is_lost(self, size: int) -> bool:
+        """Gilbert-Elliott model (every packet is lost in the bad state), then bandwidth cap"""
+        if self.in_burst:
+            self.in_burst = self.random.random() >= 1.0 / max(self.burst_length, 1.0)
+        else:
+            self.in_burst = self.random.random() < self.burst
+        if self.in_burst or self.random.random() < self.loss:
+            return True
+        if self.bandwidth_mbps:
+            now = time.monotonic()
+            start = max(self.link_free_at, now)
+            if (start - now) * 1000.0 > self.queue_ms:
+                return True
+            self.link_free_at = start + (size + IP_UDP_HEADERS) * 8 / (
+                self.bandwidth_mbps * 1e6
+            )
+        return False
+
+    def transmit(self, packet: bytes) -> List[bytes]:
+        """return the packets that actually leave the link after `packet`, in their order"""
+        released = []
+        if self.is_lost(len(packet)):
+            self.dropped_count += 1
+        elif self.reorder and self.random.random() < self.reorder:
+            self.delayed.append((self.random.randint(1, self.reorder_depth), packet))
+        else:
+            released.append(packet)
+        delayed = []
+        for count, delayed_packet in self.delayed:
+            if count <= len(released):
+                released.append(delayed_packet)
+            else:
+                delayed.append((count - len(released), delayed_packet))
+        self.delayed = delayed
+        self.sent_count += len(released)
+        return released
+
+    def flush(self) -> List[bytes]:
+        """return the packets that are still delayed"""
+        released = [x[1] for x in self.delayed]
+        self.delayed = []
+        self.sent_count += len(released)
+        return released
+
+
+@contextmanager
+def emulated_link(**kwargs):
+    """set the environment variables read by the emulated senders, restoring the previous ones at exit"""
+    names = {ENVIRON_PREFIX + x.upper(): x for x in LINK_PARAMETERS}
+    previous = {x: os.environ.get(x) for x in names}
+    for name, key in names.items():
+        if kwargs.get(key) is not None:
+            os.environ[name] = str(kwargs[key])
+        else:
+            os.environ.pop(name, None)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def get_group_parameters(
+    redundancy: Optional[float], group_size: Optional[int]
+) -> Tuple[int, int]:
+    """return the number of data and parity packets per group (at most 256 packets)"""
+    group_size = group_size or DEFAULT_GROUP_SIZE
+    redundancy = max(redundancy or 1.0, 1.0)
+    group_size = max(1, min(group_size, int(256 / redundancy)))
+    parity_count = math.ceil(group_size * (redundancy - 1.0) - 1e-9)
+    return group_size, min(parity_count, 256 - group_size)
+
+
+class EmulatedSender:
+    """read stdin and send it as groups of UDP packets"""
+
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        redundancy: Optional[float] = None,
+        group_size: Optional[int] = None,
+        max_rate_mbps: Optional[float] = None,
+        mtu: Optional[int] = None,
+        keepalive_ms: Optional[int] = None,
+        link: Optional[LinkEmulator] = None,
+    ):
+        self.address = (ip, port)
+        self.data_count, self.parity_count = get_group_parameters(
+            redundancy, group_size
+        )
+        self.payload_size = (mtu or DEFAULT_MTU) - IP_UDP_HEADERS - PACKET_HEADER.size
+        if self.payload_size <= 0:
+            raise ValueError("MTU is too small")
+        self.max_rate_mbps = max_rate_mbps
+        self.keepalive_s = (keepalive_ms or 500) / 1000.0
+        self.link = link or LinkEmulator()
+        self.session = random.getrandbits(32)
+        self.next_send_time = 0.0
+        self.sock = None  # type: Optional[socket.socket]
+
+    def send_packet(self, packet: bytes):
+        for released in self.link.transmit(packet):
+            self.sendto(released)
+
+    def sendto(self, packet: bytes):
+        if self.max_rate_mbps:
+            now = time.monotonic()
+            if self.next_send_time > now:
+                time.sleep(self.next_send_time - now)
+            self.next_send_time = max(self.next_send_time, now) + (
+                len(packet) + IP_UDP_HEADERS
+            ) * 8 / (self.max_rate_mbps * 1e6)
+        self.sock.sendto(packet, self.address)
+
+    def send_group(self, group_index: int, data: bytes):
+        blocks = [
+            data[i : i + self.payload_size].ljust(self.payload_size, b"\0")
+            for i in range(0, len(data), self.payload_size)
+        ]
+        # the last group may have less data packets, but keeps the same ratio of parity packets
+        parity_count = math.ceil(self.parity_count * len(blocks) / self.data_count)
+        blocks += encode_blocks(blocks, parity_count)
+        data_count = len(blocks) - parity_count
+        for index, block in enumerate(blocks):
+            header = PACKET_HEADER.pack(
+                PACKET_MAGIC,
+                PACKET_DATA,
+                self.session,
+                group_index,
+                index,
+                data_count,
+                parity_count,
+                len(data),
+            )
+            self.send_packet(header + block)
+
+    def send(self, fd: int) -> int:
+        """send all data read from the file descriptor and return its size"""
+        group_bytes = self.data_count * self.payload_size
+        buffer = bytearray()
+        total_size = 0
+        group_index = 0
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as self.sock:
+            while True:
+                ready, __, __ = select.select([fd], [], [], self.keepalive_s)
+                if not ready:
+                    self.sendto(
+                        PACKET_HEADER.pack(
+                            PACKET_MAGIC, PACKET_KEEPALIVE, self.session, 0, 0, 0, 0, 0
+                        )
+                    )
+                    continue
+                data = os.read(fd, 1 << 16)
+                if not data:
+                    break
+                buffer += data
+                total_size += len(data)
+                while len(buffer) >= group_bytes:
+                    self.send_group(group_index, bytes(buffer[:group_bytes]))
+                    del buffer[:group_bytes]
+                    group_index += 1
+            if buffer:
+                self.send_group(group_index, bytes(buffer))
+                group_index += 1
+            for packet in self.link.flush():
+                self.sendto(packet)
+            end = PACKET_HEADER.pack(
+                PACKET_MAGIC, PACKET_END, self.session, group_index, 0, 0, 0, 0
+            ) + END_PAYLOAD.pack(total_size)
+            for __ in range(END_REPEAT):
+                self.sendto(end)
+        logger.debug(
+            "%s bytes sent in %s group(s), %s packet(s) dropped by the link",
+            total_size,
+            group_index,
+            self.link.dropped_count,
+        )
+        return total_size
+
+
+class EmulatedReceiver:
+    """receive groups of UDP packets, decode them and write the data in order"""
+
+    def __init__(self, ip: str, port: int, timeout_s: Optional[float] = None):
+        self.address = (ip, port)
+        self.timeout_s = timeout_s or DEFAULT_TIMEOUT_S
+        self.session = None  # type: Optional[int]
+        self.groups = {}  # type: Dict[int, Dict[int, bytes]]
+        self.decoded = {}  # type: Dict[int, bytes]
+        self.next_group = 0
+        self.group_count = None  # type: Optional[int]
+        self.total_size = None  # type: Optional[int]
+        self.written_size = 0
+        self.stats = {
+            "packets": 0,
+            "data_packets": 0,
+            "parity_packets": 0,
+            "recovered_packets": 0,
+            "lost_groups": 0,
+        }
+
+    def process_packet(self, packet: bytes, output) -> bool:
+        """process a packet and return `True` when the transfer is complete"""
+        if len(packet) < PACKET_HEADER.size:
+            return False
+        magic, kind, session, group, index, data_count, parity_count, size = (
+            PACKET_HEADER.unpack_from(packet)
+        )
+        if magic != PACKET_MAGIC:
+            return False
+        if self.session is None and kind != PACKET_KEEPALIVE:
+            self.session = session
+        if session != self.session:
+            return False
+        self.stats["packets"] += 1
+        if kind == PACKET_END:
+            self.group_count = group
+            (self.total_size,) = END_PAYLOAD.unpack_from(packet, PACKET_HEADER.size)
+        elif kind == PACKET_DATA and group >= self.next_group:
+            if group not in self.decoded:
+                received = self.groups.setdefault(group, {})
+                received[index] = packet[PACKET_HEADER.size :]
+                self.stats[
+                    "data_packets" if index < data_count else "parity_packets"
+                ] += 1
+                if len(received) >= data_count:
+                    blocks = decode_blocks(received, data_count, parity_count)
+                    self.stats["recovered_packets"] += sum(
+                        1 for i in range(data_count) if i not in received
+                    )
+                    self.decoded[group] = b"".join(blocks)[:size]
+                    del self.groups[group]
+            while self.next_group in self.decoded:
+                data = self.decoded.pop(self.next_group)
+                output.write(data)
+                self.written_size += len(data)
+                self.next_group += 1
+        return self.group_count is not None and self.next_group >= self.group_count
+
+    def receive(self, output) -> bool:
+        """write received data to `output` and return `True` if the transfer is complete"""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 24)
+            sock.bind(self.address)
+            while True:
+                timeout = None if self.session is None else self.timeout_s
+                ready, __, __ = select.select([sock], [], [], timeout)
+                if not ready:
+                    break
+                packet = sock.recv(1 << 16)
+                if self.process_packet(packet, output):
+                    return True
+        self.stats["lost_groups"] = (
+            self.group_count or self.next_group + len(self.groups) + len(self.decoded)
+        ) - self.next_group
+        return False
+
+
+def main_send(argv: Optional[List[str]] = None):
+    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(description="emulate hairgaps over a lossy link")
+    parser.add_argument("-p", type=int, default=8008)
+    parser.add_argument("-r", type=float)
+    parser.add_argument("-N", type=int)
+    parser.add_argument("-b", type=float)
+    parser.add_argument("-M", type=int)
+    parser.add_argument("-k", type=int)
+    parser.add_argument("ip")
+    args = parser.parse_args(argv)
+    sender = EmulatedSender(
+        args.ip,
+        args.p,
+        redundancy=args.r,
+        group_size=args.N,
+        max_rate_mbps=args.b,
+        mtu=args.M,
+        keepalive_ms=args.k,
+        link=LinkEmulator.from_environ(),
+    )
+    sender.send(sys.stdin.buffer.fileno())
+
+
+def main_receive(argv: Optional[List[str]] = None):
+    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(description="emulate hairgapr over a lossy link")
+    parser.add_argument("-p", type=int, default=8008)
+    parser.add_argument("-t", type=float)
+    parser.add_argument("-m", type=float)  # unused
+    parser.add_argument("ip")
+    args = parser.parse_args(argv)
+    receiver = EmulatedReceiver(args.ip, args.p, timeout_s=args.t)
+    complete = receiver.receive(sys.stdout.buffer)
+    sys.stdout.buffer.flush()
+    # a single line, easy to parse by calibration tools
+    logger.info("stats: %s", json.dumps(receiver.stats, sort_keys=True))
+    if not complete:
+        logger.error(
+            "incomplete transfer: %s bytes written, %s group(s) lost",
+            receiver.written_size,
+            receiver.stats["lost_groups"],
+        )
+        sys.exit(1)
@@ -0,0 +1,238 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Persistent history of the transfers, stored in a local SQLite database.
+
+When `Config(history_path=...)` is set, :class:`hairgap.sender.DirectorySender` adds a record at the end of each
+`send_directory` and :class:`hairgap.receiver.Receiver` at the end of each transfer.
+Both sides use the SHA256 of the index file as transfer identifier, so their records can be matched.
+
+.. code-block:: bash
+
+    pyhairgap history /var/lib/hairgap/history.sqlite3 --slowest --limit 10
+
+"""
+
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from hairgap.utils import Config, ensure_dir
+
+SIDE_SENDER = "sender"
+SIDE_RECEIVER = "receiver"
+STATUS_COMPLETE = "complete"
+STATUS_FAILED = "failed"
+STATUS_INTERRUPTED = "interrupted"
+
+ORDERINGS = {
+    "recent": "created DESC",
+    "slowest": "throughput_bps ASC",
+    "largest": "bytes DESC",
+    "errors": "errors DESC, created DESC",
+}
+
+
+class TransferRecord:
+    """performance report of a transfer, on one side of the link"""
+
+    def __init__(
+        self,
+        side: str,
+        transfer_id: Optional[str],
+        status: str = STATUS_COMPLETE,
+        attributes: Optional[Dict[str, Optional[str]]] = None,
+        files: int = 0,
+        size: int = 0,
+        duration_s: float = 0.0,
+        durations: Optional[Dict[str, float]] = None,
+        errors: int = 0,
+        config: Optional[Dict] = None,
+        created: Optional[float] = None,
+    ):
+        """
+        :param side: "sender" or "receiver"
+        :param transfer_id: SHA256 of the index file
+        :param status: "complete", "failed" or "interrupted"
+        :param attributes: attributes of the transfer (see :meth:`DirectorySender.get_attributes`)
+        :param files: number of files (including the index)
+        :param size: number of bytes (including the index)
+        :param duration_s: total duration of the transfer
+        :param durations: duration of each stage
+        :param errors: number of files with an invalid digest
+        :param config: the used :class:`Config`, as a dict
+        :param created: timestamp of the end of the transfer
+        """
+        self.side = side
+        self.transfer_id = transfer_id
+        self.status = status
+        self.attributes = attributes or {}
+        self.files = files
+        self.size = size
+        self.duration_s = duration_s
+        self.durations = durations or {}
+        self.errors = errors
+        self.config = config or {}
+        self.created = time.time() if created is None else created
+
+    @property
+    def throughput_bps(self) -> Optional[float]:
+        """effective throughput, in bytes per second"""
+        if self.duration_s <= 0:
+            return None
+        return self.size / self.duration_s
+
+    def as_dict(self) -> Dict:
+        return {
+            "side": self.side,
+            "transfer_id": self.transfer_id,
+            "status": self.status,
+            "attributes": self.attributes,
+            "files": self.files,
+            "bytes": self.size,
+            "duration_s": self.duration_s,
+            "durations": self.durations,
+            "throughput_bps": self.throughput_bps,
+            "errors": self.errors,
+            "config": self.config,
+            "created": self.created,
+        }
+
+    def __repr__(self):
+        return "<TransferRecord %s %s (%s)>" % (
+            self.side,
+            self.transfer_id,
+            self.status,
+        )
+
+
+class HistoryStore:
+    """append-only store of :class:`TransferRecord`.
+
+    Every method opens its own connection, so a store can be shared by several threads or processes.
+    """
+
+    def __init__(self, db_abspath: str, db_timeout_s: float = 30.0):
+        self.db_abspath = db_abspath
+        self.db_timeout_s = db_timeout_s
+        ensure_dir(db_abspath, parent=True)
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS transfers ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "side TEXT NOT NULL, "
+                "transfer_id TEXT, "
+                "status TEXT NOT NULL, "
+                "attributes TEXT NOT NULL, "
+                "files INTEGER NOT NULL, "
+                "bytes INTEGER NOT NULL, "
+                "duration_s REAL NOT NULL, "
+                "durations TEXT NOT NULL, "
+                "throughput_bps REAL, "
+                "errors INTEGER NOT NULL, "
+                "config TEXT NOT NULL, "
+                "created REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS transfers_id ON transfers (transfer_id)"
+            )
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """open a connection and commit the current transaction when leaving the context"""
+        connection = sqlite3.connect(self.db_abspath, timeout=self.db_timeout_s)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def add(self, record: TransferRecord):
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT INTO transfers (side, transfer_id, status, attributes, files, bytes, duration_s, "
+                "durations, throughput_bps, errors, config, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    record.side,
+                    record.transfer_id,
+                    record.status,
+                    json.dumps(record.attributes, sort_keys=True),
+                    record.files,
+                    record.size,
+                    record.duration_s,
+                    json.dumps(record.durations, sort_keys=True),
+                    record.throughput_bps,
+                    record.errors,
+                    json.dumps(record.config, sort_keys=True),
+                    record.created,
+                ),
+            )
+
+    def get_records(
+        self,
+        side: Optional[str] = None,
+        transfer_id: Optional[str] = None,
+        order: str = "recent",
+        limit: Optional[int] = None,
+    ) -> List[TransferRecord]:
+        """return records, ordered by "recent", "slowest" (lowest throughput), "largest" or "errors"."""
+        query = (
+            "SELECT side, transfer_id, status, attributes, files, bytes, duration_s, durations, errors, "
+            "config, created FROM transfers"
+        )
+        conditions, args = [], []
+        if side:
+            conditions.append("side = ?")
+            args.append(side)
+        if transfer_id:
+            conditions.append("transfer_id = ?")
+            args.append(transfer_id)
+        if order == "slowest":
+            conditions.append("throughput_bps IS NOT NULL")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY %s, id" % ORDERINGS[order]
+        if limit:
+            query += " LIMIT ?"
+            args.append(limit)
+        with self.connect() as connection:
+            rows = connection.execute(query, args).fetchall()
+        return [
+            TransferRecord(
+                side=row[0],
+                transfer_id=row[1],
+                status=row[2],
+                attributes=json.loads(row[3]),
+                files=row[4],
+                size=row[5],
+                duration_s=row[6],
+                durations=json.loads(row[7]),
+                errors=row[8],
+                config=json.loads(row[9]),
+                created=row[10],
+            )
+            for row in rows
+        ]
+
+
+def add_record(config: Config, record: TransferRecord):
+    """add a record to the history configured by `config.history_path` (if any)"""
+    if not config.history_path:
+        return
+    record.config = config.as_dict()
+    HistoryStore(config.history_path).add(record)
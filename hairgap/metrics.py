@@ -0,0 +1,300 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Cumulative metrics of a :class:`hairgap.receiver.Receiver`, unlike its `transfer_*` attributes (reset by each index).
+
+Values are available as a dict (:meth:`MetricsRegistry.snapshot`) or in the Prometheus text format,
+served on `http://127.0.0.1:{config.metrics_port}/metrics` while the receiver loop is running.
+"""
+
+import abc
+import bisect
+import logging
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+# in seconds
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(abc.ABC):
+    """base class of metrics: subclasses define :meth:`get_value`"""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, help_text: str = ""):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+
+    @abc.abstractmethod
+    def get_value(self):
+        """return the current value"""
+
+    def get_samples(self) -> List[str]:
+        """return the lines of the Prometheus text format, without the comments"""
+        return ["%s %s" % (self.name, format_value(self.get_value()))]
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# HELP %s %s" % (self.name, self.help_text.replace("\n", " ")),
+            "# TYPE %s %s" % (self.name, self.metric_type),
+        ]
+        return "\n".join(lines + self.get_samples()) + "\n"
+
+
+class Counter(Metric):
+    """monotonic value"""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, help_text: str = ""):
+        super().__init__(name, help_text)
+        self.value = 0.0
+
+    def inc(self, value: float = 1.0):
+        if value < 0:
+            raise ValueError("counters can only be increased")
+        with self.lock:
+            self.value += value
+
+    def get_value(self) -> float:
+        return self.value
+
+
+class Gauge(Metric):
+    """value that can go up and down, or computed by a function when it is read"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, help_text: str = ""):
+        super().__init__(name, help_text)
+        self.value = 0.0
+        self.function = None  # type: Optional[Callable[[], float]]
+
+    def set(self, value: float):
+        with self.lock:
+            self.value = value
+
+    def inc(self, value: float = 1.0):
+        with self.lock:
+            self.value += value
+
+    def dec(self, value: float = 1.0):
+        self.inc(-value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def get_value(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Histogram(Metric):
+    """distribution of observed values (like durations) in cumulative buckets"""
+
+    metric_type = "histogram"
+
+    def __init__(
+        self, name: str, help_text: str = "", buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, help_text)
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def get_value(self) -> Dict[str, Union[float, Dict[str, int]]]:
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        buckets = {}
+        for bound, bucket_count in zip(self.buckets + [math.inf], counts):
+            cumulative += bucket_count
+            buckets[format_value(bound)] = cumulative
+        return {"count": count, "sum": total, "buckets": buckets}
+
+    def get_samples(self) -> List[str]:
+        value = self.get_value()
+        lines = [
+            '%s_bucket{le="%s"} %s' % (self.name, bound, count)
+            for (bound, count) in value["buckets"].items()
+        ]
+        lines.append("%s_sum %s" % (self.name, format_value(value["sum"])))
+        lines.append("%s_count %s" % (self.name, value["count"]))
+        return lines
+
+
+class MetricsRegistry:
+    """set of named metrics"""
+
+    def __init__(self):
+        self.metrics = {}  # type: Dict[str, Metric]
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """add a metric, or return the already registered metric with the same name"""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str = "") -> Counter:
+        return self.register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str = "") -> Gauge:
+        return self.register(Gauge(name, help_text))
+
+    def histogram(
+        self, name: str, help_text: str = "", buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets=buckets))
+
+    def snapshot(self) -> Dict:
+        """return the current value of each metric"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {x.name: x.get_value() for x in metrics}
+
+    def to_prometheus(self) -> str:
+        """return all metrics in the Prometheus text format"""
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda x: x.name)
+        return "".join(x.to_prometheus() for x in metrics)
+
+
+class ReceiverMetrics:
+    """metrics updated by a :class:`hairgap.receiver.Receiver`"""
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None):
+        self.registry = registry or MetricsRegistry()
+        r = self.registry
+        self.link_bytes = r.counter(
+            "hairgap_link_bytes_total", "bytes received by hairgapr"
+        )
+        self.receive_failures = r.counter(
+            "hairgap_receive_failures_total", "errors returned by hairgapr"
+        )
+        self.received_files = r.counter(
+            "hairgap_received_files_total", "files of transfers received"
+        )
+        self.received_bytes = r.counter(
+            "hairgap_received_bytes_total", "bytes of the files of transfers received"
+        )
+        self.file_errors = r.counter(
+            "hairgap_file_errors_total", "files received with an invalid digest"
+        )
+        self.unexpected_files = r.counter(
+            "hairgap_unexpected_files_total", "files received outside of a transfer"
+        )
+        self.transfers = r.counter("hairgap_transfers_total", "completed transfers")
+        self.process_queue_depth = r.gauge(
+            "hairgap_process_queue_depth", "received files waiting to be processed"
+        )
+        self.expected_files = r.gauge(
+            "hairgap_expected_files", "files of the current transfer not received yet"
+        )
+        self.processing_lag = r.gauge(
+            "hairgap_processing_lag_seconds",
+            "delay between the reception of the last processed file and its processing",
+        )
+        self.transfer_throughput = r.gauge(
+            "hairgap_transfer_throughput_bps",
+            "effective throughput of the last completed transfer (bytes per second)",
+        )
+        self.receive_seconds = r.histogram(
+            "hairgap_receive_seconds", "duration of the reception of each file"
+        )
+        self.process_seconds = r.histogram(
+            "hairgap_process_seconds", "duration of the processing of each file"
+        )
+        self.transfer_seconds = r.histogram(
+            "hairgap_transfer_seconds",
+            "duration of each transfer, from the index to the last file",
+        )
+        self.syncs = r.counter(
+            "hairgap_syncs_total",
+            "flushes of received files to disk (one per file or per transfer)",
+        )
+        self.sync_seconds = r.histogram(
+            "hairgap_sync_seconds", "duration of each flush of received files to disk"
+        )
+
+
+class MetricsServer:
+    """serve the metrics of a registry on `/metrics`, in a background thread"""
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = "127.0.0.1"):
+        self.registry = registry
+        self.address = (host, port)
+        self.server = None  # type: Optional[ThreadingHTTPServer]
+        self.thread = None  # type: Optional[threading.Thread]
+
+    def get_handler_class(self):
+        registry = self.registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.partition("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                content = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logger.debug("metrics: " + format, *args)
+
+        return MetricsHandler
+
+    @property
+    def port(self) -> int:
+        """the actual port (useful if 0 has been given)"""
+        return self.server.server_address[1]
+
+    def start(self):
+        self.server = ThreadingHTTPServer(self.address, self.get_handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info("metrics served on http://%s:%s/metrics", *self.address)
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.server = None
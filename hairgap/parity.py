@@ -0,0 +1,321 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Reed-Solomon parity files, computed over groups of files.
+
+Each group of `n` data files is protected by `k` parity files: any `k` missing files of the group can be rebuilt
+from the other ones.
+Data files are seen as streams made of their size (8 bytes) followed by their content, padded with zeros to the size
+of the largest stream of the group.
+
+Parity files are linear combinations of these streams over GF(256), using a Cauchy matrix (so any square
+sub-matrix can be inverted). The multiplication of a whole block by a constant is done by `bytes.translate`
+and the addition by a XOR on large integers, so the work is done at C speed without any dependency.
+
+The sender writes parity files next to its index file, and sends them as the files of `PARITY_DIRNAME`: a source
+directory already containing this directory cannot be sent with parity files.
+
+The same code is available for in-memory blocks (:func:`encode_blocks` and :func:`decode_blocks`).
+"""
+
+import os
+import struct
+from typing import Dict, List, Optional
+
+PARITY_DIRNAME = ".hairgap-parity"
+SIZE_HEADER = struct.Struct(">Q")
+
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11D
+for _i in range(255, 512):
+    GF_EXP[_i] = GF_EXP[_i - 255]
+_MUL_TABLES = {}  # type: Dict[int, bytes]
+
+
+def gf_mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inv(a: int) -> int:
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+def get_coefficient(parity_index: int, data_index: int, parity_count: int) -> int:
+    """coefficient of the data file in the given parity file (Cauchy matrix)"""
+    return gf_inv(parity_index ^ (parity_count + data_index))
+
+
+def mul_block(coefficient: int, block: bytes) -> bytes:
+    if coefficient == 1:
+        return block
+    if coefficient not in _MUL_TABLES:
+        _MUL_TABLES[coefficient] = bytes(gf_mul(coefficient, x) for x in range(256))
+    return block.translate(_MUL_TABLES[coefficient])
+
+
+def xor_blocks(blocks: List[bytes], size: int) -> bytes:
+    value = 0
+    for block in blocks:
+        value ^= int.from_bytes(block, "little")
+    return value.to_bytes(size, "little")
+
+
+def invert_matrix(matrix: List[List[int]]) -> List[List[int]]:
+    """invert a square matrix over GF(256) (Gauss-Jordan elimination)"""
+    size = len(matrix)
+    rows = [
+        list(row) + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)
+    ]
+    for col in range(size):
+        pivot = next((r for r in range(col, size) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError("singular matrix")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(inv, x) for x in rows[col]]
+        for r in range(size):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [x ^ gf_mul(factor, y) for x, y in zip(rows[r], rows[col])]
+    return [row[size:] for row in rows]
+
+
+class PaddedStream:
+    """read a data file as its size, followed by its content and padded with zeros"""
+
+    def __init__(self, abspath: Optional[str]):
+        self.fd = None
+        self.size = 0
+        self.header = b""
+        if abspath is None or not os.path.isfile(abspath):
+            return
+        self.fd = open(abspath, "rb")
+        self.size = os.path.getsize(abspath)
+        self.header = SIZE_HEADER.pack(self.size)
+
+    @property
+    def length(self) -> int:
+        return SIZE_HEADER.size + self.size
+
+    def read(self, size: int) -> bytes:
+        data = self.header[:size]
+        self.header = self.header[size:]
+        if self.fd is not None and len(data) < size:
+            data += self.fd.read(size - len(data))
+        return data + b"\0" * (size - len(data))
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+
+
+def solve_blocks(
+    blocks: Dict[int, bytes],
+    missing: List[int],
+    parity_blocks: Dict[int, bytes],
+    parity_count: int,
+    inverse: List[List[int]],
+    size: int,
+) -> List[bytes]:
+    """compute the missing data blocks from the present data blocks and the parity blocks
+
+    :param inverse: inverse of the coefficients of the missing blocks in the used parity blocks
+        (rows are sorted like `parity_blocks`, columns like `missing`)
+    """
+    # remove the contribution of the present blocks from each parity block
+    remainders = [
+        xor_blocks(
+            [parity_block]
+            + [
+                mul_block(get_coefficient(j, i, parity_count), b)
+                for i, b in blocks.items()
+            ],
+            size,
+        )
+        for j, parity_block in sorted(parity_blocks.items())
+    ]
+    return [
+        xor_blocks([mul_block(c, b) for c, b in zip(row, remainders)], size)
+        for row in inverse
+    ]
+
+
+def encode_blocks(blocks: List[bytes], parity_count: int) -> List[bytes]:
+    """compute the parity blocks of a group of in-memory blocks of the same size"""
+    if len(blocks) + parity_count > 256:
+        raise ValueError("too many blocks in a parity group")
+    size = len(blocks[0]) if blocks else 0
+    return [
+        xor_blocks(
+            [
+                mul_block(get_coefficient(j, i, parity_count), b)
+                for i, b in enumerate(blocks)
+            ],
+            size,
+        )
+        for j in range(parity_count)
+    ]
+
+
+def decode_blocks(
+    blocks: Dict[int, bytes], data_count: int, parity_count: int
+) -> Optional[List[bytes]]:
+    """rebuild a group of in-memory blocks encoded by :func:`encode_blocks`.
+
+    :param blocks: received blocks; data blocks are indexed from 0 to `data_count - 1`,
+        parity blocks from `data_count` to `data_count + parity_count - 1`
+    :return: all data blocks, or `None` if too many blocks are missing
+    """
+    missing = [i for i in range(data_count) if i not in blocks]
+    if not missing:
+        return [blocks[i] for i in range(data_count)]
+    parity_blocks = {i - data_count: b for i, b in blocks.items() if i >= data_count}
+    if len(parity_blocks) < len(missing):
+        return None
+    used_parities = sorted(parity_blocks)[: len(missing)]
+    matrix = [
+        [get_coefficient(j, i, parity_count) for i in missing] for j in used_parities
+    ]
+    present = {i: b for i, b in blocks.items() if i < data_count}
+    size = len(next(iter(blocks.values())))
+    rebuilt = solve_blocks(
+        present,
+        missing,
+        {j: parity_blocks[j] for j in used_parities},
+        parity_count,
+        invert_matrix(matrix),
+        size,
+    )
+    result = dict(present)
+    result.update(zip(missing, rebuilt))
+    return [result[i] for i in range(data_count)]
+
+
+def write_parity_files(
+    data_abspaths: List[str],
+    parity_abspaths: List[str],
+    block_size: int = 1 << 20,
+):
+    """compute the parity files of a group of data files
+
+    :param data_abspaths: the data files of the group (at most `256 - len(parity_abspaths)`)
+    :param parity_abspaths: the parity files to create
+    :param block_size: size of the blocks that are read at once
+    """
+    parity_count = len(parity_abspaths)
+    if len(data_abspaths) + parity_count > 256:
+        raise ValueError("too many files in a parity group")
+    streams = [PaddedStream(x) for x in data_abspaths]
+    length = max(x.length for x in streams)
+    coefficients = [
+        [get_coefficient(j, i, parity_count) for i in range(len(streams))]
+        for j in range(parity_count)
+    ]
+    parity_fds = []
+    for abspath in parity_abspaths:
+        os.makedirs(os.path.dirname(abspath), exist_ok=True)
+        parity_fds.append(open(abspath, "wb"))
+    try:
+        for offset in range(0, length, block_size):
+            size = min(block_size, length - offset)
+            blocks = [x.read(size) for x in streams]
+            for parity_fd, row in zip(parity_fds, coefficients):
+                parity_fd.write(
+                    xor_blocks([mul_block(c, b) for c, b in zip(row, blocks)], size)
+                )
+    finally:
+        for stream in streams:
+            stream.close()
+        for parity_fd in parity_fds:
+            parity_fd.close()
+
+
+def rebuild_data_files(
+    data_abspaths: List[str],
+    missing: List[int],
+    parity_abspaths: Dict[int, str],
+    parity_count: int,
+    block_size: int = 1 << 20,
+) -> List[int]:
+    """rebuild missing data files of a group.
+
+    :param data_abspaths: all data files of the group (missing ones are written at these paths)
+    :param missing: indices of the missing data files
+    :param parity_abspaths: available parity files, indexed by their parity index
+    :param parity_count: number of parity files of the group (including the missing ones)
+    :param block_size: size of the blocks that are read at once
+    :return: indices of the rebuilt data files (empty if there are not enough parity files)
+    """
+    if not missing or len(parity_abspaths) < len(missing):
+        return []
+    used_parities = sorted(parity_abspaths)[: len(missing)]
+    matrix = [
+        [get_coefficient(j, i, parity_count) for i in missing] for j in used_parities
+    ]
+    inverse = invert_matrix(matrix)
+    length = os.path.getsize(parity_abspaths[used_parities[0]])
+    present = [i for i in range(len(data_abspaths)) if i not in missing]
+    streams = {i: PaddedStream(data_abspaths[i]) for i in present}
+    parity_fds = {j: open(parity_abspaths[j], "rb") for j in used_parities}
+    tmp_abspaths = {i: "%s.rebuilt" % data_abspaths[i] for i in missing}
+    out_fds = {}
+    for i, abspath in tmp_abspaths.items():
+        os.makedirs(os.path.dirname(abspath), exist_ok=True)
+        out_fds[i] = open(abspath, "wb")
+    try:
+        for offset in range(0, length, block_size):
+            size = min(block_size, length - offset)
+            blocks = {i: x.read(size) for i, x in streams.items()}
+            parity_blocks = {}
+            for j in used_parities:
+                parity_block = parity_fds[j].read(size)
+                parity_blocks[j] = parity_block + b"\0" * (size - len(parity_block))
+            rebuilt = solve_blocks(
+                blocks, missing, parity_blocks, parity_count, inverse, size
+            )
+            for i, block in zip(missing, rebuilt):
+                out_fds[i].write(block)
+    finally:
+        for stream in streams.values():
+            stream.close()
+        for fd in list(parity_fds.values()) + list(out_fds.values()):
+            fd.close()
+    # remove the size header and the padding
+    for i, tmp_abspath in tmp_abspaths.items():
+        with open(tmp_abspath, "rb") as in_fd:
+            header = in_fd.read(SIZE_HEADER.size)
+            size = (
+                SIZE_HEADER.unpack(header)[0] if len(header) == SIZE_HEADER.size else 0
+            )
+            with open(data_abspaths[i], "wb") as out_fd:
+                while size > 0:
+                    data = in_fd.read(min(block_size, size))
+                    if not data:
+                        break
+                    out_fd.write(data)
+                    size -= len(data)
+        os.remove(tmp_abspath)
+    return list(missing)
@@ -0,0 +1,127 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Compress the standard input to the standard output with several threads, like `pigz`.
+
+The input is cut into blocks, compressed as independent gzip members by a pool of threads (zlib releases the GIL), and
+written in order: the output is a multi-member gzip stream, read as a single stream by `gzip`, `tar xz` and
+`tarfile` (so by the receiver).
+
+Used by :class:`hairgap.sender.DirectorySender` as a pipeline stage when `config.compression_threads` is set:
+
+.. code-block:: bash
+
+    tar cf - index.txt data | python hairgap/pgzip.py --threads 4 | hairgaps …
+
+This module only depends on the standard library, so it can be run by its path.
+"""
+
+import argparse
+import collections
+import os
+import sys
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Deque, List, Optional, Tuple
+
+BLOCK_SIZE = 1 << 20
+COMPRESSION_LEVEL = 6
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def compress_block(data: bytes, level: int = COMPRESSION_LEVEL) -> bytes:
+    """return a complete gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(
+    in_fd: BinaryIO,
+    out_fd: BinaryIO,
+    threads: int = 4,
+    block_size: int = BLOCK_SIZE,
+    level: int = COMPRESSION_LEVEL,
+) -> Tuple[int, int]:
+    """compress `in_fd` to `out_fd` and return the input and output sizes
+
+    at most `2 * threads` blocks are kept in memory
+    """
+    in_size, out_size = 0, 0
+    pending = collections.deque()  # type: Deque[Future]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for data in iter(lambda: in_fd.read(block_size), b""):
+            in_size += len(data)
+            pending.append(executor.submit(compress_block, data, level))
+            if len(pending) >= 2 * threads:
+                out_size += write_block(out_fd, pending.popleft())
+        if in_size == 0:
+            # an empty input is still a valid gzip stream
+            pending.append(executor.submit(compress_block, b"", level))
+        while pending:
+            out_size += write_block(out_fd, pending.popleft())
+    out_fd.flush()
+    return in_size, out_size
+
+
+def write_block(out_fd: BinaryIO, future: Future) -> int:
+    data = future.result()
+    out_fd.write(data)
+    return len(data)
+
+
+def get_command(
+    threads: int, block_size: Optional[int] = None, level: Optional[int] = None
+) -> List[str]:
+    """return the command that runs this module (with the current Python interpreter)"""
+    cmd = [sys.executable, os.path.abspath(__file__), "--threads", str(threads)]
+    if block_size:
+        cmd += ["--block-size", str(block_size)]
+    if level is not None:
+        cmd += ["--level", str(level)]
+    return cmd
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="compress stdin to stdout with several threads (multi-member gzip)"
+    )
+    parser.add_argument(
+        "--threads", "-p", type=int, default=os.cpu_count() or 1, help="[CPU count]"
+    )
+    parser.add_argument(
+        "--block-size", "-b", type=int, default=BLOCK_SIZE, help="[%s]" % BLOCK_SIZE
+    )
+    parser.add_argument(
+        "--level",
+        "-l",
+        type=int,
+        default=COMPRESSION_LEVEL,
+        help="[%s]" % COMPRESSION_LEVEL,
+    )
+    args = parser.parse_args(argv)
+    try:
+        compress_stream(
+            sys.stdin.buffer,
+            sys.stdout.buffer,
+            threads=max(args.threads, 1),
+            block_size=args.block_size,
+            level=args.level,
+        )
+    except BrokenPipeError:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Run commands connected by pipes (like `tar czf - . | hairgaps …`), without any shell.
+
+Each command is a direct child process. Data is moved between two successive commands by a thread (with `os.splice`
+when available, so data is not copied to Python buffers) that counts the transferred bytes and the time spent waiting
+for each side:
+
+  * `read_wait_s`: the downstream command waits for data, so the upstream command is slow,
+  * `write_wait_s`: the upstream command waits for the downstream command to consume data.
+
+When a command fails, all other commands are killed, so the pipeline never hangs.
+
+.. code-block:: python
+
+    result = Pipeline([("tar", ["tar", "czf", "-", "."]), ("split", ["split", "-b", "1000", "-"])]).run()
+    if not result.success:
+        logger.error(result.get_report())
+
+"""
+
+import logging
+import os
+import select
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+from typing import IO, Callable, List, Optional, Tuple, Union
+
+from hairgap.tracing import NOOP_TRACER, Tracer
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1 << 16
+POLL_INTERVAL_S = 0.05
+KILL_DELAY_S = 2.0
+
+
+class Stage:
+    """a command of the pipeline"""
+
+    def __init__(self, name: str, cmd: List[str]):
+        self.name = name
+        self.cmd = cmd
+        self.process = None  # type: Optional[subprocess.Popen]
+        self.stderr_fd = None  # type: Optional[IO[bytes]]
+        self.stderr = ""
+        self.returncode = None  # type: Optional[int]
+        self.killed = False
+        # killed by the supervisor, because another stage failed
+        self.start_time = 0.0
+        self.end_time = None  # type: Optional[float]
+
+    @property
+    def duration_s(self) -> float:
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    @property
+    def command_line(self) -> str:
+        return " ".join(shlex.quote(x) for x in self.cmd)
+
+    def __repr__(self):
+        return "<Stage %s (returncode=%s)>" % (self.name, self.returncode)
+
+
+class Pipe:
+    """copy data between two stages"""
+
+    def __init__(
+        self,
+        upstream: Stage,
+        downstream: Stage,
+        progress: Optional[Callable[[int], None]] = None,
+    ):
+        self.upstream = upstream
+        self.downstream = downstream
+        self.progress = progress
+        # called with the size of each block of copied data
+        self.size = 0
+        self.read_wait_s = 0.0
+        self.write_wait_s = 0.0
+        self.broken = False
+        # the downstream stage has stopped reading
+        self.thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def name(self) -> str:
+        return "%s|%s" % (self.upstream.name, self.downstream.name)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.pump, name=self.name, daemon=True)
+        self.thread.start()
+
+    def pump(self):
+        src = self.upstream.process.stdout
+        dst = self.downstream.process.stdin
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        try:
+            if hasattr(os, "splice"):
+                self.pump_splice(src_fd, dst_fd)
+            else:
+                self.pump_buffered(src_fd, dst_fd)
+        except (BrokenPipeError, ValueError, OSError):
+            self.broken = True
+        finally:
+            for fd in (dst, src):
+                try:
+                    fd.close()
+                except OSError:
+                    pass
+
+    def add_size(self, size: int):
+        self.size += size
+        if self.progress is not None:
+            self.progress(size)
+
+    def pump_buffered(self, src_fd: int, dst_fd: int):
+        while True:
+            start = time.monotonic()
+            data = os.read(src_fd, BUFFER_SIZE)
+            middle = time.monotonic()
+            self.read_wait_s += middle - start
+            if not data:
+                break
+            view = memoryview(data)
+            while view:
+                view = view[os.write(dst_fd, view) :]
+            self.write_wait_s += time.monotonic() - middle
+            self.add_size(len(data))
+
+    def pump_splice(self, src_fd: int, dst_fd: int):
+        """move data from pipe to pipe in the kernel; non-blocking splices allow to measure both waits"""
+        readable = select.poll()
+        readable.register(src_fd, select.POLLIN)
+        writable = select.poll()
+        writable.register(dst_fd, select.POLLOUT)
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        while True:
+            start = time.monotonic()
+            readable.poll()
+            self.read_wait_s += time.monotonic() - start
+            try:
+                size = os.splice(src_fd, dst_fd, BUFFER_SIZE, flags=flags)
+            except BlockingIOError:
+                # the downstream pipe is full
+                start = time.monotonic()
+                writable.poll()
+                self.write_wait_s += time.monotonic() - start
+                continue
+            if not size:
+                break
+            self.add_size(size)
+
+    def __repr__(self):
+        return "<Pipe %s (%s bytes)>" % (self.name, self.size)
+
+
+class PipelineResult:
+    def __init__(self, stages: List[Stage], pipes: List[Pipe], timed_out: bool):
+        self.stages = stages
+        self.pipes = pipes
+        self.timed_out = timed_out
+
+    @property
+    def success(self) -> bool:
+        return not self.timed_out and all(x.returncode == 0 for x in self.stages)
+
+    @property
+    def failed_stage(self) -> Optional[Stage]:
+        """the first stage that has failed by itself (not killed by the supervisor)"""
+        failed = [x for x in self.stages if x.returncode and not x.killed]
+        if not failed:
+            return None
+        return min(failed, key=lambda x: x.end_time or 0.0)
+
+    @property
+    def command_line(self) -> str:
+        return " | ".join(x.command_line for x in self.stages)
+
+    def get_bottleneck(self) -> Optional[Stage]:
+        """return the stage that made the other ones wait the most"""
+        waits = {x.name: 0.0 for x in self.stages}
+        for pipe in self.pipes:
+            waits[pipe.upstream.name] += pipe.read_wait_s
+            waits[pipe.downstream.name] += pipe.write_wait_s
+        if not self.pipes:
+            return None
+        name = max(waits, key=lambda x: waits[x])
+        return next(x for x in self.stages if x.name == name)
+
+    def get_report(self) -> str:
+        """human-readable report of each stage and pipe"""
+        lines = []
+        for stage in self.stages:
+            lines.append(
+                "%s: returncode=%s%s, %.3fs [%s]"
+                % (
+                    stage.name,
+                    stage.returncode,
+                    " (killed)" if stage.killed else "",
+                    stage.duration_s,
+                    stage.command_line,
+                )
+            )
+            if stage.stderr:
+                lines.append("%s stderr: %s" % (stage.name, stage.stderr.strip()))
+        for pipe in self.pipes:
+            lines.append(
+                "%s: %s bytes, waiting for %s: %.3fs, waiting for %s: %.3fs"
+                % (
+                    pipe.name,
+                    pipe.size,
+                    pipe.upstream.name,
+                    pipe.read_wait_s,
+                    pipe.downstream.name,
+                    pipe.write_wait_s,
+                )
+            )
+        if self.timed_out:
+            lines.append("timeout exceeded")
+        return "\n".join(lines)
+
+
+class Pipeline:
+    """run named commands connected by pipes
+
+    :param stages: list of (name, command); names must be unique
+    :param stdin: input of the first command (`None` for an empty input)
+    :param stdout: output of the last command (`None` to ignore it)
+    :param cwd: working directory of all commands
+    :param timeout_s: kill all commands after this delay
+    :param tracer: a span is recorded for the whole pipeline
+    :param progress: called with the size of each block of data copied to the last command
+    :param progress_stage: name of the command whose input is counted by `progress` instead of the last one (not
+        the first one, that reads `stdin`)
+    """
+
+    def __init__(
+        self,
+        stages: List[Tuple[str, List[str]]],
+        stdin: Union[None, int, IO] = None,
+        stdout: Union[None, int, IO] = None,
+        cwd: Optional[str] = None,
+        timeout_s: Optional[float] = None,
+        tracer: Tracer = NOOP_TRACER,
+        progress: Optional[Callable[[int], None]] = None,
+        progress_stage: Optional[str] = None,
+    ):
+        if not stages:
+            raise ValueError("a pipeline requires at least one command")
+        self.stages = [Stage(name, [str(x) for x in cmd]) for (name, cmd) in stages]
+        self.stdin = subprocess.DEVNULL if stdin is None else stdin
+        self.stdout = subprocess.DEVNULL if stdout is None else stdout
+        self.cwd = cwd
+        self.timeout_s = timeout_s
+        self.tracer = tracer
+        self.progress = progress
+        self.progress_stage = progress_stage or self.stages[-1].name
+
+    def run(self) -> PipelineResult:
+        with self.tracer.span(
+            "pipeline", stages="|".join(x.name for x in self.stages)
+        ) as span:
+            result = self.run_stages()
+            for stage in result.stages:
+                span.set_attribute("%s.returncode" % stage.name, stage.returncode)
+            for pipe in result.pipes:
+                span.set_attribute("%s.bytes" % pipe.name, pipe.size)
+                span.set_attribute("%s.read_wait_s" % pipe.name, pipe.read_wait_s)
+                span.set_attribute("%s.write_wait_s" % pipe.name, pipe.write_wait_s)
+        if result.success:
+            logger.debug("pipeline succeeded:\n%s", result.get_report())
+        return result
+
+    def run_stages(self) -> PipelineResult:
+        pipes = []  # type: List[Pipe]
+        last_index = len(self.stages) - 1
+        start = time.monotonic()
+        timed_out = False
+        for index, stage in enumerate(self.stages):
+            stage.stderr_fd = tempfile.TemporaryFile()
+            stage.start_time = time.monotonic()
+            try:
+                stage.process = subprocess.Popen(
+                    stage.cmd,
+                    stdin=self.stdin if index == 0 else subprocess.PIPE,
+                    stdout=self.stdout if index == last_index else subprocess.PIPE,
+                    stderr=stage.stderr_fd,
+                    cwd=self.cwd,
+                )
+            except OSError as e:
+                logger.error("unable to launch %s: %s", stage.name, e)
+                stage.returncode = 127
+                stage.end_time = time.monotonic()
+                stage.stderr_fd.write(str(e).encode())
+                self.kill_all()
+                break
+            if index > 0:
+                pipe = Pipe(
+                    self.stages[index - 1],
+                    stage,
+                    progress=(
+                        self.progress if stage.name == self.progress_stage else None
+                    ),
+                )
+                pipes.append(pipe)
+                pipe.start()
+        else:
+            timed_out = self.supervise(start)
+        for stage in self.stages:
+            if stage.process is not None and stage.returncode is None:
+                # killed after a launch error
+                stage.returncode = stage.process.wait()
+                stage.end_time = time.monotonic()
+        self.wait_pipes(pipes)
+        for stage in self.stages:
+            if stage.stderr_fd is None:
+                continue
+            stage.stderr_fd.seek(0)
+            stage.stderr = stage.stderr_fd.read().decode(errors="replace")
+            stage.stderr_fd.close()
+        return PipelineResult(self.stages, pipes, timed_out)
+
+    def supervise(self, start: float) -> bool:
+        """wait for all stages; kill them as soon as one of them fails. Return `True` on timeout"""
+        running = [x for x in self.stages if x.process is not None]
+        while running:
+            for stage in list(running):
+                returncode = stage.process.poll()
+                if returncode is None:
+                    continue
+                stage.returncode = returncode
+                stage.end_time = time.monotonic()
+                running.remove(stage)
+                if returncode != 0 and not stage.killed:
+                    logger.warning(
+                        "%s has failed (returncode=%s): stopping the pipeline.",
+                        stage.name,
+                        returncode,
+                    )
+                    self.kill_all()
+            if self.timeout_s and time.monotonic() - start > self.timeout_s and running:
+                logger.error("pipeline timeout exceeded: stopping the pipeline.")
+                self.kill_all()
+                for stage in running:
+                    stage.returncode = stage.process.wait()
+                    stage.end_time = time.monotonic()
+                return True
+            if running:
+                time.sleep(POLL_INTERVAL_S)
+        return False
+
+    def kill_all(self):
+        """terminate all running stages (then kill them if they are still running)"""
+        running = [
+            x for x in self.stages if x.process is not None and x.process.poll() is None
+        ]
+        for stage in running:
+            stage.killed = True
+            stage.process.terminate()
+        deadline = time.monotonic() + KILL_DELAY_S
+        for stage in running:
+            try:
+                stage.process.wait(max(deadline - time.monotonic(), 0.0))
+            except subprocess.TimeoutExpired:
+                stage.process.kill()
+
+    @staticmethod
+    def wait_pipes(pipes: List[Pipe]):
+        for pipe in pipes:
+            pipe.thread.join()
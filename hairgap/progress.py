@@ -0,0 +1,254 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Live progress of a :class:`hairgap.sender.DirectorySender`: bytes and files sent, current throughput, and the
+expected end of the transfer.
+
+Bytes are counted while they are written to the transport (to the standard input of `hairgaps` for the default
+transport), so the throughput is the actual throughput of the link. The estimated time of arrival includes the
+delay after each remaining file (`config.end_delay_s`), so it tells when the link will be free again.
+
+Tar archives are an exception: the size of the compressed archive is unknown while `hairgaps` sends it. Bytes are
+counted before their compression when it is a separate command (`config.compression_threads`), otherwise the total
+size (and the estimated time of arrival) is unknown. With other transports, the archive is written before being
+sent and its size is known.
+
+.. code-block:: python
+
+    sender = DirectorySender(config)
+    sender.progress.callback = lambda x: print(x.sent_bytes, x.total_bytes, x.rate_bps, x.eta_s)
+    sender.prepare_directory()
+    sender.send_directory()
+
+The same values can be followed from another thread:
+
+.. code-block:: python
+
+    for progress in sender.progress.updates(interval_s=5.0):
+        print(progress)
+
+"""
+
+import collections
+import threading
+import time
+from typing import Callable, Deque, Iterator, Optional, Tuple
+
+RATE_WINDOW_S = 10.0
+UNITS = ("B", "KiB", "MiB", "GiB", "TiB")
+
+
+class Progress:
+    """snapshot of a transfer"""
+
+    def __init__(
+        self,
+        total_files: int = 0,
+        total_bytes: int = 0,
+        sent_files: int = 0,
+        sent_bytes: int = 0,
+        elapsed_s: float = 0.0,
+        rate_bps: Optional[float] = None,
+        eta_s: Optional[float] = None,
+        finished: bool = False,
+    ):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        # 0 if unknown
+        self.sent_files = sent_files
+        self.sent_bytes = sent_bytes
+        self.elapsed_s = elapsed_s
+        self.rate_bps = rate_bps
+        # throughput over the last `RATE_WINDOW_S` seconds
+        self.eta_s = eta_s
+        # remaining time (`None` if unknown)
+        self.finished = finished
+
+    @property
+    def ratio(self) -> Optional[float]:
+        if not self.total_bytes:
+            return None
+        return min(self.sent_bytes / self.total_bytes, 1.0)
+
+    def __repr__(self):
+        return "<Progress %s/%s files, %s/%s bytes, eta=%s>" % (
+            self.sent_files,
+            self.total_files,
+            self.sent_bytes,
+            self.total_bytes,
+            self.eta_s,
+        )
+
+
+class ProgressTracker:
+    """count the sent bytes and files (from any thread), and report the progress
+
+    :param callback: called with a :class:`Progress`, at most every `interval_s` seconds while data is sent, after
+        each file, and at the end of the transfer
+    :param interval_s: minimum delay between two calls of `callback`
+    """
+
+    def __init__(
+        self,
+        callback: Optional[Callable[[Progress], None]] = None,
+        interval_s: float = 1.0,
+    ):
+        self.callback = callback
+        self.interval_s = interval_s
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.total_files = 0
+        self.total_bytes = 0
+        self.end_delay_s = 0.0
+        self.sent_files = 0
+        self.sent_bytes = 0
+        self.start_time = None  # type: Optional[float]
+        self.end_time = None  # type: Optional[float]
+        self.samples = collections.deque()  # type: Deque[Tuple[float, int]]
+        self.last_report = 0.0
+
+    def start(self, total_files: int, total_bytes: int, end_delay_s: float = 0.0):
+        """reset all counters
+
+        :param total_files: number of files to send (0 if unknown)
+        :param total_bytes: number of bytes to send (0 if unknown)
+        :param end_delay_s: delay after each file
+        """
+        with self.lock:
+            self.total_files = total_files
+            self.total_bytes = total_bytes
+            self.end_delay_s = end_delay_s or 0.0
+            self.sent_files = 0
+            self.sent_bytes = 0
+            self.start_time = time.monotonic()
+            self.end_time = None
+            self.samples = collections.deque([(self.start_time, 0)])
+            self.last_report = self.start_time
+        self.report()
+
+    def set_total_bytes(self, total_bytes: int):
+        """update the number of bytes to send, when it is only known after the start"""
+        with self.lock:
+            self.total_bytes = total_bytes
+        self.report()
+
+    def add_bytes(self, size: int):
+        """count sent bytes (negative when data must be sent again)"""
+        now = time.monotonic()
+        with self.lock:
+            self.sent_bytes += size
+            self.samples.append((now, self.sent_bytes))
+            while len(self.samples) > 2 and now - self.samples[1][0] > RATE_WINDOW_S:
+                self.samples.popleft()
+            if now - self.last_report < self.interval_s:
+                return
+            self.last_report = now
+        self.report()
+
+    def add_file(self):
+        """count a sent file (after its end delay)"""
+        with self.lock:
+            self.sent_files += 1
+            self.last_report = time.monotonic()
+        self.report()
+
+    def finish(self):
+        """mark the transfer as finished (successfully or not)"""
+        with self.lock:
+            self.end_time = time.monotonic()
+            self.sent_files = max(self.sent_files, self.total_files)
+        self.report()
+
+    def get_progress(self) -> Progress:
+        with self.lock:
+            return self.get_progress_unlocked()
+
+    def get_progress_unlocked(self) -> Progress:
+        if self.start_time is None:
+            return Progress()
+        finished = self.end_time is not None
+        now = self.end_time if finished else time.monotonic()
+        first_time, first_bytes = self.samples[0]
+        rate_bps = None
+        if now > first_time and self.sent_bytes > first_bytes:
+            rate_bps = (self.sent_bytes - first_bytes) / (now - first_time)
+        eta_s = None
+        if finished:
+            eta_s = 0.0
+        elif self.total_bytes and rate_bps:
+            remaining_bytes = max(self.total_bytes - self.sent_bytes, 0)
+            remaining_files = max(self.total_files - self.sent_files, 0)
+            eta_s = remaining_bytes / rate_bps + remaining_files * self.end_delay_s
+        return Progress(
+            total_files=self.total_files,
+            total_bytes=self.total_bytes,
+            sent_files=self.sent_files,
+            sent_bytes=self.sent_bytes,
+            elapsed_s=now - self.start_time,
+            rate_bps=rate_bps,
+            eta_s=eta_s,
+            finished=finished,
+        )
+
+    def report(self):
+        with self.condition:
+            progress = self.get_progress_unlocked()
+            self.condition.notify_all()
+        if self.callback is not None:
+            self.callback(progress)
+
+    def updates(self, interval_s: float = 1.0) -> Iterator[Progress]:
+        """yield the progress every `interval_s` seconds (or on each new file), until the end of the transfer"""
+        while True:
+            with self.condition:
+                self.condition.wait(interval_s)
+                progress = self.get_progress_unlocked()
+            yield progress
+            if progress.finished:
+                return
+
+
+def format_size(size: float) -> str:
+    for unit in UNITS[:-1]:
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f %s" % (size, UNITS[-1])
+
+
+def format_duration(duration_s: Optional[float]) -> str:
+    if duration_s is None:
+        return "--:--:--"
+    duration_s = int(duration_s)
+    return "%02d:%02d:%02d" % (
+        duration_s // 3600,
+        (duration_s // 60) % 60,
+        duration_s % 60,
+    )
+
+
+def format_progress(progress: Progress) -> str:
+    """single-line, human-readable, progress"""
+    ratio = progress.ratio
+    return "%5s %s/%s, %s/%s files, %s/s, elapsed %s, eta %s" % (
+        "--%" if ratio is None else "%d%%" % (ratio * 100),
+        format_size(progress.sent_bytes),
+        format_size(progress.total_bytes) if progress.total_bytes else "?",
+        progress.sent_files,
+        progress.total_files or "?",
+        format_size(progress.rate_bps or 0.0),
+        format_duration(progress.elapsed_s),
+        format_duration(progress.eta_s),
+    )
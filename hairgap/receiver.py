@@ -9,16 +9,18 @@ The algorithm is simple:
         process_file()
 
 
-`receive_file` launches the command hairgapr that waits for a transfer and exists when a file is received.
+`receive_file` launches the command hairgapr that waits for a transfer and exists when a file is received
+(or uses another transport, see :mod:`hairgap.transport`).
 `process_file` read the first bytes of the file
 
 - if they match HAIRGAP_MAGIC_NUMBER_INDEX, then this is an index file, with:
     - the transfer identifier
     - the previous transfer identifier
-    - the list of following files and their sha256 (in the transfer order)
+    - the list of following files and their digest (in the transfer order, sha256 unless another algorithm is declared)
 - otherwise, this is the next expected file, as read by the index file
 
 Empty files cannot be sent by hairgap, so they are replaced by the HAIRGAP_MAGIC_NUMBER_EMPTY constant.
+Files compressed by the sender (announced by the index) start with the HAIRGAP_MAGIC_NUMBER_GZIP constant.
 If a new index file is read before the last expected file of the previous index, then we start a new index:
 we assume that the sender has been interrupted and has restarted the whole process.
 
@@ -46,31 +48,94 @@ but can also be run in separate threads for handling large files.
 # ##############################################################################
 
 import datetime
-import hashlib
 import io
 import logging
 import os
 import re
-import shlex
 import shutil
-import subprocess
 import tarfile
 import tempfile
 import time
 import uuid
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from queue import Empty, Queue
 from threading import Thread
-from typing import Dict, Optional, Set, List
+from typing import Dict, List, Optional, Set, Tuple
 
+from hairgap.chunks import (
+    format_ranges,
+    get_chunk_count,
+    get_chunk_relpath,
+    parse_chunk,
+)
+from hairgap.compact import CompactEntries, CompactIndex, is_compact_index
+from hairgap.compression import ENCODING_GZIP, ENCODING_PATTERN, decompress_file
 from hairgap.constants import (
+    HAIRGAP_MAGIC_NUMBER_COMPACT,
     HAIRGAP_MAGIC_NUMBER_EMPTY,
     HAIRGAP_MAGIC_NUMBER_ESCAPE,
+    HAIRGAP_MAGIC_NUMBER_GZIP,
     HAIRGAP_MAGIC_NUMBER_INDEX,
+    HAIRGAP_MAGIC_NUMBER_MESSAGE,
+    HAIRGAP_MAGIC_NUMBER_SEGMENT,
+)
+from hairgap.digests import (
+    DEFAULT_DIGEST,
+    DIGEST_PATTERN,
+    get_available_digests,
+    get_file_digest,
+    new_digest,
+)
+from hairgap.durability import (
+    DURABILITY_FILE,
+    DURABILITY_TRANSFER,
+    sync_directory,
+    sync_file,
+    sync_tree,
+)
+from hairgap.history import (
+    SIDE_RECEIVER,
+    STATUS_COMPLETE,
+    STATUS_FAILED,
+    STATUS_INTERRUPTED,
+    TransferRecord,
+    add_record,
 )
-from hairgap.utils import FILENAME_PATTERN, Config, ensure_dir, now
+from hairgap.metrics import MetricsServer, ReceiverMetrics
+from hairgap.parity import PARITY_DIRNAME, rebuild_data_files
+from hairgap.pipeline import Pipeline
+from hairgap.replay import StreamRecorder
+from hairgap.segments import END_PATTERN, SEGMENT_PATTERN
+from hairgap.tracing import NOOP_SPAN, Span
+from hairgap.utils import FILENAME_PATTERN, SIZE_PATTERN, Config, ensure_dir, now
+from hairgap.zerocopy import copy_fd, copy_to_offset
 
 logger = logging.getLogger(__name__)
 
+PARITY_PATTERN = r"^\[parity (\d+) (\d+)\]$"
+
+
+class RecentDigests:
+    """bounded set of binary digests: the oldest ones are forgotten first"""
+
+    def __init__(self, max_size: int = 65536):
+        self.max_size = max_size
+        self.digests = OrderedDict()  # type: OrderedDict[bytes, None]
+
+    def add(self, digest: bytes):
+        self.digests[digest] = None
+        self.digests.move_to_end(digest)
+        while len(self.digests) > self.max_size:
+            self.digests.popitem(last=False)
+
+    def __contains__(self, digest: bytes) -> bool:
+        return digest in self.digests
+
+    def __len__(self):
+        return len(self.digests)
+
 
 class Receiver:
     """
@@ -106,8 +171,11 @@ class Receiver:
         self.process_queue = Queue()
         self.process_thread = None
         self.receive_thread = None
+        self.express_thread = None
         self.continue_loop = True  # type: bool
         self.hairgap_subprocess = None
+        self.express_subprocess = None
+        # pending receptions, with a `terminate()` method (`subprocess.Popen` with the hairgap transport)
 
         self.expected_files = Queue()
         self.transfer_start_time = None  # type: Optional[datetime.datetime]
@@ -126,71 +194,202 @@ class Receiver:
         # attributes of the last index
         self.current_split_status = False
         # is the last transfer split into chunks?
+        self.current_split_archives = False
+        # are the chunks of the last transfer self-contained archives?
+        self.current_compression = False
+        # does the last transfer contain compressed files?
+        self.current_digest = DEFAULT_DIGEST
+        # digest algorithm of the files of the last transfer (see :mod:`hairgap.digests`)
+        self.current_index_digest = None  # type: Optional[str]
+        # sha256 of the last index
+        self.carousel_index_digest = None  # type: Optional[str]
+        # sha256 of the index of the current carousel transfer (files are repeated)
+        self.carousel_pending = {}  # type: Dict[str, List[str]]
+        # files of the current carousel transfer that are not received yet: {digest: [relative paths]}
+        self.carousel_sizes = {}  # type: Dict[str, Optional[int]]
+        # size of each pending content of the current carousel transfer (None if not given by the index)
+        self.carousel_pending_sizes = Counter()  # type: Counter
+        # number of pending contents of the current carousel transfer, per size
+        self.carousel_complete = False
+        # all files of the current carousel transfer are received
+        self.recent_digests = RecentDigests()
+        # digests of the last received files (in carousel mode), to tell repeated files from unexpected ones
+        self.current_parity = None  # type: Optional[Tuple[int, int]]
+        # (group size, parity count) if parity files are added to the last transfer
+        self.current_files = []  # type: List[Tuple[str, str]]
+        # (digest, relative path) of all files of the last transfer (only when parity files are used)
+        self.current_failed_files = set()  # type: Set[str]
+        # relative paths of the files that have not been correctly received
+        # (only when parity files or self-contained chunks are used)
+        self.current_chunks = {}  # type: Dict[str, Tuple[str, int, int, int]]
+        # chunks of large files of the last transfer:
+        # {chunk relative path: (file relative path, chunk index, chunk size, file size)}
+        self.current_chunked_files = {}  # type: Dict[str, Tuple[int, Set[int], str]]
+        # {file relative path: (number of chunks, indices of the correctly received chunks, digest of the file)}
+        self.current_segmented = False
+        # is the index of the last transfer sent as segments? (see :mod:`hairgap.segments`)
+        self.current_segments_ended = False
+        # has the last segment been received?
+        self.current_segments = set()  # type: Set[int]
+        # indices of the received segments of the last transfer (its trailer included)
+        self.current_segment_files = 0  # type: int
+        # number of files listed by the received segments of the last transfer
+        self.current_segments_announced = None  # type: Optional[Tuple[int, int]]
+        # (number of segments, number of files) announced by the trailer of the last transfer
+        self.transfer_in_progress = False
+        # an index has been read, but not all of its files
+        self.transfer_span = NOOP_SPAN  # type: Span
+        # span of the current transfer, from the index read to the last file
+        self.transfer_durations = {}  # type: Dict[str, float]
+        # total duration of each stage of the current transfer
+        self.metrics = ReceiverMetrics()
+        # cumulative metrics, never reset
+        self.metrics.process_queue_depth.set_function(self.process_queue.qsize)
+        self.metrics.expected_files.set_function(
+            lambda: self.expected_files.qsize() + len(self.carousel_pending)
+        )
+        self.metrics_server = None  # type: Optional[MetricsServer]
+        self.recorder = None  # type: Optional[StreamRecorder]
+        # copy received streams, to replay them later
+        if config.record_path:
+            self.recorder = StreamRecorder(config.record_path)
 
-    def receive_file(self, tmp_path) -> Optional[bool]:
+    def receive_file(self, tmp_path, port: Optional[int] = None) -> Optional[bool]:
         """receive a single file and returns
         True if hairgap did not raise an error
         False if hairgap did raise an error but Ctrl-C
         None if hairgap was terminated by Ctrl-C
+
+        :param tmp_path: where the received file is written
+        :param port: the express port, when the file is not received on the main port
         """
         logger.info("receiving '%s' via hairgap…", tmp_path)
+        start = time.time()
         ensure_dir(tmp_path, parent=True)
-        with open(tmp_path, "wb") as fd:
-            cmd = [
-                str(self.config.hairgapr_path),
-                "-p",
-                str(self.port or self.config.destination_port),
-            ]
-            if self.config.timeout_s:
-                cmd += ["-t", str(self.config.timeout_s)]
-            if self.config.mem_limit_mb:
-                cmd += ["-m", str(self.config.mem_limit_mb)]
-            cmd.append(self.config.destination_ip)
-            self.hairgap_subprocess = subprocess.Popen(
-                cmd, stdout=fd, stderr=subprocess.PIPE
+        with open(tmp_path, "wb") as fd, self.config.tracer.span(
+            "receive_file", root=True, path=tmp_path
+        ) as span:
+
+            def register(handle):
+                if port is None:
+                    self.hairgap_subprocess = handle
+                else:
+                    self.express_subprocess = handle
+
+            returncode, stderr = self.config.transport.receive(
+                self.config,
+                fd,
+                port or self.port or self.config.destination_port,
+                register=register,
             )
-            logger.debug("hairgapr command: '%s'.", " ".join(cmd))
-            __, stderr = self.hairgap_subprocess.communicate()
             fd.flush()
-        returncode = self.hairgap_subprocess.returncode
-        if returncode == 0:
-            self.hairgap_subprocess = None
-            logger.info("'%s' received via hairgap.", tmp_path)
-            return True
+            span.set_attribute("bytes", fd.tell())
+            span.set_attribute("returncode", returncode)
+            self.metrics.link_bytes.inc(fd.tell())
         if returncode == -2:
             logger.info("exiting hairgap…")
             return None
+        if port is None:
+            self.hairgap_subprocess = None
         else:
-            logger.warning(
-                "an error %d was encountered by hairgap: \n%s",
-                returncode,
-                stderr.decode(),
-            )
-        self.hairgap_subprocess = None
+            self.express_subprocess = None
+        if returncode == 0:
+            logger.info("'%s' received via hairgap.", tmp_path)
+            self.metrics.receive_seconds.observe(time.time() - start)
+            if port is None:
+                self.add_transfer_duration("receive", time.time() - start)
+            return True
+        self.metrics.receive_failures.inc()
+        logger.warning(
+            "an error %d was encountered by hairgap: \n%s",
+            returncode,
+            stderr,
+        )
         return False
 
     def receive_loop(self):
         logger.info("entering receiving loop…")
         while self.continue_loop:
             tmp_abspath = self.get_reception_filepath()
+            start = time.time()
             try:
                 r = self.receive_file(tmp_abspath)
             except Exception as e:
                 logger.exception(e)
                 time.sleep(1)
                 continue
+            end = time.time()
             if r is None:  # Ctrl-C
                 if os.path.isfile(tmp_abspath):
                     os.remove(tmp_abspath)
                 continue
-            elif not r:
+            if not r:
                 time.sleep(1)
             if self.threading:
-                self.process_queue.put((bool(r), tmp_abspath))
+                self.process_queue.put((bool(r), tmp_abspath, start, end))
             else:
+                self.record_received_file(tmp_abspath, bool(r), start, end)
                 self.process_received_file(tmp_abspath)
         logger.info("receiving loop exited.")
 
+    def express_loop(self):
+        """receive small messages on the express port, independently of the bulk transfers"""
+        logger.info("entering express loop…")
+        while self.continue_loop:
+            tmp_abspath = self.get_reception_filepath()
+            try:
+                r = self.receive_file(tmp_abspath, port=self.config.express_port)
+                if r:
+                    self.process_express_file(tmp_abspath)
+                elif r is False:
+                    time.sleep(1)
+            except Exception as e:
+                logger.exception(e)
+                time.sleep(1)
+            if os.path.isfile(tmp_abspath):
+                os.remove(tmp_abspath)
+        logger.info("express loop exited.")
+
+    def process_express_file(self, tmp_abspath: str):
+        message = self.read_message(tmp_abspath)
+        if message is None:
+            self.transfer_file_unexpected(tmp_abspath)
+            return
+        data, attributes = message
+        self.message_received(data, attributes)
+
+    @staticmethod
+    def read_message(
+        tmp_abspath: str,
+    ) -> Optional[Tuple[bytes, Dict[str, str]]]:
+        """read a message sent by :meth:`DirectorySender.send_message`
+
+        :return: the content of the message and its attributes, `None` if this is not a message
+        """
+        prefix = HAIRGAP_MAGIC_NUMBER_MESSAGE.encode()
+        attributes = {}
+        with open(tmp_abspath, "rb") as fd:
+            if fd.read(len(prefix)) != prefix:
+                return None
+            for line in iter(fd.readline, b""):
+                if line == b"\n":
+                    break
+                key, sep, value = line.decode().rstrip("\n").partition(" = ")
+                if sep:
+                    attributes[key] = value
+            data = fd.read()
+        return data, attributes
+
+    def message_received(self, data: bytes, attributes: Dict[str, str]):
+        """called when a message is received on the express port.
+
+        this method is called by the express loop: bulk transfers are still received meanwhile.
+
+        :param data: content of the message
+        :param attributes: attributes of the message
+        """
+        logger.info("message received (%s bytes).", len(data))
+
     def get_reception_filepath(self):
         return os.path.join(
             self.config.destination_path, "receiving", str(uuid.uuid4())
@@ -200,7 +399,8 @@ class Receiver:
         logger.info("entering processing loop…")
         while self.continue_loop:
             try:
-                valid, tmp_abspath = self.process_queue.get(timeout=1)
+                valid, tmp_abspath, start, end = self.process_queue.get(timeout=1)
+                self.record_received_file(tmp_abspath, valid, start, end)
                 self.process_received_file(tmp_abspath, valid=valid)
             except Empty:
                 # the timeout is required to quit the thread when self.continue_loop is False
@@ -210,6 +410,16 @@ class Receiver:
                 time.sleep(1)
         logger.info("processing loop exited.")
 
+    def record_received_file(
+        self, tmp_abspath: str, valid: bool, start: float, end: float
+    ):
+        """copy a received stream before its processing (if `config.record_path` is set)
+
+        called by the processing thread, so the copy never delays the next reception when `threading` is True
+        """
+        if self.recorder is not None:
+            self.recorder.record(tmp_abspath, valid, start, end)
+
     @staticmethod
     def is_gz_file(tmp_abspath: str):
         if not os.path.isfile(tmp_abspath):
@@ -228,21 +438,33 @@ class Receiver:
         :param valid: the file has been correctly received by hairgap
         :return:
         """
-        if self.config.use_tar_archives or (
-            self.config.use_tar_archives is None  # auto-detect mode
-            and self.expected_files.empty()
-            and self.is_gz_file(tmp_abspath)
+        start = time.time()
+        size = 0
+        if os.path.isfile(tmp_abspath):
+            size = os.path.getsize(tmp_abspath)
+            # the file has been written by hairgapr until the end of its reception
+            self.metrics.processing_lag.set(start - os.path.getmtime(tmp_abspath))
+        with self.config.tracer.span(
+            "process_file", parent=self.transfer_span, path=tmp_abspath, bytes=size
         ):
-            try:
-                self.process_received_file_tar(tmp_abspath, valid=valid)
-            except Exception as e:
-                logger.exception(
-                    "invalid tar.gz  '%s' file (removed): %s.", tmp_abspath, e
-                )
-                if os.path.isfile(tmp_abspath):
-                    os.remove(tmp_abspath)
-        else:
-            self.process_received_file_no_tar(tmp_abspath, valid=valid)
+            if self.config.use_tar_archives or (
+                self.config.use_tar_archives is None  # auto-detect mode
+                and self.expected_files.empty()
+                and self.carousel_index_digest is None
+                and self.is_gz_file(tmp_abspath)
+            ):
+                try:
+                    self.process_received_file_tar(tmp_abspath, valid=valid)
+                except Exception as e:
+                    logger.exception(
+                        "invalid tar.gz  '%s' file (removed): %s.", tmp_abspath, e
+                    )
+                    if os.path.isfile(tmp_abspath):
+                        os.remove(tmp_abspath)
+            else:
+                self.process_received_file_no_tar(tmp_abspath, valid=valid)
+        self.metrics.process_seconds.observe(time.time() - start)
+        self.add_transfer_duration("process", time.time() - start)
 
     def process_received_file_tar(self, tmp_abspath: str, valid: bool = True):
         """
@@ -293,36 +515,63 @@ class Receiver:
                 count += 1
             if count == 0:
                 ensure_dir(self.get_current_transfer_directory(), parent=False)
-            self.transfer_complete()
+            self.complete_transfer()
         os.remove(tmp_abspath)
 
     def process_received_file_no_tar(self, tmp_abspath: str, valid: bool = True):
         empty_prefix = HAIRGAP_MAGIC_NUMBER_EMPTY.encode()
         index_prefix = HAIRGAP_MAGIC_NUMBER_INDEX.encode()
         escape_prefix = HAIRGAP_MAGIC_NUMBER_ESCAPE.encode()
+        gzip_prefix = HAIRGAP_MAGIC_NUMBER_GZIP.encode()
+        segment_prefix = HAIRGAP_MAGIC_NUMBER_SEGMENT.encode()
+        index_prefixes = {index_prefix, HAIRGAP_MAGIC_NUMBER_COMPACT.encode()}
         if os.path.isfile(tmp_abspath):
             with open(tmp_abspath, "rb") as fd:
                 prefix = fd.read(len(empty_prefix))
         else:
             prefix = b""
+        if prefix in index_prefixes and self.is_repeated_index(tmp_abspath):
+            os.remove(tmp_abspath)
+            return
+        elif prefix not in index_prefixes and self.carousel_complete:
+            # duplicate of an already received file: no need to compute its digest
+            if os.path.isfile(tmp_abspath):
+                os.remove(tmp_abspath)
+            return
         if prefix == escape_prefix:  # must be done before the sha256
             escaped_tmp_abspath = tmp_abspath + ".b"
             with open(escaped_tmp_abspath, "wb") as fd_out:
                 with open(tmp_abspath, "rb") as fd_in:
-                    fd_in.read(len(escape_prefix))
-                    for data in iter(lambda: fd_in.read(65536), b""):
-                        fd_out.write(data)
+                    copy_fd(fd_in.fileno(), fd_out.fileno(), offset=len(escape_prefix))
             os.rename(escaped_tmp_abspath, tmp_abspath)  # no need to use shutil.move
         if prefix == empty_prefix:
             open(tmp_abspath, "w").close()
-        if prefix == index_prefix:
+        if prefix == gzip_prefix and self.current_compression:
+            start = time.time()
+            with self.config.tracer.span("decompress"):
+                self.decompress_received_file(tmp_abspath)
+            self.add_transfer_duration("decompress", time.time() - start)
+        if prefix in index_prefixes:
             self.read_index(tmp_abspath)
             os.remove(tmp_abspath)
             self.transfer_start()
-            if self.expected_files.empty():
+            if (
+                self.expected_files.empty()
+                and not self.carousel_pending
+                and not self.current_segmented
+            ):
                 # empty transfer => we mark it as complete
                 ensure_dir(self.get_current_transfer_directory(), parent=False)
-                self.transfer_complete()
+                self.carousel_complete = self.carousel_index_digest is not None
+                self.complete_transfer()
+        elif prefix == segment_prefix:
+            self.read_segment(tmp_abspath)
+            os.remove(tmp_abspath)
+            if self.is_transfer_received():
+                ensure_dir(self.get_current_transfer_directory(), parent=False)
+                self.finish_transfer()
+        elif self.carousel_index_digest is not None:
+            self.process_carousel_file(tmp_abspath, valid=valid)
         elif self.expected_files.empty():
             if valid:
                 self.transfer_file_unexpected(tmp_abspath, prefix=prefix)
@@ -330,24 +579,273 @@ class Receiver:
                 os.remove(tmp_abspath)
         else:
             expected_sha256, file_relpath = self.expected_files.get()
-            actual_sha256_obj = hashlib.sha256()
-            if os.path.isfile(tmp_abspath):
-                with open(tmp_abspath, "rb") as in_fd:
-                    for data in iter(lambda: in_fd.read(65536), b""):
-                        actual_sha256_obj.update(data)
-            self.transfer_file_received(
+            start = time.time()
+            with self.config.tracer.span("hash", path=file_relpath):
+                actual_sha256 = self.get_file_digest(tmp_abspath, self.current_digest)
+            self.add_transfer_duration("hash", time.time() - start)
+            self.transfer_entry_received(
                 tmp_abspath,
                 file_relpath,
-                actual_sha256=actual_sha256_obj.hexdigest(),
+                actual_sha256=actual_sha256,
                 expected_sha256=expected_sha256,
             )
-            if self.expected_files.empty():
-                # all files of the transfer have been received
-                if self.current_split_status:
-                    self.unsplit_received_files(
-                        self.config, self.get_current_transfer_directory()
-                    )
-                self.transfer_complete()
+            if (
+                self.current_parity or self.current_split_archives
+            ) and actual_sha256 != expected_sha256.lower():
+                self.current_failed_files.add(file_relpath)
+            if self.is_transfer_received():
+                self.finish_transfer()
+
+    def is_transfer_received(self) -> bool:
+        """return True if all files of the current transfer have been received"""
+        if self.current_segmented and not self.current_segments_ended:
+            return False
+        return self.transfer_in_progress and self.expected_files.empty()
+
+    def finish_transfer(self):
+        """rebuild the lost files and unsplit the received ones if required, then complete the transfer"""
+        if self.current_parity:
+            start = time.time()
+            with self.config.tracer.span("repair"):
+                self.repair_received_files()
+            self.add_transfer_duration("repair", time.time() - start)
+        if self.current_split_status:
+            self.unsplit_current_transfer()
+        self.complete_transfer()
+
+    @staticmethod
+    def decompress_received_file(tmp_abspath: str):
+        """decompress in-place a file compressed by the sender; invalid files are kept as-is (so their sha256 is
+        invalid)"""
+        decoded_tmp_abspath = tmp_abspath + ".b"
+        try:
+            decompress_file(
+                tmp_abspath,
+                decoded_tmp_abspath,
+                offset=len(HAIRGAP_MAGIC_NUMBER_GZIP.encode()),
+            )
+        except zlib.error as e:
+            logger.warning("unable to decompress '%s': %s", tmp_abspath, e)
+            os.remove(decoded_tmp_abspath)
+            return
+        os.rename(decoded_tmp_abspath, tmp_abspath)
+
+    def is_repeated_index(self, tmp_abspath: str) -> bool:
+        """return True if this index has already been read (the current transfer is a carousel)"""
+        if self.carousel_index_digest is None:
+            return False
+        return self.get_file_digest(tmp_abspath) == self.carousel_index_digest
+
+    @staticmethod
+    def get_file_digest(tmp_abspath: str, algorithm: str = DEFAULT_DIGEST) -> str:
+        """return the digest of a received file (the digest of an empty content if the file is missing)
+
+        An empty string is returned when the algorithm is not available, so the file is considered as invalid.
+        """
+        try:
+            digest = new_digest(algorithm)
+        except ValueError as e:
+            logger.error("unable to check '%s': %s", tmp_abspath, e)
+            return ""
+        if not os.path.isfile(tmp_abspath):
+            return digest.hexdigest()
+        return get_file_digest(tmp_abspath, algorithm)
+
+    def process_carousel_file(self, tmp_abspath: str, valid: bool = True):
+        """process a file of a carousel transfer: files are identified by their digest, not by their order
+
+        a file is ignored without computing its digest when no pending file has the same size
+        """
+        size = os.path.getsize(tmp_abspath) if os.path.isfile(tmp_abspath) else 0
+        if (
+            not self.carousel_pending_sizes[size]
+            and not self.carousel_pending_sizes[None]
+        ):
+            # repeated file (or file of another transfer)
+            if os.path.isfile(tmp_abspath):
+                os.remove(tmp_abspath)
+            return
+        actual_sha256 = self.get_file_digest(tmp_abspath, self.current_digest)
+        binary_digest = bytes.fromhex(actual_sha256)
+        file_relpaths = self.carousel_pending.pop(actual_sha256, None)
+        if file_relpaths is None:
+            if binary_digest not in self.recent_digests:
+                # corrupted file, or file of another transfer
+                logger.warning(
+                    "unexpected file in carousel transfer [%s=%s, valid=%s].",
+                    self.current_digest,
+                    actual_sha256,
+                    valid,
+                )
+            if os.path.isfile(tmp_abspath):
+                os.remove(tmp_abspath)
+            return
+        self.recent_digests.add(binary_digest)
+        self.carousel_pending_sizes[self.carousel_sizes.pop(actual_sha256, None)] -= 1
+        # several files can share the same content
+        for index, file_relpath in enumerate(file_relpaths[1:]):
+            copy_abspath = "%s.%s" % (tmp_abspath, index)
+            shutil.copy(tmp_abspath, copy_abspath)
+            self.transfer_entry_received(
+                copy_abspath,
+                file_relpath,
+                actual_sha256=actual_sha256,
+                expected_sha256=actual_sha256,
+            )
+        self.transfer_entry_received(
+            tmp_abspath,
+            file_relpaths[0],
+            actual_sha256=actual_sha256,
+            expected_sha256=actual_sha256,
+        )
+        if not self.carousel_pending:
+            logger.info("all files of the carousel transfer have been received.")
+            if self.current_split_status:
+                self.unsplit_current_transfer()
+            self.carousel_complete = True
+            self.complete_transfer()
+
+    def repair_received_files(self):
+        """rebuild the files that have not been correctly received, thanks to the parity files.
+
+        parity files are removed from the transfer directory."""
+        receive_path = self.get_current_transfer_directory()
+        if not receive_path:
+            return
+        group_size, parity_count = self.current_parity
+        parity_prefix = PARITY_DIRNAME + "/"
+        data_files = [
+            x for x in self.current_files if not x[1].startswith(parity_prefix)
+        ]
+        for group_index, start in enumerate(range(0, len(data_files), group_size)):
+            group = data_files[start : start + group_size]
+            data_abspaths = [os.path.join(receive_path, x[1]) for x in group]
+            missing = [
+                i
+                for i, (__, file_relpath) in enumerate(group)
+                if file_relpath in self.current_failed_files
+                or not os.path.isfile(data_abspaths[i])
+            ]
+            if not missing:
+                continue
+            parity_abspaths = {}
+            for parity_index in range(parity_count):
+                file_relpath = "%s%s.%s" % (parity_prefix, group_index, parity_index)
+                file_abspath = os.path.join(receive_path, file_relpath)
+                if file_relpath not in self.current_failed_files and os.path.isfile(
+                    file_abspath
+                ):
+                    parity_abspaths[parity_index] = file_abspath
+            rebuilt = rebuild_data_files(
+                data_abspaths, missing, parity_abspaths, parity_count
+            )
+            if not rebuilt:
+                logger.error(
+                    "unable to rebuild %s file(s) of group %s: %s parity file(s) available.",
+                    len(missing),
+                    group_index,
+                    len(parity_abspaths),
+                )
+            for i in rebuilt:
+                expected_sha256, file_relpath = group[i]
+                actual_sha256 = self.get_file_digest(
+                    data_abspaths[i], self.current_digest
+                )
+                if actual_sha256 != expected_sha256.lower():
+                    logger.error("unable to rebuild file %s.", file_relpath)
+                    continue
+                logger.info("file %s rebuilt from parity files.", file_relpath)
+                self.current_failed_files.discard(file_relpath)
+                self.transfer_error_count -= 1
+                self.transfer_success_count += 1
+        # parity files are not part of the transfer
+        self.transfer_error_count -= len(
+            [x for x in self.current_failed_files if x.startswith(parity_prefix)]
+        )
+        shutil.rmtree(os.path.join(receive_path, PARITY_DIRNAME), ignore_errors=True)
+
+    def add_transfer_duration(self, stage: str, duration_s: float):
+        self.transfer_durations[stage] = (
+            self.transfer_durations.get(stage, 0.0) + duration_s
+        )
+
+    def complete_transfer(self):
+        """call :meth:`transfer_complete`, then end the span of the transfer and record it in the history"""
+        self.check_chunked_files()
+        missing_segments = self.check_segments()
+        self.sync_transfer()
+        self.transfer_complete()
+        self.transfer_in_progress = False
+        self.metrics.transfers.inc()
+        if self.transfer_start_time is not None:
+            duration = (now() - self.transfer_start_time).total_seconds()
+            self.metrics.transfer_seconds.observe(duration)
+            if duration > 0:
+                self.metrics.transfer_throughput.set(
+                    self.transfer_received_size / duration
+                )
+        self.add_history_record(STATUS_FAILED if missing_segments else STATUS_COMPLETE)
+        span = self.transfer_span
+        span.set_attribute("received_files", self.transfer_received_count)
+        span.set_attribute("bytes", self.transfer_received_size)
+        span.set_attribute("success_count", self.transfer_success_count)
+        span.set_attribute("error_count", self.transfer_error_count)
+        span.end()
+        self.transfer_span = NOOP_SPAN
+
+    def sync_received_file(self, file_abspath: str):
+        """flush a received file and its directory to disk, if `config.durability` is `"file"`"""
+        if self.config.durability != DURABILITY_FILE:
+            return
+        start = time.time()
+        with self.config.tracer.span("sync", path=file_abspath):
+            sync_file(file_abspath)
+            sync_directory(os.path.dirname(file_abspath))
+        self.add_sync_duration(time.time() - start)
+
+    def sync_transfer(self):
+        """flush all files of the current transfer to disk, if `config.durability` is `"transfer"`
+
+        with `"file"`, only the files extracted from split archives are flushed (the other ones already are)
+        """
+        durability = self.config.durability
+        if not (
+            durability == DURABILITY_TRANSFER
+            or (durability == DURABILITY_FILE and self.current_split_status)
+        ):
+            return
+        receive_path = self.get_current_transfer_directory()
+        if not receive_path or not os.path.isdir(receive_path):
+            return
+        start = time.time()
+        with self.config.tracer.span("sync", path=receive_path):
+            sync_tree(receive_path)
+        self.add_sync_duration(time.time() - start)
+
+    def add_sync_duration(self, duration_s: float):
+        self.metrics.syncs.inc()
+        self.metrics.sync_seconds.observe(duration_s)
+        self.add_transfer_duration("sync", duration_s)
+
+    def add_history_record(self, status: str):
+        """add a report of the current transfer to the history (if `config.history_path` is set)"""
+        if not self.config.history_path:
+            return
+        duration = 0.0
+        if self.transfer_start_time is not None:
+            duration = (now() - self.transfer_start_time).total_seconds()
+        record = TransferRecord(
+            SIDE_RECEIVER,
+            self.current_index_digest,
+            status=status,
+            attributes=dict(self.current_attributes),
+            files=self.transfer_received_count,
+            size=self.transfer_received_size,
+            duration_s=duration,
+            durations=dict(self.transfer_durations),
+            errors=self.transfer_error_count,
+        )
+        add_record(self.config, record)
 
     def transfer_start(self):
         """called before the first file of a transfer
@@ -380,35 +878,113 @@ class Receiver:
         names: List[str] = os.listdir(dir_abspath)
         if not names:
             return
-        folder_1 = os.path.join(dir_abspath, str(uuid.uuid4()))
-        folder_2 = os.path.join(dir_abspath, str(uuid.uuid4()))
-        ensure_dir(folder_1, parent=False)
-        ensure_dir(folder_2, parent=False)
-        for name in names:
-            os.rename(os.path.join(dir_abspath, name), os.path.join(folder_1, name))
-        names.sort()
-        cat_cmd = [config.cat] + names
-        tar_cmd = [config.tar, "xz", "-C", folder_2]
-        esc_tar_cmd = [shlex.quote(x) for x in tar_cmd]
-        esc_cat_cmd = [shlex.quote(x) for x in cat_cmd]
-        cmd = "%s | %s" % (" ".join(esc_cat_cmd), " ".join(esc_tar_cmd))
-        p = subprocess.Popen(
-            cmd,  # nosec
-            shell=True,  # nosec
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            cwd=folder_1,
-        )
-        stdout, stderr = p.communicate(b"")
-        if p.returncode:
-            logger.error("command = %s , return code = %s", cmd, p.returncode)
-            logger.error("stdout = %s\nstderr = %s", stdout.decode(), stderr.decode())
-        names = os.listdir(folder_2)
-        for name in names:
-            os.rename(os.path.join(folder_2, name), os.path.join(dir_abspath, name))
-        shutil.rmtree(folder_1)
-        shutil.rmtree(folder_2)
+        with config.tracer.span("unsplit", chunks=len(names)):
+            folder_1 = os.path.join(dir_abspath, str(uuid.uuid4()))
+            folder_2 = os.path.join(dir_abspath, str(uuid.uuid4()))
+            ensure_dir(folder_1, parent=False)
+            ensure_dir(folder_2, parent=False)
+            for name in names:
+                os.rename(os.path.join(dir_abspath, name), os.path.join(folder_1, name))
+            names.sort()
+            cat_cmd = [config.cat] + names
+            tar_cmd = [config.tar, "xz", "-C", folder_2]
+            pipeline = Pipeline(
+                [("cat", cat_cmd), ("tar", tar_cmd)], cwd=folder_1, tracer=config.tracer
+            )
+            result = pipeline.run()
+            if not result.success:
+                logger.error(
+                    "unable to run '%s'.\n%s", result.command_line, result.get_report()
+                )
+            names = os.listdir(folder_2)
+            for name in names:
+                os.rename(os.path.join(folder_2, name), os.path.join(dir_abspath, name))
+            shutil.rmtree(folder_1)
+            shutil.rmtree(folder_2)
+
+    def unsplit_current_transfer(self):
+        """rebuild the original files of the current transfer from its received chunks"""
+        start = time.time()
+        if self.current_split_archives:
+            self.extract_received_archives(
+                self.config,
+                self.get_current_transfer_directory(),
+                failed_names=self.current_failed_files,
+            )
+        else:
+            self.unsplit_received_files(
+                self.config, self.get_current_transfer_directory()
+            )
+        self.add_transfer_duration("unsplit", time.time() - start)
+
+    @staticmethod
+    def extract_received_archives(
+        config: Config,
+        dir_abspath,
+        failed_names: Set[str] = frozenset(),
+        threads: Optional[int] = None,
+    ) -> int:
+        """extract in parallel the self-contained chunks written by
+        :meth:`hairgap.sender.DirectorySender.archive_directory_chunks`.
+
+        Corrupted or missing chunks are skipped: the files of the other chunks are still extracted.
+
+        :param failed_names: chunks that have not been correctly received
+        :param threads: number of chunks extracted at once (the number of CPUs by default)
+        :return: the number of extracted chunks
+        """
+        names = os.listdir(dir_abspath)  # type: List[str]
+        if not names:
+            return 0
+        with config.tracer.span("unsplit", chunks=len(names)) as span:
+            folder_1 = os.path.join(dir_abspath, str(uuid.uuid4()))
+            folder_2 = os.path.join(dir_abspath, str(uuid.uuid4()))
+            ensure_dir(folder_1, parent=False)
+            ensure_dir(folder_2, parent=False)
+            for name in names:
+                os.rename(os.path.join(dir_abspath, name), os.path.join(folder_1, name))
+
+            def extract_chunk(name: str) -> bool:
+                if name in failed_names:
+                    logger.error("chunk '%s' not correctly received: skipped.", name)
+                    return False
+                # extracted apart, so a truncated chunk does not leave partial files
+                chunk_abspath = os.path.join(folder_2, name)
+                ensure_dir(chunk_abspath, parent=False)
+                tar_cmd = [config.tar, "xzf", name, "-C", chunk_abspath]
+                result = Pipeline(
+                    [("tar", tar_cmd)], cwd=folder_1, tracer=config.tracer
+                ).run()
+                if not result.success:
+                    logger.error(
+                        "unable to run '%s'.\n%s",
+                        result.command_line,
+                        result.get_report(),
+                    )
+                    return False
+                for root, dirnames, filenames in os.walk(chunk_abspath):
+                    for filename in filenames:
+                        src_abspath = os.path.join(root, filename)
+                        dst_abspath = os.path.join(
+                            dir_abspath, os.path.relpath(src_abspath, chunk_abspath)
+                        )
+                        ensure_dir(dst_abspath, parent=True)
+                        os.rename(src_abspath, dst_abspath)
+                return True
+
+            with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+                extracted = sum(executor.map(extract_chunk, sorted(names)))
+            span.set_attribute("extracted", extracted)
+            if extracted < len(names):
+                logger.error(
+                    "%s chunk(s) out of %s extracted in '%s'.",
+                    extracted,
+                    len(names),
+                    dir_abspath,
+                )
+            shutil.rmtree(folder_1)
+            shutil.rmtree(folder_2)
+        return extracted
 
     # noinspection PyMethodMayBeStatic
     def transfer_file_unexpected(self, tmp_abspath: str, prefix: bytes = None):
@@ -416,6 +992,7 @@ class Receiver:
 
         :param tmp_abspath: absolute path of the received file
         :param prefix: is the first bytes of the received file."""
+        self.metrics.unexpected_files.inc()
         if prefix is None:
             logger.error("unexpected file received")
         else:
@@ -423,6 +1000,192 @@ class Receiver:
         if os.path.isfile(tmp_abspath):
             os.remove(tmp_abspath)
 
+    def transfer_entry_received(
+        self,
+        tmp_abspath,
+        entry_relpath,
+        actual_sha256: Optional[str] = None,
+        expected_sha256: Optional[str] = None,
+    ):
+        """call :meth:`transfer_chunk_received` for a chunk of a large file, :meth:`transfer_file_received` otherwise"""
+        chunk = self.current_chunks.get(entry_relpath)
+        if chunk is None:
+            self.transfer_file_received(
+                tmp_abspath,
+                entry_relpath,
+                actual_sha256=actual_sha256,
+                expected_sha256=expected_sha256,
+            )
+            return
+        file_relpath, index, chunk_size, file_size = chunk
+        self.transfer_chunk_received(
+            tmp_abspath,
+            file_relpath,
+            index,
+            chunk_size,
+            file_size,
+            actual_sha256=actual_sha256,
+            expected_sha256=expected_sha256,
+        )
+
+    def transfer_chunk_received(
+        self,
+        tmp_abspath,
+        file_relpath,
+        index: int,
+        chunk_size: int,
+        file_size: int,
+        actual_sha256: Optional[str] = None,
+        expected_sha256: Optional[str] = None,
+    ):
+        """called when a chunk of a large file is received (see :mod:`hairgap.chunks`):
+        a valid chunk is written at its offset in the destination file, and the received file is removed
+
+        :param file_relpath: the destination path of the large file
+        :param index: the index of this chunk
+        :param chunk_size: the size of each chunk (except the last one)
+        :param file_size: the size of the large file
+        """
+        size = os.path.getsize(tmp_abspath) if os.path.isfile(tmp_abspath) else 0
+        self.transfer_received_count += 1
+        self.transfer_received_size += size
+        self.metrics.received_files.inc()
+        self.metrics.received_bytes.inc(size)
+        values = {
+            "f": file_relpath,
+            "i": index,
+            "d": self.current_digest,
+            "as": actual_sha256,
+            "es": expected_sha256,
+            "s": size,
+        }
+        receive_path = self.get_current_transfer_directory()
+        if actual_sha256 != (expected_sha256 or "").lower():
+            logger.warning(
+                "received chunk %(i)s of %(f)s [%(d)s=%(as)s instead of %(d)s=%(es)s, size=%(s)s]."
+                % values
+            )
+            self.transfer_error_count += 1
+            self.metrics.file_errors.inc()
+        elif receive_path:
+            file_abspath = os.path.join(receive_path, file_relpath)
+            ensure_dir(file_abspath, parent=True)
+            received = self.current_chunked_files[file_relpath][1]
+            dst_fd = os.open(file_abspath, os.O_WRONLY | os.O_CREAT, 0o666)
+            try:
+                if not received:
+                    # remove any previous content, and keep holes for the missing chunks
+                    os.ftruncate(dst_fd, 0)
+                    os.ftruncate(dst_fd, file_size)
+                with open(tmp_abspath, "rb") as src_fd:
+                    copy_to_offset(src_fd.fileno(), dst_fd, index * chunk_size)
+            finally:
+                os.close(dst_fd)
+            self.sync_received_file(file_abspath)
+            received.add(index)
+            logger.info(
+                "received chunk %(i)s of %(f)s [%(d)s=%(es)s, size=%(s)s]." % values
+            )
+            self.transfer_success_count += 1
+        else:
+            logger.warning("no receive path defined: ignoring '%s'.", file_relpath)
+        if os.path.isfile(tmp_abspath):
+            os.remove(tmp_abspath)
+
+    def check_chunked_files(self):
+        """call :meth:`transfer_chunks_missing` for each large file of the current transfer with missing chunks,
+        and check the digest of the other ones (each invalid file is counted as an error)
+        """
+        missing_count = 0
+        receive_path = self.get_current_transfer_directory()
+        for file_relpath, (chunk_count, received, file_digest) in sorted(
+            self.current_chunked_files.items()
+        ):
+            missing = [x for x in range(chunk_count) if x not in received]
+            if missing:
+                missing_count += len(missing)
+                self.transfer_chunks_missing(file_relpath, missing, chunk_count)
+                continue
+            if not receive_path:
+                continue
+            file_abspath = os.path.join(receive_path, file_relpath)
+            actual_digest = self.get_file_digest(file_abspath, self.current_digest)
+            if actual_digest != file_digest:
+                logger.error(
+                    "file %s rebuilt from its chunks [%s=%s instead of %s=%s].",
+                    file_relpath,
+                    self.current_digest,
+                    actual_digest,
+                    self.current_digest,
+                    file_digest,
+                )
+                self.transfer_error_count += 1
+                self.metrics.file_errors.inc()
+        if missing_count:
+            self.transfer_span.set_attribute("missing_chunks", missing_count)
+
+    def check_segments(self) -> int:
+        """compare the segments and files of a segmented transfer with the ones announced by its trailer,
+        and call :meth:`transfer_segments_missing` if some segments have been lost
+
+        :return: the number of missing segments, each one being counted as an error
+        """
+        if self.current_segments_announced is None:
+            return 0
+        segment_count, file_count = self.current_segments_announced
+        missing = [x for x in range(segment_count) if x not in self.current_segments]
+        missing_files = file_count - self.current_segment_files
+        if missing:
+            self.transfer_error_count += len(missing)
+            self.transfer_span.set_attribute("missing_segments", len(missing))
+            self.transfer_segments_missing(missing, segment_count, missing_files)
+        elif missing_files:
+            logger.error(
+                "%s file(s) announced by the trailer, %s listed by the segments.",
+                file_count,
+                self.current_segment_files,
+            )
+        return len(missing)
+
+    # noinspection PyMethodMayBeStatic
+    def transfer_segments_missing(
+        self, missing: List[int], segment_count: int, missing_files: int
+    ):
+        """called at the end of a segmented transfer if some of its segments have been lost:
+        the files they list are neither expected nor received.
+
+        :param missing: indices of the missing segments
+        :param segment_count: number of segments announced by the trailer (the trailer excepted)
+        :param missing_files: number of files listed by the missing segments
+        """
+        logger.error(
+            "%s segment(s) missing out of %s (%s): %s file(s) not received.",
+            len(missing),
+            segment_count,
+            format_ranges(missing),
+            missing_files,
+        )
+
+    # noinspection PyMethodMayBeStatic
+    def transfer_chunks_missing(
+        self, file_relpath: str, missing: List[int], chunk_count: int
+    ):
+        """called at the end of a transfer for each large file with missing (or corrupted) chunks.
+
+        The destination file is kept, with holes instead of the missing chunks.
+
+        :param file_relpath: the destination path of the large file
+        :param missing: indices of the missing chunks (chunk `i` starts at offset `i * chunk_size`)
+        :param chunk_count: total number of chunks of the file
+        """
+        logger.error(
+            "file %s: %s chunk(s) missing out of %s (%s).",
+            file_relpath,
+            len(missing),
+            chunk_count,
+            format_ranges(missing),
+        )
+
     def transfer_file_received(
         self,
         tmp_abspath,
@@ -437,8 +1200,8 @@ class Receiver:
 
         :param tmp_abspath: the path of the received file
         :param file_relpath: the destination path of the received file
-        :param actual_sha256: actual SHA256 (not provided in case of tar archives)
-        :param expected_sha256: expected SHA256 (not provided in case of tar archives)
+        :param actual_sha256: actual digest (not provided in case of tar archives), see `self.current_digest`
+        :param expected_sha256: expected digest (not provided in case of tar archives)
         :param tmp_fd: provided when tmp_abspath is not given
         :return:
         """
@@ -454,6 +1217,7 @@ class Receiver:
                         dst_fd.write(data)
                         size += len(data)
                     tmp_fd.close()
+                self.sync_received_file(file_abspath)
             else:
                 logger.warning("no receive path defined: ignoring '%s'.", file_relpath)
         elif os.path.isfile(tmp_abspath):
@@ -464,58 +1228,263 @@ class Receiver:
                 file_abspath = os.path.join(receive_path, file_relpath)
                 ensure_dir(file_abspath, parent=True)
                 shutil.move(tmp_abspath, file_abspath)
+                self.sync_received_file(file_abspath)
             else:
                 logger.warning("no receive path defined: removing '%s'.", tmp_abspath)
                 os.remove(tmp_abspath)
         else:
             size = 0
         self.transfer_received_size += size
+        self.metrics.received_files.inc()
+        self.metrics.received_bytes.inc(size)
+        if expected_sha256:
+            # digests of the index may be uppercase
+            expected_sha256 = expected_sha256.lower()
         values = {
             "f": file_relpath,
+            "d": self.current_digest,
             "as": actual_sha256,
             "es": expected_sha256,
             "s": size,
         }
         if actual_sha256 == expected_sha256:
-            logger.info("received file %(f)s [sha256=%(es)s, size=%(s)s]." % values)
+            logger.info("received file %(f)s [%(d)s=%(es)s, size=%(s)s]." % values)
             self.transfer_success_count += 1
         else:
             logger.warning(
-                "received file %(f)s [sha256=%(as)s instead of sha256=%(es)s, size=%(s)s]."
+                "received file %(f)s [%(d)s=%(as)s instead of %(d)s=%(es)s, size=%(s)s]."
                 % values
             )
             self.transfer_error_count += 1
+            self.metrics.file_errors.inc()
 
     def read_index(self, index_abspath):
+        if self.transfer_in_progress:
+            # the previous transfer has been interrupted
+            self.check_chunked_files()
+            self.add_history_record(STATUS_INTERRUPTED)
+            self.transfer_span.set_attribute("interrupted", True)
+            self.transfer_span.end()
+        self.transfer_in_progress = True
+        self.transfer_durations = {}
         self.transfer_start_time = now()
         logger.info("reading received index…")
         self.current_attributes = {x: None for x in self.available_attributes}
 
         self.expected_files = Queue()
-        expected_count = 0
         self.current_split_status = False
-        with open(index_abspath) as fd:
-            for line in fd:
-                if line == "[splitted_content]\n":
-                    self.current_split_status = True
-                matcher = re.match(FILENAME_PATTERN, line)
-                if matcher:
-                    self.expected_files.put((matcher.group(1), matcher.group(2)))
-                    expected_count += 1
-                    continue
-                matcher = re.match(r"^(.+) = (.+)$", line)
-                if matcher:
-                    key, value = matcher.groups()
-                    if key in self.available_attributes:
-                        self.current_attributes[key] = value
-                    continue
+        self.current_split_archives = False
+        self.current_compression = False
+        self.current_digest = DEFAULT_DIGEST
+        self.current_index_digest = self.get_file_digest(index_abspath)
+        self.carousel_index_digest = None
+        self.carousel_pending = {}
+        self.carousel_sizes = {}
+        self.carousel_pending_sizes = Counter()
+        self.carousel_complete = False
+        self.current_parity = None
+        self.current_files = []
+        self.current_failed_files = set()
+        self.current_chunks = {}
+        self.current_chunked_files = {}
+        self.current_segmented = False
+        self.current_segments_ended = False
+        self.current_segments = set()
+        self.current_segment_files = 0
+        self.current_segments_announced = None
+        if is_compact_index(index_abspath):
+            expected_count = self.read_compact_index(index_abspath)
+        else:
+            with open(index_abspath) as fd:
+                expected_count = self.read_index_lines(fd)
         self.transfer_received_size = os.path.getsize(index_abspath)
         self.transfer_received_count = 1
         self.transfer_success_count = 1
         self.transfer_error_count = 0
+        self.transfer_span = self.config.tracer.span(
+            "transfer",
+            root=True,
+            index_digest=self.current_index_digest,
+            expected_files=expected_count,
+        )
+        for key, value in self.current_attributes.items():
+            if value is not None:
+                self.transfer_span.set_attribute(key, value)
         logger.info("index read: expecting %s file(s).", expected_count)
 
+    def read_compact_index(self, index_abspath: str) -> int:
+        """read a compact index (see :mod:`hairgap.compact`); its entries are decoded when files are received
+
+        :return: the number of expected files
+        """
+        try:
+            index = CompactIndex(index_abspath)
+        except ValueError as e:
+            logger.error("unable to read the compact index: %s", e)
+            return 0
+        self.read_index_lines(index.header_lines)
+        if self.carousel_index_digest or self.current_parity:
+            # files are identified by their digest or must be rebuilt: all entries are required
+            return self.read_index_lines(index.iter_lines())
+        self.expected_files = CompactEntries(index, self.add_chunk)
+        # the encoding of each file is only known when it is decoded
+        self.current_compression = True
+        return len(index)
+
+    def read_segment(self, segment_abspath: str):
+        """read a segment of the index of the current transfer and add its files to the expected ones"""
+        with open(segment_abspath) as fd:
+            fd.readline()  # magic number
+            matcher = re.match(SEGMENT_PATTERN, fd.readline())
+            if (
+                not self.current_segmented
+                or not matcher
+                or matcher.group(2).lower() != self.current_index_digest
+            ):
+                logger.warning("segment of an unknown index: ignored.")
+                return
+            self.current_segments.add(int(matcher.group(1)))
+            expected_count = self.read_index_lines(fd)
+        self.transfer_received_size += os.path.getsize(segment_abspath)
+        self.transfer_received_count += 1
+        self.transfer_success_count += 1
+        logger.info(
+            "segment %s read: expecting %s more file(s).",
+            matcher.group(1),
+            expected_count,
+        )
+
+    def read_index_lines(self, fd) -> int:
+        """read the lines of an index (or of an index segment) and update the current transfer
+
+        :return: the number of files added to the expected ones
+        """
+        expected_count = 0
+        chunk = None
+        size = None
+        for line in fd:
+            if line == "[splitted_content]\n":
+                self.current_split_status = True
+            elif line == "[split_archives]\n":
+                self.current_split_status = True
+                self.current_split_archives = True
+            elif line == "[segmented]\n":
+                self.current_segmented = True
+            elif line.startswith("[end "):
+                matcher = re.match(END_PATTERN, line)
+                if matcher:
+                    self.current_segments_ended = True
+                    self.current_segments_announced = (
+                        int(matcher.group(1)),
+                        int(matcher.group(2)),
+                    )
+                else:
+                    logger.warning("invalid end of segments: %r.", line)
+            elif line == "[carousel]\n":
+                self.carousel_index_digest = self.current_index_digest
+            elif line.startswith("[digest "):
+                matcher = re.match(DIGEST_PATTERN, line)
+                self.current_digest = matcher.group(1) if matcher else line.strip()
+                if self.current_digest not in get_available_digests():
+                    logger.error(
+                        "unsupported digest: %r, files cannot be checked.", line
+                    )
+            elif line.startswith("[encoding "):
+                matcher = re.match(ENCODING_PATTERN, line)
+                if matcher and matcher.group(1) == ENCODING_GZIP:
+                    self.current_compression = True
+                else:
+                    logger.warning("unknown encoding: %r.", line)
+            elif line.startswith("[chunk "):
+                # applies to the next file
+                chunk = parse_chunk(line)
+                if chunk is None:
+                    logger.warning("invalid chunk: %r.", line)
+            elif line.startswith("[size "):
+                # applies to the next file
+                matcher = re.match(SIZE_PATTERN, line)
+                size = int(matcher.group(1)) if matcher else None
+            elif line.startswith("[parity "):
+                matcher = re.match(PARITY_PATTERN, line)
+                if matcher:
+                    self.current_parity = (
+                        int(matcher.group(1)),
+                        int(matcher.group(2)),
+                    )
+            matcher = re.match(FILENAME_PATTERN, line)
+            entry_relpath = matcher.group(2) if matcher else None
+            if matcher and self.current_segmented and (not chunk or chunk[0] == 0):
+                # the chunks of a large file are counted once
+                self.current_segment_files += 1
+            if matcher and chunk:
+                # each chunk is an entry of the transfer
+                entry_relpath = self.add_chunk(matcher.group(2), *chunk)
+                size = min(chunk[1], chunk[2] - chunk[0] * chunk[1])
+                chunk = None
+            if matcher and self.current_parity:
+                self.current_files.append((matcher.group(1), entry_relpath))
+            if matcher and self.carousel_index_digest:
+                digest = matcher.group(1).lower()
+                if digest not in self.carousel_pending:
+                    self.carousel_sizes[digest] = size
+                    self.carousel_pending_sizes[size] += 1
+                self.carousel_pending.setdefault(digest, []).append(entry_relpath)
+                size = None
+                expected_count += 1
+                continue
+            elif matcher:
+                self.expected_files.put((matcher.group(1), entry_relpath))
+                size = None
+                expected_count += 1
+                continue
+            matcher = re.match(r"^(.+) = (.+)$", line)
+            if matcher:
+                key, value = matcher.groups()
+                if key in self.available_attributes:
+                    self.current_attributes[key] = value
+                continue
+        return expected_count
+
+    def add_chunk(
+        self,
+        file_relpath: str,
+        index: int,
+        chunk_size: int,
+        file_size: int,
+        file_digest: str,
+    ) -> str:
+        """add a chunk of a large file to the current transfer
+
+        :return: the relative path of the chunk, as an entry of the transfer
+        """
+        entry_relpath = get_chunk_relpath(file_relpath, index)
+        self.current_chunks[entry_relpath] = (
+            file_relpath,
+            index,
+            chunk_size,
+            file_size,
+        )
+        self.current_chunked_files.setdefault(
+            file_relpath, (get_chunk_count(file_size, chunk_size), set(), file_digest)
+        )
+        return entry_relpath
+
     def loop(self):
+        if self.config.metrics_port:
+            self.metrics_server = MetricsServer(
+                self.metrics.registry, self.config.metrics_port
+            )
+            self.metrics_server.start()
+        try:
+            self.run_loops()
+        finally:
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+
+    def run_loops(self):
+        if self.config.express_port:
+            self.express_thread = Thread(target=self.express_loop)
+            self.express_thread.start()
         if self.threading:
             self.process_thread = Thread(target=self.process_loop)
             self.process_thread.start()
@@ -525,3 +1494,5 @@ class Receiver:
             self.process_thread.join()
         else:
             self.receive_loop()
+        if self.express_thread is not None:
+            self.express_thread.join()
@@ -0,0 +1,139 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Record the raw streams received by a :class:`hairgap.receiver.Receiver`, and replay them later without any sender.
+
+With `Config(record_path=...)`, the processing thread copies each received stream (before its processing) to this
+directory, and appends its timings to `streams.jsonl` (so the reception of the next stream does not wait for the copy):
+
+.. code-block:: json
+
+    {"name": "8c0f…", "size": 1048576, "valid": true, "start": 1600000000.0, "end": 1600000002.5}
+
+:func:`replay_streams` gives these streams to :meth:`Receiver.process_received_file`, at the recorded speed
+(waiting for the recorded arrival time of each stream) or as fast as possible, so the processing (hashing, moves,
+tar extraction, unsplitting…) can be profiled on real workloads.
+
+.. code-block:: bash
+
+    pyhairgap receive 10.0.0.2 /data/received --record-path /data/record
+    pyhairgap replay /data/record /tmp/replayed --speed 0 --trace-file /tmp/spans.jsonl
+
+"""
+
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Dict, Iterator, List, Optional
+
+from hairgap.utils import ensure_dir
+
+logger = logging.getLogger(__name__)
+
+STREAMS_FILENAME = "streams.jsonl"
+
+
+class StreamRecorder:
+    """copy received streams to a directory, with their timings"""
+
+    def __init__(self, record_path: str):
+        self.record_path = record_path
+        ensure_dir(record_path, parent=False)
+
+    def record(self, tmp_abspath: str, valid: bool, start: float, end: float):
+        """copy a received stream; errors are logged, but never interrupt the reception
+
+        :param tmp_abspath: the received file (not processed yet)
+        :param valid: the file has been correctly received by hairgap
+        :param start: timestamp of the start of the reception (the receiver was waiting from this time)
+        :param end: timestamp of the end of the reception
+        """
+        name = os.path.basename(tmp_abspath)
+        try:
+            size = 0
+            if os.path.isfile(tmp_abspath):
+                # a copy, not a link: some files are modified in-place by their processing
+                shutil.copyfile(tmp_abspath, os.path.join(self.record_path, name))
+                size = os.path.getsize(tmp_abspath)
+            metadata = {
+                "name": name,
+                "size": size,
+                "valid": valid,
+                "start": start,
+                "end": end,
+            }
+            with open(os.path.join(self.record_path, STREAMS_FILENAME), "a") as fd:
+                fd.write(json.dumps(metadata, sort_keys=True) + "\n")
+        except OSError as e:
+            logger.warning("unable to record '%s': %s", tmp_abspath, e)
+
+
+def read_streams(record_path: str) -> Iterator[Dict]:
+    """yield the metadata of each recorded stream, in the reception order"""
+    with open(os.path.join(record_path, STREAMS_FILENAME)) as fd:
+        for line in fd:
+            if line.strip():
+                yield json.loads(line)
+
+
+def replay_streams(
+    receiver, record_path: str, speed: Optional[float] = 1.0
+) -> List[Dict]:
+    """give the recorded streams to `receiver.process_received_file`, and return the timings of each stream
+
+    :param receiver: a :class:`hairgap.receiver.Receiver`
+    :param record_path: directory written by a :class:`StreamRecorder`
+    :param speed: `1.0` to replay at the recorded speed, `2.0` twice faster…, `None` or `0` as fast as possible
+    :return: list of dicts `{"name", "size", "valid", "lag_s", "process_s"}`,
+        where `lag_s` is the delay between the (scaled) arrival time of the stream and the start of its processing
+        (always 0 when replayed as fast as possible)
+    """
+    results = []
+    replay_start = time.time()
+    record_start = None
+    for stream in read_streams(record_path):
+        if record_start is None:
+            record_start = stream["end"]
+        tmp_abspath = receiver.get_reception_filepath()
+        ensure_dir(tmp_abspath, parent=True)
+        src_abspath = os.path.join(record_path, stream["name"])
+        if os.path.isfile(src_abspath):
+            shutil.copyfile(src_abspath, tmp_abspath)
+        arrival = None
+        if speed:
+            arrival = replay_start + (stream["end"] - record_start) / speed
+            delay = arrival - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        start = time.time()
+        receiver.process_received_file(tmp_abspath, valid=stream["valid"])
+        end = time.time()
+        results.append(
+            {
+                "name": stream["name"],
+                "size": stream["size"],
+                "valid": stream["valid"],
+                "lag_s": 0.0 if arrival is None else max(start - arrival, 0.0),
+                "process_s": end - start,
+            }
+        )
+    logger.info(
+        "%s stream(s) replayed in %.3f seconds.",
+        len(results),
+        time.time() - replay_start,
+    )
+    return results
@@ -0,0 +1,91 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Stream the index of large transfers as segments, so sending starts before the whole tree is hashed.
+
+With `Config(index_segment_files=...)`, :meth:`hairgap.sender.DirectorySender.prepare_directory` only writes a header
+index (attributes and options, with a `[segmented]` line but without any file). Files are hashed by
+:meth:`hairgap.sender.DirectorySender.send_directory`, batch by batch: each batch is described by an index segment,
+sent just before its files, and the next batch is hashed while the current one is sent.
+
+.. code-block:: text
+
+    # *-* HAIRGAP-SEGMT *-*
+    [segment 0 <sha256 of the header index>]
+    4e9c… = data/file-1.txt
+    0b31… = data/file-2.txt
+
+The last segment is a trailer, with the number of segments and of files: `[end 3 2000]`.
+The receiver extends its list of expected files with each segment, and completes the transfer after the trailer;
+segments lost on the way are found by comparing the received ones with the trailer, and the transfer is failed.
+Segments are kept beside the index file, so a new call to `send_directory` sends them again without hashing.
+
+Not available with carousels, parity files or `split_size`.
+"""
+
+import os
+import re
+from typing import Iterator, List, Set, Tuple
+
+from hairgap.utils import FILENAME_PATTERN
+
+SEGMENT_PATTERN = r"^\[segment (\d+) ([a-fA-F\d]{64})\]$"
+END_PATTERN = r"^\[end (\d+) (\d+)\]$"
+
+
+def get_segment_name(index: int) -> str:
+    return "%06d.txt" % index
+
+
+def iter_batches(
+    dir_abspath: str, batch_size: int, excluded: Set[str] = frozenset()
+) -> Iterator[List[Tuple[str, str]]]:
+    """walk a directory (in the index order) and yield lists of at most `batch_size` files
+
+    :param excluded: relative paths of files to ignore (already listed by previous segments)
+    :return: iterator over lists of (absolute path, relative path)
+    """
+    batch = []
+    for root, dirnames, filenames in os.walk(dir_abspath):
+        dirnames.sort()
+        filenames.sort()
+        for filename in filenames:
+            file_abspath = os.path.join(root, filename)
+            if not os.path.isfile(file_abspath):
+                continue
+            file_relpath = os.path.relpath(file_abspath, dir_abspath)
+            if file_relpath in excluded:
+                continue
+            batch.append((file_abspath, file_relpath))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def read_segment_relpaths(segment_abspath: str) -> Tuple[Set[str], bool]:
+    """return the relative paths of the files listed by a segment, and `True` if this segment is the trailer"""
+    relpaths = set()
+    is_trailer = False
+    with open(segment_abspath) as fd:
+        for line in fd:
+            if re.match(END_PATTERN, line):
+                is_trailer = True
+                continue
+            matcher = re.match(FILENAME_PATTERN, line)
+            if matcher:
+                relpaths.add(matcher.group(2))
+    return relpaths, is_trailer
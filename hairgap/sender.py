@@ -17,22 +17,47 @@
 import hashlib
 import logging
 import os
-import random
 import re
-import shlex
 import shutil
-import subprocess
 import tempfile
+import threading
 import time
 import uuid
-from typing import Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
+from hairgap import pgzip
+from hairgap.chunks import hash_chunks, parse_chunk
+from hairgap.compact import write_compact_index
+from hairgap.compression import (
+    ENCODING_GZIP,
+    ENCODING_PATTERN,
+    compress_file,
+    should_compress,
+)
 from hairgap.constants import (
+    HAIRGAP_MAGIC_NUMBER_COMPACT,
     HAIRGAP_MAGIC_NUMBER_EMPTY,
     HAIRGAP_MAGIC_NUMBER_ESCAPE,
+    HAIRGAP_MAGIC_NUMBER_GZIP,
     HAIRGAP_MAGIC_NUMBER_INDEX,
+    HAIRGAP_MAGIC_NUMBER_MESSAGE,
+    HAIRGAP_MAGIC_NUMBER_SEGMENT,
+)
+from hairgap.digests import DEFAULT_DIGEST, DIGEST_SHA256, get_file_digest
+from hairgap.history import (
+    SIDE_SENDER,
+    STATUS_COMPLETE,
+    STATUS_FAILED,
+    TransferRecord,
+    add_record,
 )
-from hairgap.utils import FILENAME_PATTERN, Config, ensure_dir
+from hairgap.parity import PARITY_DIRNAME, write_parity_files
+from hairgap.pipeline import Pipeline
+from hairgap.progress import ProgressTracker
+from hairgap.segments import get_segment_name, iter_batches, read_segment_relpaths
+from hairgap.utils import FILENAME_PATTERN, Config, ensure_dir, plan_shards
+from hairgap.zerocopy import FileRange
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +65,10 @@ HAIRGAP_PREFIXES = {
     HAIRGAP_MAGIC_NUMBER_INDEX.encode(),
     HAIRGAP_MAGIC_NUMBER_EMPTY.encode(),
     HAIRGAP_MAGIC_NUMBER_ESCAPE.encode(),
+    HAIRGAP_MAGIC_NUMBER_MESSAGE.encode(),
+    HAIRGAP_MAGIC_NUMBER_GZIP.encode(),
+    HAIRGAP_MAGIC_NUMBER_SEGMENT.encode(),
+    HAIRGAP_MAGIC_NUMBER_COMPACT.encode(),
 }
 
 
@@ -59,6 +88,14 @@ class DirectorySender:
 
     def __init__(self, config: Config):
         self.config = config
+        self.prepare_duration_s = None  # type: Optional[float]
+        # duration of the last call to `prepare_directory`
+        self.prepared_size = None  # type: Optional[Tuple[int, int]]
+        # result of the last call to `prepare_directory`
+        self.sent_file_count = 0
+        # number of files sent by the last call to `send_directory` (including index files)
+        self.progress = ProgressTracker()
+        # progress of the current (or last) call to `send_directory`, see :mod:`hairgap.progress`
 
     def get_attributes(self) -> Dict[str, str]:
         """return a dict of attributes to add in the index file (like unique IDs to track transfers on the receiver side)
@@ -83,20 +120,80 @@ class DirectorySender:
             return True
         return self.config.use_tar_archives
 
+    @property
+    def use_carousel(self):
+        """files are repeated, so the receiver can fill the gaps left by lost files"""
+        return self.config.carousel_repeat > 1 or bool(self.config.carousel_deadline_s)
+
+    @property
+    def use_parity(self):
+        """parity files are added to each group of files, so the receiver can rebuild lost files"""
+        return bool(self.config.parity_group_size and self.config.parity_count)
+
+    @property
+    def use_segments(self):
+        """the index is sent as segments, hashed while the previous ones are sent (see :mod:`hairgap.segments`)"""
+        return bool(
+            self.config.index_segment_files
+            and not self.use_carousel
+            and not self.use_parity
+            and not self.config.split_size
+        )
+
+    @property
+    def use_compact_index(self):
+        """a compact binary index is sent instead of the text one (see :mod:`hairgap.compact`)"""
+        return bool(
+            self.config.compact_index
+            and not self.use_tar_archives
+            and not self.use_segments
+        )
+
+    @property
+    def sent_index_abspath(self) -> str:
+        """index file that is sent (the compact one if `use_compact_index`)"""
+        if self.use_compact_index:
+            return self.index_abspath + ".bin"
+        return self.index_abspath
+
+    @property
+    def segments_abspath(self) -> str:
+        """directory where index segments are kept"""
+        return self.index_abspath + ".segments"
+
+    @property
+    def parity_abspath(self) -> str:
+        """directory where parity files are kept (sent as the files of `PARITY_DIRNAME`, see :mod:`hairgap.parity`)"""
+        return self.index_abspath + ".parity"
+
+    @property
+    def compressed_abspath(self) -> str:
+        """directory where compressed copies of the files are kept (see :mod:`hairgap.compression`)"""
+        return self.index_abspath + ".compressed"
+
     def prepare_directory(self) -> Tuple[int, int]:
         """create an index file and return the number of files and the total size (including the index file).
 
-        **can modify in-place some files (those empty or beginning by `# *-* HAIRGAP-`)** when not `config.use_tar_archives`
+        **modify in-place the content of the directory** when `config.split_size` is set
+        (the total size is then the size of the content to send); with `config.compression`, compressed copies of the
+        files are written in :attr:`compressed_abspath`
 
         result is always (1, 0) when `config.use_tar_archives` and not `config.always_compute_size` to speed up
 
         """
         start = time.time()
-        if self.use_tar_archives:
-            r = self.prepare_directory_tar()
-        else:
-            r = self.prepare_directory_no_tar()
+        with self.config.tracer.span(
+            "prepare", directory=self.transfer_abspath, tar=self.use_tar_archives
+        ) as span:
+            if self.use_tar_archives:
+                r = self.prepare_directory_tar()
+            else:
+                r = self.prepare_directory_no_tar()
+            span.set_attribute("files", r[0])
+            span.set_attribute("bytes", r[1])
         end = time.time()
+        self.prepare_duration_s = end - start
+        self.prepared_size = r
         logger.info(
             "%s files, %s bytes in %s seconds (%s B/s)",
             r[0],
@@ -106,14 +203,18 @@ class DirectorySender:
         )
         return r
 
+    def write_index_header(self, fd):
+        """write the magic number and the attributes of the transfer to the index file"""
+        fd.write(HAIRGAP_MAGIC_NUMBER_INDEX)
+        fd.write("[hairgap]\n")
+        for k, v in sorted(self.get_attributes().items()):
+            fd.write("%s = %s\n" % (k, v.replace("\n", "")))
+
     def prepare_directory_tar(self) -> Tuple[int, int]:
         logger.info("preparing '%s' as a single tar archive…", self.transfer_abspath)
         ensure_dir(self.index_abspath)
         with open(self.index_abspath, "w") as fd:
-            fd.write(HAIRGAP_MAGIC_NUMBER_INDEX)
-            fd.write("[hairgap]\n")
-            for k, v in sorted(self.get_attributes().items()):
-                fd.write("%s = %s\n" % (k, v.replace("\n", "")))
+            self.write_index_header(fd)
         total_size = 0
         total_files = 1
         if self.config.always_compute_size:
@@ -136,52 +237,85 @@ class DirectorySender:
         logger.info("preparing '%s' as multiple files…", self.transfer_abspath)
         dir_abspath = self.transfer_abspath
         index_path = self.index_abspath
+        tracer = self.config.tracer
+        if self.use_segments:
+            return self.prepare_directory_segmented()
+        if self.use_parity and os.path.lexists(
+            os.path.join(dir_abspath, PARITY_DIRNAME)
+        ):
+            # the receiver would mix these files with the parity files
+            raise ValueError(
+                "'%s' cannot be sent with parity files: it contains '%s'"
+                % (dir_abspath, PARITY_DIRNAME)
+            )
         if self.config.split_size:
-            self.split_source_files(dir_abspath, self.config.split_size)
+            with tracer.span("split", split_size=self.config.split_size):
+                self.split_source_files(dir_abspath, self.config.split_size)
 
+        if os.path.isdir(self.compressed_abspath):
+            # compressed files of a previous preparation
+            shutil.rmtree(self.compressed_abspath)
         total_files, total_size = 1, 0
         ensure_dir(index_path)
         with open(index_path, "w") as fd:
-            fd.write(HAIRGAP_MAGIC_NUMBER_INDEX)
-            fd.write("[hairgap]\n")
-            for k, v in sorted(self.get_attributes().items()):
-                fd.write("%s = %s\n" % (k, v.replace("\n", "")))
-            if self.config.split_size:
+            self.write_index_header(fd)
+            if self.config.digest != DEFAULT_DIGEST:
+                fd.write("[digest %s]\n" % self.config.digest)
+            if self.config.split_size and self.config.split_archives:
+                fd.write("[split_archives]\n")
+            elif self.config.split_size:
                 fd.write("[splitted_content]\n")
+            if self.use_carousel:
+                fd.write("[carousel]\n")
+            if self.use_parity:
+                fd.write(
+                    "[parity %s %s]\n"
+                    % (self.config.parity_group_size, self.config.parity_count)
+                )
             fd.write("[files]\n")
+            data_abspaths = []
+            compressed_abspaths = []
             for root, dirnames, filenames in os.walk(dir_abspath):
                 dirnames.sort()
                 filenames.sort()
                 for filename in filenames:
                     file_abspath = os.path.join(root, filename)
-                    expected_sha256 = hashlib.sha256()
                     if not os.path.isfile(file_abspath):
                         continue
-                    filesize = os.path.getsize(file_abspath)
-                    with open(file_abspath, "rb") as in_fd:
-                        # start by checking special contents
-                        prefix = in_fd.read(len(HAIRGAP_MAGIC_NUMBER_INDEX.encode()))
-                        expected_sha256.update(prefix)
-                        for data in iter(lambda: in_fd.read(65536), b""):
-                            expected_sha256.update(data)
-                    # if the file starts with a special value, we must rewrite it entirely
-                    # to escape by HAIRGAP_MAGIC_NUMBER_ESCAPE
-                    # maybe not very efficient, but such files are expected to be small
-                    if prefix in HAIRGAP_PREFIXES:
-                        suffix = random.randint(100000, 1000000 - 1)  # nosec
-                        escaped_file_abspath = f"{file_abspath}.{suffix}"
-                        with open(escaped_file_abspath, "wb") as fd_out:
-                            fd_out.write(HAIRGAP_MAGIC_NUMBER_ESCAPE.encode())
-                            with open(file_abspath, "rb") as fd_in:
-                                for data in iter(lambda: fd_in.read(65536), b""):
-                                    fd_out.write(data)
-                        os.rename(escaped_file_abspath, file_abspath)
-
-                    total_size += filesize
                     file_relpath = os.path.relpath(file_abspath, dir_abspath)
-                    fd.write("%s = %s\n" % (expected_sha256.hexdigest(), file_relpath))
+                    entries = self.write_file_entries(fd, file_abspath, file_relpath)
+                    for src_abspath, filesize, compress in entries:
+                        total_size += filesize
+                        total_files += 1
+                        data_abspaths.append(src_abspath)
+                        if compress:
+                            compressed_abspaths.append((src_abspath, file_relpath))
+            if self.use_parity:
+                with tracer.span("parity", files=len(data_abspaths)):
+                    parity_abspaths = self.prepare_parity_files(data_abspaths)
+                for parity_abspath in parity_abspaths:
+                    digest, filesize = self.prepare_file(
+                        parity_abspath, self.config.digest
+                    )
+                    total_size += filesize
+                    file_relpath = os.path.join(
+                        PARITY_DIRNAME,
+                        os.path.relpath(parity_abspath, self.parity_abspath),
+                    )
+                    fd.write("%s = %s\n" % (digest, file_relpath))
                     total_files += 1
-        total_size += os.path.getsize(index_path)
+        if compressed_abspaths:
+            # after the parity files, computed on the original content
+            with tracer.span("compress", files=len(compressed_abspaths)) as span:
+                saved_size = self.compress_files(compressed_abspaths)
+                span.set_attribute("saved_bytes", saved_size)
+            total_size -= saved_size
+        if self.use_compact_index:
+            with tracer.span("compact_index"):
+                write_compact_index(
+                    index_path, self.sent_index_abspath, self.config.compact_index
+                )
+        total_size += os.path.getsize(self.sent_index_abspath)
         logger.info(
             "%s file(s), %s byte(s), prepared in '%s'.",
             total_files,
@@ -190,6 +324,170 @@ class DirectorySender:
         )
         return total_files, total_size
 
+    def write_file_entries(
+        self, fd, file_abspath: str, file_relpath: str
+    ) -> List[Tuple[str, int, bool]]:
+        """hash a file (or each of its chunks) and write its entries to an index file
+
+        :return: for each entry, the file to send, its size and `True` if it must be compressed
+        """
+        chunk_size = self.config.chunk_size
+        if chunk_size and not self.use_parity:
+            file_size = os.path.getsize(file_abspath)
+            if file_size > chunk_size:
+                return self.write_chunk_entries(
+                    fd, file_abspath, file_relpath, file_size
+                )
+        with self.config.tracer.span("prepare_file", path=file_relpath) as span:
+            digest, filesize = self.prepare_file(file_abspath, self.config.digest)
+            span.set_attribute("bytes", filesize)
+            compress = should_compress(file_abspath, self.config.compression)
+            if compress:
+                span.set_attribute("encoding", ENCODING_GZIP)
+                fd.write("[encoding %s]\n" % ENCODING_GZIP)
+        if self.use_carousel:
+            fd.write("[size %s]\n" % filesize)
+        fd.write("%s = %s\n" % (digest, file_relpath))
+        return [(file_abspath, filesize, compress)]
+
+    def write_chunk_entries(
+        self, fd, file_abspath: str, file_relpath: str, file_size: int
+    ) -> List[Tuple[str, int, bool]]:
+        """hash each chunk of a file larger than `config.chunk_size`, and the whole file, and write the entries of
+        its chunks to an index file (see :mod:`hairgap.chunks`); chunks are sent as byte ranges of the file
+
+        :return: for each chunk, the file to send, the size of the chunk and `False` (chunks are not compressed)
+        """
+        chunk_size = self.config.chunk_size
+        with self.config.tracer.span(
+            "prepare_file", path=file_relpath, bytes=file_size
+        ) as span:
+            digests, file_digest = hash_chunks(
+                file_abspath, chunk_size, self.config.digest
+            )
+            span.set_attribute("chunks", len(digests))
+        entries = []
+        for index, digest in enumerate(digests):
+            fd.write(
+                "[chunk %s %s %s %s]\n" % (index, chunk_size, file_size, file_digest)
+            )
+            fd.write("%s = %s\n" % (digest, file_relpath))
+            size = min(chunk_size, file_size - index * chunk_size)
+            entries.append((file_abspath, size, False))
+        return entries
+
+    def prepare_directory_segmented(self) -> Tuple[int, int]:
+        """write the header index of a segmented transfer (see :mod:`hairgap.segments`); files are hashed when sent
+
+        :return: the number of files and their total size (including the index and segment files), before any chunking
+            or compression
+        """
+        ensure_dir(self.index_abspath)
+        with open(self.index_abspath, "w") as fd:
+            self.write_index_header(fd)
+            if self.config.digest != DEFAULT_DIGEST:
+                fd.write("[digest %s]\n" % self.config.digest)
+            fd.write("[segmented]\n")
+            fd.write("[files]\n")
+        for abspath in (self.segments_abspath, self.compressed_abspath):
+            if os.path.isdir(abspath):
+                # segments and compressed files of a previous preparation
+                shutil.rmtree(abspath)
+        files, size = 0, 0
+        for batch in iter_batches(self.transfer_abspath, 1):
+            files += 1
+            size += os.path.getsize(batch[0][0])
+        segments = (files + self.config.index_segment_files - 1) // (
+            self.config.index_segment_files
+        )
+        logger.info(
+            "%s file(s), %s byte(s), to send in %s segment(s) from '%s'.",
+            files,
+            size,
+            segments,
+            self.transfer_abspath,
+        )
+        return files + segments + 2, size + os.path.getsize(self.index_abspath)
+
+    @staticmethod
+    def prepare_file(
+        file_abspath: str, algorithm: str = DEFAULT_DIGEST
+    ) -> Tuple[str, int]:
+        """compute the digest of a file (files starting by a special value are escaped when they are sent)
+
+        :param algorithm: see :mod:`hairgap.digests`
+        :return: the digest of the original content, and its size
+        """
+        filesize = os.path.getsize(file_abspath)
+        return get_file_digest(file_abspath, algorithm), filesize
+
+    def compress_files(self, files: List[Tuple[str, str]]) -> int:
+        """write compressed copies of files in :attr:`compressed_abspath` and return the number of saved bytes
+
+        :param files: list of (absolute path, relative path); source files are not modified
+        """
+        saved_size = 0
+        for file_abspath, file_relpath in files:
+            dst_abspath = os.path.join(self.compressed_abspath, file_relpath)
+            ensure_dir(dst_abspath, parent=True)
+            tmp_abspath = dst_abspath + ".tmp"
+            filesize = os.path.getsize(file_abspath)
+            saved_size += filesize - compress_file(file_abspath, tmp_abspath)
+            os.replace(tmp_abspath, dst_abspath)
+        logger.info("%s file(s) compressed, %s byte(s) saved.", len(files), saved_size)
+        return saved_size
+
+    @staticmethod
+    def open_file(
+        file_abspath: str, byte_range: Optional[Tuple[int, int]] = None
+    ) -> BinaryIO:
+        """open a file to send, or only a byte range (offset, length) of this file"""
+        if byte_range is None:
+            return open(file_abspath, "rb")
+        return FileRange(file_abspath, *byte_range)
+
+    @classmethod
+    def get_file_header(
+        cls, file_abspath: str, byte_range: Optional[Tuple[int, int]] = None
+    ) -> bytes:
+        """return the bytes to send before the content of a data file (or of a byte range of this file):
+        a magic value for empty files and for files starting by a special value, nothing otherwise
+        """
+        with cls.open_file(file_abspath, byte_range) as fd:
+            prefix = fd.read(len(HAIRGAP_MAGIC_NUMBER_INDEX.encode()))
+        if not prefix:
+            return HAIRGAP_MAGIC_NUMBER_EMPTY.encode()
+        elif prefix in HAIRGAP_PREFIXES:
+            return HAIRGAP_MAGIC_NUMBER_ESCAPE.encode()
+        return b""
+
+    def prepare_parity_files(self, data_abspaths: List[str]) -> List[str]:
+        """create the parity files of each group of data files (in the index order), in :attr:`parity_abspath`
+
+        :return: the list of created parity files
+        """
+        group_size = self.config.parity_group_size
+        parity_count = self.config.parity_count
+        if os.path.isdir(self.parity_abspath):
+            # parity files of a previous preparation
+            shutil.rmtree(self.parity_abspath)
+        parity_abspaths = []
+        for group_index, start in enumerate(range(0, len(data_abspaths), group_size)):
+            group_abspaths = [
+                os.path.join(self.parity_abspath, "%s.%s" % (group_index, parity_index))
+                for parity_index in range(parity_count)
+            ]
+            write_parity_files(
+                data_abspaths[start : start + group_size], group_abspaths
+            )
+            parity_abspaths += group_abspaths
+        logger.info(
+            "%s parity file(s) created in '%s'.",
+            len(parity_abspaths),
+            self.parity_abspath,
+        )
+        return parity_abspaths
+
     @staticmethod
     def archive_and_split_directory(
         config: Config,
@@ -199,7 +497,7 @@ class DirectorySender:
         prefix: str = "content.tar.gz.",
     ):
         ensure_dir(splitted_path, parent=False)
-        tar_cmd = [config.tar, "czf", "-", "-C", original_path, "."]
+        stages = DirectorySender.get_archive_stages(config, ["-C", original_path, "."])
         split_cmd = [
             config.split,
             "-b",
@@ -207,29 +505,93 @@ class DirectorySender:
             "-",
             prefix,
         ]
-        esc_tar_cmd = [shlex.quote(x) for x in tar_cmd]
-        esc_split_cmd = [shlex.quote(x) for x in split_cmd]
-        cmd = "%s | %s" % (" ".join(esc_tar_cmd), " ".join(esc_split_cmd))
         logger.info("archive and split '%s' to '%s'…", original_path, splitted_path)
-        p = subprocess.Popen(
-            cmd,  # nosec
-            shell=True,  # nosec
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
+        pipeline = Pipeline(
+            stages + [("split", split_cmd)],
             cwd=splitted_path,
+            tracer=config.tracer,
+        )
+        result = pipeline.run()
+        if not result.success:
+            logger.error(
+                "unable to run '%s'.\n%s", result.command_line, result.get_report()
+            )
+
+    @staticmethod
+    def archive_directory_chunks(
+        config: Config,
+        original_path: str,
+        archives_path: str,
+        split_size: int = 100 * 1000 * 1000,
+        prefix: str = "content.",
+    ) -> List[str]:
+        """archive whole files into self-contained .tar.gz chunks of at most `split_size` bytes of original content
+        (a larger file is alone in its chunk); chunks are compressed in parallel.
+
+        raise ValueError if a chunk cannot be created (this chunk is removed)
+
+        :return: the names of the created chunks
+        """
+        ensure_dir(archives_path, parent=False)
+        chunks = plan_shards(original_path, max_size=split_size)
+        names = ["%s%05d.tar.gz" % (prefix, index) for index in range(len(chunks))]
+        logger.info(
+            "archive '%s' to %s chunk(s) in '%s'…",
+            original_path,
+            len(chunks),
+            archives_path,
         )
-        stdout, stderr = p.communicate(b"")
-        if p.returncode:
-            logger.error("command = %s , return code = %s", cmd, p.returncode)
-            logger.error("stdout = %s\nstderr = %s", stdout.decode(), stderr.decode())
+
+        def archive_chunk(name: str, chunk: List[Tuple[str, int]]):
+            list_abspath = os.path.join(archives_path, name + ".files")
+            with open(list_abspath, "wb") as fd:
+                for file_relpath, __ in chunk:
+                    # "./" prefix: names starting by "-" must not be read as options
+                    fd.write(os.fsencode(os.path.join(".", file_relpath)) + b"\0")
+            stages = DirectorySender.get_archive_stages(
+                config, ["-C", original_path, "--null", "-T", list_abspath]
+            )
+            archive_abspath = os.path.join(archives_path, name)
+            with open(archive_abspath, "wb") as fd:
+                result = Pipeline(stages, stdout=fd, tracer=config.tracer).run()
+            os.remove(list_abspath)
+            if not result.success:
+                logger.error(
+                    "unable to run '%s'.\n%s", result.command_line, result.get_report()
+                )
+                os.remove(archive_abspath)
+                raise ValueError("Unable to archive '%s'" % archive_abspath)
+
+        # each chunk is already compressed by `compression_threads` threads
+        workers = (os.cpu_count() or 1) // (config.compression_threads or 1)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            list(executor.map(archive_chunk, names, chunks))
+        return names
+
+    @staticmethod
+    def get_archive_stages(
+        config: Config, tar_args: List[str]
+    ) -> List[Tuple[str, List[str]]]:
+        """return the pipeline stages writing a .tar.gz archive to their standard output
+
+        :param tar_args: the files to archive (with their `-C` options)
+        :return: `tar czf -`, or `tar cf -` followed by a parallel compression when `config.compression_threads` is set
+        """
+        if not config.compression_threads:
+            return [("tar", [config.tar, "czf", "-"] + tar_args)]
+        return [
+            ("tar", [config.tar, "cf", "-"] + tar_args),
+            ("gzip", pgzip.get_command(config.compression_threads)),
+        ]
 
     def split_source_files(self, dir_abspath: str, split_size: int):
         """transform some files into a single, splitted, archive
+        (or into several self-contained archives with `config.split_archives`)
 
         move the content of the source folder in a subfolder
         create another folder in the same source folder
         create a tar.gz file with the first subfolder and split it into chunks into the second subfolder
+        (or create a tar.gz file per chunk of whole files)
         remove the first subfolder
         move the content of the second subfolder to its parent
         remove the second subfolder"""
@@ -242,9 +604,24 @@ class DirectorySender:
         ensure_dir(folder_1, parent=False)
         for name in names:
             os.rename(os.path.join(dir_abspath, name), os.path.join(folder_1, name))
-        self.archive_and_split_directory(
-            self.config, folder_1, folder_2, split_size=split_size
-        )
+        if self.config.split_archives:
+            try:
+                self.archive_directory_chunks(
+                    self.config, folder_1, folder_2, split_size=split_size
+                )
+            except ValueError:
+                # the source directory is restored
+                for name in names:
+                    os.rename(
+                        os.path.join(folder_1, name), os.path.join(dir_abspath, name)
+                    )
+                shutil.rmtree(folder_1)
+                shutil.rmtree(folder_2)
+                raise
+        else:
+            self.archive_and_split_directory(
+                self.config, folder_1, folder_2, split_size=split_size
+            )
         names = os.listdir(folder_2)
         shutil.rmtree(folder_1)
         for name in names:
@@ -273,77 +650,390 @@ class DirectorySender:
             raise ValueError("missing index '%s'.", index_path)
         logger.info("sending '%s'…", self.transfer_abspath)
         start = time.time()
-        if self.use_tar_archives:
-            self.send_directory_tar(port=port)
-        else:
-            self.send_directory_no_tar(port=port)
+        self.sent_file_count = 0
+        self.start_progress()
+        try:
+            with self.config.tracer.span(
+                "send", directory=self.transfer_abspath, tar=self.use_tar_archives
+            ):
+                if self.use_tar_archives:
+                    self.send_directory_tar(port=port)
+                else:
+                    self.send_directory_no_tar(port=port)
+        except ValueError:
+            self.add_history_record(STATUS_FAILED, time.time() - start)
+            raise
+        finally:
+            self.progress.finish()
         end = time.time()
+        self.add_history_record(STATUS_COMPLETE, end - start)
         logger.info(
             "directory '%s' sent in %s seconds.", self.transfer_abspath, (end - start)
         )
 
+    def start_progress(self):
+        """reset the progress, with the expected number of files and bytes (from `prepare_directory` if possible)
+
+        the size of a compressed tar archive is unknown: its uncompressed size is only expected when the bytes are
+        counted before a separate compression command (`config.compression_threads`)
+        """
+        if self.prepared_size and self.prepared_size[1]:
+            files, size = self.prepared_size
+        else:
+            files, size = self.get_directory_size()
+        if self.use_tar_archives:
+            self.progress.start(files, size if self.config.compression_threads else 0)
+            return
+        cycles = max(self.config.carousel_repeat, 1) if self.use_carousel else 1
+        self.progress.start(
+            files * cycles, size * cycles, end_delay_s=self.config.end_delay_s
+        )
+
+    def get_directory_size(self) -> Tuple[int, int]:
+        """return the number of files and the total size of the directory to send (including the index file)"""
+        files, size = 1, os.path.getsize(self.index_abspath)
+        for root, dirnames, filenames in os.walk(self.transfer_abspath):
+            for filename in filenames:
+                file_abspath = os.path.join(root, filename)
+                if os.path.isfile(file_abspath):
+                    files += 1
+                    size += os.path.getsize(file_abspath)
+        return files, size
+
     def send_directory_tar(self, port: Optional[int] = None):
         """send all files using hairgap, using the tar method.
 
         :param port: the port to send to, overriding the default config
         """
+        self.sent_file_count += 1
         dir_abspath = self.transfer_abspath
         index_path = self.index_abspath
-        tar_cmd = [
-            self.config.tar,
-            "czf",
-            "-",
-            "-C",
-            os.path.dirname(index_path),
-            os.path.basename(index_path),
-            "-C",
-            os.path.dirname(dir_abspath),
-            os.path.basename(dir_abspath),
-        ]
+        stages = self.get_archive_stages(
+            self.config,
+            [
+                "-C",
+                os.path.dirname(index_path),
+                os.path.basename(index_path),
+                "-C",
+                os.path.dirname(dir_abspath),
+                os.path.basename(dir_abspath),
+            ],
+        )
         # we use gzip, not for compression (most files are probably already compressed) but for the CRC checksum
         # we cannot use more efficient algorithms like xz/bz2 (they cannot compress streams)
         logger.info("sending %s via hairgap …", dir_abspath)
         hairgap_cmd = self.get_hairgap_command(self.config, port)
+        for name, cmd in stages:
+            logger.debug("%s command: '%s'.", name, " ".join(cmd))
+        if hairgap_cmd is None:
+            self.send_archive_transport(stages, port=port)
+            return
         logger.debug("hairgaps command: '%s'.", " ".join(hairgap_cmd))
-        logger.debug("tar command: '%s'.", " ".join(tar_cmd))
-        esc_tar_cmd = [shlex.quote(x) for x in tar_cmd]
-        esc_hairgap_cmd = [shlex.quote(x) for x in hairgap_cmd]
-        cmd = "%s|%s" % (" ".join(esc_tar_cmd), " ".join(esc_hairgap_cmd))
-        p = subprocess.Popen(
-            cmd,
-            shell=True,  # nosec
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-        )
-        stdout, stderr = p.communicate(b"")
-        time.sleep(self.config.end_delay_s)
-        if p.returncode:
+        with self.config.tracer.span("hairgaps"):
+            # count the archive before its compression when it is a separate command
+            pipeline = Pipeline(
+                stages + [("hairgaps", hairgap_cmd)],
+                tracer=self.config.tracer,
+                progress=self.progress.add_bytes,
+                progress_stage=stages[-1][0] if len(stages) > 1 else None,
+            )
+            result = pipeline.run()
+        with self.config.tracer.span("end_delay"):
+            time.sleep(self.config.end_delay_s)
+        if not result.success:
             logger.error(
-                "unable to run '%s'.\nreturncode=%s\nstdout=%r\nstderr=%r\n",
-                " ".join(cmd),
-                p.returncode,
-                stdout.decode(),
-                stderr.decode(),
+                "unable to run '%s'.\n%s", result.command_line, result.get_report()
             )
             raise ValueError("Unable to send '%s'" % dir_abspath)
+        bottleneck = result.get_bottleneck()
+        logger.info(
+            "%s sent via hairgap (bottleneck: %s).",
+            dir_abspath,
+            bottleneck.name if bottleneck else None,
+        )
+
+    def send_archive_transport(
+        self, stages: List[Tuple[str, List[str]]], port: Optional[int] = None
+    ):
+        """write the archive to a temporary file, then send it with a transport that is not an external command
+
+        :param stages: the pipeline writing the archive, see :meth:`get_archive_stages`
+        """
+        dir_abspath = self.transfer_abspath
+        config = self.config
+        with tempfile.TemporaryFile() as tmp_fd:
+            result = Pipeline(stages, stdout=tmp_fd, tracer=config.tracer).run()
+            if not result.success:
+                logger.error(
+                    "unable to run '%s'.\n%s", result.command_line, result.get_report()
+                )
+                raise ValueError("Unable to send '%s'" % dir_abspath)
+            self.progress.set_total_bytes(os.fstat(tmp_fd.fileno()).st_size)
+            tmp_fd.seek(0)
+            with config.tracer.span("hairgaps"):
+                try:
+                    config.transport.send(
+                        config,
+                        tmp_fd,
+                        port or config.destination_port,
+                        progress=self.progress.add_bytes,
+                    )
+                except ValueError as e:
+                    logger.error("unable to send '%s': %s", dir_abspath, e)
+                    raise ValueError("Unable to send '%s'" % dir_abspath)
+        with config.tracer.span("end_delay"):
+            time.sleep(config.end_delay_s)
 
     def send_directory_no_tar(self, port: Optional[int] = None):
-        """send all files using hairgap"""
+        """send all files using hairgap.
+
+        In carousel mode, the index and all files are sent several times."""
+        if self.use_segments:
+            self.send_directory_segmented(port=port)
+            return
+        if not self.use_carousel:
+            self.send_directory_cycle(port=port)
+            return
+        start = time.time()
+        deadline_s = self.config.carousel_deadline_s
+        cycle = 0
+        while cycle < self.config.carousel_repeat or (
+            deadline_s and time.time() - start < deadline_s
+        ):
+            logger.info("sending '%s' (cycle %s)…", self.transfer_abspath, cycle + 1)
+            self.send_directory_cycle(port=port)
+            cycle += 1
+
+    def send_directory_cycle(self, port: Optional[int] = None):
+        """send the index and all files once"""
+        self.send_file(
+            self.config,
+            self.sent_index_abspath,
+            port=port,
+            progress=self.progress.add_bytes,
+        )
+        self.sent_file_count += 1
+        self.progress.add_file()
+        self.send_index_files(self.index_abspath, port=port)
+
+    def send_directory_segmented(self, port: Optional[int] = None):
+        """send the header index, then each segment followed by its files;
+        the next segment is prepared in a separate thread while the files of the current one are sent
+
+        if a file cannot be sent, the preparation of the next segment is stopped before the error is raised
+        """
+        self.send_file(
+            self.config, self.index_abspath, port=port, progress=self.progress.add_bytes
+        )
+        self.sent_file_count += 1
+        self.progress.add_file()
+        cancelled = threading.Event()
+        segments = self.iter_segments(cancelled=cancelled)
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(next, segments, None)
+                try:
+                    while True:
+                        segment_abspath = future.result()
+                        if segment_abspath is None:
+                            break
+                        future = executor.submit(next, segments, None)
+                        self.send_file(
+                            self.config,
+                            segment_abspath,
+                            port=port,
+                            progress=self.progress.add_bytes,
+                        )
+                        self.sent_file_count += 1
+                        self.progress.add_file()
+                        self.send_index_files(segment_abspath, port=port)
+                finally:
+                    # the prefetched segment stops after its current file
+                    cancelled.set()
+                    future.cancel()
+        finally:
+            segments.close()
+
+    def iter_segments(
+        self, cancelled: Optional[threading.Event] = None
+    ) -> Iterator[str]:
+        """yield the segments of the transfer, the trailer being the last one
+
+        segments kept by a previous call are yielded first, then the remaining files are hashed batch by batch
+
+        :param cancelled: stop as soon as this event is set (the current segment is not kept)
+        """
+        header_digest = get_file_digest(self.index_abspath, DIGEST_SHA256)
+        ensure_dir(self.segments_abspath, parent=False)
+        names = sorted(
+            x for x in os.listdir(self.segments_abspath) if x.endswith(".txt")
+        )
+        excluded = set()  # type: Set[str]
+        for name in names:
+            segment_abspath = os.path.join(self.segments_abspath, name)
+            relpaths, is_trailer = read_segment_relpaths(segment_abspath)
+            excluded |= relpaths
+            yield segment_abspath
+            if is_trailer:
+                return
+        index = len(names)
+        file_count = len(excluded)
+        batches = iter_batches(
+            self.transfer_abspath, self.config.index_segment_files, excluded=excluded
+        )
+        for batch in batches:
+            with self.config.tracer.span(
+                "prepare_segment", segment=index, files=len(batch)
+            ):
+                segment_abspath = self.write_segment(
+                    index, header_digest, batch, cancelled=cancelled
+                )
+            if segment_abspath is None:
+                return
+            yield segment_abspath
+            index += 1
+            file_count += len(batch)
+        yield self.write_segment(
+            index, header_digest, [], trailer="[end %s %s]\n" % (index, file_count)
+        )
+
+    def write_segment(
+        self,
+        index: int,
+        header_digest: str,
+        batch: List[Tuple[str, str]],
+        trailer: str = "",
+        cancelled: Optional[threading.Event] = None,
+    ) -> Optional[str]:
+        """hash (and compress) a batch of files, and write their segment
+
+        :param batch: list of (absolute path, relative path)
+        :param cancelled: stop before the next file as soon as this event is set
+        :return: the path of the segment (`None` if cancelled)
+        """
+        segment_abspath = os.path.join(self.segments_abspath, get_segment_name(index))
+        compressed_abspaths = []
+        with open(segment_abspath + ".tmp", "w") as fd:
+            fd.write(HAIRGAP_MAGIC_NUMBER_SEGMENT)
+            fd.write("[segment %s %s]\n" % (index, header_digest))
+            for file_abspath, file_relpath in batch:
+                if cancelled is not None and cancelled.is_set():
+                    break
+                entries = self.write_file_entries(fd, file_abspath, file_relpath)
+                compressed_abspaths += [(x[0], file_relpath) for x in entries if x[2]]
+            fd.write(trailer)
+        if cancelled is not None and cancelled.is_set():
+            os.remove(segment_abspath + ".tmp")
+            return None
+        if compressed_abspaths:
+            self.compress_files(compressed_abspaths)
+        # a segment is kept only when all its files are ready
+        os.replace(segment_abspath + ".tmp", segment_abspath)
+        return segment_abspath
+
+    def send_index_files(self, index_path: str, port: Optional[int] = None):
+        """send the files listed by an index file (or by an index segment)"""
         dir_abspath = self.transfer_abspath
-        index_path = self.index_abspath
-        self.send_file(self.config, index_path, port=port)
+        encoding = None
+        chunk = None
         with open(index_path) as fd:
             for line in fd:
+                # [encoding …] and [chunk …] apply to the next file
+                matcher = re.match(ENCODING_PATTERN, line)
+                if matcher:
+                    encoding = matcher.group(1)
+                    continue
+                if line.startswith("[chunk "):
+                    chunk = parse_chunk(line)
+                    continue
                 matcher = re.match(FILENAME_PATTERN, line)
                 if not matcher:
                     continue
                 file_relpath = matcher.group(2)
                 actual_sha256 = matcher.group(1)
                 file_abspath = os.path.join(dir_abspath, file_relpath)
+                if file_relpath.startswith(PARITY_DIRNAME + "/"):
+                    file_abspath = os.path.join(
+                        self.parity_abspath, file_relpath[len(PARITY_DIRNAME) + 1 :]
+                    )
+                elif encoding == ENCODING_GZIP:
+                    file_abspath = os.path.join(self.compressed_abspath, file_relpath)
+                # a chunk is a byte range of the file
+                chunk_range = None
+                if chunk is not None:
+                    chunk_range = (chunk[0] * chunk[1], chunk[1])
                 self.send_file(
-                    self.config, file_abspath, sha256=actual_sha256, port=port
+                    self.config,
+                    file_abspath,
+                    sha256=actual_sha256,
+                    port=port,
+                    progress=self.progress.add_bytes,
+                    escape=True,
+                    encoding=encoding,
+                    byte_range=chunk_range,
                 )
+                encoding = None
+                chunk = None
+                self.sent_file_count += 1
+                self.progress.add_file()
+
+    def add_history_record(self, status: str, send_duration_s: float):
+        """add a report of the last `send_directory` to the history (if `config.history_path` is set)"""
+        if not self.config.history_path:
+            return
+        files, size = self.get_directory_size()
+        durations = {
+            "send": send_duration_s,
+            "end_delay": self.sent_file_count * (self.config.end_delay_s or 0.0),
+        }
+        if self.prepare_duration_s is not None:
+            durations["prepare"] = self.prepare_duration_s
+        index_sha256 = hashlib.sha256()
+        with open(self.sent_index_abspath, "rb") as fd:
+            for data in iter(lambda: fd.read(65536), b""):
+                index_sha256.update(data)
+        record = TransferRecord(
+            SIDE_SENDER,
+            index_sha256.hexdigest(),
+            status=status,
+            attributes=self.get_attributes(),
+            files=files,
+            size=size,
+            duration_s=send_duration_s,
+            durations=durations,
+        )
+        add_record(self.config, record)
+
+    @staticmethod
+    def get_message_content(
+        data: bytes, attributes: Optional[Dict[str, str]] = None
+    ) -> bytes:
+        """encode a message and its attributes, as expected by :meth:`Receiver.read_message`"""
+        header = HAIRGAP_MAGIC_NUMBER_MESSAGE
+        for k, v in sorted((attributes or {}).items()):
+            header += "%s = %s\n" % (k, v.replace("\n", ""))
+        header += "\n"
+        return header.encode() + data
+
+    @classmethod
+    def send_message(
+        cls,
+        config: Config,
+        data: bytes,
+        attributes: Optional[Dict[str, str]] = None,
+    ):
+        """send a small message on the express port, without waiting for the end of bulk transfers.
+
+        :param config: `config.express_port` must be set
+        :param data: content of the message
+        :param attributes: attributes of the message (same constraints as :meth:`get_attributes`)
+        """
+        if not config.express_port:
+            raise ValueError("no express port is configured")
+        with tempfile.NamedTemporaryFile() as fd:
+            fd.write(cls.get_message_content(data, attributes))
+            fd.flush()
+            cls.send_file(config, fd.name, port=config.express_port)
 
     @classmethod
     def send_file(
@@ -352,20 +1042,35 @@ class DirectorySender:
         file_abspath: str,
         sha256: Optional[str] = None,
         port: Optional[int] = None,
+        progress: Optional[Callable[[int], None]] = None,
+        escape: bool = False,
+        encoding: Optional[str] = None,
+        byte_range: Optional[Tuple[int, int]] = None,
     ):
+        """send a single file
+
+        :param sha256: digest of the file, only logged
+        :param progress: called with the number of sent bytes, see :meth:`hairgap.transport.Transport.send`
+        :param escape: the file is a data file, that must be escaped if it starts with a special value
+        :param encoding: the file has been compressed by :meth:`prepare_directory` (see :mod:`hairgap.compression`)
+        :param byte_range: (offset, length) to only send a part of the file, like a chunk (see :mod:`hairgap.chunks`)
+        """
         if not os.path.isfile(file_abspath):
             logger.warning("missing file '%s'.", file_abspath)
             raise ValueError("Missing file '%s'." % file_abspath)
-        empty_file_fd = None
         file_size = os.path.getsize(file_abspath)
-        if file_size == 0:
+        if byte_range is not None:
+            file_size = max(0, min(byte_range[1], file_size - byte_range[0]))
+        header = b""
+        if encoding == ENCODING_GZIP:
+            header = HAIRGAP_MAGIC_NUMBER_GZIP.encode()
+        elif escape:
+            header = cls.get_file_header(file_abspath, byte_range=byte_range)
+        elif file_size == 0:
             # we cannot send empty files
-            empty_file_fd = tempfile.NamedTemporaryFile(delete=True)
-            empty_file_fd.write(HAIRGAP_MAGIC_NUMBER_EMPTY.encode())
-            empty_file_fd.flush()
-            file_abspath = empty_file_fd.name
+            header = HAIRGAP_MAGIC_NUMBER_EMPTY.encode()
         if sha256:
-            msg = "Sending %s via hairgap [sha526=%s, size=%s]…" % (
+            msg = "Sending %s via hairgap [digest=%s, size=%s]…" % (
                 file_abspath,
                 sha256,
                 file_size,
@@ -376,51 +1081,29 @@ class DirectorySender:
                 port or config.destination_port,
             )
         logger.info(msg)
-        cmd = cls.get_hairgap_command(config, port)
-        logger.info(" ".join(cmd))
-        with open(file_abspath, "rb") as tmp_fd:
-            p = subprocess.Popen(
-                cmd, stdin=tmp_fd, stderr=subprocess.PIPE, stdout=subprocess.PIPE
-            )
-            stdout, stderr = p.communicate()
-            if p.returncode:
-                logger.error(
-                    "unable to run '%s'.\nreturncode=%s\nstdout=%r\nstderr=%r\n",
-                    " ".join(cmd),
-                    p.returncode,
-                    stdout.decode(),
-                    stderr.decode(),
+        with cls.open_file(file_abspath, byte_range) as tmp_fd, config.tracer.span(
+            "hairgaps", path=file_abspath, bytes=file_size
+        ):
+            try:
+                config.transport.send(
+                    config,
+                    tmp_fd,
+                    port or config.destination_port,
+                    progress=progress,
+                    header=header,
                 )
+            except ValueError as e:
+                logger.error("unable to send '%s': %s", file_abspath, e)
                 raise ValueError("Unable to send '%s'" % file_abspath)
         logger.info(
             "file '%s' sent; sleeping for %ss.", file_abspath, config.end_delay_s
         )
-        if empty_file_fd is not None:
-            empty_file_fd.close()
-        time.sleep(config.end_delay_s)
+        with config.tracer.span("end_delay"):
+            time.sleep(config.end_delay_s)
 
     @staticmethod
-    def get_hairgap_command(config: Config, port: Optional[int]):
-        cmd = [
-            str(config.hairgaps_path),
-            "-p",
-            str(port or config.destination_port),
-        ]
-        if config.redundancy:
-            cmd += [
-                "-r",
-                str(config.redundancy),
-            ]
-        if config.error_chunk_size:
-            cmd += [
-                "-N",
-                str(config.error_chunk_size),
-            ]
-        if config.max_rate_mbps:
-            cmd += ["-b", str(config.max_rate_mbps)]
-        if config.mtu_b:
-            cmd += ["-M", str(config.mtu_b)]
-        if config.keepalive_ms:
-            cmd += ["-k", str(config.keepalive_ms)]
-        cmd.append(config.destination_ip)
-        return cmd
+    def get_hairgap_command(config: Config, port: Optional[int]) -> Optional[List[str]]:
+        """return the command that sends its standard input, or `None` if the transport is not a command"""
+        return config.transport.get_send_command(
+            config, port or config.destination_port
+        )
@@ -0,0 +1,305 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Split huge directories into bounded sub-transfers (shards).
+
+Each shard is a complete transfer, with its own index file, linked to its parent transfer by three attributes.
+A lost shard does not compromise the other ones, and the receiver can process each shard as soon as it is received.
+Incomplete transfers are forgotten by the receiver after a delay (or when too many transfers are incomplete), and
+reported by :meth:`ShardedReceiver.shard_missing`.
+
+.. code-block:: python
+
+    sender = ShardedDirectorySender(config, max_shard_size=10 * 1000 * 1000 * 1000)
+    sender.prepare_directory()  # moves files into shards
+    sender.send_directory()  # can be called again to resend the shards that were not sent
+
+"""
+
+import logging
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from hairgap.receiver import Receiver
+from hairgap.sender import DirectorySender
+from hairgap.utils import Config, ensure_dir, plan_shards
+
+logger = logging.getLogger(__name__)
+
+SHARD_PARENT_ATTRIBUTE = "hairgap_parent"
+SHARD_INDEX_ATTRIBUTE = "hairgap_shard"
+SHARD_COUNT_ATTRIBUTE = "hairgap_shards"
+SHARD_ATTRIBUTES = {
+    SHARD_PARENT_ATTRIBUTE,
+    SHARD_INDEX_ATTRIBUTE,
+    SHARD_COUNT_ATTRIBUTE,
+}
+
+
+class ShardSender(DirectorySender):
+    """send a single shard, with the attributes of its parent transfer"""
+
+    def __init__(
+        self,
+        config: Config,
+        parent: "ShardedDirectorySender",
+        shard_index: int,
+        shard_count: int,
+    ):
+        super().__init__(config)
+        self.parent = parent
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+
+    def get_attributes(self) -> Dict[str, str]:
+        attributes = self.parent.get_attributes()
+        attributes[SHARD_PARENT_ATTRIBUTE] = self.parent.get_transfer_id()
+        attributes[SHARD_INDEX_ATTRIBUTE] = str(self.shard_index)
+        attributes[SHARD_COUNT_ATTRIBUTE] = str(self.shard_count)
+        return attributes
+
+    @property
+    def transfer_abspath(self) -> str:
+        return os.path.join(self.parent.shards_abspath, str(self.shard_index))
+
+    @property
+    def index_abspath(self):
+        return os.path.join(self.parent.shards_abspath, "%s.txt" % self.shard_index)
+
+
+class ShardedDirectorySender(DirectorySender):
+    """Send the content of a directory as several independent transfers.
+
+    Like :class:`DirectorySender`, must be subclassed to implement `transfer_abspath` and `index_abspath`.
+    The index file only stores the identifier of the transfer and the number of shards.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        max_shard_size: Optional[int] = None,
+        max_shard_files: Optional[int] = None,
+    ):
+        super().__init__(config)
+        self.max_shard_size = max_shard_size
+        self.max_shard_files = max_shard_files
+        self._transfer_id = None  # type: Optional[str]
+
+    def get_transfer_id(self) -> str:
+        """return a unique identifier, shared by all shards (stored in the index file)"""
+        if self._transfer_id is None and os.path.isfile(self.index_abspath):
+            with open(self.index_abspath) as fd:
+                for line in fd:
+                    key, sep, value = line.rstrip("\n").partition(" = ")
+                    if key == SHARD_PARENT_ATTRIBUTE:
+                        self._transfer_id = value
+        if self._transfer_id is None:
+            self._transfer_id = str(uuid.uuid4())
+        return self._transfer_id
+
+    @property
+    def shards_abspath(self) -> str:
+        """directory where shards are prepared"""
+        return self.transfer_abspath.rstrip("/") + ".shards"
+
+    def get_shard_senders(self) -> List[ShardSender]:
+        """return the senders of the prepared shards that have not been sent yet"""
+        if not os.path.isdir(self.shards_abspath):
+            return []
+        shard_count = 0
+        with open(self.index_abspath) as fd:
+            for line in fd:
+                key, sep, value = line.rstrip("\n").partition(" = ")
+                if key == SHARD_COUNT_ATTRIBUTE:
+                    shard_count = int(value)
+        indices = sorted(int(x) for x in os.listdir(self.shards_abspath) if x.isdigit())
+        return [ShardSender(self.config, self, x, shard_count) for x in indices]
+
+    def prepare_directory(self) -> Tuple[int, int]:
+        """move files into shards, and prepare each shard.
+        An empty directory gives a single empty shard, so the receiver still completes the transfer.
+
+        :return: the total number of files and their total size (including index files)
+        """
+        dir_abspath = self.transfer_abspath
+        shards = plan_shards(
+            dir_abspath, max_size=self.max_shard_size, max_files=self.max_shard_files
+        ) or [[]]
+        logger.info("'%s' split into %s shard(s).", dir_abspath, len(shards))
+        for shard_index, shard in enumerate(shards):
+            shard_abspath = os.path.join(self.shards_abspath, str(shard_index))
+            ensure_dir(shard_abspath, parent=False)
+            for file_relpath, __ in shard:
+                dst_abspath = os.path.join(shard_abspath, file_relpath)
+                ensure_dir(dst_abspath, parent=True)
+                os.rename(os.path.join(dir_abspath, file_relpath), dst_abspath)
+        ensure_dir(self.index_abspath)
+        with open(self.index_abspath, "w") as fd:
+            fd.write("%s = %s\n" % (SHARD_PARENT_ATTRIBUTE, self.get_transfer_id()))
+            fd.write("%s = %s\n" % (SHARD_COUNT_ATTRIBUTE, len(shards)))
+        total_files, total_size = 0, 0
+        for sender in self.get_shard_senders():
+            files, size = sender.prepare_directory()
+            total_files += files
+            total_size += size
+        return total_files, total_size
+
+    def send_directory(self, port: Optional[int] = None):
+        """send each shard and remove it once sent.
+
+        A failed shard does not prevent the next ones from being sent, but a `ValueError` is raised at the end.
+        Shards that have not been sent are kept, so this method can be called again.
+        """
+        failed = []
+        for sender in self.get_shard_senders():
+            try:
+                sender.send_directory(port=port)
+            except Exception as e:
+                logger.exception("unable to send shard %s: %s", sender.shard_index, e)
+                failed.append(sender.shard_index)
+                continue
+            shutil.rmtree(sender.transfer_abspath)
+            os.remove(sender.index_abspath)
+        if failed:
+            raise ValueError(
+                "unable to send shard(s) %s" % ", ".join(str(x) for x in failed)
+            )
+        if os.path.isdir(self.shards_abspath):
+            shutil.rmtree(self.shards_abspath)
+
+
+class PendingShards:
+    """shards received for a parent transfer that is not complete yet"""
+
+    def __init__(self, shard_count: int):
+        self.shard_count = shard_count
+        self.received = set()  # type: Set[int]
+        self.error_count = 0
+        self.last_time = time.monotonic()
+
+    @property
+    def missing(self) -> List[int]:
+        return [x for x in range(self.shard_count) if x not in self.received]
+
+
+class ShardedReceiver(Receiver):
+    """call :meth:`sharded_transfer_complete` when all shards of a transfer have been received.
+
+    Subclasses must keep the shard attributes in their available attributes:
+
+    .. code-block:: python
+
+        class MyReceiver(ShardedReceiver):
+            available_attributes = ShardedReceiver.available_attributes | {"uid"}
+
+    """
+
+    available_attributes = set(SHARD_ATTRIBUTES)  # type: Set[str]
+    max_pending_transfers = 64
+    # incomplete parent transfers that are remembered; the oldest ones are forgotten first
+    pending_timeout_s = 86400.0
+    # an incomplete parent transfer is forgotten when no shard has been received for this delay
+
+    def __init__(self, config: Config, threading: bool = False, port: int = None):
+        super().__init__(config, threading=threading, port=port)
+        self.pending_shards = OrderedDict()  # type: OrderedDict[str, PendingShards]
+        # received shards of each incomplete parent transfer, the least recently updated first
+
+    def transfer_complete(self):
+        super().transfer_complete()
+        parent_id = self.current_attributes.get(SHARD_PARENT_ATTRIBUTE)
+        if not parent_id:
+            return
+        try:
+            shard_index = int(self.current_attributes[SHARD_INDEX_ATTRIBUTE])
+            shard_count = int(self.current_attributes[SHARD_COUNT_ATTRIBUTE])
+        except (KeyError, TypeError, ValueError):
+            shard_index, shard_count = -1, 0
+        if not 0 <= shard_index < shard_count:
+            logger.error(
+                "invalid shard attributes for transfer %s: %r.",
+                parent_id,
+                {x: self.current_attributes.get(x) for x in sorted(SHARD_ATTRIBUTES)},
+            )
+            return
+        pending = self.pending_shards.pop(parent_id, None) or PendingShards(shard_count)
+        self.pending_shards[parent_id] = pending
+        pending.received.add(shard_index)
+        pending.error_count += self.transfer_error_count
+        pending.last_time = time.monotonic()
+        logger.info(
+            "shard %s of %s received for transfer %s.",
+            shard_index + 1,
+            shard_count,
+            parent_id,
+        )
+        if len(pending.received) >= pending.shard_count:
+            del self.pending_shards[parent_id]
+            self.sharded_transfer_complete(parent_id, error_count=pending.error_count)
+        self.forget_pending_shards()
+
+    def forget_pending_shards(self):
+        """forget the oldest incomplete transfers, calling :meth:`shard_missing` for each of them"""
+        now = time.monotonic()
+        while self.pending_shards:
+            parent_id, pending = next(iter(self.pending_shards.items()))
+            if (
+                len(self.pending_shards) <= self.max_pending_transfers
+                and now - pending.last_time < self.pending_timeout_s
+            ):
+                break
+            del self.pending_shards[parent_id]
+            self.shard_missing(
+                parent_id,
+                pending.missing,
+                pending.shard_count,
+                error_count=pending.error_count,
+            )
+
+    def shard_missing(
+        self,
+        parent_id: str,
+        missing: List[int],
+        shard_count: int,
+        error_count: int = 0,
+    ):
+        """called when an incomplete transfer is forgotten: only some of its shards have been received.
+
+        :param parent_id: the identifier of the parent transfer
+        :param missing: indices of the shards that have not been received
+        :param shard_count: total number of shards
+        :param error_count: number of files of the received shards that have not been correctly received
+        """
+        logger.error(
+            "transfer %s is incomplete: %s shard(s) of %s missing (%s error(s)).",
+            parent_id,
+            len(missing),
+            shard_count,
+            error_count,
+        )
+
+    def sharded_transfer_complete(self, parent_id: str, error_count: int = 0):
+        """called when all shards of a transfer have been received.
+
+        :param parent_id: the identifier of the parent transfer
+        :param error_count: number of files that have not been correctly received
+        """
+        logger.info(
+            "all shards of transfer %s received (%s error(s)).", parent_id, error_count
+        )
@@ -0,0 +1,341 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Persistent queue of directories to send, and a daemon that keeps the link busy.
+
+.. code-block:: python
+
+    queue = SendQueue("/var/spool/hairgap")
+    queue.submit("/data/to/send", priority=10)
+    SpoolDaemon(Config(destination_ip="192.168.1.1"), queue).loop()
+
+Jobs are copied into the spool directory when they are submitted (since the sender can modify them in-place),
+and are sent by decreasing priority. Jobs with the same priority are sent in their submission order.
+"""
+
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from hairgap.sender import DirectorySender
+from hairgap.utils import Config, ensure_dir, now
+
+logger = logging.getLogger(__name__)
+
+STATE_PENDING = "pending"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+
+class SpoolJob:
+    """a directory waiting in the spool directory"""
+
+    def __init__(
+        self,
+        uid: str,
+        priority: int,
+        state: str,
+        submission: str,
+        attributes: Dict[str, str],
+        job_abspath: str,
+    ):
+        self.uid = uid
+        self.priority = priority
+        self.state = state
+        self.submission = submission
+        self.attributes = attributes
+        self.job_abspath = job_abspath
+
+    @property
+    def data_abspath(self) -> str:
+        return os.path.join(self.job_abspath, "data")
+
+    @property
+    def index_abspath(self) -> str:
+        return os.path.join(self.job_abspath, "index.txt")
+
+    @property
+    def prepared_abspath(self) -> str:
+        """created when `prepare_directory` is finished: the job can be sent again without any preparation"""
+        return os.path.join(self.job_abspath, "prepared")
+
+    def __repr__(self):
+        return "<SpoolJob %s (priority=%s, %s)>" % (self.uid, self.priority, self.state)
+
+
+class SendQueue:
+    """priority-ordered queue of jobs, stored in a SQLite database in the spool directory.
+
+    Every method opens its own connection, so a queue can be shared by several threads or processes
+    (for example, a running daemon and the `pyhairgap submit` command).
+    """
+
+    def __init__(self, spool_path: str, db_timeout_s: float = 30.0):
+        self.spool_path = spool_path
+        self.db_timeout_s = db_timeout_s
+        ensure_dir(self.jobs_path, parent=False)
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "uid TEXT UNIQUE NOT NULL, "
+                "priority INTEGER NOT NULL DEFAULT 0, "
+                "state TEXT NOT NULL, "
+                "submission TEXT NOT NULL, "
+                "attributes TEXT NOT NULL, "
+                "error TEXT)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_order ON jobs (state, priority, id)"
+            )
+
+    @property
+    def db_abspath(self) -> str:
+        return os.path.join(self.spool_path, "queue.sqlite3")
+
+    @property
+    def jobs_path(self) -> str:
+        return os.path.join(self.spool_path, "jobs")
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """open a connection and commit the current transaction when leaving the context"""
+        connection = sqlite3.connect(self.db_abspath, timeout=self.db_timeout_s)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get_job_path(self, uid: str) -> str:
+        return os.path.join(self.jobs_path, uid)
+
+    def submit(
+        self,
+        source: str,
+        priority: int = 0,
+        attributes: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """copy a file or a directory into the spool directory and add it to the queue.
+
+        :param source: the file or the directory to send
+        :param priority: jobs with higher priorities are sent first
+        :param attributes: extra attributes, added to the index file
+        :return: the unique id of the new job
+        """
+        uid = str(uuid.uuid4())
+        job_path = self.get_job_path(uid)
+        data_path = os.path.join(job_path, "data")
+        if os.path.isfile(source):
+            ensure_dir(data_path, parent=False)
+            shutil.copy(source, os.path.join(data_path, os.path.basename(source)))
+        elif os.path.isdir(source):
+            shutil.copytree(source, data_path)
+        else:
+            raise ValueError("missing source '%s'" % source)
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (uid, priority, state, submission, attributes) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    uid,
+                    priority,
+                    STATE_PENDING,
+                    now().strftime("%Y-%m-%dT%H:%M:%S"),
+                    json.dumps(attributes or {}),
+                ),
+            )
+        logger.info("'%s' submitted as job %s [priority=%s].", source, uid, priority)
+        return uid
+
+    def pop(self) -> Optional[SpoolJob]:
+        """mark the next pending job as running and return it (`None` if the queue is empty)"""
+        with self.connect() as connection:
+            # an immediate transaction prevents two daemons from taking the same job
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT uid FROM jobs WHERE state = ? ORDER BY priority DESC, id ASC LIMIT 1",
+                (STATE_PENDING,),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE jobs SET state = ? WHERE uid = ?", (STATE_RUNNING, row[0])
+                )
+        if row is None:
+            return None
+        return self.get_job(row[0])
+
+    def get_job(self, uid: str) -> Optional[SpoolJob]:
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT uid, priority, state, submission, attributes FROM jobs WHERE uid = ?",
+                (uid,),
+            ).fetchone()
+        if row is None:
+            return None
+        return self.job_from_row(row)
+
+    def job_from_row(self, row) -> SpoolJob:
+        return SpoolJob(
+            uid=row[0],
+            priority=row[1],
+            state=row[2],
+            submission=row[3],
+            attributes=json.loads(row[4]),
+            job_abspath=self.get_job_path(row[0]),
+        )
+
+    def get_jobs(self, state: Optional[str] = STATE_PENDING) -> List[SpoolJob]:
+        """return jobs in their sending order"""
+        query = "SELECT uid, priority, state, submission, attributes FROM jobs"
+        parameters = ()
+        if state is not None:
+            query += " WHERE state = ?"
+            parameters = (state,)
+        query += " ORDER BY priority DESC, id ASC"
+        with self.connect() as connection:
+            rows = connection.execute(query, parameters).fetchall()
+        return [self.job_from_row(row) for row in rows]
+
+    def set_state(self, job: SpoolJob, state: str, error: Optional[str] = None):
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET state = ?, error = ? WHERE uid = ?",
+                (state, error, job.uid),
+            )
+        job.state = state
+
+    def complete(self, job: SpoolJob):
+        """the job has been sent: remove its data"""
+        self.set_state(job, STATE_DONE)
+        shutil.rmtree(self.get_job_path(job.uid), ignore_errors=True)
+
+    def fail(self, job: SpoolJob, error: str):
+        """the job cannot be sent: its data are kept for a manual inspection"""
+        self.set_state(job, STATE_FAILED, error=error)
+
+    def requeue_running(self) -> int:
+        """put back in the queue jobs that were running when a previous daemon was stopped.
+
+        `prepare_directory` modifies files in-place, so a job interrupted during its preparation cannot be
+        safely prepared again and is marked as failed.
+        """
+        count = 0
+        for job in self.get_jobs(STATE_RUNNING):
+            if os.path.isfile(job.prepared_abspath):
+                self.set_state(job, STATE_PENDING)
+                count += 1
+            else:
+                self.fail(job, "interrupted during its preparation")
+        return count
+
+
+class SpoolDirectorySender(DirectorySender):
+    """send a spooled job, with the attributes expected by :class:`hairgap.cli.SimpleDirReceiver`"""
+
+    def __init__(self, config: Config, job: SpoolJob):
+        super().__init__(config)
+        self.job = job
+
+    def get_attributes(self) -> Dict[str, str]:
+        attributes = {"uid": self.job.uid, "creation": self.job.submission}
+        attributes.update(self.job.attributes)
+        return attributes
+
+    @property
+    def transfer_abspath(self) -> str:
+        return self.job.data_abspath
+
+    @property
+    def index_abspath(self):
+        return self.job.index_abspath
+
+
+class SpoolDaemon:
+    """send queued jobs, one after the other, as long as the queue is not empty"""
+
+    sender_class = SpoolDirectorySender
+
+    def __init__(self, config: Config, queue: SendQueue, poll_interval_s: float = 1.0):
+        self.config = config
+        self.queue = queue
+        self.poll_interval_s = poll_interval_s
+        self.continue_loop = True  # type: bool
+
+    def get_sender(self, job: SpoolJob) -> DirectorySender:
+        return self.sender_class(self.config, job)
+
+    def prepare_job(self, job: SpoolJob) -> bool:
+        """prepare a job (only once, even if the daemon has been restarted)"""
+        if os.path.isfile(job.prepared_abspath):
+            return True
+        try:
+            self.get_sender(job).prepare_directory()
+        except Exception as e:
+            logger.exception("unable to prepare job %s: %s", job.uid, e)
+            self.queue.fail(job, str(e))
+            return False
+        open(job.prepared_abspath, "w").close()
+        return True
+
+    def send_job(self, job: SpoolJob) -> bool:
+        logger.info("sending job %s…", job.uid)
+        try:
+            self.get_sender(job).send_directory()
+        except Exception as e:
+            logger.exception("unable to send job %s: %s", job.uid, e)
+            self.queue.fail(job, str(e))
+            return False
+        self.queue.complete(job)
+        return True
+
+    def run_pending(self) -> int:
+        """send all pending jobs and return the number of processed jobs
+
+        the next job is prepared while the current one is sent, so the link does not wait for its preparation.
+        """
+        count = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            job = self.queue.pop()
+            future = executor.submit(self.prepare_job, job) if job else None
+            while job is not None:
+                prepared = future.result()
+                next_job = self.queue.pop() if self.continue_loop else None
+                next_future = None
+                if next_job is not None:
+                    next_future = executor.submit(self.prepare_job, next_job)
+                if prepared and self.continue_loop:
+                    self.send_job(job)
+                count += 1
+                job, future = next_job, next_future
+        return count
+
+    def loop(self):
+        requeued = self.queue.requeue_running()
+        if requeued:
+            logger.warning("%s interrupted job(s) put back in the queue.", requeued)
+        logger.info("entering spool loop…")
+        while self.continue_loop:
+            if not self.run_pending():
+                time.sleep(self.poll_interval_s)
+        logger.info("spool loop exited.")
@@ -2,6 +2,7 @@
 ¾ËđƢȌҏⓂ♔
 
 """
+
 # ##############################################################################
 #  This file is part of Hairgap                                                #
 #                                                                              #
@@ -18,7 +19,35 @@
 #                                                                              #
 # ##############################################################################
 
+import os
 import unittest
+from typing import Dict
+
+from hairgap.transport import MemoryTransport
+from hairgap.utils import Config
+
+
+def write_files(dirname: str, contents: Dict[str, bytes]):
+    """create the files of a {relative path: content} dict, and their parent directories"""
+    for name, content in contents.items():
+        path = os.path.join(dirname, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fd:
+            fd.write(content)
+
+
+def get_memory_config(tmp_dir: str, **options) -> Config:
+    """configuration of transfers without tar archive and without end delay, in a :class:`MemoryTransport`"""
+    kwargs = {
+        "destination_ip": "localhost",
+        "destination_path": os.path.join(tmp_dir, "transfering"),
+        "end_delay_s": 0.0,
+        "use_tar_archives": False,
+        "transport": MemoryTransport(),
+    }
+    kwargs.update(options)
+    return Config(**kwargs)
+
 
 if __name__ == "__main__":
     unittest.main()
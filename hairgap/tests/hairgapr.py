@@ -39,7 +39,7 @@ def main():
         sock.bind((args.ip, args.p))
         sock.listen(0)
         conn, __ = sock.accept()
-        for data in iter(lambda: conn.recv(4096), b""):
+        for data in iter(lambda: conn.recv(65536), b""):
             size += len(data)
             sys.stdout.buffer.write(data)
     logger.debug("%s bytes received" % size)
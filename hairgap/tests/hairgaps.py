@@ -19,6 +19,7 @@ import argparse
 import logging
 import socket
 import sys
+import time
 
 logger = logging.getLogger("hairgaps")
 
@@ -40,9 +41,18 @@ def main():
         "waiting for data to send to %s:%s on buffer fileno %s"
         % (args.ip, args.p, sys.stdin.buffer.fileno())
     )
-    with socket.create_connection((args.ip, args.p)) as sock:
-        for data in iter(lambda: sys.stdin.buffer.read(4096), b""):
-            sock.send(data)
+    # unlike UDP, TCP requires the receiver to be ready: give it some time
+    for attempt in range(50):
+        try:
+            sock = socket.create_connection((args.ip, args.p))
+            break
+        except ConnectionRefusedError:
+            if attempt == 49:
+                raise
+            time.sleep(0.1)
+    with sock:
+        for data in iter(lambda: sys.stdin.buffer.read(65536), b""):
+            sock.sendall(data)
             size += len(data)
     logger.debug("%s bytes sent" % size)
 
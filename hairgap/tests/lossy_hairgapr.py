@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""replace the hairgapr binary with a UDP transfer over an emulated lossy link"""
+
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import sys
+
+try:
+    from hairgap.emulator import main_receive
+except ImportError:  # hairgap is not installed: use the source tree
+    sys.path.insert(
+        0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    )
+    from hairgap.emulator import main_receive
+
+
+if __name__ == "__main__":
+    main_receive()
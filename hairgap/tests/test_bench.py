@@ -0,0 +1,31 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+from unittest import TestCase
+
+from hairgap.bench import get_scenarios, run_scenario
+
+
+class TestBench(TestCase):
+    def test_get_scenarios(self):
+        actual = list(get_scenarios(["tiny"], [True, False], [None, 1000], [True]))
+        self.assertEqual(3, len(actual))
+        self.assertFalse(any(x["use_tar_archives"] and x["split_size"] for x in actual))
+
+    def test_run_scenario(self):
+        result = run_scenario("mixed", use_tar_archives=True, end_delay_s=0.1)
+        self.assertTrue(result["valid"])
+        self.assertEqual(112, result["files"])
+        self.assertGreater(result["throughput_bps"], 0)
@@ -0,0 +1,104 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+from unittest import TestCase
+
+from hairgap.calibration import (
+    check_probe,
+    get_candidates,
+    make_probe,
+    merge_results,
+    recommend_profile,
+    run_calibration,
+)
+from hairgap.transport import MemoryTransport
+from hairgap.utils import Config
+
+
+class TestCalibration(TestCase):
+    def test_probe(self):
+        candidate = {"redundancy": 1.5}
+        data = make_probe(3, 4, candidate, 1024)
+        header = check_probe(data)
+        self.assertEqual(3, header["probe"])
+        self.assertEqual(candidate, header["candidate"])
+        self.assertTrue(header["valid"])
+        self.assertFalse(check_probe(data[:-1])["valid"])
+        self.assertIsNone(check_probe(b"not a probe"))
+
+    def test_recommend_profile(self):
+        sent = [
+            {
+                "probe": 1,
+                "candidate": {"redundancy": 1.0},
+                "size": 100,
+                "sent": True,
+                "send_s": 1.0,
+            },
+            {
+                "probe": 2,
+                "candidate": {"redundancy": 1.0},
+                "size": 100,
+                "sent": True,
+                "send_s": 1.0,
+            },
+            {
+                "probe": 3,
+                "candidate": {"redundancy": 2.0},
+                "size": 100,
+                "sent": True,
+                "send_s": 1.0,
+            },
+            {
+                "probe": 4,
+                "candidate": {"redundancy": 2.0},
+                "size": 100,
+                "sent": True,
+                "send_s": 1.0,
+            },
+        ]
+        received = [
+            {"probe": 1, "valid": True, "size": 100, "receive_s": 1.0, "stats": None},
+            {"probe": 2, "valid": False, "size": 50, "receive_s": 1.0, "stats": None},
+            {"probe": 3, "valid": True, "size": 100, "receive_s": 2.0, "stats": None},
+            {"probe": 4, "valid": True, "size": 100, "receive_s": 2.0, "stats": None},
+        ]
+        summaries = merge_results(sent, received)
+        by_redundancy = {x["candidate"]["redundancy"]: x for x in summaries}
+        self.assertEqual(0.5, by_redundancy[1.0]["loss_rate"])
+        self.assertEqual(100.0, by_redundancy[1.0]["goodput_bps"])
+        self.assertEqual(0.0, by_redundancy[2.0]["loss_rate"])
+        self.assertEqual(50.0, by_redundancy[2.0]["goodput_bps"])
+        self.assertEqual(2.0, recommend_profile(summaries)["redundancy"])
+        profile = recommend_profile(summaries, max_loss_rate=0.5)
+        self.assertEqual(1.0, profile["redundancy"])
+        self.assertIsNone(profile["mtu_b"])
+
+    def test_run_calibration(self):
+        config = Config(
+            destination_ip="localhost",
+            end_delay_s=0.0,
+            transport=MemoryTransport(),
+        )
+        candidates = get_candidates(redundancies=[1.0, 2.0])
+        summaries = run_calibration(
+            config, candidates, probe_size=4096, repeat=2, start_delay_s=0.0
+        )
+        self.assertEqual(2, len(summaries))
+        for summary in summaries:
+            self.assertEqual(2, summary["probes"])
+            self.assertEqual(2, summary["valid"])
+            self.assertEqual(0.0, summary["loss_rate"])
+            self.assertGreater(summary["goodput_bps"], 0.0)
@@ -0,0 +1,181 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from unittest import TestCase
+
+from hairgap.chunks import (
+    CHUNK_PATTERN,
+    format_ranges,
+    get_chunk_count,
+    hash_chunks,
+    parse_chunk,
+)
+from hairgap.digests import get_file_digest
+from hairgap.tests import (
+    get_memory_config,
+    test_protocol,
+    test_receiver,
+    write_files,
+)
+from hairgap.utils import FILENAME_PATTERN, Config
+
+CHUNK_SIZE = 1 << 20
+
+
+class ChunkReceiver(test_receiver.DemoReceiver):
+    def __init__(self, config: Config, after_reception_path: str):
+        super().__init__(config, after_reception_path)
+        self.missing_chunks = {}
+
+    def transfer_chunks_missing(self, file_relpath, missing, chunk_count):
+        super().transfer_chunks_missing(file_relpath, missing, chunk_count)
+        self.missing_chunks[file_relpath] = (missing, chunk_count)
+
+
+class TestChunks(TestCase):
+    contents = {
+        "large.bin": os.urandom(2 * CHUNK_SIZE + 1000),
+        "small.txt": b"small\n",
+        os.path.join("logs", "large.json"): b'{"level": "info"}\n' * 200000,
+    }
+
+    def test_hash_chunks(self):
+        self.assertEqual(3, get_chunk_count(2 * CHUNK_SIZE + 1000, CHUNK_SIZE))
+        self.assertEqual(2, get_chunk_count(2 * CHUNK_SIZE, CHUNK_SIZE))
+        content = self.contents["large.bin"]
+        with tempfile.TemporaryDirectory() as dirname:
+            write_files(dirname, self.contents)
+            file_abspath = os.path.join(dirname, "large.bin")
+            digests, file_digest = hash_chunks(file_abspath, CHUNK_SIZE, "sha256")
+            expected = [
+                hashlib.sha256(content[x : x + CHUNK_SIZE]).hexdigest()
+                for x in range(0, len(content), CHUNK_SIZE)
+            ]
+            self.assertEqual(expected, digests)
+            self.assertEqual(get_file_digest(file_abspath), file_digest)
+            # the original file is kept as-is
+            with open(file_abspath, "rb") as fd:
+                self.assertEqual(content, fd.read())
+        self.assertEqual(
+            (1, 1024, 5000, "abcd"), parse_chunk("[chunk 1 1024 5000 ABCD]\n")
+        )
+        self.assertIsNone(parse_chunk("[chunk 1 1024 5000]\n"))
+
+    def test_format_ranges(self):
+        self.assertEqual("", format_ranges([]))
+        self.assertEqual("0-2, 5, 7-8", format_ranges([0, 1, 2, 5, 7, 8]))
+
+    def test_send_directory(self):
+        for options in ({}, {"carousel_repeat": 2}, {"compression": "auto"}):
+            with self.subTest(**options):
+                self.check_send_directory(**options)
+
+    def check_send_directory(self, **options):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = get_memory_config(tmp_dir, chunk_size=CHUNK_SIZE, **options)
+            src_path = os.path.join(tmp_dir, "original")
+            write_files(src_path, self.contents)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            with open(sender.index_abspath) as fd:
+                index = fd.read()
+            self.assertEqual(7, len(re.findall(CHUNK_PATTERN, index, re.MULTILINE)))
+            dst_path = os.path.join(tmp_dir, "received")
+            receiver = test_protocol.SingleDirReceiver(config, dst_path)
+            receiver_thread = threading.Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            self.assertEqual(0, receiver.transfer_error_count)
+            self.assertEqual(
+                ["large.bin", "logs", "small.txt"], sorted(os.listdir(dst_path))
+            )
+            for name, content in self.contents.items():
+                with open(os.path.join(dst_path, name), "rb") as fd:
+                    self.assertEqual(content, fd.read())
+
+    def test_missing_chunk(self):
+        receiver, content = self.receive_chunks(lost_chunk=1)
+        self.assertEqual(1, receiver.complete_count)
+        self.assertEqual(1, receiver.transfer_error_count)
+        self.assertEqual({"large.bin": ([1], 3)}, receiver.missing_chunks)
+        expected = self.contents["large.bin"]
+        # the file is kept, with a hole instead of the missing chunk
+        self.assertEqual(len(expected), len(content))
+        self.assertEqual(expected[:CHUNK_SIZE], content[:CHUNK_SIZE])
+        self.assertEqual(b"\0" * CHUNK_SIZE, content[CHUNK_SIZE : 2 * CHUNK_SIZE])
+        self.assertEqual(expected[2 * CHUNK_SIZE :], content[2 * CHUNK_SIZE :])
+
+    def test_invalid_file_digest(self):
+        receiver, content = self.receive_chunks(file_digest="0" * 64)
+        self.assertEqual(self.contents["large.bin"], content)
+        self.assertEqual(1, receiver.complete_count)
+        # all chunks are valid, but not the rebuilt file
+        self.assertEqual({}, receiver.missing_chunks)
+        self.assertEqual(1, receiver.transfer_error_count)
+
+    def receive_chunks(self, lost_chunk=None, file_digest=None):
+        """process the index and the chunks of a transfer (without `large.bin` chunk `lost_chunk`, and with another
+        digest for the whole `large.bin`) and return the receiver and the received content of `large.bin`
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = get_memory_config(tmp_dir, chunk_size=CHUNK_SIZE)
+            src_path = os.path.join(tmp_dir, "original")
+            write_files(src_path, self.contents)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            dst_path = os.path.join(tmp_dir, "received")
+            receiver = ChunkReceiver(config, dst_path)
+            tmp_abspath = os.path.join(tmp_dir, "received-file")
+            with open(sender.index_abspath, "rb") as fd:
+                index = fd.read()
+            if file_digest is not None:
+                index = re.sub(
+                    rb"(\[chunk \d+ \d+ %d )[a-f\d]+\]"
+                    % len(self.contents["large.bin"]),
+                    rb"\g<1>" + file_digest.encode() + b"]",
+                    index,
+                )
+            with open(tmp_abspath, "wb") as fd:
+                fd.write(index)
+            receiver.process_received_file(tmp_abspath)
+            chunk = None
+            for line in index.decode().splitlines():
+                if re.match(CHUNK_PATTERN, line):
+                    chunk = parse_chunk(line)
+                    continue
+                matcher = re.match(FILENAME_PATTERN, line)
+                if not matcher:
+                    continue
+                file_relpath = matcher.group(2)
+                with open(os.path.join(src_path, file_relpath), "rb") as fd:
+                    content = fd.read()
+                if chunk is not None:
+                    offset = chunk[0] * chunk[1]
+                    content = content[offset : offset + chunk[1]]
+                    if file_relpath == "large.bin" and chunk[0] == lost_chunk:
+                        content = b"lost"
+                with open(tmp_abspath, "wb") as fd:
+                    fd.write(content)
+                receiver.process_received_file(tmp_abspath)
+                chunk = None
+            with open(os.path.join(dst_path, "large.bin"), "rb") as fd:
+                return receiver, fd.read()
@@ -0,0 +1,146 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from hairgap.compact import (
+    COMPACT_RAW,
+    COMPACT_ZLIB,
+    CompactEntries,
+    CompactIndex,
+    encode_varint,
+    is_compact_index,
+    write_compact_index,
+)
+from hairgap.constants import HAIRGAP_MAGIC_NUMBER_INDEX
+from hairgap.tests import test_protocol
+from hairgap.transport import MemoryTransport
+from hairgap.utils import Config
+
+DIGEST = "4e9c" * 16
+FILE_DIGEST = "7d1a" * 16
+TEXT_INDEX = (
+    HAIRGAP_MAGIC_NUMBER_INDEX
+    + "[hairgap]\n"
+    + "current_uid = 1234\n"
+    + "[files]\n"
+    + "%s = data/é/file-1.txt\n" % DIGEST
+    + "[encoding gzip]\n"
+    + "[size 12]\n"
+    + "%s = data/é/file-2.json\n" % DIGEST.upper()
+    + "[chunk 0 1000 1500 %s]\n" % FILE_DIGEST
+    + "%s = data/large.bin\n" % DIGEST
+    + "[chunk 1 1000 1500 %s]\n" % FILE_DIGEST
+    + "%s = data/large.bin\n" % DIGEST
+)
+
+
+class TestCompactIndex(TestCase):
+    def write_index(self, dirname: str, compact_format: str) -> str:
+        text_abspath = os.path.join(dirname, "index.txt")
+        with open(text_abspath, "w") as fd:
+            fd.write(TEXT_INDEX)
+        compact_abspath = os.path.join(dirname, "index.bin")
+        write_compact_index(text_abspath, compact_abspath, compact_format)
+        return compact_abspath
+
+    def test_encode_varint(self):
+        self.assertEqual(b"\x00", encode_varint(0))
+        self.assertEqual(b"\x7f", encode_varint(127))
+        self.assertEqual(b"\xac\x02", encode_varint(300))
+
+    def test_read_index(self):
+        for compact_format in (COMPACT_RAW, COMPACT_ZLIB):
+            with self.subTest(compact_format=compact_format):
+                with tempfile.TemporaryDirectory() as dirname:
+                    compact_abspath = self.write_index(dirname, compact_format)
+                    self.assertTrue(is_compact_index(compact_abspath))
+                    index = CompactIndex(compact_abspath)
+                    self.assertEqual(
+                        ["[hairgap]\n", "current_uid = 1234\n", "[files]\n"],
+                        index.header_lines,
+                    )
+                    self.assertEqual(4, len(index))
+                    self.assertEqual(
+                        TEXT_INDEX.split("[files]\n")[1].replace(
+                            DIGEST.upper(), DIGEST
+                        ),
+                        "".join(index.iter_lines()),
+                    )
+
+    def test_truncated_index(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            compact_abspath = self.write_index(dirname, COMPACT_RAW)
+            with open(compact_abspath, "r+b") as fd:
+                fd.truncate(os.path.getsize(compact_abspath) - 2)
+            chunks = []
+            entries = CompactEntries(
+                CompactIndex(compact_abspath),
+                lambda *args: chunks.append(args) or "chunk",
+            )
+            self.assertEqual(4, entries.qsize())
+            self.assertEqual((DIGEST, "data/é/file-1.txt"), entries.get())
+            entries.get()
+            self.assertEqual((DIGEST, "chunk"), entries.get())
+            self.assertEqual([("data/large.bin", 0, 1000, 1500, FILE_DIGEST)], chunks)
+            # the last entry is lost
+            self.assertTrue(entries.empty())
+            self.assertEqual(0, entries.qsize())
+
+    def test_send_directory(self):
+        for options in (
+            {"compact_index": COMPACT_RAW},
+            {"compact_index": COMPACT_ZLIB, "compression": "auto"},
+            {"compact_index": COMPACT_ZLIB, "chunk_size": 100000},
+            {"compact_index": COMPACT_ZLIB, "carousel_repeat": 2},
+            {"compact_index": COMPACT_RAW, "parity_group_size": 4},
+        ):
+            with self.subTest(**options):
+                self.check_send_directory(**options)
+
+    def check_send_directory(self, **options):
+        contents = {"file-%03d.txt" % i: b"content %d\n" % i for i in range(20)}
+        contents["large.json"] = b'{"level": "info"}\n' * 20000
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = Config(
+                destination_ip="localhost",
+                destination_path=os.path.join(tmp_dir, "transfering"),
+                end_delay_s=0.0,
+                use_tar_archives=False,
+                transport=MemoryTransport(),
+                **options
+            )
+            src_path = os.path.join(tmp_dir, "original")
+            os.makedirs(src_path)
+            for name, content in contents.items():
+                with open(os.path.join(src_path, name), "wb") as fd:
+                    fd.write(content)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            self.assertTrue(is_compact_index(sender.sent_index_abspath))
+            dst_path = os.path.join(tmp_dir, "received")
+            receiver = test_protocol.SingleDirReceiver(config, dst_path)
+            receiver_thread = threading.Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            self.assertEqual(0, receiver.transfer_error_count)
+            for name, content in contents.items():
+                with open(os.path.join(dst_path, name), "rb") as fd:
+                    self.assertEqual(content, fd.read())
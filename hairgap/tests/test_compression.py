@@ -0,0 +1,111 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import gzip
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from hairgap.compression import (
+    compress_file,
+    decompress_file,
+    estimate_ratio,
+    should_compress,
+)
+from hairgap.constants import HAIRGAP_MAGIC_NUMBER_GZIP
+from hairgap.tests import get_memory_config, test_protocol, write_files
+
+
+def get_logs(count: int) -> bytes:
+    return b"".join(
+        json.dumps(
+            {"id": i, "level": "info", "message": "request %s" % (i % 7)}
+        ).encode()
+        + b"\n"
+        for i in range(count)
+    )
+
+
+class TestCompression(TestCase):
+    contents = {
+        "logs.json": get_logs(5000),
+        "random.bin": os.urandom(100000),
+        "archive.gz": gzip.compress(get_logs(5000)),
+        "small.json": get_logs(10),
+        "gzip_prefix.txt": HAIRGAP_MAGIC_NUMBER_GZIP.encode() + get_logs(1000),
+    }
+
+    def test_should_compress(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            write_files(dirname, self.contents)
+            path = lambda x: os.path.join(dirname, x)
+            self.assertLess(estimate_ratio(path("logs.json")), 0.2)
+            self.assertGreater(estimate_ratio(path("random.bin")), 0.9)
+            self.assertTrue(should_compress(path("logs.json"), "auto"))
+            self.assertFalse(should_compress(path("logs.json"), None))
+            self.assertFalse(should_compress(path("random.bin"), "auto"))
+            self.assertTrue(should_compress(path("random.bin"), "gzip"))
+            self.assertFalse(should_compress(path("archive.gz"), "auto"))
+            self.assertFalse(should_compress(path("small.json"), "gzip"))
+
+    def test_compress_file(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            write_files(dirname, self.contents)
+            src_path = os.path.join(dirname, "logs.json")
+            dst_path = os.path.join(dirname, "logs.json.gz")
+            size = compress_file(src_path, dst_path)
+            self.assertEqual(size, os.path.getsize(dst_path))
+            with open(dst_path, "rb") as fd:
+                self.assertEqual(self.contents["logs.json"], gzip.decompress(fd.read()))
+            decompress_file(dst_path, src_path + ".2")
+            with open(src_path + ".2", "rb") as fd:
+                self.assertEqual(self.contents["logs.json"], fd.read())
+
+    def test_send_directory(self):
+        for options in ({}, {"carousel_repeat": 2}, {"parity_group_size": 2}):
+            with self.subTest(**options):
+                self.check_send_directory(**options)
+
+    def check_send_directory(self, **options):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = get_memory_config(tmp_dir, compression="auto", **options)
+            src_path = os.path.join(tmp_dir, "original")
+            write_files(src_path, self.contents)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            # compressed copies are written aside: a second preparation gives the same result
+            files, size = sender.prepare_directory()
+            with open(sender.index_abspath) as fd:
+                index = fd.read()
+            for name, content in self.contents.items():
+                with open(os.path.join(src_path, name), "rb") as fd:
+                    self.assertEqual(content, fd.read())
+            self.assertEqual(2, index.count("[encoding gzip]\n"))
+            if not config.parity_group_size:
+                original_size = sum(len(x) for x in self.contents.values())
+                self.assertLess(size, original_size / 2)
+            dst_path = os.path.join(tmp_dir, "received")
+            receiver = test_protocol.SingleDirReceiver(config, dst_path)
+            receiver_thread = threading.Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            self.assertEqual(sorted(self.contents), sorted(os.listdir(dst_path)))
+            for name, content in self.contents.items():
+                with open(os.path.join(dst_path, name), "rb") as fd:
+                    self.assertEqual(content, fd.read())
@@ -0,0 +1,153 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from unittest import TestCase
+
+from hairgap.constants import HAIRGAP_MAGIC_NUMBER_INDEX
+from hairgap.digests import (
+    DIGEST_BLAKE2B,
+    DIGEST_SHA256,
+    get_available_digests,
+    get_file_digest,
+    new_digest,
+)
+from hairgap.tests import test_protocol, test_receiver
+from hairgap.transport import MemoryTransport
+from hairgap.utils import FILENAME_PATTERN, Config
+
+
+class TestDigests(TestCase):
+    contents = {
+        "a.txt": b"a\n" * 100000,
+        "b.txt": b"b\n",
+        "c.bin": os.urandom(3000000),
+        "d.txt": b"b\n",
+    }
+
+    def test_get_file_digest(self):
+        self.assertIn(DIGEST_SHA256, get_available_digests())
+        self.assertIn(DIGEST_BLAKE2B, get_available_digests())
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, "c.bin")
+            with open(path, "wb") as fd:
+                fd.write(self.contents["c.bin"])
+            self.assertEqual(
+                hashlib.sha256(self.contents["c.bin"]).hexdigest(),
+                get_file_digest(path),
+            )
+            self.assertEqual(
+                hashlib.blake2b(self.contents["c.bin"], digest_size=32).hexdigest(),
+                get_file_digest(path, DIGEST_BLAKE2B),
+            )
+            for algorithm in get_available_digests():
+                digest = new_digest(algorithm)
+                digest.update(self.contents["c.bin"])
+                self.assertEqual(digest.hexdigest(), get_file_digest(path, algorithm))
+        self.assertRaises(ValueError, new_digest, "md5")
+
+    def test_filename_pattern(self):
+        for length in (32, 64):
+            line = "%s = a.txt" % ("a" * length)
+            self.assertIsNotNone(re.match(FILENAME_PATTERN, line))
+        for length in (31, 48, 63, 128):
+            line = "%s = a.txt" % ("a" * length)
+            self.assertIsNone(re.match(FILENAME_PATTERN, line))
+
+    def test_uppercase_digest(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            receiver = test_receiver.DemoReceiver(
+                Config(destination_path=dirname), os.path.join(dirname, "dst")
+            )
+            tmp_abspath = os.path.join(dirname, "received")
+            with open(tmp_abspath, "wb") as fd:
+                fd.write(b"b\n")
+            digest = hashlib.sha256(b"b\n").hexdigest()
+            receiver.transfer_file_received(
+                tmp_abspath,
+                "b.txt",
+                actual_sha256=digest,
+                expected_sha256=digest.upper(),
+            )
+            self.assertEqual(1, receiver.transfer_success_count)
+            self.assertEqual(0, receiver.transfer_error_count)
+
+    def test_send_directory(self):
+        for algorithm in get_available_digests():
+            for options in ({}, {"carousel_repeat": 2}, {"parity_group_size": 2}):
+                with self.subTest(digest=algorithm, **options):
+                    self.check_send_directory(digest=algorithm, **options)
+
+    def check_send_directory(self, **options):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = Config(
+                destination_ip="localhost",
+                destination_path=os.path.join(tmp_dir, "transfering"),
+                end_delay_s=0.0,
+                use_tar_archives=False,
+                transport=MemoryTransport(),
+                **options
+            )
+            src_path = os.path.join(tmp_dir, "original")
+            os.makedirs(src_path)
+            for name, content in self.contents.items():
+                with open(os.path.join(src_path, name), "wb") as fd:
+                    fd.write(content)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            with open(sender.index_abspath) as fd:
+                index = fd.read()
+            if config.digest == DIGEST_SHA256:
+                self.assertNotIn("[digest ", index)
+            else:
+                self.assertIn("[digest %s]\n" % config.digest, index)
+            dst_path = os.path.join(tmp_dir, "received")
+            # the receiver follows the index, whatever its own configuration
+            receiver_config = Config(
+                destination_path=config.destination_path,
+                use_tar_archives=False,
+                transport=config.transport,
+            )
+            receiver = test_protocol.SingleDirReceiver(receiver_config, dst_path)
+            receiver_thread = threading.Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            self.assertEqual(0, receiver.transfer_error_count)
+            self.assertEqual(sorted(self.contents), sorted(os.listdir(dst_path)))
+            for name, content in self.contents.items():
+                with open(os.path.join(dst_path, name), "rb") as fd:
+                    self.assertEqual(content, fd.read())
+
+    def test_unsupported_digest(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            receiver = test_receiver.DemoReceiver(
+                Config(destination_path=dirname, use_tar_archives=False),
+                os.path.join(dirname, "destination"),
+            )
+            index = HAIRGAP_MAGIC_NUMBER_INDEX + "[hairgap]\n[digest unknown]\n"
+            index += "[files]\n%s = a.txt\n" % hashlib.sha256(b"a\n").hexdigest()
+            for content in (index.encode(), b"a\n"):
+                tmp_abspath = os.path.join(dirname, "received")
+                with open(tmp_abspath, "wb") as fd:
+                    fd.write(content)
+                receiver.process_received_file(tmp_abspath)
+            self.assertEqual(1, receiver.complete_count)
+            self.assertEqual(1, receiver.transfer_error_count)
@@ -0,0 +1,79 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from hairgap import durability
+from hairgap.durability import (
+    DURABILITY_FILE,
+    DURABILITY_NONE,
+    DURABILITY_TRANSFER,
+    sync_tree,
+)
+from hairgap.tests import get_memory_config, test_protocol, write_files
+
+
+class TestDurability(TestCase):
+    contents = {
+        os.path.join("sub", "file-%s.txt" % i): b"content %d\n" % i for i in range(5)
+    }
+
+    def test_sync_tree(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            write_files(dirname, self.contents)
+            with mock.patch.object(
+                durability, "sync_file", wraps=durability.sync_file
+            ) as sync_file:
+                sync_tree(dirname, use_syncfs=False)
+            self.assertEqual(5, sync_file.call_count)
+            with mock.patch.object(durability, "syncfs", return_value=True):
+                with mock.patch.object(durability, "sync_file") as sync_file:
+                    sync_tree(dirname)
+            sync_file.assert_not_called()
+
+    def test_receive(self):
+        for policy, syncs in (
+            (DURABILITY_NONE, 0),
+            (DURABILITY_FILE, 5),
+            (DURABILITY_TRANSFER, 1),
+        ):
+            with self.subTest(durability=policy):
+                receiver = self.check_receive(policy)
+                self.assertEqual(syncs, receiver.metrics.syncs.get_value())
+                self.assertEqual(
+                    syncs, receiver.metrics.sync_seconds.get_value()["count"]
+                )
+                self.assertEqual(syncs > 0, "sync" in receiver.transfer_durations)
+
+    def check_receive(self, policy: str) -> test_protocol.SingleDirReceiver:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = get_memory_config(tmp_dir, durability=policy)
+            src_path = os.path.join(tmp_dir, "original")
+            write_files(src_path, self.contents)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            dst_path = os.path.join(tmp_dir, "received")
+            receiver = test_protocol.SingleDirReceiver(config, dst_path)
+            receiver_thread = threading.Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            self.assertEqual(0, receiver.transfer_error_count)
+            self.assertEqual(5, len(os.listdir(os.path.join(dst_path, "sub"))))
+        return receiver
@@ -0,0 +1,122 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import TestCase
+
+from hairgap.bench import get_free_port, run_scenario
+from hairgap.emulator import (
+    LinkEmulator,
+    emulated_link,
+    get_group_parameters,
+)
+
+
+def get_filename(name):
+    return os.path.join(os.path.dirname(__file__), name)
+
+
+class TestLinkEmulator(TestCase):
+    def test_get_group_parameters(self):
+        self.assertEqual((64, 0), get_group_parameters(None, None))
+        self.assertEqual((64, 32), get_group_parameters(1.5, None))
+        self.assertEqual((85, 170), get_group_parameters(3.0, 100))
+        self.assertEqual((10, 0), get_group_parameters(0.5, 10))
+
+    def test_loss(self):
+        link = LinkEmulator(loss=0.1, seed=42)
+        received = sum(len(link.transmit(b"x")) for __ in range(10000))
+        self.assertAlmostEqual(0.9, received / 10000, delta=0.02)
+
+    def test_burst(self):
+        link = LinkEmulator(burst=0.01, burst_length=20, seed=42)
+        lost = [not link.transmit(b"x") for __ in range(10000)]
+        bursts = [i for i in range(1, len(lost)) if lost[i] and not lost[i - 1]]
+        self.assertGreater(len(bursts), 0)
+        # losses are grouped: far less bursts than lost packets
+        self.assertGreater(sum(lost) / len(bursts), 5)
+
+    def test_reorder(self):
+        link = LinkEmulator(reorder=0.2, reorder_depth=4, seed=42)
+        packets = [b"%d" % i for i in range(1000)]
+        received = []
+        for packet in packets:
+            received += link.transmit(packet)
+        received += link.flush()
+        self.assertEqual(sorted(packets), sorted(received))
+        self.assertNotEqual(packets, received)
+
+    def test_from_environ(self):
+        link = LinkEmulator.from_environ(
+            {"HAIRGAP_EMULATOR_LOSS": "0.5", "HAIRGAP_EMULATOR_REORDER_DEPTH": "3"}
+        )
+        self.assertEqual(0.5, link.loss)
+        self.assertEqual(3, link.reorder_depth)
+        with emulated_link(burst=0.25):
+            self.assertEqual(0.25, LinkEmulator.from_environ().burst)
+        self.assertNotIn("HAIRGAP_EMULATOR_BURST", os.environ)
+
+
+class TestEmulatedTransfer(TestCase):
+    def transfer(self, data: bytes, redundancy: float, **link) -> bytes:
+        port = get_free_port(17000)
+        with tempfile.TemporaryFile() as out_fd, tempfile.TemporaryFile() as in_fd:
+            in_fd.write(data)
+            in_fd.seek(0)
+            receiver = subprocess.Popen(
+                [sys.executable, get_filename("lossy_hairgapr.py")]
+                + ["-p", str(port), "-t", "1", "localhost"],
+                stdout=out_fd,
+                stderr=subprocess.DEVNULL,
+            )
+            time.sleep(0.5)  # UDP packets sent before the bind are lost
+            with emulated_link(seed=1, **link):
+                subprocess.check_call(
+                    [sys.executable, get_filename("lossy_hairgaps.py")]
+                    + ["-p", str(port), "-r", str(redundancy), "-b", "200"]
+                    + ["-N", "32", "localhost"],
+                    stdin=in_fd,
+                    stderr=subprocess.DEVNULL,
+                )
+            self.assertEqual(0 if redundancy > 1 else 1, receiver.wait(timeout=30))
+            out_fd.seek(0)
+            return out_fd.read()
+
+    def test_redundancy(self):
+        data = random.Random(0).randbytes(500000)  # nosec B311
+        self.assertEqual(
+            data, self.transfer(data, 1.5, loss=0.05, burst=0.002, reorder=0.05)
+        )
+
+    def test_no_redundancy(self):
+        data = random.Random(0).randbytes(500000)  # nosec B311
+        received = self.transfer(data, 1.0, loss=0.05)
+        self.assertLess(len(received), len(data))
+        self.assertEqual(data[: len(received)], received)
+
+    def test_run_scenario(self):
+        result = run_scenario(
+            "tiny",
+            use_tar_archives=True,
+            end_delay_s=0.1,
+            link={"loss": 0.02, "seed": 1},
+            redundancy=1.5,
+        )
+        self.assertTrue(result["valid"])
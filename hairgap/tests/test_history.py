@@ -0,0 +1,103 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import re
+import tempfile
+from unittest import TestCase
+
+from hairgap.history import (
+    STATUS_COMPLETE,
+    STATUS_INTERRUPTED,
+    HistoryStore,
+    TransferRecord,
+)
+from hairgap.tests import test_receiver, test_sender
+from hairgap.utils import FILENAME_PATTERN
+
+
+class TestHistory(TestCase):
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            store = HistoryStore(os.path.join(dirname, "history.sqlite3"))
+            for index, (size, duration) in enumerate([(100, 1), (1000, 2), (10, 0)]):
+                store.add(
+                    TransferRecord(
+                        "sender",
+                        "id%s" % index,
+                        size=size,
+                        duration_s=duration,
+                        durations={"send": duration},
+                        attributes={"uid": str(index)},
+                        created=index,
+                    )
+                )
+            store.add(TransferRecord("receiver", "id0", size=100, duration_s=4))
+            recent = store.get_records(side="sender")
+            self.assertEqual(["id2", "id1", "id0"], [x.transfer_id for x in recent])
+            self.assertEqual({"uid": "2"}, recent[0].attributes)
+            self.assertIsNone(recent[0].throughput_bps)
+            slowest = store.get_records(order="slowest", limit=2)
+            self.assertEqual(
+                [("receiver", 25), ("sender", 100)],
+                [(x.side, x.throughput_bps) for x in slowest],
+            )
+            self.assertEqual(2, len(store.get_records(transfer_id="id0")))
+
+    def test_transfer(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            history_path = os.path.join(dirname, "history.sqlite3")
+            config = test_sender.TestSender.get_config(
+                dirname, split_size=None, history_path=history_path
+            )
+            sender = test_sender.DemoDirectorySender(
+                config, os.path.join(dirname, "sender")
+            )
+            sender.create_files(file_count=3, file_size=100)
+            sender.prepare_directory()
+            sender.add_history_record(STATUS_COMPLETE, 2.0)
+            receiver = test_receiver.DemoReceiver(
+                config, os.path.join(dirname, "destination")
+            )
+            with open(sender.index_abspath, "rb") as fd:
+                index = fd.read()
+            contents = [index, index]  # the first transfer is interrupted
+            for line in index.decode().splitlines():
+                matcher = re.match(FILENAME_PATTERN, line)
+                if matcher:
+                    file_abspath = os.path.join(
+                        sender.transfer_abspath, matcher.group(2)
+                    )
+                    with open(file_abspath, "rb") as fd:
+                        contents.append(fd.read())
+            for index, content in enumerate(contents):
+                tmp_abspath = os.path.join(dirname, "received-%s" % index)
+                with open(tmp_abspath, "wb") as fd:
+                    fd.write(content)
+                receiver.process_received_file(tmp_abspath)
+            sent, received, interrupted = HistoryStore(history_path).get_records(
+                order="largest"
+            )
+        self.assertEqual(sent.transfer_id, received.transfer_id)
+        self.assertEqual(sent.transfer_id, interrupted.transfer_id)
+        self.assertEqual(STATUS_INTERRUPTED, interrupted.status)
+        self.assertEqual(STATUS_COMPLETE, received.status)
+        self.assertEqual({"key": "value"}, sent.attributes)
+        self.assertEqual((4, 4), (sent.files, received.files))
+        self.assertEqual(sent.size, received.size)
+        self.assertEqual(0, received.errors)
+        self.assertEqual({"send", "end_delay", "prepare"}, set(sent.durations))
+        self.assertEqual({"process", "hash"}, set(received.durations))
+        self.assertEqual(history_path, sent.config["history_path"])
@@ -0,0 +1,119 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import hashlib
+import http.client
+import os
+import tempfile
+from unittest import TestCase
+
+from hairgap.constants import HAIRGAP_MAGIC_NUMBER_INDEX
+from hairgap.metrics import Metric, MetricsRegistry, MetricsServer
+from hairgap.tests import test_receiver
+from hairgap.utils import Config
+
+
+class TestMetrics(TestCase):
+    def test_registry(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("files_total", "received files")
+        counter.inc()
+        counter.inc(2)
+        self.assertIs(counter, registry.counter("files_total"))
+        with self.assertRaises(ValueError):
+            counter.inc(-1)
+        with self.assertRaises(TypeError):
+            registry.register(Metric("untyped"))
+        gauge = registry.gauge("depth")
+        gauge.set(4)
+        gauge.dec()
+        histogram = registry.histogram("duration_seconds", buckets=[0.1, 1.0])
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value)
+        self.assertEqual(
+            {
+                "files_total": 3,
+                "depth": 3,
+                "duration_seconds": {
+                    "count": 4,
+                    "sum": 4.25,
+                    "buckets": {"0.1": 1, "1": 3, "+Inf": 4},
+                },
+            },
+            registry.snapshot(),
+        )
+        gauge.set_function(lambda: 12)
+        self.assertEqual(12, registry.snapshot()["depth"])
+        expected = (
+            "# HELP depth \n"
+            "# TYPE depth gauge\n"
+            "depth 12\n"
+            "# HELP duration_seconds \n"
+            "# TYPE duration_seconds histogram\n"
+            'duration_seconds_bucket{le="0.1"} 1\n'
+            'duration_seconds_bucket{le="1"} 3\n'
+            'duration_seconds_bucket{le="+Inf"} 4\n'
+            "duration_seconds_sum 4.25\n"
+            "duration_seconds_count 4\n"
+            "# HELP files_total received files\n"
+            "# TYPE files_total counter\n"
+            "files_total 3\n"
+        )
+        self.assertEqual(expected, registry.to_prometheus())
+
+    def test_server(self):
+        registry = MetricsRegistry()
+        registry.counter("files_total").inc()
+        server = MetricsServer(registry, 0)
+        server.start()
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", server.port)
+            connection.request("GET", "/metrics")
+            response = connection.getresponse()
+            self.assertEqual(200, response.status)
+            self.assertIn("files_total 1\n", response.read().decode())
+            connection.request("GET", "/")
+            response = connection.getresponse()
+            response.read()
+            self.assertEqual(404, response.status)
+            connection.close()
+        finally:
+            server.stop()
+
+    def test_receiver(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            receiver = test_receiver.DemoReceiver(
+                Config(destination_path=dirname, use_tar_archives=False),
+                os.path.join(dirname, "destination"),
+            )
+            files = [b"a\n", b"b\n"]
+            index = HAIRGAP_MAGIC_NUMBER_INDEX + "[hairgap]\n[files]\n"
+            for i, content in enumerate(files):
+                index += "%s = %s.txt\n" % (hashlib.sha256(content).hexdigest(), i)
+            for i, content in enumerate([index.encode(), b"a\n", b"corrupted\n"]):
+                tmp_abspath = os.path.join(dirname, "received-%s" % i)
+                with open(tmp_abspath, "wb") as fd:
+                    fd.write(content)
+                receiver.process_received_file(tmp_abspath)
+                if i == 0:
+                    self.assertEqual(2, receiver.metrics.expected_files.get_value())
+            snapshot = receiver.metrics.registry.snapshot()
+        self.assertEqual(1, snapshot["hairgap_transfers_total"])
+        self.assertEqual(2, snapshot["hairgap_received_files_total"])
+        self.assertEqual(12, snapshot["hairgap_received_bytes_total"])
+        self.assertEqual(1, snapshot["hairgap_file_errors_total"])
+        self.assertEqual(0, snapshot["hairgap_expected_files"])
+        self.assertEqual(3, snapshot["hairgap_process_seconds"]["count"])
+        self.assertEqual(1, snapshot["hairgap_transfer_seconds"]["count"])
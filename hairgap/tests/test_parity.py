@@ -0,0 +1,102 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import random
+import tempfile
+from unittest import TestCase
+
+from hairgap.constants import HAIRGAP_MAGIC_NUMBER_INDEX
+from hairgap.parity import (
+    decode_blocks,
+    encode_blocks,
+    gf_inv,
+    gf_mul,
+    invert_matrix,
+    rebuild_data_files,
+    write_parity_files,
+)
+
+
+class TestParity(TestCase):
+    def test_gf(self):
+        for a in range(1, 256):
+            self.assertEqual(1, gf_mul(a, gf_inv(a)))
+        matrix = [[1, 2], [3, 4]]
+        inverse = invert_matrix(matrix)
+        product = [
+            [
+                gf_mul(matrix[i][0], inverse[0][j])
+                ^ gf_mul(matrix[i][1], inverse[1][j])
+                for j in range(2)
+            ]
+            for i in range(2)
+        ]
+        self.assertEqual([[1, 0], [0, 1]], product)
+
+    def test_rebuild(self):
+        # reproducible test data, not security-relevant
+        rnd = random.Random(42)  # nosec B311
+        contents = [
+            b"",
+            HAIRGAP_MAGIC_NUMBER_INDEX.encode() + b"escaped",
+            bytes(rnd.randrange(256) for __ in range(3000)),
+            b"small",
+            bytes(rnd.randrange(256) for __ in range(1000)),
+        ]
+        with tempfile.TemporaryDirectory() as dirname:
+            data_abspaths = [os.path.join(dirname, "data", str(i)) for i in range(5)]
+            parity_abspaths = [
+                os.path.join(dirname, "parity", str(j)) for j in range(3)
+            ]
+            os.makedirs(os.path.join(dirname, "data"))
+            for abspath, content in zip(data_abspaths, contents):
+                with open(abspath, "wb") as fd:
+                    fd.write(content)
+            write_parity_files(data_abspaths, parity_abspaths, block_size=512)
+            os.remove(data_abspaths[1])
+            with open(data_abspaths[2], "wb") as fd:
+                fd.write(b"corrupted")
+            os.remove(data_abspaths[4])
+            # not enough parity files
+            self.assertEqual(
+                [],
+                rebuild_data_files(
+                    data_abspaths, [1, 2, 4], {0: parity_abspaths[0]}, 3
+                ),
+            )
+            actual = rebuild_data_files(
+                data_abspaths,
+                [1, 2, 4],
+                {j: parity_abspaths[j] for j in range(3)},
+                3,
+                block_size=700,
+            )
+            self.assertEqual([1, 2, 4], actual)
+            for abspath, content in zip(data_abspaths, contents):
+                with open(abspath, "rb") as fd:
+                    self.assertEqual(content, fd.read())
+
+    def test_blocks(self):
+        # reproducible test data, not security-relevant
+        rnd = random.Random(42)  # nosec B311
+        blocks = [rnd.randbytes(100) for __ in range(10)]
+        parity_blocks = encode_blocks(blocks, 4)
+        received = {i: x for i, x in enumerate(blocks + parity_blocks)}
+        for i in (0, 3, 7, 12):
+            del received[i]
+        self.assertEqual(blocks, decode_blocks(received, 10, 4))
+        del received[5]
+        self.assertIsNone(decode_blocks(received, 10, 4))
@@ -0,0 +1,93 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import gzip
+import importlib.resources
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+from threading import Thread
+from unittest import TestCase
+
+from hairgap.pgzip import compress_stream, get_command
+from hairgap.tests import test_protocol
+from hairgap.transport import MemoryTransport
+from hairgap.utils import Config
+
+
+class TestParallelGzip(TestCase):
+    def test_compress_stream(self):
+        data = b"".join(b"line %d\n" % i for i in range(100000)) + os.urandom(50000)
+        out_fd = io.BytesIO()
+        in_size, out_size = compress_stream(
+            io.BytesIO(data), out_fd, threads=3, block_size=65536
+        )
+        self.assertEqual(len(data), in_size)
+        self.assertEqual(out_size, len(out_fd.getvalue()))
+        self.assertLess(out_size, len(data) / 2)
+        self.assertEqual(data, gzip.decompress(out_fd.getvalue()))
+        out_fd = io.BytesIO()
+        compress_stream(io.BytesIO(b""), out_fd)
+        self.assertEqual(b"", gzip.decompress(out_fd.getvalue()))
+
+    def test_command(self):
+        data = os.urandom(300000) * 3
+        with tempfile.TemporaryDirectory() as dirname:
+            # the command does not depend on the current directory
+            p = subprocess.run(
+                get_command(2, block_size=100000),
+                input=data,
+                stdout=subprocess.PIPE,
+                cwd=dirname,
+                check=True,
+            )
+        self.assertEqual(data, gzip.decompress(p.stdout))
+
+    def test_send_directory(self):
+        ref = importlib.resources.files("hairgap").joinpath("tests")
+        with tempfile.TemporaryDirectory() as tmp_dir, importlib.resources.as_file(
+            ref
+        ) as original_path:
+            config = Config(
+                destination_ip="localhost",
+                destination_path=os.path.join(tmp_dir, "transfering"),
+                end_delay_s=0.0,
+                use_tar_archives=True,
+                transport=MemoryTransport(),
+                compression_threads=2,
+            )
+            src_path = os.path.join(tmp_dir, "original_copy")
+            shutil.copytree(original_path, src_path)
+            dst_path = os.path.join(tmp_dir, "received")
+            receiver = test_protocol.SingleDirReceiver(config, dst_path)
+            receiver_thread = Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            for root, dirnames, filenames in os.walk(src_path):
+                for filename in filenames:
+                    src_abspath = os.path.join(root, filename)
+                    dst_abspath = os.path.join(
+                        dst_path, os.path.relpath(src_abspath, src_path)
+                    )
+                    with open(src_abspath, "rb") as src_fd, open(
+                        dst_abspath, "rb"
+                    ) as dst_fd:
+                        self.assertEqual(src_fd.read(), dst_fd.read())
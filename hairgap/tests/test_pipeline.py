@@ -0,0 +1,101 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import sys
+import tempfile
+import time
+from unittest import TestCase
+
+from hairgap.pipeline import Pipeline
+from hairgap.tracing import Tracer
+from hairgap.tests.test_tracing import ListExporter
+
+
+class TestPipeline(TestCase):
+    def test_success(self):
+        exporter = ListExporter()
+        content = os.urandom(300000)
+        with tempfile.TemporaryFile() as src, tempfile.TemporaryFile() as dst:
+            src.write(content)
+            src.seek(0)
+            result = Pipeline(
+                [("cat_1", ["cat"]), ("cat_2", ["cat"]), ("cat_3", ["cat"])],
+                stdin=src,
+                stdout=dst,
+                tracer=Tracer([exporter]),
+            ).run()
+            dst.seek(0)
+            self.assertEqual(content, dst.read())
+        self.assertTrue(result.success)
+        self.assertIsNone(result.failed_stage)
+        self.assertEqual([0, 0, 0], [x.returncode for x in result.stages])
+        self.assertEqual([len(content)] * 2, [x.size for x in result.pipes])
+        self.assertEqual("cat_1|cat_2", result.pipes[0].name)
+        self.assertIsNotNone(result.get_bottleneck())
+        self.assertIn("cat_2|cat_3: 300000 bytes", result.get_report())
+        self.assertEqual(["pipeline"], [x.name for x in exporter.spans])
+        self.assertEqual(300000, exporter.spans[0].attributes["cat_1|cat_2.bytes"])
+
+    def test_progress_stage(self):
+        content = os.urandom(300000)
+        sizes = []
+        with tempfile.TemporaryFile() as src, tempfile.TemporaryFile() as dst:
+            src.write(content)
+            src.seek(0)
+            result = Pipeline(
+                [("cat", ["cat"]), ("gzip", ["gzip", "-c"]), ("cat_2", ["cat"])],
+                stdin=src,
+                stdout=dst,
+                progress=sizes.append,
+                progress_stage="gzip",
+            ).run()
+        self.assertTrue(result.success)
+        self.assertEqual(len(content), sum(sizes))
+
+    def test_bottleneck(self):
+        slow_cmd = [sys.executable, "-c", "import time; time.sleep(1); print('a')"]
+        result = Pipeline([("slow", slow_cmd), ("cat", ["cat"])]).run()
+        self.assertTrue(result.success)
+        self.assertEqual(2, result.pipes[0].size)
+        self.assertEqual("slow", result.get_bottleneck().name)
+        self.assertGreater(result.pipes[0].read_wait_s, 0.5)
+
+    def test_failure(self):
+        """a failing stage stops the whole pipeline, without waiting for the other ones"""
+        endless_cmd = [sys.executable, "-c", "import time; time.sleep(60)"]
+        failing_cmd = [sys.executable, "-c", "import sys; sys.exit(3)"]
+        start = time.monotonic()
+        result = Pipeline([("endless", endless_cmd), ("failing", failing_cmd)]).run()
+        self.assertLess(time.monotonic() - start, 10.0)
+        self.assertFalse(result.success)
+        self.assertEqual("failing", result.failed_stage.name)
+        self.assertEqual(3, result.stages[1].returncode)
+        self.assertTrue(result.stages[0].killed)
+
+    def test_missing_command(self):
+        result = Pipeline(
+            [("cat", ["cat"]), ("missing", ["/nonexistent/command"])]
+        ).run()
+        self.assertFalse(result.success)
+        self.assertEqual(127, result.stages[1].returncode)
+
+    def test_timeout(self):
+        endless_cmd = [sys.executable, "-c", "import time; time.sleep(60)"]
+        start = time.monotonic()
+        result = Pipeline([("endless", endless_cmd)], timeout_s=0.5).run()
+        self.assertLess(time.monotonic() - start, 10.0)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.success)
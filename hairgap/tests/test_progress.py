@@ -0,0 +1,110 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import importlib.resources
+import io
+import os
+import shutil
+import tempfile
+from threading import Thread
+from unittest import TestCase
+
+from hairgap.progress import ProgressTracker, format_progress
+from hairgap.tests import test_protocol
+from hairgap.transport import HairgapTransport, MemoryTransport
+from hairgap.utils import Config
+
+
+class TestProgress(TestCase):
+    def test_tracker(self):
+        reports = []
+        tracker = ProgressTracker(callback=reports.append, interval_s=3600.0)
+        tracker.start(4, 1000, end_delay_s=2.0)
+        tracker.add_bytes(100)  # throttled
+        self.assertEqual(1, len(reports))
+        tracker.add_bytes(150)
+        tracker.add_file()
+        progress = reports[-1]
+        self.assertEqual(2, len(reports))
+        self.assertEqual(250, progress.sent_bytes)
+        self.assertEqual(1, progress.sent_files)
+        self.assertEqual(0.25, progress.ratio)
+        self.assertGreater(progress.rate_bps, 0.0)
+        # remaining bytes at the current rate, and 3 end delays
+        self.assertGreater(progress.eta_s, 6.0)
+        self.assertIn("25%", format_progress(progress))
+        tracker.add_bytes(-50)  # sent again
+        self.assertEqual(200, tracker.get_progress().sent_bytes)
+        tracker.finish()
+        progress = reports[-1]
+        self.assertTrue(progress.finished)
+        self.assertEqual(4, progress.sent_files)
+        self.assertEqual(0.0, progress.eta_s)
+        self.assertEqual([progress.finished], [x.finished for x in tracker.updates()])
+
+    def test_counted_command(self):
+        sizes = []
+        data = os.urandom(200000)
+        p, stdout, stderr = HairgapTransport.feed_command(
+            ["cat"], io.BytesIO(data), progress=sizes.append
+        )
+        self.assertEqual(0, p.returncode)
+        self.assertEqual(data, stdout)
+        self.assertEqual(len(data), sum(sizes))
+
+    def test_send_directory(self):
+        for use_tar_archives in (False, True):
+            with self.subTest(use_tar_archives=use_tar_archives):
+                self.check_send_directory(use_tar_archives)
+
+    def check_send_directory(self, use_tar_archives: bool):
+        ref = importlib.resources.files("hairgap").joinpath("tests")
+        with tempfile.TemporaryDirectory() as tmp_dir, importlib.resources.as_file(
+            ref
+        ) as original_path:
+            config = Config(
+                destination_ip="localhost",
+                destination_path=os.path.join(tmp_dir, "transfering"),
+                end_delay_s=0.0,
+                use_tar_archives=use_tar_archives,
+                transport=MemoryTransport(),
+            )
+            src_path = os.path.join(tmp_dir, "original_copy")
+            shutil.copytree(original_path, src_path)
+            receiver = test_protocol.SingleDirReceiver(
+                config, os.path.join(tmp_dir, "received")
+            )
+            receiver_thread = Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender = test_protocol.SingleDirSender(config, src_path)
+            reports = []
+            sender.progress.callback = reports.append
+            sender.progress.interval_s = 0.0
+            total_files, total_bytes = sender.prepare_directory()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            progress = reports[-1]
+            self.assertTrue(progress.finished)
+            self.assertEqual(total_files, progress.sent_files)
+            self.assertGreater(progress.sent_bytes, 0)
+            if not use_tar_archives:
+                sent_files = [x.sent_files for x in reports]
+                self.assertEqual(sorted(sent_files), sent_files)
+                self.assertEqual(list(range(total_files + 1)), sorted(set(sent_files)))
+                self.assertGreaterEqual(progress.sent_bytes, total_bytes)
+            else:
+                # the archive is written before being sent: its size is known
+                self.assertEqual(progress.total_bytes, progress.sent_bytes)
@@ -67,6 +67,17 @@ class SingleDirReceiver(Receiver):
         return self.after_reception_path
 
 
+class MessageReceiver(SingleDirReceiver):
+    def __init__(self, config: Config, after_reception_path: str):
+        super().__init__(config, after_reception_path)
+        self.messages = []
+
+    def message_received(self, data: bytes, attributes: Dict[str, str]):
+        super().message_received(data, attributes)
+        self.messages.append((data, attributes))
+        self.continue_loop = False
+
+
 class SingleDirSender(DirectorySender):
     def __init__(self, config: Config, directory_path: str):
         super().__init__(config)
@@ -213,6 +224,22 @@ class TestDiodeTransfer(TestCase):
             SingleDirSender.send_file(config, src_path)
             self.assertEqual(b"Unexpected content\n", receiver.unexpected_content)
 
+    def test_send_message(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = self.get_config(tmp_dir, express_port=self.get_free_port(16124))
+            receiver = MessageReceiver(config, os.path.join(tmp_dir, "destination"))
+            express_thread = Thread(target=receiver.express_loop, args=())
+            express_thread.start()
+            time.sleep(1.0)
+            SingleDirSender.send_message(
+                config, b"urgent\n" + HAIRGAP_MAGIC_NUMBER_INDEX.encode(), {"a": "b"}
+            )
+            express_thread.join()
+            self.assertEqual(
+                [(b"urgent\n" + HAIRGAP_MAGIC_NUMBER_INDEX.encode(), {"a": "b"})],
+                receiver.messages,
+            )
+
     def test_send_constants(self):
         with tempfile.TemporaryDirectory() as tmp_dir:
             src_path = os.path.join(tmp_dir, "original")
@@ -262,21 +289,25 @@ class TestDiodeTransfer(TestCase):
             self.assertEqual(src_content, dst_content)
 
     @staticmethod
-    def get_config(
-        tmp_dir, use_tar_archives: bool = False, split_size: Optional[int] = None
-    ):
-        src_port = 15124
+    def get_free_port(src_port: int = 15124) -> int:
         while True:
             try:
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
                     sock.bind(("localhost", src_port))
-                break
+                return src_port
             except OSError:
                 src_port += 1
 
+    def get_config(
+        self,
+        tmp_dir,
+        use_tar_archives: bool = False,
+        split_size: Optional[int] = None,
+        **kwargs,
+    ):
         return Config(
             destination_ip="localhost",
-            destination_port=src_port,
+            destination_port=self.get_free_port(),
             destination_path=os.path.join(tmp_dir, "transfering"),
             end_delay_s=3.0,
             error_chunk_size=None,
@@ -290,6 +321,7 @@ class TestDiodeTransfer(TestCase):
             hairgaps=get_filename("hairgaps.py"),
             use_tar_archives=use_tar_archives,
             split_size=split_size,
+            **kwargs,
         )
 
     @staticmethod
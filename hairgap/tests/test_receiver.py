@@ -0,0 +1,218 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import hashlib
+import os
+import re
+import tempfile
+from typing import Optional
+from unittest import TestCase
+
+from hairgap.constants import HAIRGAP_MAGIC_NUMBER_EMPTY, HAIRGAP_MAGIC_NUMBER_INDEX
+from hairgap.parity import PARITY_DIRNAME
+from hairgap.receiver import Receiver
+from hairgap.tests import test_sender
+from hairgap.utils import FILENAME_PATTERN, Config, ensure_dir
+
+
+class DemoReceiver(Receiver):
+    def __init__(self, config: Config, after_reception_path: str):
+        super().__init__(config)
+        self.after_reception_path = after_reception_path
+        self.complete_count = 0
+
+    def transfer_complete(self):
+        super().transfer_complete()
+        self.complete_count += 1
+
+    def get_current_transfer_directory(self) -> Optional[str]:
+        return self.after_reception_path
+
+
+class TestReceiver(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dirname = self.tmp_dir.name
+        self.receiver = DemoReceiver(
+            Config(destination_path=self.dirname, use_tar_archives=False),
+            os.path.join(self.dirname, "destination"),
+        )
+        self.counter = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def receive(self, content: bytes, valid: bool = True):
+        self.counter += 1
+        tmp_abspath = os.path.join(self.dirname, "received-%s" % self.counter)
+        with open(tmp_abspath, "wb") as fd:
+            fd.write(content)
+        self.receiver.process_received_file(tmp_abspath, valid=valid)
+        self.assertFalse(os.path.isfile(tmp_abspath))
+
+    @staticmethod
+    def get_index(files, *sections: str) -> bytes:
+        index = HAIRGAP_MAGIC_NUMBER_INDEX + "[hairgap]\n"
+        for section in sections:
+            index += "[%s]\n" % section
+        index += "[files]\n"
+        for name, content in files:
+            index += "%s = %s\n" % (hashlib.sha256(content).hexdigest(), name)
+        return index.encode()
+
+    def read_destination(self, name: str) -> bytes:
+        with open(os.path.join(self.dirname, "destination", name), "rb") as fd:
+            return fd.read()
+
+    def test_carousel(self):
+        files = [("a.txt", b"a\n"), ("b.txt", b"b\n"), ("c.txt", b"a\n")]
+        index = self.get_index(files, "carousel")
+        # first cycle: b.txt is lost
+        self.receive(index)
+        self.receive(b"a\n")
+        self.receive(b"corrupted\n", valid=False)
+        self.assertEqual(0, self.receiver.complete_count)
+        # second cycle: the gap is filled, duplicates are ignored
+        self.receive(index)
+        self.receive(b"a\n")
+        self.assertEqual(0, self.receiver.complete_count)
+        self.receive(b"b\n")
+        self.assertEqual(1, self.receiver.complete_count)
+        # third cycle: everything is ignored
+        self.receive(index)
+        self.receive(b"a\n")
+        self.receive(b"b\n")
+        self.assertEqual(1, self.receiver.complete_count)
+        for name, content in files:
+            self.assertEqual(content, self.read_destination(name))
+
+    def test_carousel_sizes(self):
+        files = [("a.txt", b"a\n"), ("b.txt", b"bb\n")]
+        index = HAIRGAP_MAGIC_NUMBER_INDEX + "[hairgap]\n[carousel]\n[files]\n"
+        for name, content in files:
+            index += "[size %s]\n" % len(content)
+            index += "%s = %s\n" % (hashlib.sha256(content).hexdigest(), name)
+        self.receive(index.encode())
+        self.receive(b"a\n")
+        digests = []
+        get_file_digest = self.receiver.get_file_digest
+        self.receiver.get_file_digest = lambda *args: digests.append(args) or (
+            get_file_digest(*args)
+        )
+        # repeated file: no pending file has its size, so its digest is not computed
+        self.receive(b"a\n")
+        self.assertEqual([], digests)
+        self.receive(b"bb\n")
+        self.assertEqual(1, len(digests))
+        self.assertEqual(1, self.receiver.complete_count)
+        for name, content in files:
+            self.assertEqual(content, self.read_destination(name))
+
+    def send_prepared(self, sender, corrupted=()):
+        """simulate the reception of all files of a prepared transfer"""
+        with open(sender.index_abspath, "rb") as fd:
+            index = fd.read()
+        self.receive(index)
+        for line in index.decode().splitlines():
+            matcher = re.match(FILENAME_PATTERN, line)
+            if not matcher:
+                continue
+            file_relpath = matcher.group(2)
+            file_abspath = os.path.join(sender.transfer_abspath, file_relpath)
+            if file_relpath.startswith(PARITY_DIRNAME + "/"):
+                file_abspath = os.path.join(
+                    sender.parity_abspath, os.path.basename(file_relpath)
+                )
+            with open(file_abspath, "rb") as fd:
+                content = fd.read() or HAIRGAP_MAGIC_NUMBER_EMPTY.encode()
+            if file_relpath in corrupted:
+                self.receive(b"", valid=False)
+            else:
+                self.receive(content)
+
+    def test_parity(self):
+        config = test_sender.TestSender.get_config(
+            self.dirname, split_size=None, parity_group_size=4, parity_count=2
+        )
+        sender = test_sender.DemoDirectorySender(
+            config, os.path.join(self.dirname, "sender")
+        )
+        sender.create_files(file_count=10, file_size=100)
+        with open(os.path.join(sender.transfer_abspath, "00000003.txt"), "w") as fd:
+            fd.write(HAIRGAP_MAGIC_NUMBER_INDEX)
+        open(os.path.join(sender.transfer_abspath, "00000004.txt"), "w").close()
+        sender.prepare_directory()
+        # parity files are written outside the source directory, so it can be prepared again
+        self.assertFalse(
+            os.path.exists(os.path.join(sender.transfer_abspath, PARITY_DIRNAME))
+        )
+        sender.prepare_directory()
+        corrupted = {
+            "00000000.txt",
+            "00000003.txt",
+            "00000004.txt",
+            ".hairgap-parity/1.0",
+            "00000008.txt",
+        }
+        self.send_prepared(sender, corrupted=corrupted)
+        self.assertEqual(1, self.receiver.complete_count)
+        self.assertEqual(0, self.receiver.transfer_error_count)
+        self.assertEqual(
+            ["0000000%s.txt" % i for i in range(10)],
+            sorted(os.listdir(os.path.join(self.dirname, "destination"))),
+        )
+        self.assertEqual(
+            HAIRGAP_MAGIC_NUMBER_INDEX.encode(), self.read_destination("00000003.txt")
+        )
+        self.assertEqual(b"", self.read_destination("00000004.txt"))
+        self.assertEqual(b"123456789\n" * 100, self.read_destination("00000008.txt"))
+
+    def test_parity_directory_conflict(self):
+        config = test_sender.TestSender.get_config(
+            self.dirname, split_size=None, parity_group_size=4, parity_count=2
+        )
+        sender = test_sender.DemoDirectorySender(
+            config, os.path.join(self.dirname, "sender")
+        )
+        sender.create_files(file_count=2, file_size=100)
+        parity_abspath = os.path.join(sender.transfer_abspath, PARITY_DIRNAME, "0.0")
+        ensure_dir(parity_abspath, parent=True)
+        with open(parity_abspath, "w") as fd:
+            fd.write("user data")
+        with self.assertRaises(ValueError):
+            sender.prepare_directory()
+        with open(parity_abspath) as fd:
+            self.assertEqual("user data", fd.read())
+
+    def test_split_archives(self):
+        config = test_sender.TestSender.get_config(
+            self.dirname, split_size=250000, split_archives=True
+        )
+        sender = test_sender.DemoDirectorySender(
+            config, os.path.join(self.dirname, "sender")
+        )
+        sender.create_files(file_count=10, file_size=10000)
+        sender.prepare_directory()
+        self.assertEqual(5, len(os.listdir(sender.transfer_abspath)))
+        self.send_prepared(sender, corrupted={"content.00002.tar.gz"})
+        self.assertEqual(1, self.receiver.complete_count)
+        self.assertEqual(1, self.receiver.transfer_error_count)
+        received = sorted(os.listdir(os.path.join(self.dirname, "destination")))
+        # only the two files of the corrupted chunk are lost
+        self.assertEqual(8, len(received))
+        for name in received:
+            self.assertEqual(b"123456789\n" * 10000, self.read_destination(name))
@@ -0,0 +1,104 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import importlib.resources
+import os
+import shutil
+import tempfile
+from threading import Thread
+from unittest import TestCase
+
+from hairgap.replay import read_streams, replay_streams
+from hairgap.tests import test_protocol
+from hairgap.transport import MemoryTransport
+from hairgap.utils import Config
+
+
+class TestReplay(TestCase):
+    def test_record_replay(self):
+        ref = importlib.resources.files("hairgap").joinpath("tests")
+        with tempfile.TemporaryDirectory() as tmp_dir, importlib.resources.as_file(
+            ref
+        ) as original_path:
+            record_path = os.path.join(tmp_dir, "record")
+            config = Config(
+                destination_ip="localhost",
+                destination_path=os.path.join(tmp_dir, "transfering"),
+                end_delay_s=0.0,
+                use_tar_archives=False,
+                transport=MemoryTransport(),
+                record_path=record_path,
+            )
+            src_path = os.path.join(tmp_dir, "original_copy")
+            shutil.copytree(original_path, src_path)
+            receiver = test_protocol.SingleDirReceiver(
+                config, os.path.join(tmp_dir, "received")
+            )
+            receiver_thread = Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+
+            streams = list(read_streams(record_path))
+            file_count = sum(len(x[2]) for x in os.walk(src_path))
+            self.assertEqual(file_count + 1, len(streams))  # with the index
+            self.assertTrue(all(x["valid"] for x in streams))
+            self.assertTrue(all(x["start"] <= x["end"] for x in streams))
+
+            replay_config = Config(
+                destination_path=os.path.join(tmp_dir, "replaying"),
+                use_tar_archives=False,
+            )
+            dst_path = os.path.join(tmp_dir, "replayed")
+            replayer = test_protocol.SingleDirReceiver(replay_config, dst_path)
+            results = replay_streams(replayer, record_path, speed=None)
+            self.assertEqual([x["name"] for x in streams], [x["name"] for x in results])
+            self.assertEqual([x["size"] for x in streams], [x["size"] for x in results])
+            for filename in os.listdir(original_path):
+                if not filename.endswith(".py"):
+                    continue
+                with open(os.path.join(original_path, filename), "rb") as fd:
+                    src_content = fd.read()
+                with open(os.path.join(dst_path, filename), "rb") as fd:
+                    self.assertEqual(src_content, fd.read())
+
+    def test_record_in_process_thread(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            record_path = os.path.join(tmp_dir, "record")
+            config = Config(
+                destination_path=os.path.join(tmp_dir, "transfering"),
+                use_tar_archives=False,
+                record_path=record_path,
+            )
+            receiver = test_protocol.SingleDirReceiver(
+                config, os.path.join(tmp_dir, "received"), threading=True
+            )
+            tmp_abspath = receiver.get_reception_filepath()
+            os.makedirs(os.path.dirname(tmp_abspath), exist_ok=True)
+            with open(tmp_abspath, "wb") as fd:
+                fd.write(b"unexpected content\n")
+            # the receive loop only queues the received file, with its timings
+            receiver.process_queue.put((True, tmp_abspath, 1.0, 2.0))
+            process_thread = Thread(target=receiver.process_loop)
+            process_thread.start()
+            process_thread.join(30.0)
+            self.assertFalse(process_thread.is_alive())
+            streams = list(read_streams(record_path))
+            self.assertEqual(1, len(streams))
+            self.assertEqual(19, streams[0]["size"])
+            self.assertEqual((1.0, 2.0), (streams[0]["start"], streams[0]["end"]))
@@ -0,0 +1,213 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+from hairgap.constants import (
+    HAIRGAP_MAGIC_NUMBER_INDEX,
+    HAIRGAP_MAGIC_NUMBER_SEGMENT,
+)
+from hairgap.segments import (
+    END_PATTERN,
+    get_segment_name,
+    iter_batches,
+    read_segment_relpaths,
+)
+from hairgap.tests import get_memory_config, test_protocol, write_files
+from hairgap.transport import MemoryTransport
+from hairgap.utils import FILENAME_PATTERN, Config
+
+
+class SegmentLossTransport(MemoryTransport):
+    """drop a segment and the files it lists"""
+
+    def __init__(self, lost_segment: int):
+        super().__init__()
+        self.lost_header = (
+            "%s[segment %s " % (HAIRGAP_MAGIC_NUMBER_SEGMENT, lost_segment)
+        ).encode()
+        self.dropping = False
+
+    def send(self, config, fd, port, progress=None, header=b""):
+        data = header + fd.read()
+        if data.startswith(HAIRGAP_MAGIC_NUMBER_SEGMENT.encode()):
+            self.dropping = data.startswith(self.lost_header)
+        if not self.dropping:
+            self.get_queue(port).put(data)
+
+
+class FailingTransport(MemoryTransport):
+    """send indexes and segments, but no data file"""
+
+    def send(self, config, fd, port, progress=None, header=b""):
+        data = header + fd.read(len(HAIRGAP_MAGIC_NUMBER_SEGMENT))
+        if not data.startswith(
+            (HAIRGAP_MAGIC_NUMBER_SEGMENT.encode(), HAIRGAP_MAGIC_NUMBER_INDEX.encode())
+        ):
+            raise ValueError("link down")
+
+
+class TestSegments(TestCase):
+    contents = {
+        "a.txt": b"first file\n",
+        "b.txt": b"",
+        "large.bin": os.urandom(300000),
+        os.path.join("logs", "c.json"): b'{"level": "info"}\n' * 20000,
+        os.path.join("logs", "d.txt"): b"fourth file\n",
+    }
+
+    @staticmethod
+    def get_config(tmp_dir: str, **options) -> Config:
+        return get_memory_config(tmp_dir, index_segment_files=2, **options)
+
+    def test_iter_batches(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            write_files(dirname, self.contents)
+            batches = list(iter_batches(dirname, 2))
+            self.assertEqual([2, 2, 1], [len(x) for x in batches])
+            relpaths = [y[1] for x in batches for y in x]
+            self.assertEqual(sorted(self.contents), sorted(relpaths))
+            batches = list(iter_batches(dirname, 2, excluded={"a.txt", "b.txt"}))
+            self.assertEqual([2, 1], [len(x) for x in batches])
+
+    def test_send_directory(self):
+        for options in ({}, {"chunk_size": 100000}, {"compression": "auto"}):
+            with self.subTest(**options):
+                self.check_send_directory(**options)
+
+    def check_send_directory(self, **options):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = self.get_config(tmp_dir, **options)
+            src_path = os.path.join(tmp_dir, "original")
+            write_files(src_path, self.contents)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            self.assertTrue(sender.use_segments)
+            with open(sender.index_abspath) as fd:
+                index = fd.read()
+            self.assertIn("[segmented]\n", index)
+            self.assertNotRegex(index, FILENAME_PATTERN)
+            dst_path = os.path.join(tmp_dir, "received")
+            receiver = test_protocol.SingleDirReceiver(config, dst_path)
+            receiver_thread = threading.Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            self.assertEqual(0, receiver.transfer_error_count)
+            # header index, 3 segments, trailer and data files
+            self.assertEqual(sender.sent_file_count, receiver.transfer_received_count)
+            names = sorted(os.listdir(sender.segments_abspath))
+            self.assertEqual(4, len(names))
+            with open(os.path.join(sender.segments_abspath, names[-1])) as fd:
+                self.assertRegex(fd.read(), END_PATTERN[1:-1])
+            for name, content in self.contents.items():
+                with open(os.path.join(dst_path, name), "rb") as fd:
+                    self.assertEqual(content, fd.read())
+
+    def test_replay_segments(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = self.get_config(tmp_dir)
+            src_path = os.path.join(tmp_dir, "original")
+            write_files(src_path, self.contents)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            segments = sender.iter_segments()
+            first_abspath = next(segments)
+            self.assertEqual(
+                {"a.txt", "b.txt"}, read_segment_relpaths(first_abspath)[0]
+            )
+            # the first segment is kept, the next ones are prepared again
+            segment_abspaths = list(sender.iter_segments())
+            self.assertEqual(4, len(segment_abspaths))
+            self.assertEqual(first_abspath, segment_abspaths[0])
+            relpaths = set()
+            for segment_abspath in segment_abspaths:
+                relpaths |= read_segment_relpaths(segment_abspath)[0]
+            self.assertEqual(set(self.contents), relpaths)
+            self.assertTrue(read_segment_relpaths(segment_abspaths[-1])[1])
+            with mock.patch.object(sender, "prepare_file") as prepare_file:
+                self.assertEqual(segment_abspaths, list(sender.iter_segments()))
+            prepare_file.assert_not_called()
+
+    def test_foreign_segment(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = self.get_config(tmp_dir)
+            src_path = os.path.join(tmp_dir, "original")
+            write_files(src_path, self.contents)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            segment_abspaths = list(sender.iter_segments())
+            receiver = test_protocol.SingleDirReceiver(
+                config, os.path.join(tmp_dir, "received")
+            )
+            tmp_abspath = os.path.join(tmp_dir, "received-file")
+            with open(sender.index_abspath, "a") as fd:
+                fd.write("title = another transfer\n")
+            for path in [sender.index_abspath] + segment_abspaths:
+                with open(path, "rb") as fd_in, open(tmp_abspath, "wb") as fd_out:
+                    fd_out.write(fd_in.read())
+                receiver.process_received_file(tmp_abspath)
+            # segments do not belong to the received index
+            self.assertTrue(receiver.expected_files.empty())
+            self.assertFalse(receiver.current_segments_ended)
+            self.assertTrue(receiver.transfer_in_progress)
+
+    def test_missing_segment(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = self.get_config(tmp_dir)
+            config = config.replace(transport=SegmentLossTransport(1))
+            src_path = os.path.join(tmp_dir, "original")
+            write_files(src_path, self.contents)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            receiver = test_protocol.SingleDirReceiver(
+                config, os.path.join(tmp_dir, "received")
+            )
+            receiver_thread = threading.Thread(target=receiver.loop)
+            receiver_thread.start()
+            with mock.patch.object(
+                receiver, "transfer_segments_missing"
+            ) as transfer_segments_missing:
+                sender.send_directory()
+                receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            # the second segment lists 2 of the 5 files
+            transfer_segments_missing.assert_called_once_with([1], 3, 2)
+            self.assertEqual(1, receiver.transfer_error_count)
+
+    def test_send_failure(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = self.get_config(tmp_dir)
+            config = config.replace(transport=FailingTransport())
+            src_path = os.path.join(tmp_dir, "original")
+            write_files(src_path, self.contents)
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            write_file_entries = sender.write_file_entries
+
+            def slow_write_file_entries(*args):
+                time.sleep(0.2)
+                return write_file_entries(*args)
+
+            sender.write_file_entries = slow_write_file_entries
+            with self.assertRaises(ValueError):
+                sender.send_directory()
+            # the prefetched segment is abandoned after its first file
+            self.assertEqual([get_segment_name(0)], os.listdir(sender.segments_abspath))
@@ -15,6 +15,7 @@
 # ##############################################################################
 import os
 import socket
+import tarfile
 import tempfile
 from typing import Dict
 from unittest import TestCase
@@ -82,6 +83,48 @@ class TestSender(TestCase):
             actual = set(os.listdir(sender.transfer_abspath))
             self.assertEqual(expected, actual)
 
+    def test_archive_directory_chunks(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            sender = self.create_sender(dirname)
+            archives_path = os.path.join(dirname, "archives")
+            actual = DirectorySender.archive_directory_chunks(
+                sender.config, sender.transfer_abspath, archives_path, split_size=250000
+            )
+            expected = ["content.%05d.tar.gz" % i for i in range(5)]
+            self.assertEqual(expected, actual)
+            self.assertEqual(set(expected), set(os.listdir(archives_path)))
+            members = []
+            for name in actual:
+                with tarfile.open(os.path.join(archives_path, name), "r:gz") as tar_fd:
+                    names = [os.path.normpath(x) for x in tar_fd.getnames()]
+                self.assertEqual(2, len(names))
+                members += names
+            self.assertEqual(["%08d.txt" % i for i in range(10)], sorted(members))
+
+    def test_archive_directory_chunks_failure(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            sender = self.create_sender(dirname)
+            sender.config = sender.config.replace(tar="false", split_archives=True)
+            names = sorted(os.listdir(sender.transfer_abspath))
+            with self.assertRaises(ValueError):
+                sender.split_source_files(sender.transfer_abspath, split_size=250000)
+            # no truncated archive is kept, the source files are restored
+            self.assertEqual(names, sorted(os.listdir(sender.transfer_abspath)))
+
+    def test_prepare_directory_no_tar_split_archives(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            config = self.get_config(dirname, split_size=250000, split_archives=True)
+            sender = DemoDirectorySender(config, dirname)
+            sender.create_files()
+            sender.prepare_directory_no_tar()
+            with open(sender.index_abspath) as fd:
+                actual = fd.read().splitlines()
+            self.assertEqual("[split_archives]", actual[3])
+            self.assertEqual(
+                ["content.%05d.tar.gz" % i for i in range(5)],
+                [x.partition(" = ")[2] for x in actual[5:]],
+            )
+
     def test_prepare_directory_no_tar_splitted(self):
         with tempfile.TemporaryDirectory() as dirname:
             sender = self.create_sender(dirname)
@@ -141,7 +184,7 @@ class TestSender(TestCase):
         return sender
 
     @staticmethod
-    def get_config(tmp_dir, use_tar_archives: bool = False, split_size=10000):
+    def get_config(tmp_dir, use_tar_archives: bool = False, split_size=10000, **kwargs):
         src_port = 15124
         while True:
             try:
@@ -166,4 +209,5 @@ class TestSender(TestCase):
             hairgaps=get_filename("hairgaps.py"),
             use_tar_archives=use_tar_archives,
             split_size=split_size,
+            **kwargs,
         )
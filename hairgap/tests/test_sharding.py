@@ -0,0 +1,165 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import tempfile
+from typing import Optional
+from unittest import TestCase
+
+from hairgap.sharding import (
+    SHARD_COUNT_ATTRIBUTE,
+    SHARD_INDEX_ATTRIBUTE,
+    SHARD_PARENT_ATTRIBUTE,
+    ShardedDirectorySender,
+    ShardedReceiver,
+    plan_shards,
+)
+from hairgap.tests import test_sender
+from hairgap.utils import ensure_dir
+
+
+class DemoShardedSender(ShardedDirectorySender):
+    def __init__(self, config, dirname: str, **kwargs):
+        super().__init__(config, **kwargs)
+        self.root_directory = dirname
+
+    @property
+    def transfer_abspath(self) -> str:
+        return os.path.join(self.root_directory, "original")
+
+    @property
+    def index_abspath(self):
+        return os.path.join(self.root_directory, "index.txt")
+
+
+class DemoShardedReceiver(ShardedReceiver):
+    def __init__(self, config):
+        super().__init__(config)
+        self.completed = []
+        self.missing = []
+
+    def get_current_transfer_directory(self) -> Optional[str]:
+        return None
+
+    def sharded_transfer_complete(self, parent_id: str, error_count: int = 0):
+        super().sharded_transfer_complete(parent_id, error_count=error_count)
+        self.completed.append(parent_id)
+
+    def shard_missing(self, parent_id: str, missing, shard_count: int, error_count=0):
+        super().shard_missing(parent_id, missing, shard_count, error_count=error_count)
+        self.missing.append((parent_id, missing, shard_count))
+
+
+class TestSharding(TestCase):
+    @staticmethod
+    def create_files(dirname, sizes):
+        for index, size in enumerate(sizes):
+            path = os.path.join(dirname, "sub%s" % (index % 2), "%02d.txt" % index)
+            ensure_dir(path, parent=True)
+            with open(path, "wb") as fd:
+                fd.write(b"x" * size)
+
+    def test_plan_shards(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            self.create_files(dirname, [60, 50, 40, 30, 200, 10])
+            actual = plan_shards(dirname, max_size=100)
+        expected = [
+            [("sub0/04.txt", 200)],
+            [("sub0/00.txt", 60), ("sub1/03.txt", 30), ("sub1/05.txt", 10)],
+            [("sub0/02.txt", 40), ("sub1/01.txt", 50)],
+        ]
+        self.assertEqual(expected, actual)
+
+    def test_plan_shards_max_files(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            self.create_files(dirname, [10] * 5)
+            actual = plan_shards(dirname, max_files=2)
+        self.assertEqual([2, 2, 1], [len(x) for x in actual])
+
+    def test_plan_shards_many_files(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            self.create_files(dirname, [10] * 100)
+            actual = plan_shards(dirname, max_size=25, max_files=3)
+        self.assertEqual([2] * 50, [len(x) for x in actual])
+        self.assertEqual(100, len({x for shard in actual for x in shard}))
+
+    def test_prepare_and_receive(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            config = test_sender.TestSender.get_config(dirname, split_size=None)
+            sender = DemoShardedSender(config, dirname, max_shard_files=4)
+            self.create_files(sender.transfer_abspath, [10] * 10)
+            self.assertEqual(13, sender.prepare_directory()[0])
+            senders = sender.get_shard_senders()
+            self.assertEqual([0, 1, 2], [x.shard_index for x in senders])
+            receiver = DemoShardedReceiver(config)
+            for shard_sender in reversed(senders):
+                attributes = shard_sender.get_attributes()
+                self.assertEqual(
+                    sender.get_transfer_id(), attributes[SHARD_PARENT_ATTRIBUTE]
+                )
+                self.assertEqual("3", attributes[SHARD_COUNT_ATTRIBUTE])
+                self.assertEqual([], receiver.completed)
+                receiver.read_index(shard_sender.index_abspath)
+                receiver.transfer_complete()
+            self.assertEqual([sender.get_transfer_id()], receiver.completed)
+
+    def test_empty_directory(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            config = test_sender.TestSender.get_config(dirname, split_size=None)
+            sender = DemoShardedSender(config, dirname, max_shard_files=4)
+            ensure_dir(sender.transfer_abspath, parent=False)
+            sender.prepare_directory()
+            senders = sender.get_shard_senders()
+            self.assertEqual([0], [x.shard_index for x in senders])
+            self.assertEqual("1", senders[0].get_attributes()[SHARD_COUNT_ATTRIBUTE])
+            receiver = DemoShardedReceiver(config)
+            receiver.read_index(senders[0].index_abspath)
+            receiver.transfer_complete()
+            self.assertEqual([sender.get_transfer_id()], receiver.completed)
+
+    def test_missing_shards(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            config = test_sender.TestSender.get_config(dirname, split_size=None)
+            receiver = DemoShardedReceiver(config)
+            receiver.max_pending_transfers = 1
+            parent_ids = []
+            for name in ("first", "second"):
+                sender = DemoShardedSender(
+                    config, os.path.join(dirname, name), max_shard_files=4
+                )
+                self.create_files(sender.transfer_abspath, [10] * 10)
+                sender.prepare_directory()
+                parent_ids.append(sender.get_transfer_id())
+                receiver.read_index(sender.get_shard_senders()[1].index_abspath)
+                receiver.transfer_complete()
+            self.assertEqual([(parent_ids[0], [0, 2], 3)], receiver.missing)
+            self.assertEqual([parent_ids[1]], list(receiver.pending_shards))
+            receiver.pending_timeout_s = 0.0
+            receiver.forget_pending_shards()
+            self.assertEqual((parent_ids[1], [0, 2], 3), receiver.missing[-1])
+            self.assertEqual([], receiver.completed)
+
+    def test_invalid_shard_attributes(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            config = test_sender.TestSender.get_config(dirname, split_size=None)
+            sender = DemoShardedSender(config, dirname, max_shard_files=4)
+            self.create_files(sender.transfer_abspath, [10] * 10)
+            sender.prepare_directory()
+            receiver = DemoShardedReceiver(config)
+            receiver.read_index(sender.get_shard_senders()[0].index_abspath)
+            del receiver.current_attributes[SHARD_INDEX_ATTRIBUTE]
+            with self.assertLogs("hairgap.sharding", level="ERROR"):
+                receiver.transfer_complete()
+            self.assertEqual({}, dict(receiver.pending_shards))
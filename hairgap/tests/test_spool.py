@@ -0,0 +1,92 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import tempfile
+from unittest import TestCase
+
+from hairgap.spool import (
+    STATE_DONE,
+    STATE_FAILED,
+    STATE_PENDING,
+    STATE_RUNNING,
+    SendQueue,
+    SpoolDaemon,
+)
+from hairgap.utils import Config
+
+
+class RecordingSpoolDaemon(SpoolDaemon):
+    def __init__(self, config: Config, queue: SendQueue):
+        super().__init__(config, queue)
+        self.sent = []
+
+    def prepare_job(self, job) -> bool:
+        open(job.prepared_abspath, "w").close()
+        return True
+
+    def send_job(self, job) -> bool:
+        self.sent.append(job.uid)
+        self.queue.complete(job)
+        return True
+
+
+class TestSendQueue(TestCase):
+    def create_source(self, dirname, name="source"):
+        path = os.path.join(dirname, name)
+        os.makedirs(path)
+        with open(os.path.join(path, "file.txt"), "w") as fd:
+            fd.write("content\n")
+        return path
+
+    def test_priority_order(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            source = self.create_source(dirname)
+            queue = SendQueue(os.path.join(dirname, "spool"))
+            low_1 = queue.submit(source, priority=0)
+            high_1 = queue.submit(source, priority=10)
+            low_2 = queue.submit(source, priority=0)
+            high_2 = queue.submit(source, priority=10)
+            actual = [job.uid for job in queue.get_jobs()]
+            self.assertEqual([high_1, high_2, low_1, low_2], actual)
+            job = queue.pop()
+            self.assertEqual(high_1, job.uid)
+            self.assertEqual(STATE_RUNNING, queue.get_job(high_1).state)
+            self.assertTrue(os.path.isfile(os.path.join(job.data_abspath, "file.txt")))
+
+    def test_daemon(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            source = self.create_source(dirname)
+            queue = SendQueue(os.path.join(dirname, "spool"))
+            uids = [queue.submit(source, priority=x % 2) for x in range(5)]
+            daemon = RecordingSpoolDaemon(Config(), queue)
+            self.assertEqual(5, daemon.run_pending())
+            self.assertEqual([uids[1], uids[3], uids[0], uids[2], uids[4]], daemon.sent)
+            self.assertEqual([], queue.get_jobs())
+            self.assertEqual(5, len(queue.get_jobs(STATE_DONE)))
+            self.assertFalse(os.path.isdir(queue.get_job_path(uids[0])))
+
+    def test_requeue_running(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            source = self.create_source(dirname)
+            queue = SendQueue(os.path.join(dirname, "spool"))
+            prepared = queue.submit(source)
+            interrupted = queue.submit(source)
+            job = queue.pop()
+            open(job.prepared_abspath, "w").close()
+            queue.pop()
+            self.assertEqual(1, queue.requeue_running())
+            self.assertEqual(STATE_PENDING, queue.get_job(prepared).state)
+            self.assertEqual(STATE_FAILED, queue.get_job(interrupted).state)
@@ -0,0 +1,154 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import json
+import os
+import re
+import tempfile
+import threading
+from typing import List
+from unittest import TestCase
+
+from hairgap.tests import test_receiver, test_sender
+from hairgap.tracing import (
+    NOOP_SPAN,
+    NOOP_TRACER,
+    JsonLinesExporter,
+    Span,
+    SpanExporter,
+    Tracer,
+)
+from hairgap.utils import FILENAME_PATTERN, Config
+
+
+class ListExporter(SpanExporter):
+    def __init__(self):
+        self.started = []  # type: List[Span]
+        self.spans = []  # type: List[Span]
+
+    def on_start(self, span: Span):
+        self.started.append(span)
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+    def get_spans(self, name: str) -> List[Span]:
+        return [x for x in self.spans if x.name == name]
+
+
+class TestTracing(TestCase):
+    def test_nested_spans(self):
+        exporter = ListExporter()
+        tracer = Tracer([exporter])
+        with tracer.span("outer", path="a") as outer:
+            with tracer.span("inner") as inner:
+                inner.set_attribute("bytes", 42)
+            detached = tracer.span("detached", root=True)
+        detached.end()
+        detached.end()  # exported only once
+        self.assertEqual(
+            ["inner", "outer", "detached"], [x.name for x in exporter.spans]
+        )
+        self.assertEqual(outer.span_id, inner.parent_id)
+        self.assertEqual(outer.trace_id, inner.trace_id)
+        self.assertIsNone(detached.parent_id)
+        self.assertNotEqual(outer.trace_id, detached.trace_id)
+        self.assertEqual({"bytes": 42}, inner.attributes)
+        self.assertGreaterEqual(outer.duration_s, inner.duration_s)
+        self.assertIsNone(tracer.current_span())
+
+    def test_threads(self):
+        exporter = ListExporter()
+        tracer = Tracer([exporter])
+        with tracer.span("main"):
+            thread = threading.Thread(target=lambda: tracer.span("other").end())
+            thread.start()
+            thread.join()
+        self.assertIsNone(exporter.get_spans("other")[0].parent_id)
+
+    def test_error(self):
+        exporter = ListExporter()
+        tracer = Tracer([exporter])
+        with self.assertRaises(ValueError):
+            with tracer.span("failing"):
+                raise ValueError("boom")
+        self.assertEqual("ValueError('boom')", exporter.spans[0].attributes["error"])
+
+    def test_noop(self):
+        self.assertIs(NOOP_TRACER, Config().tracer)
+        with NOOP_TRACER.span("stage", path="a") as span:
+            span.set_attribute("bytes", 42)
+        self.assertIs(NOOP_SPAN, span)
+        self.assertEqual({}, span.attributes)
+
+    def test_json_lines(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, "spans.jsonl")
+            tracer = Tracer([JsonLinesExporter(path)])
+            with tracer.span("outer"):
+                with tracer.span("inner", bytes=12):
+                    pass
+            tracer.close()
+            with open(path) as fd:
+                spans = [json.loads(x) for x in fd]
+        self.assertEqual(["inner", "outer"], [x["name"] for x in spans])
+        self.assertEqual(spans[1]["span_id"], spans[0]["parent_id"])
+        self.assertEqual({"bytes": 12}, spans[0]["attributes"])
+
+    def test_transfer(self):
+        exporter = ListExporter()
+        with tempfile.TemporaryDirectory() as dirname:
+            config = test_sender.TestSender.get_config(
+                dirname, split_size=None, tracer=Tracer([exporter])
+            )
+            sender = test_sender.DemoDirectorySender(
+                config, os.path.join(dirname, "sender")
+            )
+            sender.create_files(file_count=3, file_size=100)
+            sender.prepare_directory()
+            receiver = test_receiver.DemoReceiver(
+                config, os.path.join(dirname, "destination")
+            )
+            with open(sender.index_abspath, "rb") as fd:
+                contents = [fd.read()]
+            for line in contents[0].decode().splitlines():
+                matcher = re.match(FILENAME_PATTERN, line)
+                if matcher:
+                    file_abspath = os.path.join(
+                        sender.transfer_abspath, matcher.group(2)
+                    )
+                    with open(file_abspath, "rb") as fd:
+                        contents.append(fd.read())
+            for index, content in enumerate(contents):
+                tmp_abspath = os.path.join(dirname, "received-%s" % index)
+                with open(tmp_abspath, "wb") as fd:
+                    fd.write(content)
+                receiver.process_received_file(tmp_abspath)
+        (prepare,) = exporter.get_spans("prepare")
+        self.assertEqual(4, prepare.attributes["files"])
+        prepare_files = exporter.get_spans("prepare_file")
+        self.assertEqual(3, len(prepare_files))
+        self.assertTrue(all(x.parent_id == prepare.span_id for x in prepare_files))
+        self.assertEqual(1000, prepare_files[0].attributes["bytes"])
+        (transfer,) = exporter.get_spans("transfer")
+        self.assertEqual(3, transfer.attributes["expected_files"])
+        self.assertEqual(4, transfer.attributes["success_count"])
+        process_files = exporter.get_spans("process_file")
+        self.assertEqual(4, len(process_files))
+        self.assertEqual(
+            3, len([x for x in process_files if x.parent_id == transfer.span_id])
+        )
+        self.assertEqual(3, len(exporter.get_spans("hash")))
+        self.assertEqual(len(exporter.started), len(exporter.spans))
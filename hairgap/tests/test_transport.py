@@ -0,0 +1,103 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import importlib.resources
+import io
+import os
+import shutil
+import tempfile
+import time
+from threading import Thread
+from unittest import TestCase
+
+from hairgap.tests import get_memory_config, test_protocol
+from hairgap.transport import MemoryTransport, TcpTransport
+from hairgap.utils import Config
+
+
+class TestTransport(TestCase):
+    def get_config(self, tmp_dir: str, transport, **kwargs) -> Config:
+        kwargs.setdefault("use_tar_archives", None)
+        return get_memory_config(
+            tmp_dir,
+            destination_port=test_protocol.TestDiodeTransfer.get_free_port(),
+            transport=transport,
+            **kwargs,
+        )
+
+    def test_memory_file(self):
+        transport = MemoryTransport()
+        config = self.get_config(tempfile.gettempdir(), transport)
+        transport.send(config, io.BytesIO(b"content"), 1234)
+        fd = io.BytesIO()
+        self.assertEqual((0, ""), transport.receive(config, fd, 1234))
+        self.assertEqual(b"content", fd.getvalue())
+        handles = []
+        Thread(target=lambda: (time.sleep(0.2), handles[0].terminate())).start()
+        returncode, __ = transport.receive(config, fd, 1234, register=handles.append)
+        self.assertEqual(-15, returncode)
+
+    def test_tcp_file(self):
+        transport = TcpTransport()
+        config = self.get_config(tempfile.gettempdir(), transport)
+        port = config.destination_port
+        result, fd = [], io.BytesIO()
+        thread = Thread(
+            target=lambda: result.append(transport.receive(config, fd, port))
+        )
+        thread.start()
+        transport.send(config, io.BytesIO(b"content" * 100000), port)
+        thread.join()
+        self.assertEqual([(0, "")], result)
+        self.assertEqual(b"content" * 100000, fd.getvalue())
+
+    def test_memory_transfers(self):
+        for kwargs in (
+            {"use_tar_archives": True},
+            {"use_tar_archives": False},
+            {"use_tar_archives": False, "split_size": 10000},
+            {"use_tar_archives": False, "parity_group_size": 4},
+        ):
+            with self.subTest(**kwargs):
+                self.check_transfer(MemoryTransport(), **kwargs)
+
+    def test_tcp_transfer(self):
+        self.check_transfer(TcpTransport(), use_tar_archives=False)
+
+    def check_transfer(self, transport, **kwargs):
+        ref = importlib.resources.files("hairgap").joinpath("tests")
+        with tempfile.TemporaryDirectory() as tmp_dir, importlib.resources.as_file(
+            ref
+        ) as original_path:
+            config = self.get_config(tmp_dir, transport, **kwargs)
+            src_path = os.path.join(tmp_dir, "original_copy")
+            shutil.copytree(original_path, src_path)
+            dst_path = os.path.join(tmp_dir, "destination")
+            receiver = test_protocol.SingleDirReceiver(config, dst_path)
+            receiver_thread = Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            for filename in os.listdir(original_path):
+                src_filename = os.path.join(original_path, filename)
+                if os.path.isdir(src_filename):
+                    continue
+                with open(src_filename, "rb") as fd:
+                    src_content = fd.read()
+                with open(os.path.join(dst_path, filename), "rb") as fd:
+                    self.assertEqual(src_content, fd.read())
@@ -47,6 +47,16 @@ class TestUtils(TestCase):
         else:
             print("Unknown platform : %s" % platform)
 
+    def test_config_replace(self):
+        c = Config(destination_ip="10.0.0.2", redundancy=2.0, hairgapr="/opt/hairgapr")
+        replaced = c.replace(mtu_b=1400)
+        self.assertEqual(1400, replaced.mtu_b)
+        self.assertIsNone(c.mtu_b)
+        self.assertEqual("10.0.0.2", replaced.destination_ip)
+        self.assertEqual(2.0, replaced.redundancy)
+        self.assertEqual("/opt/hairgapr", replaced.hairgapr_path)
+        self.assertRaises(TypeError, c.replace, mtu=1400)
+
     def test_parse_arp(self):
         value = """Address                  HWtype  HWaddress           Flags Mask            Iface
 192.168.56.150                   (incomplete)                              enp2s0
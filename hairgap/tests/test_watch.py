@@ -0,0 +1,195 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+from hairgap.cli import SimpleDirReceiver
+from hairgap.tests import get_memory_config
+from hairgap.utils import Config
+from hairgap.watch import InotifyWatcher, PollingWatcher, WatchSender
+
+
+class RecordingWatchSender(WatchSender):
+    def __init__(self, config: Config, spool_path: str, **kwargs):
+        super().__init__(config, spool_path, **kwargs)
+        self.sent = []
+
+    def send_batch(self, batch_abspath: str) -> bool:
+        self.sent.append(sorted(os.listdir(os.path.join(batch_abspath, "data"))))
+        return super().send_batch(batch_abspath)
+
+
+class SingleTransferReceiver(SimpleDirReceiver):
+    def transfer_complete(self):
+        super().transfer_complete()
+        self.continue_loop = False
+
+
+class TestWatch(TestCase):
+    @staticmethod
+    def write_file(dirname: str, name: str, content: bytes = b"content\n"):
+        with open(os.path.join(dirname, name), "wb") as fd:
+            fd.write(content)
+
+    def test_polling_watcher(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            watcher = PollingWatcher(dirname, poll_interval_s=0.0)
+            self.write_file(dirname, "a.txt")
+            self.write_file(dirname, ".a.txt.tmp")
+            self.assertEqual([], watcher.read_events(0.0))
+            # stable since the last poll
+            self.assertEqual(["a.txt"], watcher.read_events(0.0))
+            self.assertEqual([], watcher.read_events(0.0))
+            self.write_file(dirname, "a.txt", b"new content\n")
+            watcher.read_events(0.0)
+            self.assertEqual(["a.txt"], watcher.read_events(0.0))
+
+    def test_inotify_watcher(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            try:
+                watcher = InotifyWatcher(dirname)
+            except OSError as e:
+                self.skipTest("inotify is not available: %s" % e)
+            try:
+                with open(os.path.join(dirname, "a.txt"), "wb") as fd:
+                    fd.write(b"content\n")
+                    self.assertEqual([], watcher.read_events(0.0))
+                self.write_file(dirname, ".b.txt.tmp")
+                os.rename(
+                    os.path.join(dirname, ".b.txt.tmp"), os.path.join(dirname, "b.txt")
+                )
+                os.mkdir(os.path.join(dirname, "c"))
+                self.assertEqual(["a.txt", "b.txt"], watcher.read_events(1.0))
+            finally:
+                watcher.close()
+
+    def test_catch_up(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spool_path = os.path.join(tmp_dir, "spool")
+            os.makedirs(spool_path)
+            for i in range(5):
+                self.write_file(spool_path, "%s.txt" % i)
+            sender = RecordingWatchSender(
+                get_memory_config(tmp_dir),
+                spool_path,
+                max_batch_files=2,
+                max_latency_s=60.0,
+            )
+            sender.scan()
+            # files written before the start are sent without waiting for the latency
+            self.assertEqual(3, sender.send_ready_batches())
+            self.assertEqual(
+                [["0.txt", "1.txt"], ["2.txt", "3.txt"], ["4.txt"]], sender.sent
+            )
+            self.assertEqual([".hairgap-watch"], os.listdir(spool_path))
+            self.assertEqual([], os.listdir(sender.batches_path))
+
+    def test_scan_removed_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spool_path = os.path.join(tmp_dir, "spool")
+            os.makedirs(spool_path)
+            for i in range(3):
+                self.write_file(spool_path, "%s.txt" % i)
+            sender = RecordingWatchSender(get_memory_config(tmp_dir), spool_path)
+            scandir = os.scandir
+
+            def scandir_and_remove(path):
+                entries = list(scandir(path))
+                # removed between the listing and the stat
+                os.remove(os.path.join(spool_path, "1.txt"))
+                return iter(entries)
+
+            with mock.patch("hairgap.watch.os.scandir", scandir_and_remove):
+                sender.scan()
+            self.assertEqual(["0.txt", "2.txt"], sorted(sender.pending))
+
+    def test_batch_limits(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sender = WatchSender(
+                get_memory_config(tmp_dir),
+                tmp_dir,
+                max_batch_files=10,
+                max_batch_size=100,
+                max_latency_s=60.0,
+            )
+            self.write_file(tmp_dir, "a.txt", b"a" * 60)
+            sender.add_file("a.txt")
+            self.assertFalse(sender.is_batch_ready())
+            self.assertGreater(sender.get_timeout(), 0.0)
+            self.write_file(tmp_dir, "b.txt", b"b" * 60)
+            self.write_file(tmp_dir, "c.txt", b"c" * 60)
+            sender.add_file("b.txt")
+            sender.add_file("c.txt")
+            self.assertTrue(sender.is_batch_ready())
+            self.assertEqual(["a.txt", "b.txt"], sender.pop_batch())
+            self.assertFalse(sender.is_batch_ready())
+            sender.max_latency_s = 0.0
+            self.assertTrue(sender.is_batch_ready())
+            self.assertEqual(0.0, sender.get_timeout())
+
+    def test_backlog(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spool_path = os.path.join(tmp_dir, "spool")
+            os.makedirs(spool_path)
+            sender = RecordingWatchSender(get_memory_config(tmp_dir), spool_path)
+            self.write_file(spool_path, "prepared.txt")
+            prepared = sender.create_batch(["prepared.txt"])
+            sender.get_sender(prepared).prepare_directory()
+            open(sender.get_sender(prepared).prepared_abspath, "w").close()
+            self.write_file(spool_path, "interrupted.txt")
+            interrupted = sender.create_batch(["interrupted.txt"])
+            open(sender.get_sender(interrupted).preparing_abspath, "w").close()
+            # the preparation of this batch has not started yet
+            self.write_file(spool_path, "unprepared.txt")
+            sender.create_batch(["unprepared.txt"])
+            self.assertEqual(2, sender.send_backlog())
+            self.assertEqual([["prepared.txt"], ["unprepared.txt"]], sender.sent)
+            self.assertEqual([], os.listdir(sender.batches_path))
+            self.assertEqual(
+                [os.path.basename(interrupted)], os.listdir(sender.failed_path)
+            )
+
+    def test_loop(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spool_path = os.path.join(tmp_dir, "spool")
+            os.makedirs(spool_path)
+            config = get_memory_config(tmp_dir)
+            sender = RecordingWatchSender(
+                config, spool_path, max_latency_s=0.1, poll_interval_s=0.1
+            )
+            sender_thread = threading.Thread(target=sender.loop)
+            sender_thread.start()
+            try:
+                time.sleep(0.2)
+                self.write_file(spool_path, "a.txt", b"first file\n")
+                receiver = SingleTransferReceiver(
+                    config, os.path.join(tmp_dir, "received")
+                )
+                receiver_thread = threading.Thread(target=receiver.loop)
+                receiver_thread.start()
+                receiver_thread.join(30.0)
+                self.assertFalse(receiver_thread.is_alive())
+            finally:
+                sender.continue_loop = False
+                sender_thread.join(30.0)
+            self.assertFalse(sender_thread.is_alive())
+            self.assertEqual([["a.txt"]], sender.sent)
+            dst_path = receiver.get_current_transfer_directory()
+            with open(os.path.join(dst_path, "a.txt"), "rb") as fd:
+                self.assertEqual(b"first file\n", fd.read())
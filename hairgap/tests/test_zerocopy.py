@@ -0,0 +1,174 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+import io
+import os
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from hairgap import zerocopy
+from hairgap.constants import (
+    HAIRGAP_MAGIC_NUMBER_EMPTY,
+    HAIRGAP_MAGIC_NUMBER_ESCAPE,
+    HAIRGAP_MAGIC_NUMBER_INDEX,
+)
+from hairgap.sender import DirectorySender
+from hairgap.tests import test_protocol
+from hairgap.transport import MemoryTransport
+from hairgap.utils import Config
+from hairgap.zerocopy import FileRange, copy_fd, copy_file, copy_to_offset
+
+
+class TestZeroCopy(TestCase):
+    data = os.urandom(3 * zerocopy.BUFFER_SIZE + 17)
+
+    def read_pipe(self, read_fd: int, result: list):
+        with os.fdopen(read_fd, "rb") as fd:
+            result.append(fd.read())
+
+    def copy_to_pipe(self, fd) -> bytes:
+        read_fd, write_fd = os.pipe()
+        result = []
+        thread = threading.Thread(target=self.read_pipe, args=(read_fd, result))
+        thread.start()
+        sizes = []
+        try:
+            self.assertEqual(
+                len(self.data) - 10, copy_file(fd, write_fd, progress=sizes.append)
+            )
+        finally:
+            os.close(write_fd)
+        thread.join()
+        self.assertEqual(len(self.data) - 10, sum(sizes))
+        return result[0]
+
+    def test_file_to_pipe(self):
+        with tempfile.TemporaryFile() as fd:
+            fd.write(self.data)
+            fd.seek(0)
+            fd.read(10)  # data starts at the current position
+            self.assertEqual(self.data[10:], self.copy_to_pipe(fd))
+            self.assertEqual(len(self.data), fd.tell())
+
+    def test_buffered(self):
+        fd = io.BytesIO(self.data)
+        fd.read(10)
+        self.assertEqual(self.data[10:], self.copy_to_pipe(fd))
+
+    def test_fallback(self):
+        with tempfile.TemporaryFile() as src_fd, tempfile.TemporaryFile() as dst_fd:
+            src_fd.write(self.data)
+            src_fd.seek(0)
+            with mock.patch.object(
+                zerocopy, "sendfile_chunk", side_effect=OSError(22, "EINVAL")
+            ):
+                copy_fd(src_fd.fileno(), dst_fd.fileno())
+            dst_fd.seek(0)
+            self.assertEqual(self.data, dst_fd.read())
+
+    def test_file_range(self):
+        with tempfile.NamedTemporaryFile() as src_fd:
+            src_fd.write(self.data)
+            src_fd.flush()
+            with FileRange(src_fd.name, 10, zerocopy.BUFFER_SIZE) as fd:
+                self.assertEqual(self.data[10 : 10 + zerocopy.BUFFER_SIZE], fd.read())
+                fd.seek(5)
+                with tempfile.TemporaryFile() as dst_fd:
+                    size = copy_file(fd, dst_fd.fileno())
+                    dst_fd.seek(0)
+                    self.assertEqual(
+                        self.data[15 : 10 + zerocopy.BUFFER_SIZE], dst_fd.read()
+                    )
+                self.assertEqual(zerocopy.BUFFER_SIZE - 5, size)
+                self.assertEqual(zerocopy.BUFFER_SIZE, fd.tell())
+            # the last range ends with the file
+            with FileRange(src_fd.name, len(self.data) - 17, 1000) as fd:
+                self.assertEqual(self.data[-17:], fd.read())
+
+    def test_copy_to_offset(self):
+        self.check_copy_to_offset()
+        with mock.patch.object(
+            os, "copy_file_range", side_effect=OSError(18, "EXDEV"), create=True
+        ):
+            self.check_copy_to_offset()
+
+    def check_copy_to_offset(self):
+        with tempfile.TemporaryFile() as src_fd, tempfile.TemporaryFile() as dst_fd:
+            src_fd.write(self.data)
+            src_fd.flush()
+            dst_fd.write(b"0123456789")
+            dst_fd.flush()
+            size = copy_to_offset(src_fd.fileno(), dst_fd.fileno(), 5)
+            self.assertEqual(len(self.data), size)
+            dst_fd.seek(0)
+            self.assertEqual(b"01234" + self.data, dst_fd.read())
+
+    def test_file_header(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            abspath = os.path.join(dirname, "file")
+            for content, header in (
+                (b"", b"# *-* HAIRGAP-EMPTY *-*\n"),
+                (b"data", b""),
+                (
+                    HAIRGAP_MAGIC_NUMBER_INDEX.encode() + b"data",
+                    HAIRGAP_MAGIC_NUMBER_ESCAPE.encode(),
+                ),
+            ):
+                with open(abspath, "wb") as fd:
+                    fd.write(content)
+                self.assertEqual(header, DirectorySender.get_file_header(abspath))
+                DirectorySender.prepare_file(abspath)
+                with open(abspath, "rb") as fd:  # never modified in-place
+                    self.assertEqual(content, fd.read())
+
+    def test_send_escaped(self):
+        contents = {
+            "empty.txt": b"",
+            "escape.txt": HAIRGAP_MAGIC_NUMBER_ESCAPE.encode() + b"data",
+            "index.txt": HAIRGAP_MAGIC_NUMBER_INDEX.encode(),
+            "other.txt": HAIRGAP_MAGIC_NUMBER_EMPTY.encode() + self.data,
+            "data.bin": self.data,
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = Config(
+                destination_ip="localhost",
+                destination_path=os.path.join(tmp_dir, "transfering"),
+                end_delay_s=0.0,
+                use_tar_archives=False,
+                transport=MemoryTransport(),
+                parity_group_size=3,
+                parity_count=1,
+            )
+            src_path = os.path.join(tmp_dir, "original")
+            os.makedirs(src_path)
+            for name, content in contents.items():
+                with open(os.path.join(src_path, name), "wb") as fd:
+                    fd.write(content)
+            dst_path = os.path.join(tmp_dir, "received")
+            receiver = test_protocol.SingleDirReceiver(config, dst_path)
+            receiver_thread = threading.Thread(target=receiver.loop)
+            receiver_thread.start()
+            sender = test_protocol.SingleDirSender(config, src_path)
+            sender.prepare_directory()
+            sender.send_directory()
+            receiver_thread.join(30.0)
+            self.assertFalse(receiver_thread.is_alive())
+            self.assertEqual(sorted(contents), sorted(os.listdir(dst_path)))
+            for name, content in contents.items():
+                with open(os.path.join(dst_path, name), "rb") as fd:
+                    self.assertEqual(content, fd.read())
+                with open(os.path.join(src_path, name), "rb") as fd:
+                    self.assertEqual(content, fd.read())
@@ -0,0 +1,281 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Lightweight tracing of the stages of a transfer.
+
+Spans are nested per thread: a span opened in a `with` block is the parent of the spans opened inside this block.
+Finished spans are given to exporters (a JSON-lines file, or OpenTelemetry if `opentelemetry-api` is installed).
+
+.. code-block:: python
+
+    config = Config(tracer=Tracer([JsonLinesExporter("/var/log/hairgap-spans.jsonl")]))
+    with config.tracer.span("my_stage", path="a/b") as span:
+        span.set_attribute("bytes", 42)
+
+When no tracer is configured, :attr:`Config.tracer` is a :class:`NoopTracer` whose spans do nothing.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """a timed operation, with attributes (like the number of processed bytes)"""
+
+    def __init__(
+        self,
+        tracer: "Tracer",
+        name: str,
+        parent: Optional["Span"] = None,
+        attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.trace_id = parent.trace_id if parent else "%032x" % random.getrandbits(128)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes or {}
+        self.start_time = time.time()
+        self.end_time = None  # type: Optional[float]
+
+    @property
+    def duration_s(self) -> Optional[float]:
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def end(self):
+        """end the span (only once) and export it"""
+        if self.end_time is not None:
+            return
+        self.end_time = time.time()
+        self.tracer.export(self)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start_time,
+            "end": self.end_time,
+            "duration_s": self.duration_s,
+            "attributes": self.attributes,
+        }
+
+    def __enter__(self):
+        self.tracer.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.tracer.pop(self)
+        if exc_type is not None:
+            self.set_attribute("error", repr(exc_val))
+        self.end()
+
+
+class NoopSpan(Span):
+    """span of a disabled tracer: nothing is measured nor exported"""
+
+    # noinspection PyMissingConstructor
+    def __init__(self):
+        self.name = ""
+        self.span_id = self.trace_id = self.parent_id = None
+        self.attributes = {}
+        self.start_time = self.end_time = 0.0
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class SpanExporter:
+    """receive spans when they are started and when they are finished"""
+
+    def on_start(self, span: Span):
+        pass
+
+    def export(self, span: Span):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonLinesExporter(SpanExporter):
+    """append each finished span as a JSON object to a file (one per line)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def export(self, span: Span):
+        line = json.dumps(span.as_dict(), sort_keys=True, default=str) + "\n"
+        with self.lock:
+            if self.fd is None:
+                self.fd = open(self.path, "a")
+            self.fd.write(line)
+            self.fd.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self.fd.close()
+                self.fd = None
+
+
+class OpenTelemetryExporter(SpanExporter):
+    """mirror spans as OpenTelemetry spans (requires the `opentelemetry-api` package).
+
+    The OpenTelemetry SDK must be configured by the application (tracer provider, processors and exporters).
+    """
+
+    def __init__(self, instrumentation_name: str = "hairgap"):
+        if otel_trace is None:
+            raise ImportError("the 'opentelemetry-api' package is required")
+        self.otel_tracer = otel_trace.get_tracer(instrumentation_name)
+        self.lock = threading.Lock()
+        self.otel_spans = {}  # type: Dict[str, Any]
+
+    def on_start(self, span: Span):
+        with self.lock:
+            parent = self.otel_spans.get(span.parent_id)
+        context = otel_trace.set_span_in_context(parent) if parent else None
+        otel_span = self.otel_tracer.start_span(
+            span.name, context=context, start_time=int(span.start_time * 1e9)
+        )
+        with self.lock:
+            self.otel_spans[span.span_id] = otel_span
+
+    def export(self, span: Span):
+        with self.lock:
+            otel_span = self.otel_spans.pop(span.span_id, None)
+        if otel_span is None:
+            return
+        for key, value in span.attributes.items():
+            if isinstance(value, (bool, int, float, str)):
+                otel_span.set_attribute(key, value)
+            elif value is not None:
+                otel_span.set_attribute(key, str(value))
+        otel_span.end(end_time=int(span.end_time * 1e9))
+
+
+class Tracer:
+    """create spans and give them to the exporters"""
+
+    enabled = True
+
+    def __init__(self, exporters: Optional[List[SpanExporter]] = None):
+        self.exporters = list(exporters or [])
+        self.local = threading.local()
+
+    def get_stack(self) -> List[Span]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def current_span(self) -> Optional[Span]:
+        """return the innermost span opened by a `with` block in the current thread"""
+        stack = self.get_stack()
+        return stack[-1] if stack else None
+
+    def span(
+        self,
+        name: str,
+        parent: Optional[Span] = None,
+        root: bool = False,
+        **attributes,
+    ) -> Span:
+        """start a new span, to use in a `with` block or to end explicitly with :meth:`Span.end`
+
+        :param name: name of the stage
+        :param parent: parent span (by default, the current span of the thread)
+        :param root: start a new trace, ignoring the current span
+        :param attributes: initial attributes of the span
+        """
+        if root:
+            parent = None
+        elif parent is None or parent is NOOP_SPAN:
+            parent = self.current_span()
+        span = Span(self, name, parent=parent, attributes=attributes)
+        for exporter in self.exporters:
+            try:
+                exporter.on_start(span)
+            except Exception as e:
+                logger.warning("unable to start span %s: %s", name, e)
+        return span
+
+    def push(self, span: Span):
+        self.get_stack().append(span)
+
+    def pop(self, span: Span):
+        stack = self.get_stack()
+        if span in stack:
+            stack.remove(span)
+
+    def export(self, span: Span):
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                logger.warning("unable to export span %s: %s", span.name, e)
+
+    def close(self):
+        for exporter in self.exporters:
+            exporter.close()
+
+
+class NoopTracer(Tracer):
+    """disabled tracer: :meth:`span` always returns the same inert span"""
+
+    enabled = False
+
+    def span(
+        self,
+        name: str,
+        parent: Optional[Span] = None,
+        root: bool = False,
+        **attributes,
+    ) -> Span:
+        return NOOP_SPAN
+
+
+NOOP_TRACER = NoopTracer()
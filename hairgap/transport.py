@@ -0,0 +1,365 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Transports move the bytes of a single file through the link; the protocol (index, escaping, split, tar…) is
+implemented by :class:`hairgap.sender.DirectorySender` and :class:`hairgap.receiver.Receiver`.
+
+  * :class:`HairgapTransport` (default): the `hairgaps` and `hairgapr` binaries (or any compatible command),
+  * :class:`TcpTransport`: a plain TCP connection, in-process (for testing without the hairgap binaries),
+  * :class:`MemoryTransport`: in-process queues, to exercise the protocol at memory speed.
+
+.. code-block:: python
+
+    transport = MemoryTransport()
+    config = Config(transport=transport, end_delay_s=0.0, destination_path="/tmp/received")
+
+The sender and the receiver must share the same :class:`MemoryTransport` instance.
+"""
+
+import logging
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from queue import Empty, Queue
+from typing import TYPE_CHECKING, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from hairgap.utils import Config
+
+from hairgap.zerocopy import FileRange, copy_file, write_all
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1 << 16
+POLL_INTERVAL_S = 0.1
+TERMINATED = -15
+# return code of a reception interrupted by `terminate()` (like a process killed by SIGTERM)
+ACK = b"\x06"
+# sent by the TCP receiver once the whole file is received
+
+
+class ReceptionHandle:
+    """allow to interrupt a pending in-process reception, like a `subprocess.Popen`"""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def terminate(self):
+        self.event.set()
+
+    @property
+    def terminated(self) -> bool:
+        return self.event.is_set()
+
+
+class Transport:
+    """send and receive single files"""
+
+    name = ""
+
+    def get_send_command(self, config: "Config", port: int) -> Optional[List[str]]:
+        """return the command that reads data on its standard input and sends it,
+        or `None` if this transport is not an external command"""
+        return None
+
+    def send(
+        self,
+        config: "Config",
+        fd: BinaryIO,
+        port: int,
+        progress: Optional[Callable[[int], None]] = None,
+        header: bytes = b"",
+    ):
+        """send the whole content of `fd`; raise ValueError in case of error
+
+        :param progress: called with the number of bytes of `fd` sent since its previous call
+            (negative if data must be sent again)
+        :param header: bytes sent before the content of `fd`
+        """
+        raise NotImplementedError
+
+    def receive(
+        self,
+        config: "Config",
+        fd: BinaryIO,
+        port: int,
+        register: Optional[Callable] = None,
+    ) -> Tuple[int, str]:
+        """wait for a single file, write it to `fd` and return (return code, error message)
+
+        :param register: called with an object with a `terminate()` method, that interrupts the reception
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "<%s>" % self.__class__.__name__
+
+
+class HairgapTransport(Transport):
+    """use the `hairgaps`/`hairgapr` commands of the configuration"""
+
+    name = "hairgap"
+
+    def get_send_command(self, config: "Config", port: int) -> List[str]:
+        cmd = [
+            str(config.hairgaps_path),
+            "-p",
+            str(port),
+        ]
+        if config.redundancy:
+            cmd += [
+                "-r",
+                str(config.redundancy),
+            ]
+        if config.error_chunk_size:
+            cmd += [
+                "-N",
+                str(config.error_chunk_size),
+            ]
+        if config.max_rate_mbps:
+            cmd += ["-b", str(config.max_rate_mbps)]
+        if config.mtu_b:
+            cmd += ["-M", str(config.mtu_b)]
+        if config.keepalive_ms:
+            cmd += ["-k", str(config.keepalive_ms)]
+        cmd.append(config.destination_ip)
+        return cmd
+
+    def get_receive_command(self, config: "Config", port: int) -> List[str]:
+        cmd = [str(config.hairgapr_path), "-p", str(port)]
+        if config.timeout_s:
+            cmd += ["-t", str(config.timeout_s)]
+        if config.mem_limit_mb:
+            cmd += ["-m", str(config.mem_limit_mb)]
+        cmd.append(config.destination_ip)
+        return cmd
+
+    def send(
+        self,
+        config: "Config",
+        fd: BinaryIO,
+        port: int,
+        progress: Optional[Callable[[int], None]] = None,
+        header: bytes = b"",
+    ):
+        cmd = self.get_send_command(config, port)
+        logger.info(" ".join(cmd))
+        if progress is None and not header and not isinstance(fd, FileRange):
+            # the command directly reads the file
+            p = subprocess.Popen(
+                cmd, stdin=fd, stderr=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            stdout, stderr = p.communicate()
+        else:
+            p, stdout, stderr = self.feed_command(
+                cmd, fd, progress=progress, header=header
+            )
+        if p.returncode:
+            logger.error(
+                "unable to run '%s'.\nreturncode=%s\nstdout=%r\nstderr=%r\n",
+                " ".join(cmd),
+                p.returncode,
+                stdout.decode(),
+                stderr.decode(),
+            )
+            raise ValueError("hairgaps returned %s" % p.returncode)
+
+    @staticmethod
+    def feed_command(
+        cmd: List[str],
+        fd: BinaryIO,
+        progress: Optional[Callable[[int], None]] = None,
+        header: bytes = b"",
+    ) -> Tuple[subprocess.Popen, bytes, bytes]:
+        """write `header`, then `fd`, to the standard input of the command (with `os.splice` if available),
+        counting the bytes consumed by the command"""
+        with tempfile.TemporaryFile() as out_fd, tempfile.TemporaryFile() as err_fd:
+            p = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=out_fd, stderr=err_fd
+            )
+            stdin_fd = p.stdin.fileno()
+            try:
+                write_all(stdin_fd, header)
+                copy_file(fd, stdin_fd, progress=progress)
+            except BrokenPipeError:
+                pass  # the command has stopped (its return code is checked)
+            finally:
+                try:
+                    p.stdin.close()
+                except BrokenPipeError:
+                    pass
+            p.wait()
+            out_fd.seek(0)
+            err_fd.seek(0)
+            return p, out_fd.read(), err_fd.read()
+
+    def receive(
+        self,
+        config: "Config",
+        fd: BinaryIO,
+        port: int,
+        register: Optional[Callable] = None,
+    ) -> Tuple[int, str]:
+        cmd = self.get_receive_command(config, port)
+        p = subprocess.Popen(cmd, stdout=fd, stderr=subprocess.PIPE)
+        if register is not None:
+            register(p)
+        logger.debug("hairgapr command: '%s'.", " ".join(cmd))
+        __, stderr = p.communicate()
+        return p.returncode, stderr.decode()
+
+
+class TcpTransport(Transport):
+    """send each file through a new TCP connection, without any external command.
+
+    Unlike UDP, TCP requires the receiver to listen before the sender connects: files are sent again
+    until the receiver acknowledges them (at most for `connect_timeout_s` seconds).
+    """
+
+    name = "tcp"
+
+    def __init__(self, connect_timeout_s: float = 5.0):
+        self.connect_timeout_s = connect_timeout_s
+
+    def send(
+        self,
+        config: "Config",
+        fd: BinaryIO,
+        port: int,
+        progress: Optional[Callable[[int], None]] = None,
+        header: bytes = b"",
+    ):
+        address = (config.destination_ip, port)
+        deadline = time.monotonic() + self.connect_timeout_s
+        offset = fd.tell()
+        while True:
+            try:
+                self.send_once(address, fd, progress=progress, header=header)
+                return
+            except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError):
+                # the receiver is not ready yet (or has closed its socket while this connection was pending)
+                if time.monotonic() > deadline:
+                    raise ValueError("unable to send data to %s:%s" % address)
+                time.sleep(POLL_INTERVAL_S)
+                if progress is not None:
+                    progress(offset - fd.tell())
+                fd.seek(offset)
+            except OSError as e:
+                raise ValueError("unable to send data to %s:%s: %s" % (*address, e))
+
+    @staticmethod
+    def send_once(
+        address: Tuple[str, int],
+        fd: BinaryIO,
+        progress: Optional[Callable[[int], None]] = None,
+        header: bytes = b"",
+    ):
+        with socket.create_connection(address) as sock:
+            sock.sendall(header)
+            copy_file(fd, sock.fileno(), progress=progress)
+            sock.shutdown(socket.SHUT_WR)
+            if sock.recv(1) != ACK:
+                raise ConnectionResetError("missing acknowledgment")
+
+    def receive(
+        self,
+        config: "Config",
+        fd: BinaryIO,
+        port: int,
+        register: Optional[Callable] = None,
+    ) -> Tuple[int, str]:
+        handle = ReceptionHandle()
+        if register is not None:
+            register(handle)
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind((config.destination_ip, port))
+            except OSError as e:
+                return 1, str(e)
+            sock.listen(1)
+            sock.settimeout(POLL_INTERVAL_S)
+            while True:
+                if handle.terminated:
+                    return TERMINATED, "terminated"
+                try:
+                    conn, __ = sock.accept()
+                    break
+                except socket.timeout:
+                    continue
+        with conn:
+            conn.settimeout(config.timeout_s or None)
+            try:
+                for data in iter(lambda: conn.recv(BUFFER_SIZE), b""):
+                    fd.write(data)
+                conn.sendall(ACK)
+            except OSError as e:
+                return 1, str(e)
+        return 0, ""
+
+
+class MemoryTransport(Transport):
+    """in-process queues (one per port): files are kept in memory until they are received"""
+
+    name = "memory"
+
+    def __init__(self):
+        self.queues = {}  # type: Dict[int, Queue]
+        self.lock = threading.Lock()
+
+    def get_queue(self, port: int) -> Queue:
+        with self.lock:
+            return self.queues.setdefault(port, Queue())
+
+    def send(
+        self,
+        config: "Config",
+        fd: BinaryIO,
+        port: int,
+        progress: Optional[Callable[[int], None]] = None,
+        header: bytes = b"",
+    ):
+        data = fd.read()
+        self.get_queue(port).put(header + data)
+        if progress is not None:
+            progress(len(data))
+
+    def receive(
+        self,
+        config: "Config",
+        fd: BinaryIO,
+        port: int,
+        register: Optional[Callable] = None,
+    ) -> Tuple[int, str]:
+        handle = ReceptionHandle()
+        if register is not None:
+            register(handle)
+        queue = self.get_queue(port)
+        while not handle.terminated:
+            try:
+                data = queue.get(timeout=POLL_INTERVAL_S)
+            except Empty:
+                continue
+            fd.write(data)
+            return 0, ""
+        return TERMINATED, "terminated"
+
+
+HAIRGAP_TRANSPORT = HairgapTransport()
+
+TRANSPORTS = {x.name: x for x in (HairgapTransport, TcpTransport)}
+# transports that can be selected by name (on the command line)
@@ -15,11 +15,16 @@
 # ##############################################################################
 
 import datetime
+import heapq
+import inspect
 import itertools
 import os
 import re
 import subprocess
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
+
+from hairgap.tracing import NOOP_TRACER, Tracer
+from hairgap.transport import HAIRGAP_TRANSPORT, Transport
 
 try:
     from hairgap_binaries import get_hairgapr, get_hairgaps
@@ -35,7 +40,10 @@ except ImportError:
 DEFAULT_HAIRGAPR = get_hairgapr() or "hairgapr"
 DEFAULT_HAIRGAPS = get_hairgaps() or "hairgaps"
 
-FILENAME_PATTERN = r"([a-fA-F\d]{64}) = (.*)$"
+FILENAME_PATTERN = r"([a-fA-F\d]{64}|[a-fA-F\d]{32}) = (.*)$"
+# hexadecimal digest (256 or 128 bits, see :mod:`hairgap.digests`) and relative path of a file of the index
+SIZE_PATTERN = r"^\[size (\d+)\]$"
+# size of the next file of a carousel index, so the receiver can ignore repeated files without hashing them
 
 ZERO = datetime.timedelta(0)
 HOUR = datetime.timedelta(hours=1)
@@ -127,6 +135,47 @@ def ensure_dir(path, parent=True):
     return path
 
 
+def plan_shards(
+    dir_abspath: str,
+    max_size: Optional[int] = None,
+    max_files: Optional[int] = None,
+) -> List[List[Tuple[str, int]]]:
+    """bin-pack the files of a directory into shards of at most `max_size` bytes and `max_files` files
+    (worst-fit decreasing: each file goes to the open shard with the most free space).
+
+    A file larger than `max_size` is alone in its shard. Open shards are kept in a heap, and full shards are
+    removed from it, so the cost is O(files × log(shards)).
+
+    :return: the list of shards, each shard being a list of (relative path, size)
+    """
+    files = []  # type: List[Tuple[str, int]]
+    for root, dirnames, filenames in os.walk(dir_abspath):
+        for filename in filenames:
+            file_abspath = os.path.join(root, filename)
+            if os.path.isfile(file_abspath):
+                file_relpath = os.path.relpath(file_abspath, dir_abspath)
+                files.append((file_relpath, os.path.getsize(file_abspath)))
+    files.sort(key=lambda x: (-x[1], x[0]))
+    shards = []  # type: List[List[Tuple[str, int]]]
+    open_shards = []  # type: List[Tuple[int, int]]
+    # heap of (-free space, index) of the shards that can accept more files
+    for file_relpath, size in files:
+        if open_shards and (not max_size or -open_shards[0][0] >= size):
+            free_size, index = heapq.heappop(open_shards)
+            free_size = -free_size - size if max_size else 0
+        else:
+            index, free_size = len(shards), max_size - size if max_size else 0
+            shards.append([])
+        shards[index].append((file_relpath, size))
+        if (not max_size or free_size > 0) and (
+            not max_files or len(shards[index]) < max_files
+        ):
+            heapq.heappush(open_shards, (-free_size, index))
+    for shard in shards:
+        shard.sort()
+    return shards
+
+
 def now():
     return datetime.datetime.now(utc)
 
@@ -181,6 +230,24 @@ class Config:
         use_tar_archives: Optional[bool] = None,
         always_compute_size: bool = True,
         split_size: Optional[int] = None,
+        express_port: Optional[int] = None,
+        carousel_repeat: int = 1,
+        carousel_deadline_s: Optional[float] = None,
+        parity_group_size: Optional[int] = None,
+        parity_count: int = 2,
+        tracer: Optional[Tracer] = None,
+        metrics_port: Optional[int] = None,
+        history_path: Optional[str] = None,
+        transport: Optional[Transport] = None,
+        record_path: Optional[str] = None,
+        compression: Optional[str] = None,
+        compression_threads: Optional[int] = None,
+        split_archives: bool = False,
+        digest: str = "sha256",
+        chunk_size: Optional[int] = None,
+        index_segment_files: Optional[int] = None,
+        compact_index: Optional[str] = None,
+        durability: str = "none",
     ):
         """
 
@@ -205,6 +272,37 @@ class Config:
         :param always_compute_size: always compute the total size of sent files
         :param split_size: if not None, archive all files in a .tar.gz, split it into chunks of the given size
             useless if `use_tar_archives`
+        :param express_port: port reserved to small messages, received by a dedicated loop
+        :param carousel_repeat: send each file of a transfer this number of times (the receiver ignores duplicates)
+            only when not `use_tar_archives`
+        :param carousel_deadline_s: if not None, keep repeating the files of a transfer until this delay is elapsed
+            only when not `use_tar_archives`
+        :param parity_group_size: if not None, add parity files to each group of this number of files
+            only when not `use_tar_archives`
+        :param parity_count: number of parity files per group (i.e. the number of files that can be rebuilt)
+        :param tracer: records the duration of each stage of the transfers (disabled if `None`)
+        :param metrics_port: if not None, the receiver serves its metrics on this local HTTP port
+        :param history_path: if not None, a report of each transfer is added to this SQLite database
+        :param transport: sends and receives single files (the hairgap binaries if `None`)
+        :param record_path: if not None, the receiver copies each received stream to this directory, with its timings
+            (see :mod:`hairgap.replay`)
+        :param compression: `"auto"` to compress the compressible files, `"gzip"` to compress all files,
+            only when not `use_tar_archives` (see :mod:`hairgap.compression`)
+        :param compression_threads: if not None, tar archives are compressed by this number of threads
+            (see :mod:`hairgap.pgzip`), instead of a single `tar czf` process
+        :param split_archives: with `split_size`, each chunk is a self-contained .tar.gz archive of whole files,
+            so the receiver extracts chunks in parallel and keeps the intact ones
+        :param digest: algorithm used to check each file, only when not `use_tar_archives`
+            (see :mod:`hairgap.digests`; the receiver uses the one declared by the index)
+        :param chunk_size: if not None, larger files are sent as chunks of this size, each one with its own digest,
+            only when not `use_tar_archives` and without parity files (see :mod:`hairgap.chunks`)
+        :param index_segment_files: if not None, the index is sent as segments of this number of files, each segment
+            being hashed while the previous one is sent; only when not `use_tar_archives`,
+            without carousel, parity files or `split_size` (see :mod:`hairgap.segments`)
+        :param compact_index: `"raw"` or `"zlib"` to send a compact binary index instead of the text one,
+            only when not `use_tar_archives` and without `index_segment_files` (see :mod:`hairgap.compact`)
+        :param durability: `"file"` or `"transfer"` to flush received files to disk after each file or before the end
+            of each transfer, `"none"` to let the operating system write them (see :mod:`hairgap.durability`)
         """
         self._destination_ip = destination_ip
         self._destination_port = destination_port
@@ -220,6 +318,24 @@ class Config:
         self._use_tar_archives = use_tar_archives
         self._split_size = split_size
         self._always_compute_size = always_compute_size
+        self._express_port = express_port
+        self._carousel_repeat = carousel_repeat
+        self._carousel_deadline_s = carousel_deadline_s
+        self._parity_group_size = parity_group_size
+        self._parity_count = parity_count
+        self._tracer = tracer
+        self._metrics_port = metrics_port
+        self._history_path = history_path
+        self._transport = transport
+        self._record_path = record_path
+        self._compression = compression
+        self._compression_threads = compression_threads
+        self._split_archives = split_archives
+        self._digest = digest
+        self._chunk_size = chunk_size
+        self._index_segment_files = index_segment_files
+        self._compact_index = compact_index
+        self._durability = durability
 
         self._path_hairgapr = self.get_bin_prefix("hairgapr", hairgapr)
         self._path_hairgaps = self.get_bin_prefix("hairgaps", hairgaps)
@@ -313,3 +429,103 @@ class Config:
     @property
     def split_size(self):
         return self._split_size
+
+    @property
+    def express_port(self):
+        return self._express_port
+
+    @property
+    def carousel_repeat(self):
+        return self._carousel_repeat
+
+    @property
+    def carousel_deadline_s(self):
+        return self._carousel_deadline_s
+
+    @property
+    def parity_group_size(self):
+        return self._parity_group_size
+
+    @property
+    def parity_count(self):
+        return self._parity_count
+
+    @property
+    def tracer(self) -> Tracer:
+        return self._tracer or NOOP_TRACER
+
+    @property
+    def metrics_port(self):
+        return self._metrics_port
+
+    @property
+    def history_path(self):
+        return self._history_path
+
+    @property
+    def transport(self) -> Transport:
+        return self._transport or HAIRGAP_TRANSPORT
+
+    @property
+    def record_path(self):
+        return self._record_path
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @property
+    def compression_threads(self):
+        return self._compression_threads
+
+    @property
+    def split_archives(self):
+        return self._split_archives
+
+    @property
+    def digest(self):
+        return self._digest
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    @property
+    def index_segment_files(self):
+        return self._index_segment_files
+
+    @property
+    def compact_index(self):
+        return self._compact_index
+
+    @property
+    def durability(self):
+        return self._durability
+
+    def replace(self, **options) -> "Config":
+        """return a new configuration, with the same options as this one except the given ones
+
+        raise `TypeError` if an option is unknown
+        """
+        properties = {"hairgapr": "hairgapr_path", "hairgaps": "hairgaps_path"}
+        parameters = inspect.signature(type(self).__init__).parameters
+        kwargs = {
+            x: getattr(self, properties.get(x, x)) for x in parameters if x != "self"
+        }
+        unknown = set(options) - set(kwargs)
+        if unknown:
+            raise TypeError("unknown options: %s" % ", ".join(sorted(unknown)))
+        kwargs.update(options)
+        return type(self)(**kwargs)
+
+    def as_dict(self) -> Dict:
+        """return the value of each option (the tracer excepted), as JSON-serializable values"""
+        result = {}
+        for name, value in sorted(vars(Config).items()):
+            if not isinstance(value, property) or name == "tracer":
+                continue
+            value = getattr(self, name)
+            if value is not None and not isinstance(value, (bool, int, float, str)):
+                value = str(value)
+            result[name] = value
+        return result
@@ -0,0 +1,434 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Watch a spool directory and send files as soon as their producers close them.
+
+.. code-block:: python
+
+    WatchSender(Config(destination_ip="192.168.1.1"), "/var/spool/incoming").loop()
+
+Files written in the spool directory are gathered in micro-transfers, sent as soon as one of these limits is reached:
+`max_batch_files` files, `max_batch_size` bytes, or `max_latency_s` seconds since the oldest pending file has been
+closed. Files that are closed while a micro-transfer is sent wait for the next one, so transfers grow with the load.
+
+Closed files are detected with inotify (through `ctypes`) on Linux, or by polling the directory (a file is considered
+as closed when its size and modification time are stable between two polls) on other systems.
+Only regular files at the root of the spool directory are sent; names starting by a dot are ignored, so producers
+can write a `.name.tmp` file and rename it once complete.
+
+Each micro-transfer is moved to a batch directory (`.hairgap-watch` in the spool directory by default) before its
+preparation. After a restart, batches left by the previous run are sent first, then files written in the meantime
+are sent in full batches, without waiting for `max_latency_s`.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import shutil
+import struct
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from hairgap.sender import DirectorySender
+from hairgap.utils import Config, ensure_dir, now
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+# struct inotify_event: wd, mask, cookie, len (followed by the null-padded name)
+STATE_DIRNAME = ".hairgap-watch"
+
+
+class PollingWatcher:
+    """report files whose size and modification time are stable between two polls"""
+
+    def __init__(self, path: str, poll_interval_s: float = 1.0):
+        self.path = path
+        self.poll_interval_s = poll_interval_s
+        self.overflow = False
+        # always False: all files are seen at each poll
+        self.last_poll = 0.0
+        self.candidates = {}  # type: Dict[str, Tuple[int, int]]
+        # {name: (size, mtime_ns)} at the last poll
+        self.reported = {}  # type: Dict[str, Tuple[int, int]]
+        # files already reported, until they are modified or removed
+
+    def read_events(self, timeout_s: float) -> List[str]:
+        """wait at most `timeout_s` seconds and return the names of the closed files"""
+        delay = self.last_poll + self.poll_interval_s - time.monotonic()
+        if delay > timeout_s:
+            time.sleep(max(timeout_s, 0.0))
+            return []
+        time.sleep(max(delay, 0.0))
+        self.last_poll = time.monotonic()
+        current = {}
+        for entry in os.scandir(self.path):
+            if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            current[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        names = [
+            name
+            for (name, value) in current.items()
+            if self.candidates.get(name) == value and self.reported.get(name) != value
+        ]
+        for name in names:
+            self.reported[name] = current[name]
+        self.reported = {
+            name: value
+            for (name, value) in self.reported.items()
+            if current.get(name) == value
+        }
+        self.candidates = current
+        return names
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """report files that are closed after being written, or moved into the watched directory
+
+    raise OSError if inotify is not available
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.overflow = False
+        # some events have been lost: the directory must be scanned
+        libc_name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(
+            self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO
+        )
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", path)
+
+    def read_events(self, timeout_s: float) -> List[str]:
+        """wait at most `timeout_s` seconds and return the names of the closed files"""
+        readable, __, __ = select.select([self.fd], [], [], max(timeout_s, 0.0))
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            __, mask, __, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+            elif name and not mask & IN_ISDIR and not name.startswith("."):
+                names.append(name)
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_watcher(path: str, polling: bool = False, poll_interval_s: float = 1.0):
+    """return an :class:`InotifyWatcher`, or a :class:`PollingWatcher` if inotify is not available"""
+    if not polling:
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify is not available (%s), polling '%s'.", e, path)
+    return PollingWatcher(path, poll_interval_s=poll_interval_s)
+
+
+class WatchBatchSender(DirectorySender):
+    """send a micro-transfer, with the attributes expected by :class:`hairgap.cli.SimpleDirReceiver`"""
+
+    def __init__(self, config: Config, batch_abspath: str):
+        super().__init__(config)
+        self.batch_abspath = batch_abspath
+
+    def get_attributes(self) -> Dict[str, str]:
+        return {
+            "uid": os.path.basename(self.batch_abspath),
+            "creation": now().strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+    @property
+    def transfer_abspath(self) -> str:
+        return os.path.join(self.batch_abspath, "data")
+
+    @property
+    def index_abspath(self):
+        return os.path.join(self.batch_abspath, "index.txt")
+
+    @property
+    def preparing_abspath(self) -> str:
+        """created before `prepare_directory`: the files of the batch may have been modified in-place"""
+        return os.path.join(self.batch_abspath, "preparing")
+
+    @property
+    def prepared_abspath(self) -> str:
+        """created when `prepare_directory` is finished: the batch can be sent again without any preparation"""
+        return os.path.join(self.batch_abspath, "prepared")
+
+
+class WatchSender:
+    """send the files closed in a spool directory, as micro-transfers
+
+    :param spool_path: the watched directory
+    :param state_path: where micro-transfers are moved before being sent (must be on the same filesystem)
+    :param max_batch_files: maximum number of files of a micro-transfer
+    :param max_batch_size: a micro-transfer is sent as soon as its files reach this size (in bytes)
+    :param max_latency_s: maximum delay between the closing of a file and the sending of its micro-transfer
+        (when the link is not busy)
+    :param polling: poll the directory instead of using inotify
+    :param poll_interval_s: delay between two polls, also the maximum delay before `continue_loop` is checked
+    """
+
+    sender_class = WatchBatchSender
+
+    def __init__(
+        self,
+        config: Config,
+        spool_path: str,
+        state_path: Optional[str] = None,
+        max_batch_files: int = 1000,
+        max_batch_size: int = 1 << 26,
+        max_latency_s: float = 1.0,
+        polling: bool = False,
+        poll_interval_s: float = 1.0,
+    ):
+        self.config = config
+        self.spool_path = spool_path
+        self.state_path = state_path or os.path.join(spool_path, STATE_DIRNAME)
+        self.max_batch_files = max_batch_files
+        self.max_batch_size = max_batch_size
+        self.max_latency_s = max_latency_s
+        self.polling = polling
+        self.poll_interval_s = poll_interval_s
+        self.continue_loop = True  # type: bool
+        self.pending = OrderedDict()  # type: Dict[str, Tuple[int, float]]
+        # closed files, not sent yet: {name: (size, time.monotonic() when seen)}
+        self.pending_size = 0
+
+    @property
+    def batches_path(self) -> str:
+        return os.path.join(self.state_path, "batches")
+
+    @property
+    def failed_path(self) -> str:
+        """batches that cannot be prepared are kept here, for a manual inspection"""
+        return os.path.join(self.state_path, "failed")
+
+    def get_sender(self, batch_abspath: str) -> WatchBatchSender:
+        return self.sender_class(self.config, batch_abspath)
+
+    def add_file(self, name: str, seen: Optional[float] = None):
+        """add a closed file to the pending ones"""
+        if name in self.pending:
+            return
+        try:
+            size = os.path.getsize(os.path.join(self.spool_path, name))
+        except OSError:  # already moved to a batch
+            return
+        self.pending[name] = (size, time.monotonic() if seen is None else seen)
+        self.pending_size += size
+
+    def scan(self):
+        """add all files of the spool directory, by modification time; they are considered as late"""
+        entries = []  # type: List[Tuple[int, str]]
+        for entry in os.scandir(self.spool_path):
+            if entry.name.startswith("."):
+                continue
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    mtime_ns = entry.stat(follow_symlinks=False).st_mtime_ns
+                    entries.append((mtime_ns, entry.name))
+            except OSError:  # removed during the scan
+                continue
+        entries.sort()
+        late = time.monotonic() - self.max_latency_s
+        for __, name in entries:
+            self.add_file(name, seen=late)
+        if entries:
+            logger.info("%s file(s) found in '%s'.", len(entries), self.spool_path)
+
+    def is_batch_ready(self) -> bool:
+        if not self.pending:
+            return False
+        if len(self.pending) >= self.max_batch_files:
+            return True
+        if self.pending_size >= self.max_batch_size:
+            return True
+        oldest = next(iter(self.pending.values()))[1]
+        return time.monotonic() - oldest >= self.max_latency_s
+
+    def get_timeout(self) -> float:
+        """maximum delay before the next batch must be sent"""
+        if not self.pending:
+            return self.poll_interval_s
+        oldest = next(iter(self.pending.values()))[1]
+        delay = oldest + self.max_latency_s - time.monotonic()
+        return min(max(delay, 0.0), self.poll_interval_s)
+
+    def pop_batch(self) -> List[str]:
+        """remove the files of the next micro-transfer from the pending ones"""
+        names = []
+        size = 0
+        while self.pending and len(names) < self.max_batch_files:
+            if names and size >= self.max_batch_size:
+                break
+            name, (file_size, __) = self.pending.popitem(last=False)
+            self.pending_size -= file_size
+            size += file_size
+            names.append(name)
+        return names
+
+    def create_batch(self, names: List[str]) -> Optional[str]:
+        """move files to a new batch directory and return its path (`None` if all files have disappeared)"""
+        batch_abspath = os.path.join(
+            self.batches_path,
+            "%s-%s" % (now().strftime("%Y%m%dT%H%M%S%f"), uuid.uuid4()),
+        )
+        data_abspath = ensure_dir(os.path.join(batch_abspath, "data"), parent=False)
+        count = 0
+        for name in names:
+            try:
+                os.rename(
+                    os.path.join(self.spool_path, name),
+                    os.path.join(data_abspath, name),
+                )
+                count += 1
+            except FileNotFoundError:
+                logger.warning("'%s' removed before being sent.", name)
+        if not count:
+            shutil.rmtree(batch_abspath)
+            return None
+        return batch_abspath
+
+    def send_batch(self, batch_abspath: str) -> bool:
+        """prepare (only once, even after a restart) and send a micro-transfer, then remove it
+
+        a batch that cannot be prepared is moved to :attr:`failed_path`; a batch that cannot be sent is kept
+        and sent again by the next call to :meth:`send_backlog`
+        """
+        sender = self.get_sender(batch_abspath)
+        if not os.path.isfile(sender.prepared_abspath):
+            open(sender.preparing_abspath, "w").close()
+            try:
+                sender.prepare_directory()
+            except Exception as e:
+                logger.exception("unable to prepare '%s': %s", batch_abspath, e)
+                self.fail_batch(batch_abspath)
+                return False
+            open(sender.prepared_abspath, "w").close()
+            os.remove(sender.preparing_abspath)
+        try:
+            sender.send_directory()
+        except Exception as e:
+            logger.exception("unable to send '%s': %s", batch_abspath, e)
+            return False
+        shutil.rmtree(batch_abspath, ignore_errors=True)
+        return True
+
+    def fail_batch(self, batch_abspath: str):
+        ensure_dir(self.failed_path, parent=False)
+        os.rename(
+            batch_abspath,
+            os.path.join(self.failed_path, os.path.basename(batch_abspath)),
+        )
+
+    def send_backlog(self) -> int:
+        """send the batches that are not sent yet (by a previous run, or after an error) and return their number
+
+        `prepare_directory` modifies files in-place, so a batch interrupted during its preparation cannot be
+        safely prepared again and is moved to :attr:`failed_path`. A batch whose preparation has not started yet
+        (without any marker) is prepared as usual.
+        """
+        count = 0
+        if not os.path.isdir(self.batches_path):
+            return count
+        for name in sorted(os.listdir(self.batches_path)):
+            if not self.continue_loop:
+                break
+            batch_abspath = os.path.join(self.batches_path, name)
+            sender = self.get_sender(batch_abspath)
+            if os.path.isfile(sender.preparing_abspath) and not os.path.isfile(
+                sender.prepared_abspath
+            ):
+                logger.error("'%s' interrupted during its preparation.", batch_abspath)
+                self.fail_batch(batch_abspath)
+                continue
+            if not self.send_batch(batch_abspath):
+                break
+            count += 1
+        return count
+
+    def send_ready_batches(self) -> int:
+        """send micro-transfers as long as one of the limits is reached, and return their number"""
+        count = 0
+        while self.continue_loop and self.is_batch_ready():
+            names = self.pop_batch()
+            batch_abspath = self.create_batch(names)
+            if batch_abspath is None:
+                continue
+            logger.info("sending %s file(s) from '%s'…", len(names), self.spool_path)
+            if self.send_batch(batch_abspath):
+                count += 1
+            else:
+                # the link is probably down: we wait before sending the next batches
+                break
+        return count
+
+    def loop(self):
+        ensure_dir(self.batches_path, parent=False)
+        logger.info("watching '%s'…", self.spool_path)
+        watcher = get_watcher(
+            self.spool_path, polling=self.polling, poll_interval_s=self.poll_interval_s
+        )
+        try:
+            # files are moved out of the spool directory, so none is lost between the scan and the watch
+            self.scan()
+            while self.continue_loop:
+                self.send_backlog()
+                if os.listdir(self.batches_path):
+                    # the link is probably down; new files are sent after the unsent batches
+                    time.sleep(self.poll_interval_s)
+                    continue
+                for name in watcher.read_events(self.get_timeout()):
+                    self.add_file(name)
+                if watcher.overflow:
+                    watcher.overflow = False
+                    self.scan()
+                self.send_ready_batches()
+        finally:
+            watcher.close()
+        logger.info("watch loop exited.")
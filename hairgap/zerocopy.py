@@ -0,0 +1,231 @@
+# ##############################################################################
+#  This file is part of Hairgap                                                #
+#                                                                              #
+#  Copyright (C) 2020 Matthieu Gallet <github@19pouces.net>                    #
+#  All Rights Reserved                                                         #
+#                                                                              #
+#  You may use, distribute and modify this code under the                      #
+#  terms of the (BSD-like) CeCILL-B license.                                   #
+#                                                                              #
+#  You should have received a copy of the CeCILL-B license with                #
+#  this file. If not, please visit:                                            #
+#  https://cecill.info/licences/Licence_CeCILL-B_V1-en.txt (English)           #
+#  or https://cecill.info/licences/Licence_CeCILL-B_V1-fr.txt (French)         #
+#                                                                              #
+# ##############################################################################
+"""Copy data between file descriptors without copying it through Python buffers.
+
+  * `os.splice` when one of the file descriptors is a pipe (Linux, Python 3.10+),
+  * `os.sendfile` otherwise (the source must be a regular file),
+  * `os.read`/`os.write` when both are unavailable or unsupported by these file descriptors.
+
+Data is copied from the current position of the source, or from an explicit offset (optionally limited to a given
+length: a :class:`FileRange` sends a part of a file without copying it first).
+:func:`copy_to_offset` writes a whole file at a given offset of another one (`os.copy_file_range`, or positional
+reads and writes).
+"""
+
+import errno
+import io
+import os
+import stat
+from typing import BinaryIO, Callable, List, Optional
+
+CHUNK_SIZE = 1 << 20
+BUFFER_SIZE = 1 << 16
+FALLBACK_ERRNOS = {
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EXDEV,
+    errno.EBADF,
+}
+# errors meaning that a method is not supported by these file descriptors
+
+
+def is_pipe(fd: int) -> bool:
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+
+def splice_chunk(src_fd: int, dst_fd: int, offset: Optional[int], size: int) -> int:
+    return os.splice(src_fd, dst_fd, size, offset_src=offset)
+
+
+def sendfile_chunk(src_fd: int, dst_fd: int, offset: Optional[int], size: int) -> int:
+    return os.sendfile(dst_fd, src_fd, offset, size)
+
+
+def buffered_chunk(src_fd: int, dst_fd: int, offset: Optional[int], size: int) -> int:
+    size = min(size, BUFFER_SIZE)
+    if offset is None:
+        data = os.read(src_fd, size)
+    else:
+        data = os.pread(src_fd, size, offset)
+    write_all(dst_fd, data)
+    return len(data)
+
+
+def write_all(dst_fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(dst_fd, view) :]
+
+
+def get_copiers(
+    src_fd: int, dst_fd: int
+) -> List[Callable[[int, int, Optional[int], int], int]]:
+    """return the copy methods to try, the most efficient first"""
+    copiers = []
+    if hasattr(os, "splice") and (is_pipe(src_fd) or is_pipe(dst_fd)):
+        copiers.append(splice_chunk)
+    if hasattr(os, "sendfile") and stat.S_ISREG(os.fstat(src_fd).st_mode):
+        copiers.append(sendfile_chunk)
+    copiers.append(buffered_chunk)
+    return copiers
+
+
+def copy_fd(
+    src_fd: int,
+    dst_fd: int,
+    offset: Optional[int] = None,
+    progress: Optional[Callable[[int], None]] = None,
+    length: Optional[int] = None,
+) -> int:
+    """copy `src_fd` to `dst_fd` until the end of `src_fd`, and return the number of copied bytes
+
+    :param offset: copy from this offset, without using nor updating the position of `src_fd`
+        (`None` to copy from its current position)
+    :param progress: called with the size of each copied chunk
+    :param length: copy at most this number of bytes (`None` to copy until the end of `src_fd`)
+    """
+    total = 0
+    copiers = get_copiers(src_fd, dst_fd)
+    while copiers:
+        copier = copiers.pop(0)
+        try:
+            while True:
+                size = CHUNK_SIZE if length is None else min(CHUNK_SIZE, length - total)
+                if size:
+                    size = copier(
+                        src_fd, dst_fd, None if offset is None else offset + total, size
+                    )
+                if not size:
+                    return total
+                total += size
+                if progress is not None:
+                    progress(size)
+        except OSError as e:
+            # the next method can continue from the same point
+            if e.errno not in FALLBACK_ERRNOS or not copiers:
+                raise
+    return total
+
+
+class FileRange(io.RawIOBase):
+    """read-only file object over `length` bytes of a file, from `offset` (or less, at the end of the file)
+
+    it has no `fileno()`, so that it is never read as a whole file: :func:`copy_file` copies it with explicit offsets
+    """
+
+    def __init__(self, file_abspath: str, offset: int, length: int):
+        super().__init__()
+        self.src_fd = os.open(file_abspath, os.O_RDONLY)
+        file_size = os.fstat(self.src_fd).st_size
+        self.start = min(offset, file_size)
+        self.length = min(length, file_size - self.start)
+        self.pos = 0
+
+    def close(self):
+        if not self.closed:
+            os.close(self.src_fd)
+        super().close()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.length
+        self.pos = max(0, min(pos, self.length))
+        return self.pos
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self.length - self.pos)
+        data = os.pread(self.src_fd, size, self.start + self.pos) if size > 0 else b""
+        buffer[: len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+def copy_file(
+    fd: BinaryIO, dst_fd: int, progress: Optional[Callable[[int], None]] = None
+) -> int:
+    """copy a file object (from its current position) to `dst_fd`, and return the number of copied bytes
+
+    file objects without file descriptor (like `io.BytesIO`) are copied through Python buffers
+    """
+    if isinstance(fd, FileRange):
+        total = copy_fd(
+            fd.src_fd,
+            dst_fd,
+            offset=fd.start + fd.tell(),
+            progress=progress,
+            length=fd.length - fd.tell(),
+        )
+        fd.seek(total, io.SEEK_CUR)
+        return total
+    try:
+        src_fd = fd.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        total = 0
+        for data in iter(lambda: fd.read(BUFFER_SIZE), b""):
+            write_all(dst_fd, data)
+            total += len(data)
+            if progress is not None:
+                progress(len(data))
+        return total
+    if not fd.seekable():
+        return copy_fd(src_fd, dst_fd, progress=progress)
+    # explicit offsets: the position of the file descriptor may differ from the position of the file object,
+    # that reads ahead
+    offset = fd.tell()
+    total = copy_fd(src_fd, dst_fd, offset=offset, progress=progress)
+    fd.seek(offset + total)
+    return total
+
+
+def copy_to_offset(src_fd: int, dst_fd: int, dst_offset: int) -> int:
+    """copy `src_fd` (from its beginning) to `dst_fd` at `dst_offset`, without using nor updating their positions,
+    and return the number of copied bytes
+
+    `os.copy_file_range` is used when available (Linux, Python 3.8+), `os.pread`/`os.pwrite` otherwise.
+    """
+    total = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while True:
+                size = os.copy_file_range(
+                    src_fd, dst_fd, CHUNK_SIZE, total, dst_offset + total
+                )
+                if not size:
+                    return total
+                total += size
+        except OSError as e:
+            # the positional copy can continue from the same point
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+    for data in iter(lambda: os.pread(src_fd, BUFFER_SIZE, total), b""):
+        view = memoryview(data)
+        while view:
+            size = os.pwrite(dst_fd, view, dst_offset + total)
+            view = view[size:]
+            total += size
+    return total